@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Benchmarks the differs in eevee.diffing. For each record shape and change rate this measures:
+
+    - diff: diffs per second between successive versions
+    - patch: patches per second with in_place=False
+    - marshal_copy: marshal copies per second of the record data, i.e. the cost in_place=False adds
+      to each patch
+    - copy_share: the proportion of the time taken by a patch that is spent on the copy
+    - size: the mean size in bytes of the BSON encoded diff, as it would be stored in mongo
+
+Run with: python -m benchmarks.differs [--output results.json] [--baseline baseline.json]
+"""
+import argparse
+import marshal
+import sys
+
+import bson
+
+from benchmarks.generators import RecordGenerator, SHAPES
+from benchmarks.utils import time_operation, result, add_output_arguments, finish
+from eevee.diffing import SHALLOW_DIFFER, DICT_DIFFER_DIFFER, format_diff
+
+CHANGE_RATES = (0.01, 0.1, 0.5)
+
+
+def get_differs(data):
+    """
+    Returns the differs which can be used with the given data.
+
+    :param data: the record data
+    :return: a list of differs
+    """
+    return [differ for differ in (SHALLOW_DIFFER, DICT_DIFFER_DIFFER) if differ.can_diff(data)]
+
+
+def benchmark_differ(differ, pairs, number):
+    """
+    Benchmarks the given differ against the given pairs of old and new record data.
+
+    :param differ: the differ
+    :param pairs: a list of 2-tuples of old and new data dicts
+    :param number: the number of times to run each operation in each timing repeat
+    :return: a dict of result names -> result dicts
+    """
+    diffs = [differ.diff(old, new) for old, new in pairs]
+    # the pairs are cycled through so that each timed operation works on different data
+    state = {u'i': 0}
+
+    def next_index():
+        state[u'i'] = (state[u'i'] + 1) % len(pairs)
+        return state[u'i']
+
+    def diff():
+        old, new = pairs[next_index()]
+        differ.diff(old, new)
+
+    def patch_copy():
+        i = next_index()
+        differ.patch(diffs[i], pairs[i][0], in_place=False)
+
+    sizes = [len(bson.BSON.encode({u'd': format_diff(differ, d)})) for d in diffs]
+    return {
+        u'diff': result(time_operation(diff, number), u'ops/s'),
+        u'patch': result(time_operation(patch_copy, number), u'ops/s'),
+        u'size': result(sum(sizes) / float(len(sizes)), u'bytes', higher_is_better=False),
+    }
+
+
+def run(records=50, number=1000, shapes=SHAPES, change_rates=CHANGE_RATES):
+    """
+    Runs the benchmarks.
+
+    :param records: the number of synthetic records to generate for each shape and change rate
+    :param number: the number of times to run each operation in each timing repeat
+    :param shapes: the record shapes to benchmark
+    :param change_rates: the change rates to benchmark
+    :return: a dict of result names -> result dicts
+    """
+    results = {}
+    for shape in shapes:
+        for change_rate in change_rates:
+            generator = RecordGenerator(shape)
+            pairs = []
+            for record_id in range(records):
+                old, new = generator.versions(record_id, 2, change_rate)
+                pairs.append((old, new))
+
+            prefix = u'{}.{}'.format(shape, change_rate)
+            copy_data = [old for old, _new in pairs]
+            state = {u'i': 0}
+
+            def copy():
+                state[u'i'] = (state[u'i'] + 1) % len(copy_data)
+                marshal.loads(marshal.dumps(copy_data[state[u'i']]))
+
+            copy_rate = time_operation(copy, number)
+            results[u'{}.marshal_copy'.format(prefix)] = result(copy_rate, u'ops/s')
+            for differ in get_differs(pairs[0][1]):
+                differ_results = benchmark_differ(differ, pairs, number)
+                # patch time is 1 / patch rate and copy time is 1 / copy rate
+                differ_results[u'copy_share'] = result(
+                    differ_results[u'patch'][u'value'] / copy_rate, u'ratio',
+                    higher_is_better=False)
+                for name, details in differ_results.items():
+                    results[u'{}.{}.{}'.format(prefix, differ.differ_id, name)] = details
+    return results
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=u'Benchmark the eevee differs')
+    parser.add_argument(u'--records', type=int, default=50,
+                        help=u'the number of records to generate for each shape and change rate')
+    parser.add_argument(u'--number', type=int, default=1000,
+                        help=u'the number of times to run each operation per timing repeat')
+    parser.add_argument(u'--shapes', nargs=u'+', choices=SHAPES, default=SHAPES)
+    parser.add_argument(u'--change-rates', nargs=u'+', type=float, default=CHANGE_RATES)
+    add_output_arguments(parser)
+    options = parser.parse_args(args)
+
+    results = run(options.records, options.number, options.shapes, options.change_rates)
+    return finish(u'differs', results, options)
+
+
+if __name__ == u'__main__':
+    sys.exit(main())
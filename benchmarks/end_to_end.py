@@ -0,0 +1,348 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+End to end benchmark which ingests N versions of M synthetic records into MongoDB with the Ingester,
+indexes each version into Elasticsearch with the Indexer and then measures some SearchHelper calls
+against the result. For each stage this reports records per second and how far the RSS of the
+process rose above where it was when the stage started (the largest rise across the stage's runs,
+sampled while it runs, see RssSampler), and at the end the number of bytes mongo and elasticsearch
+are using to store the data. The RSS figures are deltas rather than absolute peaks because all the
+stages run in the same process so the process' peak RSS only ever reflects the hungriest stage so
+far.
+
+The services can either be started in docker containers (--docker) or already be running (for
+example, from local binaries) in which case their locations can be passed with --mongo-host,
+--mongo-port and --elasticsearch-host. A uniquely named database, index prefix and status index
+are used and all are removed once the benchmark is complete.
+
+Run with: python -m benchmarks.end_to_end [--docker] [--records M] [--versions N]
+"""
+import argparse
+import os
+import resource
+import subprocess
+import sys
+import threading
+import time
+import timeit
+import uuid
+from datetime import datetime
+
+from elasticsearch import Elasticsearch
+from pymongo import MongoClient
+
+from benchmarks.generators import RecordGenerator, SHAPES
+from benchmarks.utils import result, add_output_arguments, finish
+from eevee.config import Config
+from eevee.indexing.feeders import SimpleIndexFeeder
+from eevee.indexing.indexers import Indexer
+from eevee.indexing.indexes import Index
+from eevee.ingestion.converters import RecordToMongoConverter
+from eevee.ingestion.feeders import BaseRecord
+from eevee.ingestion.ingesters import Ingester
+from eevee.search import SearchHelper
+from tests.ingestion.test_feeders import ExampleFeederForTests
+
+COLLECTION = u'benchmark'
+
+
+class SyntheticRecord(BaseRecord):
+    """
+    A record holding some synthetic data.
+    """
+
+    def __init__(self, version, record_id, data):
+        super(SyntheticRecord, self).__init__(version)
+        self.record_id = record_id
+        self.data = data
+
+    def convert(self):
+        return self.data
+
+    @property
+    def id(self):
+        return self.record_id
+
+    @property
+    def mongo_collection(self):
+        return COLLECTION
+
+
+def peak_rss():
+    """
+    Returns the peak resident set size of this process so far in bytes.
+
+    :return: the peak RSS in bytes
+    """
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # linux reports the value in kilobytes, macOS in bytes
+    return usage if sys.platform == u'darwin' else usage * 1024
+
+
+def current_rss():
+    """
+    Returns the current resident set size of this process in bytes. This is read from /proc where
+    it's available, elsewhere the peak RSS is used instead which means the deltas RssSampler reports
+    are only non-zero when a stage pushes the process beyond its previous peak.
+
+    :return: the RSS in bytes
+    """
+    try:
+        with open(u'/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf(u'SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError, IndexError):
+        return peak_rss()
+
+
+class RssSampler(object):
+    """
+    Context manager which samples the RSS of this process in a background thread while the code
+    inside it runs and records the largest rise above the RSS when it was entered in the delta
+    attribute.
+    """
+
+    def __init__(self, interval=0.05):
+        """
+        :param interval: the number of seconds between samples
+        """
+        self.interval = interval
+        self.baseline = None
+        self.delta = 0
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def sample(self):
+        self.delta = max(self.delta, current_rss() - self.baseline)
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.sample()
+
+    def __enter__(self):
+        self.baseline = current_rss()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stopped.set()
+        self.thread.join()
+        # take a final sample so that stages shorter than the interval are still measured
+        self.sample()
+
+
+def wait_for(check, timeout=120, interval=1):
+    """
+    Calls the check function until it returns without an exception or the timeout is reached, in
+    which case the last exception is raised.
+
+    :param check: a callable taking no arguments
+    :param timeout: the number of seconds to wait for
+    :param interval: the number of seconds to wait between checks
+    """
+    end = time.time() + timeout
+    while True:
+        try:
+            check()
+            return
+        except Exception:
+            if time.time() > end:
+                raise
+            time.sleep(interval)
+
+
+class DockerServices(object):
+    """
+    Context manager which starts MongoDB and Elasticsearch in docker containers and removes them on
+    exit.
+    """
+
+    def __init__(self, mongo_image, elasticsearch_image, mongo_port, elasticsearch_port):
+        self.mongo_image = mongo_image
+        self.elasticsearch_image = elasticsearch_image
+        self.mongo_port = mongo_port
+        self.elasticsearch_port = elasticsearch_port
+        self.containers = []
+
+    def run(self, *args):
+        container_id = subprocess.check_output([u'docker', u'run', u'-d', u'--rm'] + list(args))
+        self.containers.append(container_id.decode(u'utf-8').strip())
+
+    def __enter__(self):
+        self.run(u'-p', u'{}:27017'.format(self.mongo_port), self.mongo_image)
+        self.run(u'-p', u'{}:9200'.format(self.elasticsearch_port),
+                 u'-e', u'discovery.type=single-node', self.elasticsearch_image)
+        return self
+
+    def __exit__(self, *args):
+        for container in self.containers:
+            subprocess.call([u'docker', u'stop', container])
+
+
+def generate_versions(options):
+    """
+    Yields lists of records for each version.
+
+    :param options: the parsed options
+    :return: a generator of 2-tuples of version and list of records
+    """
+    generator = RecordGenerator(options.shape, seed=options.seed)
+    data = [generator.generate(record_id) for record_id in range(options.records)]
+    # versions are millisecond timestamps, space them a day apart going back from now
+    first_version = int(time.time() * 1000) - options.versions * 86400000
+    for number in range(options.versions):
+        version = first_version + number * 86400000
+        if number > 0:
+            data = [generator.mutate(record_data, options.change_rate) for record_data in data]
+        yield version, [SyntheticRecord(version, record_id, record_data)
+                        for record_id, record_data in enumerate(data)]
+
+
+def run_stages(config, options):
+    """
+    Runs the ingest, index and search stages and returns the results.
+
+    :param config: the config object
+    :param options: the parsed options
+    :return: a dict of result names -> result dicts
+    """
+    results = {}
+    ingest_time = 0
+    index_time = 0
+    records_ingested = 0
+    records_indexed = 0
+    ingest_rss_delta = 0
+    index_rss_delta = 0
+    previous_version = None
+
+    for version, records in generate_versions(options):
+        feeder = ExampleFeederForTests(version, records)
+        converter = RecordToMongoConverter(version, datetime.now())
+        ingester = Ingester(version, feeder, converter, config, chunk_size=options.chunk_size)
+        with RssSampler() as sampler:
+            start = timeit.default_timer()
+            ingester.ingest()
+            ingest_time += timeit.default_timer() - start
+        ingest_rss_delta = max(ingest_rss_delta, sampler.delta)
+        records_ingested += len(records)
+
+        index_feeder = SimpleIndexFeeder(config, COLLECTION, previous_version, version)
+        index = Index(config, COLLECTION, version, shards=1, replicas=0)
+        indexer = Indexer(version, config, [(index_feeder, index)], bulk_size=options.bulk_size)
+        with RssSampler() as sampler:
+            start = timeit.default_timer()
+            indexer.index()
+            index_time += timeit.default_timer() - start
+        index_rss_delta = max(index_rss_delta, sampler.delta)
+        records_indexed += index_feeder.total()
+        previous_version = version
+
+    results[u'ingest.records_per_second'] = result(records_ingested / ingest_time, u'records/s')
+    results[u'ingest.rss_delta'] = result(ingest_rss_delta, u'bytes', higher_is_better=False)
+    results[u'index.records_per_second'] = result(records_indexed / index_time, u'records/s')
+    results[u'index.rss_delta'] = result(index_rss_delta, u'bytes', higher_is_better=False)
+
+    search_helper = SearchHelper(config)
+    index_name = search_helper.prefix_index(COLLECTION)
+    search_helper.client.indices.refresh(index_name)
+    record_ids = list(range(min(options.records, 50)))
+    calls = {
+        u'get_rounded_versions': lambda: search_helper.get_rounded_versions([index_name], None),
+        u'get_index_version_counts': lambda: search_helper.get_index_version_counts(index_name),
+        u'get_records_versions': lambda: search_helper.get_records_versions(index_name,
+                                                                            record_ids),
+    }
+    with RssSampler() as sampler:
+        for name, call in sorted(calls.items()):
+            best = min(timeit.repeat(call, number=options.search_number, repeat=3))
+            results[u'search.{}.calls_per_second'.format(name)] = result(
+                options.search_number / best, u'calls/s')
+    results[u'search.rss_delta'] = result(sampler.delta, u'bytes', higher_is_better=False)
+    results[u'peak_rss'] = result(peak_rss(), u'bytes', higher_is_better=False)
+
+    with MongoClient(config.mongo_host, config.mongo_port) as client:
+        stats = client[config.mongo_database].command(u'collStats', COLLECTION)
+        results[u'mongo.data_bytes'] = result(stats[u'size'], u'bytes', higher_is_better=False)
+        results[u'mongo.storage_bytes'] = result(stats[u'storageSize'] + stats[u'totalIndexSize'],
+                                                 u'bytes', higher_is_better=False)
+    store = search_helper.client.indices.stats(index_name, metric=u'store')
+    results[u'elasticsearch.store_bytes'] = result(
+        store[u'_all'][u'primaries'][u'store'][u'size_in_bytes'], u'bytes',
+        higher_is_better=False)
+    return results
+
+
+def cleanup(config):
+    """
+    Removes the database and indexes created by the benchmark. The status index name starts with
+    the index prefix so it is removed along with the data indexes.
+
+    :param config: the config object
+    """
+    with MongoClient(config.mongo_host, config.mongo_port) as client:
+        client.drop_database(config.mongo_database)
+    elasticsearch = Elasticsearch(hosts=config.elasticsearch_hosts)
+    elasticsearch.indices.delete(u'{}*'.format(config.elasticsearch_index_prefix),
+                                 ignore=(404,))
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=u'End to end eevee benchmark')
+    parser.add_argument(u'--records', type=int, default=10000,
+                        help=u'the number of records in each version')
+    parser.add_argument(u'--versions', type=int, default=5, help=u'the number of versions')
+    parser.add_argument(u'--change-rate', type=float, default=0.1,
+                        help=u'the proportion of record values changed in each version')
+    parser.add_argument(u'--shape', choices=SHAPES, default=u'shallow',
+                        help=u'the shape of the synthetic records')
+    parser.add_argument(u'--seed', type=int, default=1)
+    parser.add_argument(u'--chunk-size', type=int, default=1000, help=u'the ingestion chunk size')
+    parser.add_argument(u'--bulk-size', type=int, default=2000, help=u'the indexing bulk size')
+    parser.add_argument(u'--search-number', type=int, default=20,
+                        help=u'the number of times to run each search call per timing repeat')
+    parser.add_argument(u'--docker', action=u'store_true',
+                        help=u'start mongo and elasticsearch in docker containers')
+    parser.add_argument(u'--mongo-image', default=u'mongo:4.0')
+    parser.add_argument(u'--elasticsearch-image',
+                        default=u'docker.elastic.co/elasticsearch/elasticsearch-oss:6.8.13')
+    parser.add_argument(u'--mongo-host', default=u'localhost')
+    parser.add_argument(u'--mongo-port', type=int, default=27017)
+    parser.add_argument(u'--elasticsearch-host', default=u'localhost')
+    parser.add_argument(u'--elasticsearch-port', type=int, default=9200)
+    add_output_arguments(parser)
+    options = parser.parse_args(args)
+
+    run_id = uuid.uuid4().hex[:8]
+    index_prefix = u'benchmark-{}-'.format(run_id)
+    config = Config(elasticsearch_hosts=[u'http://{}:{}'.format(options.elasticsearch_host,
+                                                                options.elasticsearch_port)],
+                    elasticsearch_index_prefix=index_prefix,
+                    # use a status index of our own so that the shared one isn't touched
+                    elasticsearch_status_index_name=u'{}status'.format(index_prefix),
+                    mongo_host=options.mongo_host, mongo_port=options.mongo_port,
+                    mongo_database=u'benchmark-{}'.format(run_id))
+
+    services = None
+    if options.docker:
+        services = DockerServices(options.mongo_image, options.elasticsearch_image,
+                                  options.mongo_port, options.elasticsearch_port)
+        services.__enter__()
+    try:
+        with MongoClient(config.mongo_host, config.mongo_port) as client:
+            wait_for(lambda: client.admin.command(u'ping'))
+        elasticsearch = Elasticsearch(hosts=config.elasticsearch_hosts)
+        wait_for(lambda: elasticsearch.cluster.health(wait_for_status=u'yellow'))
+
+        try:
+            results = run_stages(config, options)
+        finally:
+            cleanup(config)
+    finally:
+        if services is not None:
+            services.__exit__(*sys.exc_info())
+    return finish(u'end_to_end', results, options)
+
+
+if __name__ == u'__main__':
+    sys.exit(main())
@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+# encoding: utf-8
+import random
+import string
+
+import six
+
+# the record shapes the generator can produce
+SHAPES = (u'shallow', u'nested', u'wide', u'deep')
+
+
+class RecordGenerator(object):
+    """
+    Generates synthetic record data dicts of a given shape and mutated versions of them. All the
+    randomness comes from a seeded random.Random instance so the same parameters always produce the
+    same records, making benchmark runs comparable.
+
+    The shapes are:
+
+        - shallow: a flat dict of a moderate number of fields
+        - nested: a flat dict with some fields containing dicts and lists of dicts
+        - wide: a flat dict with a large number of fields
+        - deep: a dict with fields nested several levels down
+    """
+
+    def __init__(self, shape=u'shallow', fields=20, depth=4, seed=1):
+        """
+        :param shape: the shape of the records to generate, one of SHAPES
+        :param fields: the number of fields at each level of the record (the wide shape uses 10x
+                       this number)
+        :param depth: how many levels deep the deep shape goes
+        :param seed: the random seed
+        """
+        if shape not in SHAPES:
+            raise ValueError(u'Unknown shape: {}'.format(shape))
+        self.shape = shape
+        self.fields = fields if shape != u'wide' else fields * 10
+        self.depth = depth
+        self.random = random.Random(seed)
+
+    def value(self):
+        """
+        Returns a random leaf value, either a string, an int or a float.
+
+        :return: a value
+        """
+        choice = self.random.random()
+        if choice < 0.6:
+            length = self.random.randint(3, 30)
+            return u''.join(self.random.choice(string.ascii_letters) for _ in range(length))
+        elif choice < 0.8:
+            return self.random.randint(0, 1000000)
+        else:
+            return self.random.random() * 1000
+
+    def _flat(self, fields):
+        return {u'field_{}'.format(i): self.value() for i in range(fields)}
+
+    def _deep(self, depth):
+        data = self._flat(self.fields)
+        if depth > 1:
+            data[u'child'] = self._deep(depth - 1)
+        return data
+
+    def generate(self, record_id):
+        """
+        Generates a record data dict.
+
+        :param record_id: the id of the record, this is added to the data as the _id field
+        :return: a dict
+        """
+        if self.shape in (u'shallow', u'wide'):
+            data = self._flat(self.fields)
+        elif self.shape == u'nested':
+            data = self._flat(self.fields)
+            data[u'location'] = self._flat(5)
+            data[u'identifications'] = [self._flat(4) for _ in range(3)]
+        else:
+            data = self._deep(self.depth)
+        data[u'_id'] = record_id
+        return data
+
+    def _mutate(self, data, change_rate):
+        mutated = {}
+        for key, value in six.iteritems(data):
+            if key == u'_id':
+                mutated[key] = value
+            elif isinstance(value, dict):
+                mutated[key] = self._mutate(value, change_rate)
+            elif isinstance(value, list):
+                mutated[key] = [self._mutate(element, change_rate) for element in value]
+            elif self.random.random() < change_rate:
+                # change, remove or leave and add a new field next to it
+                choice = self.random.random()
+                if choice < 0.8:
+                    mutated[key] = self.value()
+                elif choice < 0.9:
+                    continue
+                else:
+                    mutated[key] = value
+                    mutated[u'{}_extra'.format(key)] = self.value()
+            else:
+                mutated[key] = value
+        return mutated
+
+    def mutate(self, data, change_rate):
+        """
+        Returns a new version of the given record data with roughly change_rate of its leaf values
+        changed, removed or added to. The given data is not modified.
+
+        :param data: the record data dict
+        :param change_rate: the proportion of leaf values to change, between 0 and 1
+        :return: a new dict
+        """
+        return self._mutate(data, change_rate)
+
+    def versions(self, record_id, count, change_rate):
+        """
+        Generates a list of successive versions of a record.
+
+        :param record_id: the id of the record
+        :param count: the number of versions to generate
+        :param change_rate: the proportion of leaf values to change between each version
+        :return: a list of dicts
+        """
+        versions = [self.generate(record_id)]
+        for _ in range(count - 1):
+            versions.append(self.mutate(versions[-1], change_rate))
+        return versions
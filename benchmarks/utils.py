@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# encoding: utf-8
+from __future__ import print_function
+
+import json
+import platform
+import sys
+import time
+import timeit
+
+
+def time_operation(operation, number, repeat=3):
+    """
+    Times the given operation and returns the number of times it can run per second. The operation
+    is run number times in a row and this is repeated repeat times, the fastest repeat is used.
+
+    :param operation: a callable taking no arguments
+    :param number: the number of times to run the operation in each repeat
+    :param repeat: the number of repeats
+    :return: the operations per second
+    """
+    best = min(timeit.repeat(operation, number=number, repeat=repeat))
+    return number / best if best > 0 else float(u'inf')
+
+
+def result(value, unit, higher_is_better=True):
+    """
+    Creates a result dict.
+
+    :param value: the measured value
+    :param unit: the unit of the value
+    :param higher_is_better: whether an increase in the value is an improvement
+    :return: a dict
+    """
+    return {u'value': value, u'unit': unit, u'higher_is_better': higher_is_better}
+
+
+def compare(results, baseline, threshold):
+    """
+    Compares the given results against a baseline set of results and returns the ones that have
+    regressed by more than the threshold. Results which aren't in the baseline are ignored.
+
+    :param results: a dict of result names -> result dicts
+    :param baseline: a dict of result names -> result dicts
+    :param threshold: the proportional change allowed before a result is considered a regression,
+                      e.g. 0.1 for 10%
+    :return: a list of 4-tuples of result name, baseline value, new value and proportional change
+    """
+    regressions = []
+    for name, new in sorted(results.items()):
+        old = baseline.get(name, None)
+        if old is None or not old[u'value']:
+            continue
+        change = (new[u'value'] - old[u'value']) / float(old[u'value'])
+        if not new[u'higher_is_better']:
+            change = -change
+        if change < -threshold:
+            regressions.append((name, old[u'value'], new[u'value'], change))
+    return regressions
+
+
+def add_output_arguments(parser):
+    """
+    Adds the arguments used by finish to the given argparse parser.
+
+    :param parser: an argparse parser
+    """
+    parser.add_argument(u'--output', help=u'write the results as JSON to this path')
+    parser.add_argument(u'--baseline', help=u'compare the results to the JSON results at this path')
+    parser.add_argument(u'--threshold', type=float, default=0.1,
+                        help=u'the proportional change allowed before a result is considered a '
+                             u'regression (default: 0.1)')
+
+
+def finish(name, results, options):
+    """
+    Prints the given results, writes them to the output path if there is one and compares them to
+    the baseline if there is one. The exit code for the benchmark is returned, this is 1 if any of
+    the results have regressed compared to the baseline and 0 otherwise.
+
+    :param name: the name of the benchmark
+    :param results: a dict of result names -> result dicts
+    :param options: the parsed argparse options (see add_output_arguments)
+    :return: the exit code
+    """
+    for result_name, details in sorted(results.items()):
+        print(u'{:<60} {:>16.2f} {}'.format(result_name, details[u'value'], details[u'unit']))
+
+    if options.output:
+        document = {
+            u'benchmark': name,
+            u'created': int(time.time()),
+            u'python': platform.python_version(),
+            u'platform': platform.platform(),
+            u'results': results,
+        }
+        with open(options.output, u'w') as output_file:
+            json.dump(document, output_file, indent=2, sort_keys=True)
+
+    if options.baseline:
+        with open(options.baseline, u'r') as baseline_file:
+            baseline = json.load(baseline_file)[u'results']
+        regressions = compare(results, baseline, options.threshold)
+        for result_name, old, new, change in regressions:
+            print(u'REGRESSION {}: {:.2f} -> {:.2f} ({:+.1%})'.format(result_name, old, new,
+                                                                      change), file=sys.stderr)
+        if regressions:
+            return 1
+    return 0
@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import mmap
+import os
+import re
+import struct
+import threading
+import zlib
+
+from bson import BSON
+
+# each entry in a segment file starts with a header containing the length of the compressed payload
+# and its crc32 checksum, both as unsigned big endian 32 bit ints
+ENTRY_HEADER = struct.Struct(u'>II')
+SEGMENT_NAME = u'segment-{:08d}.seg'
+SEGMENT_PATTERN = re.compile(r'^segment-(\d{8})\.seg$')
+
+
+class ArchiveError(Exception):
+    """
+    Raised when an archived entry can't be read.
+    """
+    pass
+
+
+def encode_entry(diffs):
+    """
+    Serialises the given diffs for storage in the archive. BSON is used as the diffs are already in
+    the form they're stored in mongo so they can always be encoded as BSON and, unlike pickle, it's
+    safe to decode whatever the archive files contain.
+
+    :param diffs: a dict of versions -> stored diffs
+    :return: the serialised bytes
+    """
+    return BSON.encode(diffs)
+
+
+def decode_entry(data):
+    """
+    Deserialises diffs serialised by encode_entry.
+
+    :param data: the serialised bytes
+    :return: a dict of versions -> stored diffs
+    """
+    return BSON(data).decode()
+
+
+class SegmentArchive(object):
+    """
+    Stores the cold diffs of records in append-only segment files in a directory. Each entry in a
+    segment is a record's dict of version -> stored diff, BSON encoded and zlib compressed. Entries
+    are never modified once written, when a record's archived diffs change a new entry is appended
+    and the old one is simply left behind.
+
+    An entry is located by a pointer dict containing its segment number, offset and length which
+    is stored in the record's mongo doc under the archive key. This acts as the offset index for
+    the archive. Segments are read through read only memory maps so that reading a record's archived
+    diffs doesn't require any file reads beyond the pages that are touched.
+
+    Only one process should write to an archive at a time but any number of processes can read from
+    it, including whilst it is being written to. Reading is threadsafe.
+    """
+
+    def __init__(self, path, max_segment_bytes=256 * 1024 * 1024, compression_level=6):
+        """
+        :param path: the directory to store the segment files in, it is created if it doesn't exist
+        :param max_segment_bytes: once a segment reaches this size a new one is started (default:
+                                  256MB)
+        :param compression_level: the zlib compression level to use (default: 6)
+        """
+        self.path = path
+        self.max_segment_bytes = max_segment_bytes
+        self.compression_level = compression_level
+        self.lock = threading.Lock()
+        # segment number -> mmap
+        self.maps = {}
+        self.segment = None
+        self.segment_file = None
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+    def get_segment_path(self, segment):
+        """
+        Returns the path of the given segment file.
+
+        :param segment: the segment number
+        :return: the path
+        """
+        return os.path.join(self.path, SEGMENT_NAME.format(segment))
+
+    def get_segments(self):
+        """
+        Returns the numbers of the segments in the archive in ascending order.
+
+        :return: a list of ints
+        """
+        segments = []
+        for name in os.listdir(self.path):
+            match = SEGMENT_PATTERN.match(name)
+            if match:
+                segments.append(int(match.group(1)))
+        return sorted(segments)
+
+    def get_writable_segment(self):
+        """
+        Returns the open file of the segment which entries should be appended to, starting a new
+        segment if there isn't one yet or the current one is full.
+
+        :return: the file object
+        """
+        if self.segment_file is None:
+            segments = self.get_segments()
+            self.segment = segments[-1] if segments else 0
+            self.segment_file = open(self.get_segment_path(self.segment), u'ab')
+        if self.segment_file.tell() >= self.max_segment_bytes:
+            self.segment_file.close()
+            self.segment += 1
+            self.segment_file = open(self.get_segment_path(self.segment), u'ab')
+        return self.segment_file
+
+    def write(self, diffs):
+        """
+        Appends the given diffs to the archive and returns the pointer to the new entry. The entry
+        isn't guaranteed to be on disk until flush is called so the pointer shouldn't be stored
+        anywhere else until then.
+
+        :param diffs: a dict of versions -> stored diffs
+        :return: a pointer dict
+        """
+        payload = zlib.compress(encode_entry(diffs), self.compression_level)
+        segment_file = self.get_writable_segment()
+        # in append mode the position isn't necessarily the end of the file until after a write
+        segment_file.seek(0, os.SEEK_END)
+        offset = segment_file.tell()
+        segment_file.write(ENTRY_HEADER.pack(len(payload), zlib.crc32(payload) & 0xffffffff))
+        segment_file.write(payload)
+        return {
+            u'segment': self.segment,
+            u'offset': offset,
+            u'length': ENTRY_HEADER.size + len(payload),
+        }
+
+    def flush(self):
+        """
+        Ensures all the entries written so far are on disk.
+        """
+        if self.segment_file is not None:
+            self.segment_file.flush()
+            os.fsync(self.segment_file.fileno())
+
+    def get_map(self, segment, end):
+        """
+        Returns a memory map of the given segment which covers at least up to the given end offset.
+        Maps are cached and remapped if the segment has grown beyond the end of the cached map.
+
+        :param segment: the segment number
+        :param end: the offset the map must cover
+        :return: an mmap object
+        """
+        with self.lock:
+            segment_map = self.maps.get(segment, None)
+            if segment_map is None or len(segment_map) < end:
+                # the old map isn't closed as another thread could still be reading from it, it'll
+                # be closed when it's garbage collected
+                with open(self.get_segment_path(segment), u'rb') as segment_file:
+                    segment_map = mmap.mmap(segment_file.fileno(), 0, access=mmap.ACCESS_READ)
+                self.maps[segment] = segment_map
+            return segment_map
+
+    def read(self, pointer):
+        """
+        Reads the entry at the given pointer.
+
+        :param pointer: the pointer dict
+        :return: a dict of versions -> stored diffs
+        """
+        start = pointer[u'offset']
+        end = start + pointer[u'length']
+        segment_map = self.get_map(pointer[u'segment'], end)
+        if len(segment_map) < end:
+            raise ArchiveError(u'Entry {} extends beyond the end of its segment'.format(pointer))
+        length, checksum = ENTRY_HEADER.unpack(segment_map[start:start + ENTRY_HEADER.size])
+        payload = segment_map[start + ENTRY_HEADER.size:end]
+        if length != len(payload) or zlib.crc32(payload) & 0xffffffff != checksum:
+            raise ArchiveError(u'Entry {} is corrupt'.format(pointer))
+        return decode_entry(zlib.decompress(payload))
+
+    def get_diffs(self, mongo_doc):
+        """
+        Returns all the diffs of the given mongo doc, combining the archived diffs (if there are
+        any) with the diffs stored in the doc itself.
+
+        :param mongo_doc: the mongo doc
+        :return: a dict of versions -> stored diffs
+        """
+        pointer = mongo_doc.get(u'archive', None)
+        if pointer is None:
+            return mongo_doc[u'diffs']
+        diffs = self.read(pointer)
+        diffs.update(mongo_doc[u'diffs'])
+        return diffs
+
+    def close(self):
+        """
+        Closes the segment being written and all the memory maps.
+        """
+        if self.segment_file is not None:
+            self.flush()
+            self.segment_file.close()
+            self.segment_file = None
+        with self.lock:
+            for segment_map in self.maps.values():
+                segment_map.close()
+            self.maps.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -7,7 +7,7 @@ class Config(object):
     def __init__(self, elasticsearch_hosts=None, elasticsearch_index_prefix=u'eevee-',
                  elasticsearch_status_index_name=u'status', mongo_host=u'localhost',
                  mongo_port=27017, mongo_database=u'eevee', search_from=0, search_size=100,
-                 search_default_indexes=None):
+                 search_default_indexes=None, archive_path=None):
         """
         :param elasticsearch_hosts: a list of known elasticsearch servers to connect to for
                                     searching and indexing. Defaults to ['http://localhost:9200'].
@@ -24,6 +24,8 @@ class Config(object):
         :param search_default_indexes: the default indices to search over (must be a list, should
                                        not be prefixed). Defaults to ['*'] which searches
                                        everything.
+        :param archive_path: the directory containing the segment files of the diff archive, if
+                             None (the default) there is no archive
         """
         # elasticsearch
         if elasticsearch_hosts is not None:
@@ -45,3 +47,6 @@ class Config(object):
             self.search_default_indexes = search_default_indexes
         else:
             self.search_default_indexes = [u'{}*'.format(elasticsearch_index_prefix)]
+
+        # archiving
+        self.archive_path = archive_path
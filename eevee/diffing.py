@@ -1,29 +1,153 @@
 import abc
 import marshal
+import zlib
 
 import dictdiffer
 import six
+import ujson
+from bson.binary import Binary
 
+from eevee.utils import ReadOnlyDict, freeze, thaw
 
-def format_diff(differ, diff):
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# the diff modes. In forward mode (the default) each version's diff patches the previous version's
+# data (or an empty dict for the first version) to produce the version's data. In reverse mode the
+# record's data field holds the latest version's data and each version's diff patches the version's
+# data back to the previous version's data (or an empty dict for the first version). Records stored
+# in reverse mode have their diff_mode field set to REVERSE, records without the field are forward.
+FORWARD = u'forward'
+REVERSE = u'reverse'
+DIFF_MODES = (FORWARD, REVERSE)
+
+
+def get_diff_mode(mongo_doc):
+    """
+    Returns the diff mode the given mongo doc's diffs are stored in.
+
+    :param mongo_doc: the mongo doc
+    :return: FORWARD or REVERSE
     """
-    Formats the given differ and diff for mongo storage.
+    return mongo_doc.get(u'diff_mode', FORWARD)
+
+
+def format_diff(differ, diff, codec=None):
+    """
+    Formats the given differ and diff for mongo storage. If a codec is provided the diff is encoded
+    with it and the codec's id is stored alongside the encoded diff. If the codec can't encode the
+    diff (for example because it contains a type the codec doesn't support) then the diff is stored
+    as is.
 
     :param differ: the differ object
     :param diff: the diff
+    :param codec: the DiffCodec object to encode the diff with, defaults to None in which case the
+                  diff is stored as is
     :return: a dict for storage
     """
+    if codec is not None:
+        try:
+            return {u'id': differ.differ_id, u'c': codec.codec_id, u'd': codec.encode(diff)}
+        except (TypeError, ValueError, OverflowError):
+            pass
     return {u'id': differ.differ_id, u'd': diff}
 
 
 def extract_diff(raw_diff):
     """
-    Given a diff from mongo storage, return the differ object used and the diff itself.
+    Given a diff from mongo storage, return the differ object used and the diff itself. If the diff
+    was encoded with a codec it is decoded.
 
     :param raw_diff: the diff from mongo
     :return: a 2-tuple of the differ object used to create the diff and the diff itself
     """
-    return differs[raw_diff[u'id']], raw_diff[u'd']
+    diff = raw_diff[u'd']
+    codec_id = raw_diff.get(u'c', None)
+    if codec_id is not None:
+        diff = diff_codecs[codec_id].decode(diff)
+    return differs[raw_diff[u'id']], diff
+
+
+@six.add_metaclass(abc.ABCMeta)
+class DiffCodec(object):
+    """
+    Abstract class defining the interface for codecs which encode diffs into a compact binary form
+    for storage.
+    """
+
+    def __init__(self, codec_id):
+        """
+        :param codec_id: the id of the codec, this will be stored alongside the encoded diffs
+        """
+        self.codec_id = codec_id
+
+    @abc.abstractmethod
+    def encode(self, diff):
+        """
+        Encodes the given diff.
+
+        :param diff: the diff
+        :return: a bson Binary object
+        """
+        pass
+
+    @abc.abstractmethod
+    def decode(self, encoded):
+        """
+        Decodes the given encoded diff. Note that tuples in the diff will be returned as lists which
+        matches what happens when a diff is stored in mongo without a codec.
+
+        :param encoded: the encoded diff
+        :return: the diff
+        """
+        pass
+
+
+class ZlibJSONCodec(DiffCodec):
+    """
+    A DiffCodec which serialises the diff to JSON and then compresses it with zlib. The ID used for
+    this codec is 'zj'. As this uses JSON it can only encode diffs containing JSON types.
+    """
+
+    def __init__(self, level=6):
+        """
+        :param level: the zlib compression level (default: 6)
+        """
+        super(ZlibJSONCodec, self).__init__(u'zj')
+        self.level = level
+
+    def encode(self, diff):
+        serialised = ujson.dumps(diff, ensure_ascii=False, escape_forward_slashes=False)
+        return Binary(zlib.compress(serialised.encode(u'utf-8'), self.level))
+
+    def decode(self, encoded):
+        return ujson.loads(zlib.decompress(encoded).decode(u'utf-8'))
+
+
+class ZlibMsgpackCodec(DiffCodec):
+    """
+    A DiffCodec which serialises the diff with msgpack and then compresses it with zlib. The ID used
+    for this codec is 'zm'. This requires the msgpack package to be installed.
+    """
+
+    def __init__(self, level=6):
+        """
+        :param level: the zlib compression level (default: 6)
+        """
+        super(ZlibMsgpackCodec, self).__init__(u'zm')
+        self.level = level
+
+    def encode(self, diff):
+        if msgpack is None:
+            raise ImportError(u'The msgpack package is required to use the zm codec')
+        return Binary(zlib.compress(msgpack.packb(diff, use_bin_type=True), self.level))
+
+    def decode(self, encoded):
+        if msgpack is None:
+            raise ImportError(u'The msgpack package is required to use the zm codec')
+        return msgpack.unpackb(zlib.decompress(encoded), raw=False)
 
 
 @six.add_metaclass(abc.ABCMeta)
@@ -77,6 +201,22 @@ class Differ(object):
         """
         pass
 
+    def patch_shared(self, diff_result, old):
+        """
+        Given the return from the diff function and some read only data (see eevee.utils.freeze),
+        apply the diff and return the result as new read only data. The old data is not modified
+        and the parts of it which the diff doesn't change are shared with the returned data rather
+        than copied, which is much cheaper than a deep copy when the diff is small.
+
+        This implementation simply patches a mutable copy of the old data, subclasses should
+        override it with something more efficient.
+
+        :param diff_result: the diff to apply
+        :param old: the old read only data
+        :return: the updated read only data
+        """
+        return freeze(self.patch(diff_result, thaw(old), in_place=True))
+
 
 class DictDifferDiffer(Differ):
     """
@@ -126,6 +266,38 @@ class DictDifferDiffer(Differ):
             old = marshal.loads(marshal.dumps(old))
         return dictdiffer.patch(diff_result, old, in_place=True)
 
+    def patch_shared(self, diff_result, old):
+        """
+        Applies the diff to a copy of the old read only data which shares all of the nested dicts
+        and lists which the diff doesn't touch with the old data. Only the containers on the paths
+        the diff changes are copied (and then frozen again once the diff has been applied).
+
+        :param diff_result: the diff to apply
+        :param old: the old read only data
+        :return: the updated read only data
+        """
+        new = dict(old)
+        copied = set()
+        for action, node, _changes in diff_result:
+            if isinstance(node, six.string_types):
+                path = node.split(u'.') if node else []
+            else:
+                path = list(node)
+            if action == u'change':
+                # changes replace the value at the end of the path in its parent container
+                path = path[:-1]
+            container = new
+            for key in path:
+                if isinstance(container, list):
+                    key = int(key)
+                child = container[key]
+                if id(child) not in copied:
+                    child = list(child) if isinstance(child, list) else dict(child)
+                    copied.add(id(child))
+                    container[key] = child
+                container = child
+        return freeze(dictdiffer.patch(diff_result, new, in_place=True))
+
 
 class ShallowDiffer(Differ):
     """
@@ -203,6 +375,21 @@ class ShallowDiffer(Differ):
         old.update(diff_result.get(u'c', {}))
         return old
 
+    def patch_shared(self, diff_result, old):
+        """
+        Applies the diff to a shallow copy of the old read only data. As the data has no nested
+        dicts only the top level dict needs copying.
+
+        :param diff_result: the diff to apply
+        :param old: the old read only data
+        :return: the updated read only data
+        """
+        new = ReadOnlyDict(old)
+        for key in diff_result.get(u'r', []):
+            dict.__delitem__(new, key)
+        dict.update(new, freeze(diff_result.get(u'c', {})))
+        return new
+
 
 # the differs, instantiated globally for ease of use
 SHALLOW_DIFFER = ShallowDiffer()
@@ -210,3 +397,10 @@ DICT_DIFFER_DIFFER = DictDifferDiffer()
 
 # a dict of all the differs, instantiated and keyed by their ids
 differs = {differ.differ_id: differ for differ in [SHALLOW_DIFFER, DICT_DIFFER_DIFFER]}
+
+# the codecs, instantiated globally for ease of use
+ZLIB_JSON_CODEC = ZlibJSONCodec()
+ZLIB_MSGPACK_CODEC = ZlibMsgpackCodec()
+
+# a dict of all the codecs, instantiated and keyed by their ids
+diff_codecs = {codec.codec_id: codec for codec in [ZLIB_JSON_CODEC, ZLIB_MSGPACK_CODEC]}
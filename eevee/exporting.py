@@ -0,0 +1,650 @@
+#!/usr/bin/env python
+# encoding: utf-8
+import argparse
+import csv
+import gzip
+import io
+import os
+import shutil
+import tempfile
+from multiprocessing import Pool, cpu_count
+from multiprocessing.pool import ThreadPool
+
+import six
+import ujson
+from elasticsearch_dsl import Search
+
+from eevee.archive import SegmentArchive
+from eevee.config import Config
+from eevee.diffing import get_diff_mode, REVERSE
+from eevee.indexing.utils import get_versions_and_data
+from eevee.mongo import get_mongo
+from eevee.search import SearchHelper, create_version_query
+from eevee.utils import chunk_iterator, bounded_imap
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+
+def flatten_mapping(properties, prefix=u''):
+    """
+    Given the properties from an elasticsearch mapping, return the dotted paths of all the leaf
+    fields in it, in a stable order.
+
+    :param properties: the properties dict from the mapping
+    :param prefix: the prefix to add to each path, used when recursing
+    :return: a list of dotted field paths
+    """
+    fields = []
+    for name in sorted(properties):
+        definition = properties[name]
+        path = u'{}{}'.format(prefix, name)
+        if u'properties' in definition:
+            fields.extend(flatten_mapping(definition[u'properties'], u'{}.'.format(path)))
+        else:
+            fields.append(path)
+    return fields
+
+
+def get_path(data, path):
+    """
+    Retrieves the value at the given dotted path from the given nested dict. If any part of the path
+    is missing then None is returned.
+
+    :param data: the nested dict
+    :param path: the dotted path
+    :return: the value or None
+    """
+    value = data
+    for part in path.split(u'.'):
+        if not isinstance(value, dict):
+            return None
+        value = value.get(part, None)
+    return value
+
+
+class JSONLSerialiser(object):
+    """
+    Serialises records as JSON, one record per line.
+    """
+
+    extension = u'jsonl'
+
+    def header(self):
+        """
+        Returns the text to write at the start of a shard, in this case nothing.
+
+        :return: a unicode string
+        """
+        return u''
+
+    def serialise(self, data):
+        """
+        Serialises the given record data into a line.
+
+        :param data: the record data dict
+        :return: a unicode string
+        """
+        # ujson escapes non-ascii characters by default so this is safe on python 2
+        return u'{}\n'.format(ujson.dumps(data))
+
+
+class CSVSerialiser(object):
+    """
+    Serialises records as CSV rows with the given columns. Columns are dotted paths into the record
+    data, values which are lists or dicts are written as JSON.
+    """
+
+    extension = u'csv'
+
+    def __init__(self, columns):
+        """
+        :param columns: the dotted paths of the columns to write
+        """
+        self.columns = columns
+        # the csv module in python 2 only deals with bytes so we write to a bytes buffer there
+        self.buffer = io.BytesIO() if six.PY2 else io.StringIO()
+        self.writer = csv.writer(self.buffer)
+
+    def _write_row(self, row):
+        if six.PY2:
+            row = [value.encode(u'utf-8') for value in row]
+        self.writer.writerow(row)
+        text = self.buffer.getvalue()
+        self.buffer.seek(0)
+        self.buffer.truncate()
+        return text.decode(u'utf-8') if six.PY2 else text
+
+    def _to_cell(self, value):
+        if value is None:
+            return u''
+        elif isinstance(value, (list, dict)):
+            return six.text_type(ujson.dumps(value))
+        else:
+            return six.text_type(value)
+
+    def header(self):
+        """
+        Returns the header row.
+
+        :return: a unicode string
+        """
+        return self._write_row(self.columns)
+
+    def serialise(self, data):
+        """
+        Serialises the given record data into a row.
+
+        :param data: the record data dict
+        :return: a unicode string
+        """
+        return self._write_row([self._to_cell(get_path(data, column)) for column in self.columns])
+
+
+class Exporter(object):
+    """
+    Exports the data in an index at a given version to gzipped JSONL or CSV files. The index is read
+    using a sliced scroll with each slice read and written in parallel by its own worker thread
+    into its own shard file. Each worker only holds one scroll batch in memory at a time and writes
+    records as it goes. The shards can optionally be concatenated into a single file once all of
+    them have been written (gzip files can be concatenated directly so this is a simple copy).
+    """
+
+    formats = (u'jsonl', u'csv')
+
+    def __init__(self, config, index, output_dir, version=None, export_format=u'jsonl', slices=4,
+                 batch_size=1000, columns=None, search_helper=None):
+        """
+        :param config: the config object
+        :param index: the name of the index to export (without the prefix)
+        :param output_dir: the directory to write the shard files to
+        :param version: the version to export the data at. The version is rounded down to the
+                        nearest version available in the index. If None (the default) the latest
+                        version is exported.
+        :param export_format: the format to export the data in, either jsonl or csv (default: jsonl)
+        :param slices: the number of slices to split the scroll into, this is also the number of
+                       worker threads used and the number of shard files written (default: 4)
+        :param batch_size: the number of records to retrieve in each scroll request (default: 1000)
+        :param columns: the dotted paths of the fields to write when exporting as csv. If None (the
+                        default) every field in the index's data mapping is written.
+        :param search_helper: a SearchHelper instance, optional. If one isn't provided then one is
+                              created using the config.
+        """
+        if export_format not in self.formats:
+            raise ValueError(u'Unsupported export format: {}'.format(export_format))
+        self.config = config
+        self.search_helper = search_helper if search_helper is not None else SearchHelper(config)
+        self.index = self.search_helper.prefix_index(index)
+        self.unprefixed_index = index
+        self.output_dir = output_dir
+        self.version = version
+        self.export_format = export_format
+        self.slices = slices
+        self.batch_size = batch_size
+        self.columns = columns
+
+    def get_columns(self):
+        """
+        Returns the columns to write when exporting as CSV. These are either the columns passed to
+        the constructor or all the fields in the index's data mapping.
+
+        :return: a list of dotted field paths
+        """
+        if self.columns is not None:
+            return self.columns
+        mappings = self.search_helper.client.indices.get_mapping(index=self.index)
+        columns = set()
+        # the index name could be an alias so combine the fields from all the concrete indexes
+        for index_mappings in mappings.values():
+            for mapping in index_mappings[u'mappings'].values():
+                data_mapping = mapping.get(u'properties', {}).get(u'data', {})
+                columns.update(flatten_mapping(data_mapping.get(u'properties', {})))
+        return sorted(columns)
+
+    def create_serialiser(self, columns):
+        """
+        Creates a serialiser for the export format.
+
+        :param columns: the csv columns
+        :return: a serialiser object
+        """
+        if self.export_format == u'csv':
+            return CSVSerialiser(columns)
+        return JSONLSerialiser()
+
+    def get_shard_path(self, slice_id):
+        """
+        Returns the path of the shard file the given slice is written to.
+
+        :param slice_id: the slice id
+        :return: the path
+        """
+        return os.path.join(self.output_dir, u'{}-{}.{}.gz'.format(self.unprefixed_index, slice_id,
+                                                                    self.export_format))
+
+    def create_search(self, version, slice_id):
+        """
+        Creates the search for the given slice at the given version.
+
+        :param version: the rounded version
+        :param slice_id: the slice id
+        :return: a Search object
+        """
+        search = Search(using=self.search_helper.client, index=self.index) \
+            .filter(create_version_query(version)) \
+            .source([u'data']) \
+            .params(size=self.batch_size)
+        # elasticsearch requires there to be at least 2 slices
+        if self.slices > 1:
+            search = search.extra(slice={u'id': slice_id, u'max': self.slices})
+        return search
+
+    def export_slice(self, version, slice_id, columns, write_header=True):
+        """
+        Exports the given slice to its shard file.
+
+        :param version: the rounded version
+        :param slice_id: the slice id
+        :param columns: the csv columns
+        :param write_header: whether to write the header (if the format has one) to the shard
+        :return: a 2-tuple of the shard path and the number of records written to it
+        """
+        path = self.get_shard_path(slice_id)
+        serialiser = self.create_serialiser(columns)
+        count = 0
+        with gzip.open(path, u'wb') as gzip_file:
+            with io.TextIOWrapper(gzip_file, encoding=u'utf-8', newline=u'') as shard:
+                if write_header:
+                    shard.write(serialiser.header())
+                for hit in self.create_search(version, slice_id).scan():
+                    shard.write(serialiser.serialise(hit.to_dict().get(u'data', {})))
+                    count += 1
+        return path, count
+
+    def export(self, concatenate=False):
+        """
+        Exports the index at the version. If concatenate is True, the shards are concatenated into a
+        single file once they have all been written and then removed.
+
+        :param concatenate: whether to concatenate the shards into a single file
+        :return: a 2-tuple containing a list of the paths of the files written and the total number
+                 of records exported
+        """
+        version = self.search_helper.get_rounded_versions([self.index], self.version)[self.index]
+        if version is None:
+            # the index has no data
+            return [], 0
+
+        columns = self.get_columns() if self.export_format == u'csv' else None
+        if not os.path.exists(self.output_dir):
+            os.makedirs(self.output_dir)
+
+        pool = ThreadPool(processes=self.slices)
+        try:
+            # if the shards are going to be concatenated, only the first one needs a header
+            results = pool.map(lambda slice_id: self.export_slice(
+                version, slice_id, columns, write_header=not concatenate or slice_id == 0),
+                range(self.slices))
+        finally:
+            pool.close()
+            pool.join()
+
+        paths = [path for path, _count in results]
+        total = sum(count for _path, count in results)
+        if concatenate:
+            paths = [self.concatenate(paths)]
+        return paths, total
+
+    def concatenate(self, paths):
+        """
+        Concatenates the given gzipped shard files into a single gzipped file and removes the shard
+        files. Concatenated gzip members form a valid gzip file so no decompression is needed.
+
+        :param paths: the shard paths, in order
+        :return: the path of the concatenated file
+        """
+        output_path = os.path.join(self.output_dir, u'{}.{}.gz'.format(self.unprefixed_index,
+                                                                      self.export_format))
+        with open(output_path, u'wb') as output_file:
+            for path in paths:
+                with open(path, u'rb') as shard_file:
+                    shutil.copyfileobj(shard_file, output_file)
+                os.remove(path)
+        return output_path
+
+
+def get_data_at_version(mongo_doc, version):
+    """
+    Reconstructs the data of the given mongo doc at the given version. If the record didn't exist
+    at the version then None is returned.
+
+    :param mongo_doc: the mongo doc
+    :param version: the version
+    :return: the data dict or None
+    """
+    # we stop iterating as soon as we find the version we're after so updating in place is safe
+    if get_diff_mode(mongo_doc) == REVERSE:
+        # reverse mode records are cheapest to replay from the latest version backwards
+        for data_version, data, _next_version in get_versions_and_data(mongo_doc, in_place=True,
+                                                                       latest_first=True):
+            if data_version <= version:
+                return data
+        return None
+
+    for data_version, data, next_version in get_versions_and_data(mongo_doc, in_place=True):
+        if data_version <= version < next_version:
+            return data
+        if data_version > version:
+            break
+    return None
+
+
+def reconstruct_records(args):
+    """
+    Reconstructs the data of each of the given mongo docs at the given version. Docs without any
+    data at the version (because they didn't exist yet or had been deleted) are left out. This is a
+    module level function taking a single tuple so that it can be used with a process pool.
+
+    :param args: a 2-tuple of a list of mongo docs and a version
+    :return: a list of data dicts
+    """
+    mongo_docs, version = args
+    records = []
+    for mongo_doc in mongo_docs:
+        data = get_data_at_version(mongo_doc, version)
+        if data:
+            records.append(data)
+    return records
+
+
+def merge_types(left, right):
+    """
+    Returns a type which values of both the given arrow types can be cast to. Null types are
+    replaced by the other type, compatible types are promoted (e.g. int64 and float64 to float64)
+    and anything else is exported as strings.
+
+    :param left: a pyarrow DataType
+    :param right: a pyarrow DataType
+    :return: a pyarrow DataType
+    """
+    if left == right or pyarrow.types.is_null(right):
+        return left
+    if pyarrow.types.is_null(left):
+        return right
+    try:
+        merged = pyarrow.unify_schemas([pyarrow.schema([(u'f', left)]),
+                                        pyarrow.schema([(u'f', right)])],
+                                       promote_options=u'permissive')
+        return merged.field(u'f').type
+    except (pyarrow.ArrowInvalid, pyarrow.ArrowTypeError, pyarrow.ArrowNotImplementedError):
+        return pyarrow.string()
+
+
+def merge_schemas(schema, new_schema):
+    """
+    Combines the given schemas into one which the tables of both can be cast to. Fields are kept in
+    the order they first appear and their types are merged using merge_types.
+
+    :param schema: the running pyarrow schema, or None if there isn't one yet
+    :param new_schema: the pyarrow schema to add to it
+    :return: a pyarrow schema
+    """
+    if schema is None:
+        return new_schema
+    try:
+        return pyarrow.unify_schemas([schema, new_schema], promote_options=u'permissive')
+    except (pyarrow.ArrowInvalid, pyarrow.ArrowTypeError, pyarrow.ArrowNotImplementedError):
+        # at least one field has conflicting types, merge the fields one by one
+        fields = [(field.name, field.type) for field in schema]
+        names = {name: index for index, (name, _type) in enumerate(fields)}
+        for field in new_schema:
+            if field.name in names:
+                index = names[field.name]
+                fields[index] = (field.name, merge_types(fields[index][1], field.type))
+            else:
+                names[field.name] = len(fields)
+                fields.append((field.name, field.type))
+        return pyarrow.schema(fields)
+
+
+def cast_column(column, target_type):
+    """
+    Casts the given column to the given type. Values which arrow can't cast to strings, such as
+    structs and lists, are serialised as JSON instead.
+
+    :param column: a pyarrow ChunkedArray
+    :param target_type: the pyarrow DataType to cast to
+    :return: a pyarrow ChunkedArray or Array
+    """
+    if column.type == target_type:
+        return column
+    try:
+        return column.cast(target_type)
+    except (pyarrow.ArrowInvalid, pyarrow.ArrowNotImplementedError):
+        if not pyarrow.types.is_string(target_type):
+            raise
+        values = [value if value is None or isinstance(value, six.string_types)
+                  else ujson.dumps(value) for value in column.to_pylist()]
+        return pyarrow.array(values, type=target_type)
+
+
+def conform_table(table, schema):
+    """
+    Casts the given table to the given schema, adding null columns for any fields it's missing.
+
+    :param table: a pyarrow Table
+    :param schema: the pyarrow schema, this must include all the table's fields
+    :return: a pyarrow Table
+    """
+    columns = []
+    for field in schema:
+        index = table.schema.get_field_index(field.name)
+        if index == -1:
+            columns.append(pyarrow.nulls(table.num_rows, type=field.type))
+        else:
+            columns.append(cast_column(table.column(index), field.type))
+    return pyarrow.Table.from_arrays(columns, schema=schema)
+
+
+class ColumnarExporter(object):
+    """
+    Exports the records in a mongo collection at a given version to a Parquet or Arrow IPC file.
+    The mongo docs are streamed from the collection in chunks and the records are reconstructed at
+    the version from their diffs in a process pool. The reconstructed records are built into row
+    groups, each with its own inferred schema, which are spilled to temporary Arrow files while the
+    schemas are merged. Once all the records have been reconstructed each row group is read back,
+    cast to the merged schema and written to the output file. This means fields which only appear
+    in some row groups are included (as nulls in the others) and fields whose values have
+    different types in different row groups are promoted to a common type, falling back to strings.
+    The number of records held in memory at any one time is bounded by the row group size and the
+    number of chunks in flight in the pool.
+
+    This requires the pyarrow package.
+    """
+
+    formats = (u'parquet', u'arrow')
+
+    def __init__(self, config, collection, path, version=None, export_format=u'parquet',
+                 row_group_size=10000, processes=None, max_pending=None, spill_dir=None):
+        """
+        :param config: the config object
+        :param collection: the name of the mongo collection to export
+        :param path: the path of the file to write
+        :param version: the version to export the records at. If None (the default) the latest
+                        data of each record is exported and no reconstruction is necessary.
+        :param export_format: the format to write, either parquet or arrow (default: parquet)
+        :param row_group_size: the number of records in each row group (default: 10000)
+        :param processes: the number of processes to reconstruct the records with, defaults to the
+                          number of cpus
+        :param max_pending: the maximum number of chunks being reconstructed or waiting to be
+                            written at any one time, defaults to twice the number of processes
+        :param spill_dir: the directory to create the temporary row group files in, if None (the
+                          default) the system's temporary directory is used
+        """
+        if export_format not in self.formats:
+            raise ValueError(u'Unsupported export format: {}'.format(export_format))
+        self.config = config
+        self.collection = collection
+        self.path = path
+        self.version = version
+        self.export_format = export_format
+        self.row_group_size = row_group_size
+        self.processes = processes
+        self.max_pending = max_pending
+        self.spill_dir = spill_dir
+
+    def iter_mongo_docs(self):
+        """
+        Yields the mongo docs of the records which existed at or before the version. Only the fields
+        needed for reconstruction are retrieved.
+
+        :return: a generator of mongo docs
+        """
+        with get_mongo(self.config, collection=self.collection) as mongo:
+            if self.version is None:
+                cursor = mongo.find({}, projection={u'data': True, u'_id': False})
+                for mongo_doc in cursor.batch_size(self.row_group_size):
+                    yield mongo_doc
+                return
+
+            cursor = mongo.find({u'versions': {u'$lte': self.version}},
+                                projection={u'diffs': True, u'archive': True, u'data': True,
+                                            u'diff_mode': True, u'_id': False})
+            archive = None
+            try:
+                for mongo_doc in cursor.batch_size(self.row_group_size):
+                    if mongo_doc.get(u'archive', None) is not None:
+                        # the archived diffs are merged into the doc here so that the docs sent to
+                        # the reconstruction processes are self contained
+                        if archive is None:
+                            archive = SegmentArchive(self.config.archive_path)
+                        mongo_doc[u'diffs'] = archive.get_diffs(mongo_doc)
+                        del mongo_doc[u'archive']
+                    yield mongo_doc
+            finally:
+                if archive is not None:
+                    archive.close()
+
+    def iter_row_groups(self):
+        """
+        Yields lists of reconstructed records, each one no bigger than the row group size.
+
+        :return: a generator of lists of data dicts
+        """
+        chunks = chunk_iterator(self.iter_mongo_docs(), chunk_size=self.row_group_size)
+        if self.version is None:
+            for chunk in chunks:
+                records = [mongo_doc[u'data'] for mongo_doc in chunk if mongo_doc[u'data']]
+                if records:
+                    yield records
+            return
+
+        processes = self.processes or cpu_count()
+        max_pending = self.max_pending or 2 * processes
+        pool = Pool(processes=processes)
+        try:
+            buffer = []
+            tasks = ((chunk, self.version) for chunk in chunks)
+            for records in bounded_imap(pool, reconstruct_records, tasks, max_pending):
+                buffer.extend(records)
+                while len(buffer) >= self.row_group_size:
+                    yield buffer[:self.row_group_size]
+                    buffer = buffer[self.row_group_size:]
+            if buffer:
+                yield buffer
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def open_writer(self, schema):
+        """
+        Opens a writer for the export format.
+
+        :param schema: the pyarrow schema
+        :return: a writer object with write_table and close methods
+        """
+        if self.export_format == u'parquet':
+            return pyarrow.parquet.ParquetWriter(self.path, schema)
+        return pyarrow.ipc.new_file(self.path, schema)
+
+    def export(self):
+        """
+        Exports the records to the file.
+
+        :return: the number of records exported
+        """
+        if pyarrow is None:
+            raise ImportError(u'The pyarrow package is required for columnar exports')
+
+        directory = tempfile.mkdtemp(dir=self.spill_dir, prefix=u'eevee-export-')
+        try:
+            # spill each row group with its own schema, merging the schemas as we go
+            schema = None
+            paths = []
+            total = 0
+            for number, rows in enumerate(self.iter_row_groups()):
+                table = pyarrow.Table.from_pylist(rows)
+                schema = merge_schemas(schema, table.schema)
+                path = os.path.join(directory, u'{}.arrow'.format(number))
+                with pyarrow.ipc.new_file(path, table.schema) as spill_writer:
+                    spill_writer.write_table(table)
+                paths.append(path)
+                total += len(rows)
+
+            if schema is None:
+                # there were no records so there's nothing to write
+                return 0
+
+            writer = self.open_writer(schema)
+            try:
+                for path in paths:
+                    with pyarrow.memory_map(path) as source:
+                        table = pyarrow.ipc.open_file(source).read_all()
+                    writer.write_table(conform_table(table, schema))
+                    # free up the disk space as we go
+                    os.remove(path)
+            finally:
+                writer.close()
+            return total
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+
+
+def main(args=None):
+    """
+    Command line entry point for exporting an index at a version.
+
+    :param args: the command line arguments, if None then sys.argv is used
+    """
+    parser = argparse.ArgumentParser(description=u'Export an eevee index at a version')
+    parser.add_argument(u'index', help=u'the index to export (without the prefix)')
+    parser.add_argument(u'output_dir', help=u'the directory to write the export to')
+    parser.add_argument(u'--version', type=int, default=None,
+                        help=u'the version to export, defaults to the latest')
+    parser.add_argument(u'--format', dest=u'export_format', choices=Exporter.formats,
+                        default=u'jsonl', help=u'the format to export in')
+    parser.add_argument(u'--slices', type=int, default=4,
+                        help=u'the number of slices to export in parallel')
+    parser.add_argument(u'--batch-size', type=int, default=1000,
+                        help=u'the number of records to retrieve in each request')
+    parser.add_argument(u'--concatenate', action=u'store_true',
+                        help=u'concatenate the shards into a single file')
+    parser.add_argument(u'--hosts', nargs=u'+', default=None,
+                        help=u'the elasticsearch hosts to connect to')
+    parser.add_argument(u'--prefix', default=u'eevee-', help=u'the elasticsearch index prefix')
+    options = parser.parse_args(args)
+
+    config = Config(elasticsearch_hosts=options.hosts, elasticsearch_index_prefix=options.prefix)
+    exporter = Exporter(config, options.index, options.output_dir, version=options.version,
+                        export_format=options.export_format, slices=options.slices,
+                        batch_size=options.batch_size)
+    paths, total = exporter.export(concatenate=options.concatenate)
+    print(u'Exported {} records to {}'.format(total, u', '.join(paths)))
+
+
+if __name__ == u'__main__':
+    main()
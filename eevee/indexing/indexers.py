@@ -7,11 +7,14 @@ from datetime import datetime
 
 import ujson
 from blinker import Signal
+from elasticsearch import NotFoundError, ConflictError
 from elasticsearch.helpers import streaming_bulk
 from elasticsearch_dsl import Search
 
 from eevee.indexing.utils import DOC_TYPE, get_elasticsearch_client, update_refresh_interval, \
     update_number_of_replicas
+from eevee.metrics import NULL_METRICS, timed_iterator
+from eevee.search import SearchHelper
 from eevee.utils import chunk_iterator
 
 
@@ -21,7 +24,7 @@ class Indexer(object):
     """
 
     def __init__(self, version, config, feeders_and_indexes, bulk_size=2000, update_status=True,
-                 check_batch_size=1000, always_replace=False):
+                 check_batch_size=1000, always_replace=False, metrics=None):
         """
         :param version: the version we're indexing up to
         :param config: the config object
@@ -41,6 +44,8 @@ class Indexer(object):
                                can send fewer write updates to elasticsearch by leaving documents
                                alone when they haven't changed. This doesn't impact how deletes are
                                handled. (Default: False)
+        :param metrics: a Metrics object to report timings and counts to, defaults to a no-op
+                        implementation
         """
         self.version = version
         self.config = config
@@ -50,6 +55,7 @@ class Indexer(object):
         self.update_status = update_status
         self.check_batch_size = check_batch_size
         self.always_replace = always_replace
+        self.metrics = metrics if metrics is not None else NULL_METRICS
 
         self.elasticsearch = get_elasticsearch_client(self.config, sniff_on_start=True,
                                                       sniff_on_connection_fail=True,
@@ -63,7 +69,17 @@ class Indexer(object):
                                            this signal is sent are "indexed_record", "feeder",
                                            "index" and "indexing_stats" which hold the IndexedRecord
                                            object, the feeder object, the index object and an
-                                           IndexingStats object, respectively.''')
+                                           IndexingStats object, respectively. This signal is
+                                           only sent if it has receivers when indexing starts.''')
+        self.index_batch_signal = Signal(doc=u'''Triggered when a batch of records has been
+                                                 indexed, this is a lower overhead alternative to
+                                                 the index_signal. The kwargs passed when this
+                                                 signal is sent are "indexed_records", "feeder",
+                                                 "index" and "indexing_stats" which hold a list of
+                                                 the IndexedRecord objects in the batch, the feeder
+                                                 object, the index object and an IndexingStats
+                                                 object, respectively. This signal is only sent if
+                                                 it has receivers when indexing starts.''')
         self.finish_signal = Signal(doc=u'''Triggered when the processing is complete. The kwargs
                                             passed when this signal is sent are "indexing_stats" and
                                             "stats", which hold an IndexingStats object and the
@@ -86,15 +102,29 @@ class Indexer(object):
         for feeder, index in self.feeders_and_indexes:
             # create a partial of the index_signal's send function with the objects we have at
             # our disposal here, this saves us sending around a bunch of objects just so that
-            # the tasks can fire the signal
-            partial_signal = functools.partial(self.index_signal.send, self, feeder=feeder,
-                                               index=index, indexing_stats=indexing_stats)
+            # the tasks can fire the signal. Signals without receivers aren't passed at all so
+            # that the tasks don't waste time creating and sending them
+            partial_signal = None
+            if self.index_signal.receivers:
+                partial_signal = functools.partial(self.index_signal.send, self, feeder=feeder,
+                                                   index=index, indexing_stats=indexing_stats)
+            partial_batch_signal = None
+            if self.index_batch_signal.receivers:
+                partial_batch_signal = functools.partial(self.index_batch_signal.send, self,
+                                                         feeder=feeder, index=index,
+                                                         indexing_stats=indexing_stats)
             task = IndexingTask(feeder, index, partial_signal, indexing_stats, self.bulk_size,
-                                self.elasticsearch, self.check_batch_size, self.always_replace)
+                                self.elasticsearch, self.check_batch_size, self.always_replace,
+                                self.metrics, partial_batch_signal)
             task.run()
 
         # update the status index
-        self.update_statuses()
+        with self.metrics.timer(u'index.update_statuses'):
+            self.update_statuses(indexing_stats)
+        self.metrics.increment(u'index.records', indexing_stats.document_count)
+        self.metrics.increment(u'index.indexed', indexing_stats.indexed_count)
+        self.metrics.increment(u'index.deleted', indexing_stats.deleted_count)
+        self.metrics.flush()
         # generate the stats dict
         stats = self.get_stats(indexing_stats)
         # trigger the finish signal
@@ -112,7 +142,7 @@ class Indexer(object):
         """
         end = datetime.now()
         # generate and return the report dict
-        return {
+        stats = {
             u'version': self.version,
             u'versions': sorted(indexing_stats.seen_versions),
             u'sources': sorted(set(feeder.mongo_collection for feeder in self.feeders)),
@@ -122,6 +152,9 @@ class Indexer(object):
             u'duration': (end - self.start).total_seconds(),
             u'operations': indexing_stats.op_stats,
         }
+        if self.metrics.enabled:
+            stats[u'metrics'] = self.metrics.get_totals()
+        return stats
 
     def define_indexes(self):
         """
@@ -134,10 +167,21 @@ class Indexer(object):
             if not self.elasticsearch.indices.exists(index.name):
                 self.elasticsearch.indices.create(index.name, body=index.get_index_create_body())
 
-    def update_statuses(self):
+    def update_statuses(self, indexing_stats=None):
         """
-        Run through the indexes and update the statuses for each.
+        Run through the indexes and update the statuses for each. Alongside the latest version, each
+        status document holds a summary of the versions available in the index and the number of
+        changes made in each one (see get_version_summary).
+
+        :param indexing_stats: the IndexingStats object from the indexing job, the version changes
+                               it holds are used to update the version summaries. If None then the
+                               summaries are rebuilt from scratch.
         """
+        # the version summary is only ever retrieved, never searched
+        version_summary_definition = {
+            u'type': u'object',
+            u'enabled': False
+        }
         index_definition = {
             u'settings': {
                 u'index': {
@@ -158,7 +202,8 @@ class Indexer(object):
                         u'latest_version': {
                             u'type': u'date',
                             u'format': u'epoch_millis'
-                        }
+                        },
+                        u'version_summary': version_summary_definition,
                     }
                 }
             }
@@ -167,17 +212,121 @@ class Indexer(object):
         if not self.elasticsearch.indices.exists(self.config.elasticsearch_status_index_name):
             self.elasticsearch.indices.create(self.config.elasticsearch_status_index_name,
                                               body=index_definition)
+        else:
+            # status indexes created before the version summary existed need the mapping adding
+            self.elasticsearch.indices.put_mapping(DOC_TYPE, {
+                u'properties': {
+                    u'version_summary': version_summary_definition,
+                }
+            }, index=self.config.elasticsearch_status_index_name)
 
         if self.update_status:
             # use a set to avoid updating the status for an index multiple times
             for index in set(self.indexes):
-                status_doc = {
-                    u'name': index.unprefixed_name,
-                    u'index_name': index.name,
-                    u'latest_version': self.version,
-                }
+                # make sure the data we've just indexed is visible before announcing the new latest
+                # version as searchers cache information about each index until it changes
+                self.elasticsearch.indices.refresh(index.name)
+                version_changes = None
+                if indexing_stats is not None:
+                    version_changes = indexing_stats.version_changes[index.name]
+                self.update_status_doc(index, version_changes)
+
+    def update_status_doc(self, index, version_changes=None):
+        """
+        Updates the status document for the given index. The current status document is read, a new
+        one is created using it and then written back on the condition that the current document
+        hasn't been changed in the meantime by another indexer. If it has, the whole process is
+        retried.
+
+        :param index: the index object
+        :param version_changes: a Counter of version -> change in the number of index documents at
+                                that version, optional
+        """
+        while True:
+            try:
+                status = self.elasticsearch.get(self.config.elasticsearch_status_index_name,
+                                                DOC_TYPE, index.name)
+                # only write if the status hasn't been changed since we read it
+                conditions = dict(version=status[u'_version'])
+            except NotFoundError:
+                status = None
+                # only write if no one else has created the status since we checked
+                conditions = dict(op_type=u'create')
+
+            status_doc = {
+                u'name': index.unprefixed_name,
+                u'index_name': index.name,
+                u'latest_version': self.version,
+                u'version_summary': self.get_version_summary(index, status, version_changes),
+            }
+            try:
                 self.elasticsearch.index(self.config.elasticsearch_status_index_name, DOC_TYPE,
-                                         status_doc, id=index.name)
+                                         status_doc, id=index.name, **conditions)
+                return
+            except ConflictError:
+                # another indexer has updated the status since we read it, try again
+                continue
+
+    def get_version_summary(self, index, status=None, version_changes=None):
+        """
+        Returns the summary of the versions available in the given index. This is a dict containing
+        the latest version the summary is correct for, the total number of documents in the index
+        and a list of dicts in ascending version order, each containing a version and the number of
+        index documents at that version. The list has the same structure as the one returned by
+        SearchHelper.get_index_version_counts:
+
+            {
+                "latest_version": <version>,
+                "total": <number of documents>,
+                "versions": [
+                    {
+                        "version": <version>,
+                        "changes": <number of changes>
+                    },
+                    ...
+                ]
+            }
+
+        If the index's current status document contains a summary which was current as of that
+        status and version changes are passed then the summary is updated with the changes. The
+        updated summary is then checked against the number of documents in the index and if it
+        doesn't match (because the index has been modified without the summary being updated, for
+        example by indexing without updating the status) or there is no summary to update, the
+        summary is created from scratch by aggregating over the whole index.
+
+        :param index: the index object
+        :param status: the response from elasticsearch when the current status document was
+                       retrieved, optional
+        :param version_changes: a Counter of version -> change in the number of index documents at
+                                that version, optional
+        :return: a dict
+        """
+        if status is not None and version_changes is not None:
+            source = status[u'_source']
+            summary = source.get(u'version_summary', None)
+            # the summary can only be updated if it was current as of the last status update
+            if summary is not None and summary[u'latest_version'] == source[u'latest_version']:
+                counts = Counter({entry[u'version']: entry[u'changes']
+                                  for entry in summary[u'versions']})
+                counts.update(version_changes)
+                versions = [{u'version': version, u'changes': changes}
+                            for version, changes in sorted(counts.items()) if changes > 0]
+                total = sum(entry[u'changes'] for entry in versions)
+                if total == Search(using=self.elasticsearch, index=index.name).count():
+                    return {
+                        u'latest_version': self.version,
+                        u'total': total,
+                        u'versions': versions,
+                    }
+
+        # there's no summary we can update so create one
+        search_helper = SearchHelper(self.config, client=self.elasticsearch)
+        versions = search_helper.get_index_version_counts(index.name)
+        return {
+            u'latest_version': self.version,
+            u'total': sum(entry[u'changes'] for entry in versions),
+            u'versions': versions,
+        }
 
 
 class IndexingTask:
@@ -186,12 +335,12 @@ class IndexingTask:
     """
 
     def __init__(self, feeder, index, partial_signal, indexing_stats, bulk_size, elasticsearch,
-                 check_batch_size, always_replace):
+                 check_batch_size, always_replace, metrics=None, partial_batch_signal=None):
         """
         :param feeder: the feeder object to get the mongo documents from
         :param index: the index object to get the index documents from
         :param partial_signal: a partial function which we can use to send the index signal from the
-                               parent indexer
+                               parent indexer, or None if the signal shouldn't be sent
         :param indexing_stats: an IndexingStats object to store stats on about the whole indexing
                                job, not just this task
         :param bulk_size: the number of index requests to send in each bulk request
@@ -205,6 +354,11 @@ class IndexingTask:
                                can send fewer write updates to elasticsearch by leaving documents
                                alone when they haven't changed. This doesn't impact how deletes are
                                handled.
+        :param metrics: a Metrics object to report timings to, defaults to a no-op implementation
+        :param partial_batch_signal: a partial function which we can use to send the index batch
+                                     signal from the parent indexer, or None (the default) if the
+                                     signal shouldn't be sent. Batches are sent every
+                                     check_batch_size indexed records and when the task completes.
         """
         self.feeder = feeder
         self.index = index
@@ -214,9 +368,35 @@ class IndexingTask:
         self.bulk_size = bulk_size
         self.elasticsearch = elasticsearch
         self.always_replace = always_replace
+        self.metrics = metrics if metrics is not None else NULL_METRICS
+        self.partial_batch_signal = partial_batch_signal
 
         # this is used to track the records that are currently being indexed
         self.indexed_records = {}
+        # the completed records waiting to be sent with the batch signal
+        self.completed_batch = []
+
+    def record_indexed(self, indexed_record):
+        """
+        Called when a record has been completely indexed, updates the stats and sends the signals.
+
+        :param indexed_record: the IndexedRecord object
+        """
+        self.indexing_stats.update(self.index.name, indexed_record)
+        if self.partial_signal is not None:
+            self.partial_signal(indexed_record=indexed_record)
+        if self.partial_batch_signal is not None:
+            self.completed_batch.append(indexed_record)
+            if len(self.completed_batch) >= self.check_batch_size:
+                self.send_completed_batch()
+
+    def send_completed_batch(self):
+        """
+        Sends the batch signal for the completed records waiting to be sent, if there are any.
+        """
+        if self.completed_batch:
+            self.partial_batch_signal(indexed_records=self.completed_batch)
+            self.completed_batch = []
 
     def is_clean_index(self):
         """
@@ -309,9 +489,11 @@ class IndexingTask:
         """
         is_clean = self.is_clean_index()
 
-        for mongo_docs in chunk_iterator(self.feeder.documents(), self.check_batch_size):
+        documents = timed_iterator(self.metrics, u'index.feeder_read', self.feeder.documents())
+        for mongo_docs in chunk_iterator(documents, self.check_batch_size):
             # retrieve the currently indexed documents from elasticsearch for this batch
-            indexed_docs = self.get_indexed_documents(mongo_docs, is_clean)
+            with self.metrics.timer(u'index.existence_check'):
+                indexed_docs = self.get_indexed_documents(mongo_docs, is_clean)
 
             for mongo_doc in mongo_docs:
                 # cache the record's id
@@ -319,7 +501,8 @@ class IndexingTask:
 
                 # generate the index documents for this mongo doc. Each element is a 2-tuple
                 # (version, dict to index). We wrap it in a list as it's a generator
-                to_index = list(self.index.get_index_docs(mongo_doc))
+                with self.metrics.timer(u'index.generate_docs'):
+                    to_index = list(self.index.get_index_docs(mongo_doc))
                 # retrieve any existing indexed documents for this record (this is safe because
                 # indexed_docs is a defaultdict)
                 indexed = indexed_docs[record_id]
@@ -340,9 +523,9 @@ class IndexingTask:
                     for op in itertools.chain(index_ops, delete_ops):
                         yield op
                 else:
-                    # update the stats and send the index signal as we didn't have to do anything
-                    self.indexing_stats.update(self.index.name, indexed_record)
-                    self.partial_signal(indexed_record=indexed_record)
+                    # update the stats and send the index signals as we didn't have to do
+                    # anything
+                    self.record_indexed(indexed_record)
 
     def expand_for_index(self, id_and_data):
         """
@@ -381,7 +564,10 @@ class IndexingTask:
 
             # we can ignore the success value as if there is a problem streaming_bulk will raise an
             # exception
-            for _success, info in streaming_bulk(client=self.elasticsearch,
+            client = self.elasticsearch
+            if self.metrics.enabled:
+                client = TimedBulkClient(client, self.metrics)
+            for _success, info in streaming_bulk(client=client,
                                                  actions=self.index_doc_iterator(),
                                                  expand_action_callback=self.expand_for_index,
                                                  chunk_size=self.bulk_size,
@@ -405,13 +591,13 @@ class IndexingTask:
                     continue
 
                 # if we get here the record from which this operation result came from is completely
-                # indexed, first update some stats
-                self.indexing_stats.update(self.index.name, indexed_record)
-                # send a single signal with all the details
-                self.partial_signal(indexed_record=indexed_record)
+                # indexed, update the stats and send the signals
+                self.record_indexed(indexed_record)
                 # remove the indexed record from the history (we don't need it anymore and need
                 # to avoid running out of memory)
                 del self.indexed_records[record_id]
+            if self.partial_batch_signal is not None:
+                self.send_completed_batch()
         finally:
             # set the refresh interval back to the default
             update_refresh_interval(self.elasticsearch, [self.index], None)
@@ -419,6 +605,29 @@ class IndexingTask:
             update_number_of_replicas(self.elasticsearch, [self.index], self.index.replicas)
 
 
+class TimedBulkClient(object):
+    """
+    Wrapper around an elasticsearch client which times each bulk request made through it and
+    records the size of the requests. Everything else is passed straight through to the client.
+    """
+
+    def __init__(self, client, metrics):
+        """
+        :param client: the elasticsearch client
+        :param metrics: the Metrics object to report to
+        """
+        self.client = client
+        self.metrics = metrics
+
+    def bulk(self, body, *args, **kwargs):
+        self.metrics.observe(u'index.bulk_send_bytes', len(body))
+        with self.metrics.timer(u'index.bulk_send'):
+            return self.client.bulk(body, *args, **kwargs)
+
+    def __getattr__(self, item):
+        return getattr(self.client, item)
+
+
 class IndexedRecord:
     """
     Represents a record that is being indexed/has been indexed.
@@ -473,6 +682,26 @@ class IndexedRecord:
         return (len(self.index_results) == self.index_op_count and
                 len(self.delete_results) == self.delete_op_count)
 
+    def get_version_changes(self):
+        """
+        Works out how the number of documents in the index at each version has changed as a result
+        of the bulk operations run for this record.
+
+        :return: a Counter of version -> change in the number of documents (can be negative)
+        """
+        changes = Counter()
+        for index_document_number, details in self.index_results.items():
+            existing_document = self.existing_documents.get(str(index_document_number), None)
+            if details[u'result'] == u'updated' and existing_document is not None:
+                # the existing document has been replaced so it no longer counts
+                changes[existing_document[u'meta'][u'version']] -= 1
+            changes[self.index_documents[index_document_number][0]] += 1
+        for index_document_number, details in self.delete_results.items():
+            existing_document = self.existing_documents.get(str(index_document_number), None)
+            if details[u'result'] == u'deleted' and existing_document is not None:
+                changes[existing_document[u'meta'][u'version']] -= 1
+        return changes
+
     @property
     def is_new(self):
         """
@@ -530,6 +759,9 @@ class IndexingStats:
         self.op_stats = defaultdict(Counter)
         # a set of version numbers that have been seen during the indexing job
         self.seen_versions = set()
+        # a default dict of Counter objects, where each key is a prefixed index name and each value
+        # is a Counter of the change in the number of documents in the index at each version
+        self.version_changes = defaultdict(Counter)
 
     def update(self, target_index_name, indexed_record):
         """
@@ -546,3 +778,4 @@ class IndexingStats:
         if indexed_record.stats:
             self.op_stats[target_index_name].update(indexed_record.stats)
         self.seen_versions.update(indexed_record.get_versions())
+        self.version_changes[target_index_name].update(indexed_record.get_version_changes())
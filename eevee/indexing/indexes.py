@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 # encoding: utf-8
 
+from eevee.archive import SegmentArchive
 from eevee.indexing.utils import get_versions_and_data, DOC_TYPE
 
 
@@ -9,6 +10,12 @@ class Index(object):
     Represents an index in elasticsearch.
     """
 
+    # whether to replay each record's versions using copy on write data (see
+    # get_versions_and_data). This means the data passed to create_data and the other document
+    # creation methods is read only, subclasses which need to modify it in place should either use
+    # eevee.utils.thaw to get a mutable copy or set this to False
+    copy_on_write = True
+
     def __init__(self, config, name, version, shards=5, replicas=1):
         """
         :param config: the config object
@@ -33,6 +40,18 @@ class Index(object):
         self.version = version
         self.shards = shards
         self.replicas = replicas
+        self.archive = None
+
+    def get_archive(self):
+        """
+        Returns the SegmentArchive to read archived diffs from, or None if the config doesn't
+        specify an archive path. The archive is created on first use.
+
+        :return: a SegmentArchive object or None
+        """
+        if self.archive is None and self.config.archive_path is not None:
+            self.archive = SegmentArchive(self.config.archive_path)
+        return self.archive
 
     def get_index_docs(self, mongo_doc):
         """
@@ -42,8 +61,11 @@ class Index(object):
         :param mongo_doc: the mongo doc to handle
         :return: yields a 2-tuple of version and data dict for indexing
         """
+        # only records with archived diffs need the archive
+        archive = self.get_archive() if mongo_doc.get(u'archive', None) is not None else None
         # iterate over the mongo_docs versions and send them to elasticsearch
-        for version, data, next_version in get_versions_and_data(mongo_doc, in_place=False):
+        for version, data, next_version in get_versions_and_data(
+                mongo_doc, in_place=False, archive=archive, copy_on_write=self.copy_on_write):
             yield version, self.create_index_document(data, version, next_version)
 
     def create_index_document(self, data, version, next_version):
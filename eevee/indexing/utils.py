@@ -3,13 +3,14 @@
 
 from elasticsearch import Elasticsearch, NotFoundError
 
-from eevee.diffing import extract_diff
-from eevee.utils import iter_pairs
+from eevee.diffing import extract_diff, get_diff_mode, REVERSE
+from eevee.utils import iter_pairs, ReadOnlyDict, freeze, thaw
 
 DOC_TYPE = u'_doc'
 
 
-def get_versions_and_data(mongo_doc, future_next_version=float(u'inf'), in_place=False):
+def get_versions_and_data(mongo_doc, future_next_version=float(u'inf'), in_place=False,
+                          archive=None, copy_on_write=False, latest_first=False):
     """
     Returns a generator which will yield, in order, the version, data and next version from the
     given record as a 3=tuple in that order. The next version is provided for convenience. The last
@@ -20,30 +21,102 @@ def get_versions_and_data(mongo_doc, future_next_version=float(u'inf'), in_place
     therefore cannot be modified in case this causes a diff failure. If you need to modify the data
     between iterations make a copy.
 
+    If copy_on_write is True the data yielded for each version is read only (see
+    eevee.utils.freeze) and shares all the nested dicts and lists that haven't changed with the data
+    yielded for the previous version. This avoids deep copying the data for every version whilst
+    still allowing the data for each version to be kept. Use eevee.utils.thaw to get a mutable copy.
+
+    Records stored in either diff mode (see eevee.diffing) are supported. Forward mode records are
+    cheapest to replay from the first version and reverse mode records from the latest version. If
+    the order requested with the latest_first parameter isn't the cheapest order for the record
+    then all the versions are replayed in the cheapest order and held in memory before being
+    yielded, in which case the in_place parameter is ignored.
+
     :param mongo_doc: the mongo doc
     :param future_next_version: the value yielded in the 3-tuple when the last version is yielded,
                                 defaults to +infinity
     :param in_place: if true then the returned data is updated in place each time through, if False
                      (the default) then the data returned is a new object each time through
+    :param archive: the SegmentArchive to read the record's archived diffs from, this is required
+                    if the record has any archived diffs
+    :param copy_on_write: if True then the data returned is read only and shares unchanged data
+                          with the previous version's data (default: False). This can't be used
+                          with in_place.
+    :param latest_first: if True the versions are yielded in descending order rather than
+                         ascending, note that the next version yielded alongside each version is
+                         still the version after it
     :return: a generator
     """
+    if in_place and copy_on_write:
+        raise ValueError(u'The in_place and copy_on_write options cannot be used together')
+
+    diffs = mongo_doc[u'diffs']
+    if mongo_doc.get(u'archive', None) is not None:
+        if archive is None:
+            raise ValueError(u'Record {} has archived diffs but no archive was provided'.format(
+                mongo_doc.get(u'id', None)))
+        diffs = archive.get_diffs(mongo_doc)
+
+    versions = sorted(int(version) for version in diffs)
+    reverse = get_diff_mode(mongo_doc) == REVERSE
+    # the versions must be held in memory if the order requested doesn't match the replay order
+    # and therefore each version's data must be a separate object
+    streaming = reverse == latest_first
+    in_place = in_place and streaming
+
+    if reverse:
+        replay = _replay_reverse(mongo_doc[u'data'], diffs, versions, future_next_version,
+                                 in_place, copy_on_write)
+    else:
+        replay = _replay_forward(diffs, versions, future_next_version, in_place, copy_on_write)
+
+    if streaming:
+        for version_and_data in replay:
+            yield version_and_data
+    else:
+        for version_and_data in reversed(list(replay)):
+            yield version_and_data
+
+
+def _patch(differ, diff, data, in_place, copy_on_write):
+    if copy_on_write:
+        return differ.patch_shared(diff, data)
+    return differ.patch(diff, data, in_place=in_place)
+
+
+def _replay_forward(diffs, versions, future_next_version, in_place, copy_on_write):
     # this variable will hold the actual data of the record and will be updated with the diffs as we
     # go through them. It is important, therefore, that it starts off as an empty dict because this
     # is the starting point assumed by the ingestion code when creating a records first diff
-    data = {}
+    data = ReadOnlyDict() if copy_on_write else {}
     # iterate over the versions
-    for version, next_version in iter_pairs(sorted(int(version) for version in mongo_doc[u'diffs']),
-                                            final_partner=future_next_version):
+    for version, next_version in iter_pairs(versions, final_partner=future_next_version):
         # retrieve the diff for the version
-        raw_diff = mongo_doc[u'diffs'][str(version)]
+        raw_diff = diffs[str(version)]
         # extract the differ used and the diff object itself
         differ, diff = extract_diff(raw_diff)
         # patch the data
-        data = differ.patch(diff, data, in_place=in_place)
+        data = _patch(differ, diff, data, in_place, copy_on_write)
         # yield the version, data and next version
         yield version, data, next_version
 
 
+def _replay_reverse(latest_data, diffs, versions, future_next_version, in_place, copy_on_write):
+    # start with a copy of the latest data so that the mongo doc isn't modified
+    data = freeze(latest_data) if copy_on_write else thaw(latest_data)
+    next_version = None
+    for version in reversed(versions):
+        if next_version is None:
+            yield version, data, future_next_version
+        else:
+            # patch the next version's data back to this version's data using the next version's
+            # diff
+            differ, diff = extract_diff(diffs[str(next_version)])
+            data = _patch(differ, diff, data, in_place, copy_on_write)
+            yield version, data, next_version
+        next_version = version
+
+
 def get_elasticsearch_client(config, **kwargs):
     """
     Returns an elasticsearch client created using the hosts attribute of the passed config object.
@@ -0,0 +1,259 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import os
+import shutil
+import tempfile
+from collections import defaultdict, Counter, OrderedDict
+from datetime import datetime
+
+from pymongo import InsertOne, ReplaceOne
+from six.moves import cPickle as pickle
+
+from eevee import utils
+from eevee.ingestion.ingesters import ensure_mongo_indexes_exist, ensure_diff_mode
+from eevee.mongo import get_mongo
+
+
+def apply_update(mongo_doc, update):
+    """
+    Applies the given mongo update document to the mongo doc in memory. Only the $set and $addToSet
+    operators used by the RecordToMongoConverter's for_update function are supported. $set keys
+    can use mongo's dot notation to refer to nested fields.
+
+    :param mongo_doc: the mongo doc to update, this is modified in place
+    :param update: the update document
+    """
+    for key, value in update.get(u'$set', {}).items():
+        target = mongo_doc
+        parts = key.split(u'.')
+        for part in parts[:-1]:
+            target = target.setdefault(part, {})
+        target[parts[-1]] = value
+    for key, value in update.get(u'$addToSet', {}).items():
+        values = mongo_doc.setdefault(key, [])
+        if value not in values:
+            values.append(value)
+
+
+class BackfillIngester(object):
+    """
+    Ingests several versions of a source into mongo in a single pass. Rather than running a full
+    ingestion for each version, which would read and rewrite every record's mongo document once
+    per version, the records from all the versions are grouped by id and each record's versions and
+    diffs chain is built in memory before being written to mongo once.
+
+    To keep memory usage bounded, the records read from the feeders are first spilled to disk in
+    hash partitions based on their ids and then each partition is loaded and processed in turn. This
+    means the records produced by the feeders must be picklable.
+
+    The resulting mongo documents are the same as the ones that would be produced by ingesting each
+    version in order with the Ingester with one exception: if a record id appears more than once in
+    a single version, only the first record is used.
+    """
+
+    def __init__(self, versions_and_feeders, converter_factory, config, chunk_size=1000,
+                 partitions=64, spill_dir=None, insert_op_name=u'inserted',
+                 update_op_name=u'updated'):
+        """
+        :param versions_and_feeders: a list of 2-tuples containing a version and the feeder object
+                                     to get the records for that version from
+        :param converter_factory: a function which takes a version and returns the object to use to
+                                  convert the records in that version to dicts ready for storage in
+                                  mongo (e.g. a RecordToMongoConverter)
+        :param config: the config object
+        :param chunk_size: the number of record ids to look up and write to mongo at a time
+        :param partitions: the number of partitions to spill the records into, the more partitions
+                           there are the less memory is needed to process each one (default: 64)
+        :param spill_dir: the directory to create the temporary partition files in, if None (the
+                          default) the system's temporary directory is used
+        :param insert_op_name: the name of the insert operation (for stats)
+        :param update_op_name: the name of the update operation (for stats)
+        """
+        self.versions_and_feeders = sorted(versions_and_feeders, key=lambda pair: pair[0])
+        self.converters = {version: converter_factory(version)
+                           for version, _feeder in self.versions_and_feeders}
+        self.config = config
+        self.chunk_size = chunk_size
+        self.partitions = partitions
+        self.spill_dir = spill_dir
+        self.insert_op_name = insert_op_name
+        self.update_op_name = update_op_name
+        self.seen_collections = set()
+        self.start = datetime.now()
+
+    def ensure_mongo_indexes_exist(self, mongo_collection):
+        """
+        Ensures the indexes eevee needs exist on the given collection. This function is only called
+        the first time a collection is encountered during ingestion.
+
+        :param mongo_collection: the name of the mongo collection to add the indexes to
+        """
+        ensure_mongo_indexes_exist(self.config, mongo_collection)
+
+    def ensure_diff_mode(self, mongo_collection):
+        """
+        Ensures the given collection uses the converters' diff mode, see ensure_diff_mode. This
+        function is only called the first time a collection is encountered during ingestion.
+
+        :param mongo_collection: the name of the mongo collection
+        """
+        for diff_mode in set(converter.diff_mode for converter in self.converters.values()):
+            ensure_diff_mode(self.config, mongo_collection, diff_mode)
+
+    def get_partition(self, record_id):
+        """
+        Returns the partition the given record id belongs in.
+
+        :param record_id: the record's id
+        :return: the partition number
+        """
+        return utils.stable_partition(record_id, self.partitions)
+
+    def spill(self, directory):
+        """
+        Reads the records from all the feeders in version order and writes them to the partition
+        files in the given directory.
+
+        :param directory: the directory to write the partition files in
+        :return: the paths of the partition files
+        """
+        paths = [os.path.join(directory, u'{}.pickle'.format(number))
+                 for number in range(self.partitions)]
+        partition_files = [open(path, u'wb') for path in paths]
+        try:
+            for version, feeder in self.versions_and_feeders:
+                for record in feeder.read():
+                    partition_file = partition_files[self.get_partition(record.id)]
+                    pickle.dump((version, record), partition_file, pickle.HIGHEST_PROTOCOL)
+        finally:
+            for partition_file in partition_files:
+                partition_file.close()
+        return paths
+
+    @staticmethod
+    def read_partition(path):
+        """
+        Reads the records in the given partition file and groups them by collection and id.
+
+        :param path: the path of the partition file
+        :return: a dict of collection names -> OrderedDicts of record ids -> OrderedDicts of
+                 versions -> records, the versions are in ascending order
+        """
+        groups = defaultdict(OrderedDict)
+        with open(path, u'rb') as partition_file:
+            while True:
+                try:
+                    version, record = pickle.load(partition_file)
+                except EOFError:
+                    break
+                versions = groups[record.mongo_collection].setdefault(record.id, OrderedDict())
+                # only the first record for an id in each version is used
+                versions.setdefault(version, record)
+        return groups
+
+    def build_mongo_doc(self, mongo_doc, versions, op_stats, collection):
+        """
+        Applies each version of a record to its mongo doc in version order, exactly as the Ingester
+        would, and returns the result.
+
+        :param mongo_doc: the record's current mongo doc or None if it isn't in mongo yet
+        :param versions: an OrderedDict of versions -> records in ascending version order
+        :param op_stats: a dict of versions -> collections -> Counters to add the stats to
+        :param collection: the name of the collection the record is in
+        :return: a 2-tuple containing the mongo doc (or None if no doc should exist) and a boolean
+                 indicating whether the doc has changed
+        """
+        changed = False
+        for version, record in versions.items():
+            converter = self.converters[version]
+            if mongo_doc is None:
+                mongo_doc = converter.for_insert(record)
+                if mongo_doc is not None:
+                    changed = True
+                    op_stats[version][collection][self.insert_op_name] += 1
+            else:
+                update_doc = converter.for_update(record, mongo_doc)
+                if update_doc:
+                    apply_update(mongo_doc, update_doc)
+                    changed = True
+                    op_stats[version][collection][self.update_op_name] += 1
+        return mongo_doc, changed
+
+    def ingest_partition(self, path, op_stats):
+        """
+        Ingests the records in the given partition file into mongo.
+
+        :param path: the path of the partition file
+        :param op_stats: a dict of versions -> collections -> Counters to add the stats to
+        """
+        for collection, records in self.read_partition(path).items():
+            if collection not in self.seen_collections:
+                self.seen_collections.add(collection)
+                self.ensure_diff_mode(collection)
+                self.ensure_mongo_indexes_exist(collection)
+
+            with get_mongo(self.config, self.config.mongo_database, collection) as mongo:
+                for record_ids in utils.chunk_iterator(records.keys(), self.chunk_size):
+                    filter_query = {u'id': {u'$in': record_ids}}
+                    current_docs = {doc[u'id']: doc for doc in mongo.find(filter_query)}
+
+                    operations = []
+                    for record_id in record_ids:
+                        versions = records[record_id]
+                        current_doc = current_docs.get(record_id, None)
+                        mongo_doc, changed = self.build_mongo_doc(current_doc, versions, op_stats,
+                                                                  collection)
+                        if not changed:
+                            continue
+                        if current_doc is None:
+                            operations.append(InsertOne(mongo_doc))
+                        else:
+                            operations.append(ReplaceOne({u'id': record_id}, mongo_doc))
+
+                    if operations:
+                        # each operation acts on a different id so the order doesn't matter
+                        mongo.bulk_write(operations, ordered=False)
+
+    def get_stats(self, op_stats):
+        """
+        Returns the statistics of a completed backfill as a list of dicts, one per version, in the
+        same form as the stats produced by the Ingester for each version.
+
+        :param op_stats: a dict of versions -> collections -> Counters
+        :return: a list of dicts
+        """
+        end = datetime.now()
+        stats = []
+        for version, feeder in self.versions_and_feeders:
+            operations = {collection: dict(counter)
+                          for collection, counter in op_stats[version].items()}
+            stats.append({
+                u'version': version,
+                u'source': feeder.source,
+                u'targets': sorted(operations.keys()),
+                u'ingestion_time': self.converters[version].ingestion_time,
+                u'start': self.start,
+                u'end': end,
+                u'duration': (end - self.start).total_seconds(),
+                u'operations': operations,
+                u'differs': dict(self.converters[version].differ_counts),
+            })
+        return stats
+
+    def ingest(self):
+        """
+        Ingests all the records from all the feeders into mongo.
+
+        :return: a list of stats dicts, one per version
+        """
+        op_stats = defaultdict(lambda: defaultdict(Counter))
+        directory = tempfile.mkdtemp(dir=self.spill_dir, prefix=u'eevee-backfill-')
+        try:
+            for path in self.spill(directory):
+                self.ingest_partition(path, op_stats)
+                # free up the disk space as we go
+                os.remove(path)
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+        return self.get_stats(op_stats)
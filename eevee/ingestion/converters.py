@@ -1,7 +1,169 @@
 #!/usr/bin/env python
 # encoding: utf-8
 
-from eevee.diffing import DICT_DIFFER_DIFFER, SHALLOW_DIFFER, format_diff
+import timeit
+from collections import Counter, OrderedDict
+
+from bson import BSON
+
+from eevee.diffing import DICT_DIFFER_DIFFER, SHALLOW_DIFFER, format_diff, get_diff_mode, FORWARD, \
+    REVERSE, DIFF_MODES
+from eevee.metrics import NULL_METRICS
+from eevee.utils import freeze
+
+
+def get_shape(data):
+    """
+    Returns the shape of the given data, that is the set of its top level keys along with the types
+    of their values.
+
+    :param data: the data dict
+    :return: a frozenset of 2-tuples
+    """
+    return frozenset(zip(data.keys(), map(type, data.values())))
+
+
+def stored_diff_size(differ, diff, codec=None):
+    """
+    Returns the number of bytes the given diff would take up when stored in mongo.
+
+    :param differ: the differ that produced the diff
+    :param diff: the diff
+    :param codec: the DiffCodec the diff will be encoded with, if any
+    :return: the size in bytes
+    """
+    return len(BSON.encode({u'd': format_diff(differ, diff, codec)}))
+
+
+def default_diff_cost(size, patch_seconds):
+    """
+    The default cost function used by the AdaptiveDifferSelector, this treats each byte of storage
+    as costing the same as each microsecond spent patching.
+
+    :param size: the size of the stored diff in bytes
+    :param patch_seconds: the number of seconds taken to patch the old data with the diff
+    :return: the cost
+    """
+    return size + patch_seconds * 1000000
+
+
+class FirstMatchSelector(object):
+    """
+    Selects the differ to use for each diff by choosing the first one in a list that can diff the
+    new data.
+    """
+
+    def __init__(self, differs):
+        """
+        :param differs: the list of differs to choose from, in order of preference
+        """
+        self.differs = differs
+
+    def diff(self, old, new):
+        """
+        Chooses a differ and diffs the given data with it.
+
+        :param old: the old data
+        :param new: the new data
+        :return: a 2-tuple of the differ chosen and the diff
+        """
+        differ = next(differ for differ in self.differs if differ.can_diff(new))
+        return differ, differ.diff(old, new)
+
+
+class AdaptiveDifferSelector(object):
+    """
+    Selects the differ to use for each diff based on the cost of the diffs each differ produces,
+    where the cost is a function of the diff's stored size and the time it takes to patch with.
+
+    The choice is cached by the shape of the new data (see get_shape). The first time a shape is
+    seen, and then every sample_interval diffs of that shape after that, every differ that can diff
+    the data is used and the resulting diffs are measured. The cheapest differ is then used for the
+    shape until it is next sampled. As the differs that can diff a record are worked out once per
+    shape, the differs' can_diff functions must only depend on the data's shape, which is true of
+    the differs provided by eevee.
+    """
+
+    def __init__(self, differs=None, cost=default_diff_cost, sample_interval=1000, codec=None,
+                 size_of=stored_diff_size, max_shapes=10000):
+        """
+        :param differs: the differs to choose from, defaults to [ShallowDiffer(),
+                        DictDifferDiffer()]
+        :param cost: a function which takes the stored size of a diff in bytes and the number of
+                     seconds it took to patch with and returns its cost, defaults to
+                     default_diff_cost
+        :param sample_interval: the number of diffs of each shape between samples (default: 1000)
+        :param codec: the DiffCodec the diffs will be stored with, this is used when measuring the
+                      diffs' sizes
+        :param size_of: a function which takes a differ, a diff and a codec and returns the diff's
+                        stored size in bytes, defaults to stored_diff_size
+        :param max_shapes: the maximum number of shapes to cache choices for, when this is exceeded
+                           the oldest shape is forgotten (default: 10000)
+        """
+        self.differs = differs if differs is not None else [SHALLOW_DIFFER, DICT_DIFFER_DIFFER]
+        self.cost = cost
+        self.sample_interval = sample_interval
+        self.codec = codec
+        self.size_of = size_of
+        self.max_shapes = max_shapes
+        # shape -> [candidate differs, chosen differ, diffs since the last sample]
+        self.shapes = OrderedDict()
+        self.samples = 0
+
+    def sample(self, candidates, old, new):
+        """
+        Diffs the data with each of the candidate differs and returns the cheapest one along with
+        its diff. The patch time is measured using patch_shared on a frozen copy of the old data,
+        which is made before any timing starts, so that the time taken to copy the old data isn't
+        counted against the differs.
+
+        :param candidates: the differs to try
+        :param old: the old data
+        :param new: the new data
+        :return: a 2-tuple of the differ chosen and the diff
+        """
+        self.samples += 1
+        best = None
+        frozen_old = freeze(old)
+        for differ in candidates:
+            diff = differ.diff(old, new)
+            start = timeit.default_timer()
+            differ.patch_shared(diff, frozen_old)
+            patch_seconds = timeit.default_timer() - start
+            cost = self.cost(self.size_of(differ, diff, self.codec), patch_seconds)
+            if best is None or cost < best[0]:
+                best = (cost, differ, diff)
+        return best[1], best[2]
+
+    def diff(self, old, new):
+        """
+        Chooses a differ and diffs the given data with it.
+
+        :param old: the old data
+        :param new: the new data
+        :return: a 2-tuple of the differ chosen and the diff
+        """
+        shape = get_shape(new)
+        entry = self.shapes.get(shape, None)
+        if entry is None:
+            candidates = [differ for differ in self.differs if differ.can_diff(new)]
+            if len(self.shapes) >= self.max_shapes:
+                self.shapes.popitem(last=False)
+            entry = self.shapes[shape] = [candidates, None, 0]
+
+        candidates, differ, count = entry
+        if len(candidates) == 1:
+            # there's no choice to make
+            return candidates[0], candidates[0].diff(old, new)
+
+        if differ is None or count >= self.sample_interval:
+            differ, diff = self.sample(candidates, old, new)
+            entry[1] = differ
+            entry[2] = 0
+            return differ, diff
+
+        entry[2] += 1
+        return differ, differ.diff(old, new)
 
 
 class RecordToMongoConverter(object):
@@ -9,7 +171,8 @@ class RecordToMongoConverter(object):
     This class provides functions to convert a record into a document to be inserted into mongo.
     """
 
-    def __init__(self, version, ingestion_time, differs=None):
+    def __init__(self, version, ingestion_time, differs=None, metrics=None, codec=None,
+                 selector=None, diff_mode=FORWARD):
         """
         :param version: the current version
         :param ingestion_time: the time of the ingestion operation which will be attached to all
@@ -18,7 +181,18 @@ class RecordToMongoConverter(object):
                         data. When diffing the list is iterated through in order and the first
                         differ to return True from the can_diff function is used.
                         If None then the default is used: [ShallowDiffer(), DictDifferDiffer()].
+        :param metrics: a Metrics object to report the time taken to convert and diff records to,
+                        defaults to a no-op implementation
+        :param codec: a DiffCodec object to encode the diffs with before they are stored, defaults
+                      to None in which case the diffs are stored as is
+        :param selector: the object which chooses the differ to use for each diff, for example an
+                         AdaptiveDifferSelector. Defaults to a FirstMatchSelector using the differs.
+        :param diff_mode: the diff mode to store new records in, either FORWARD (the default) or
+                          REVERSE (see eevee.diffing). Existing records are always updated in the
+                          mode they were created in.
         """
+        if diff_mode not in DIFF_MODES:
+            raise ValueError(u'Unknown diff mode: {}'.format(diff_mode))
         self.version = version
         self._ingestion_time = ingestion_time
         if differs is None:
@@ -26,6 +200,12 @@ class RecordToMongoConverter(object):
             self.differs = [SHALLOW_DIFFER, DICT_DIFFER_DIFFER]
         else:
             self.differs = differs
+        self.metrics = metrics if metrics is not None else NULL_METRICS
+        self.codec = codec
+        self.diff_mode = diff_mode
+        self.selector = selector if selector is not None else FirstMatchSelector(self.differs)
+        # the number of diffs produced by each differ, keyed by differ id
+        self.differ_counts = Counter()
 
     @property
     def ingestion_time(self):
@@ -49,24 +229,42 @@ class RecordToMongoConverter(object):
         :param new_data: the data as it is now
         :return: a tuple
         """
-        # figure out which differ to use
-        differ = next(differ for differ in self.differs if differ.can_diff(new_data))
-        # diff the data with the chosen differ
-        diff = differ.diff(existing_data, new_data)
+        # choose a differ and diff the data with it
+        with self.metrics.timer(u'ingest.diff'):
+            differ, diff = self.selector.diff(existing_data, new_data)
+        if diff:
+            self.differ_counts[differ.differ_id] += 1
         # return a tuple indicating if the data changed, the differ chosen and the diff
         return bool(diff), differ, diff
 
-    def for_insert(self, record):
+    def convert(self, record):
+        """
+        Converts the given record to the dict of data that will be stored in mongo.
+
+        :param record: the record
+        :return: a dict
+        """
+        # convert the record to a dict according to the records requirements
+        with self.metrics.timer(u'ingest.convert'):
+            return record.convert()
+
+    def for_insert(self, record, converted_record=None):
         """
         Returns the dictionary that should be inserted into mongo to add the record's information to
         the collection.
 
         :param record:  the record
+        :param converted_record: the record's converted data if it has already been converted,
+                                 if None (the default) the record is converted
         :return: a dict
         """
-        # convert the record to a dict according to the records requirements
-        converted_record = record.convert()
-        should_insert, differ, diff = self.diff_data({}, converted_record)
+        if converted_record is None:
+            converted_record = self.convert(record)
+        if self.diff_mode == REVERSE:
+            # the diff patches the record's data back to an empty dict
+            should_insert, differ, diff = self.diff_data(converted_record, {})
+        else:
+            should_insert, differ, diff = self.diff_data({}, converted_record)
         # if the converted doc is empty, ignore it
         if not should_insert:
             return None
@@ -94,35 +292,44 @@ class RecordToMongoConverter(object):
             u'versions': [self.version],
             # a dict of the incremental changes made by each version, note that the integer version
             # is converted to a string here because mongo can't handle non-string keys
-            u'diffs': {str(self.version): format_diff(differ, diff)},
+            u'diffs': {str(self.version): format_diff(differ, diff, self.codec)},
         }
+        if self.diff_mode == REVERSE:
+            # only records in reverse mode are marked so that forward records are unchanged
+            mongo_doc[u'diff_mode'] = REVERSE
         return mongo_doc
 
-    def for_update(self, record, mongo_doc):
+    def for_update(self, record, mongo_doc, converted_record=None):
         """
         Returns a dict to update the mongo representation of the given record with the new record
         version.
 
         :param record:      the record
         :param mongo_doc:   the existing mongo document
+        :param converted_record: the record's converted data if it has already been converted,
+                                 if None (the default) the record is converted
         :return: a dict
         """
         # use a pair of dicts to record any updates required on the mongo document
         sets = {}
         add_to_sets = {}
 
-        # convert the record to a dict according to the records requirements
-        converted_record = record.convert()
+        if converted_record is None:
+            converted_record = self.convert(record)
 
-        # generate a diff of the new record against the existing version in mongo
-        should_update, differ, diff = self.diff_data(mongo_doc[u'data'], converted_record)
+        # generate a diff of the new record against the existing version in mongo, in reverse mode
+        # the diff patches the new data back to the existing data
+        if get_diff_mode(mongo_doc) == REVERSE:
+            should_update, differ, diff = self.diff_data(converted_record, mongo_doc[u'data'])
+        else:
+            should_update, differ, diff = self.diff_data(mongo_doc[u'data'], converted_record)
         if should_update:
             # set some new values
             sets.update({
                 u'data': converted_record,
                 u'latest_version': self.version,
                 u'last_ingested': self.ingestion_time,
-                u'diffs.{}'.format(self.version): format_diff(differ, diff),
+                u'diffs.{}'.format(self.version): format_diff(differ, diff, self.codec),
                 # allow modification of the metadata dict
                 u'metadata': record.modify_metadata(mongo_doc[u'metadata']),
             })
@@ -0,0 +1,414 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import os
+import socket
+import threading
+import uuid
+from collections import Counter, defaultdict
+from datetime import datetime, timedelta
+
+from pymongo import ReturnDocument
+
+from eevee import utils
+from eevee.ingestion.feeders import IngestionFeeder
+from eevee.mongo import get_mongo
+
+PENDING = u'pending'
+LEASED = u'leased'
+DONE = u'done'
+
+
+def hash_partition_units(partitions):
+    """
+    Creates the parameters for a set of work units which split a feeder's records up by the hash of
+    their ids, see HashPartitionFeeder.
+
+    :param partitions: the number of partitions (and therefore work units) to create
+    :return: a list of dicts
+    """
+    return [{u'partition': partition, u'partitions': partitions}
+            for partition in range(partitions)]
+
+
+class HashPartitionFeeder(IngestionFeeder):
+    """
+    Wraps another feeder and only produces the records from it whose ids fall in the given hash
+    partition. This allows a source which can't be split up any other way to be shared amongst a
+    number of workers, although note that each worker will still read the whole source.
+    """
+
+    def __init__(self, feeder, partition, partitions):
+        """
+        :param feeder: the feeder to wrap
+        :param partition: the partition number of the records to produce
+        :param partitions: the total number of partitions
+        """
+        super(HashPartitionFeeder, self).__init__(feeder.version)
+        self.feeder = feeder
+        self.partition = partition
+        self.partitions = partitions
+
+    @property
+    def source(self):
+        return self.feeder.source
+
+    def records(self):
+        for record in self.feeder.records():
+            if utils.stable_partition(record.id, self.partitions) == self.partition:
+                yield record
+
+
+def encode_metrics(metrics):
+    """
+    Converts the metrics totals from a stats dict (see InMemoryMetrics.get_totals) into a form which
+    can be stored in mongo. The metric names contain dots which mongo doesn't allow in keys so each
+    group of metrics is stored as a list of dicts with the name as a value instead.
+
+    :param metrics: the metrics totals dict
+    :return: a dict of lists
+    """
+    encoded = {}
+    for group, values in metrics.items():
+        encoded[group] = []
+        for name, value in sorted(values.items()):
+            if isinstance(value, dict):
+                entry = dict(value)
+            else:
+                entry = {u'value': value}
+            entry[u'name'] = name
+            encoded[group].append(entry)
+    return encoded
+
+
+def decode_metrics(encoded):
+    """
+    Converts metrics totals encoded by encode_metrics back into their original form.
+
+    :param encoded: the encoded metrics totals
+    :return: the metrics totals dict
+    """
+    metrics = {}
+    for group, entries in encoded.items():
+        metrics[group] = {}
+        for entry in entries:
+            entry = dict(entry)
+            name = entry.pop(u'name')
+            metrics[group][name] = entry[u'value'] if list(entry) == [u'value'] else entry
+    return metrics
+
+
+def merge_metrics(metrics_list):
+    """
+    Merges a number of metrics totals dicts (see InMemoryMetrics.get_totals) into a single dict of
+    the same form. Counts, totals and sums are added together and the maximum of the maximums is
+    used. Histograms are assumed to have been recorded with the same buckets.
+
+    :param metrics_list: a list of metrics totals dicts
+    :return: a metrics totals dict
+    """
+    timers = {}
+    counters = Counter()
+    histograms = {}
+    for metrics in metrics_list:
+        for name, timer in metrics.get(u'timers', {}).items():
+            if name in timers:
+                merged = timers[name]
+                merged[u'count'] += timer[u'count']
+                merged[u'total'] += timer[u'total']
+                merged[u'max'] = max(merged[u'max'], timer[u'max'])
+            else:
+                timers[name] = dict(timer)
+        counters.update(metrics.get(u'counters', {}))
+        for name, histogram in metrics.get(u'histograms', {}).items():
+            if name in histograms:
+                merged = histograms[name]
+                merged[u'count'] += histogram[u'count']
+                merged[u'sum'] += histogram[u'sum']
+                merged[u'buckets'] = [left + right for left, right
+                                      in zip(merged[u'buckets'], histogram[u'buckets'])]
+            else:
+                histograms[name] = dict(histogram, buckets=list(histogram[u'buckets']))
+    return {
+        u'timers': timers,
+        u'counters': dict(counters),
+        u'histograms': histograms,
+    }
+
+
+def merge_stats(stats_list):
+    """
+    Merges the stats dicts produced by a number of Ingesters ingesting parts of the same version
+    into a single stats dict of the same form. If any of the stats include metrics totals they are
+    merged too.
+
+    :param stats_list: a list of stats dicts
+    :return: a stats dict
+    """
+    operations = defaultdict(Counter)
+    differs = Counter()
+    for stats in stats_list:
+        for collection, counts in stats[u'operations'].items():
+            operations[collection].update(counts)
+        differs.update(stats.get(u'differs', {}))
+    start = min(stats[u'start'] for stats in stats_list)
+    end = max(stats[u'end'] for stats in stats_list)
+    first = stats_list[0]
+    merged = {
+        u'version': first[u'version'],
+        u'source': first[u'source'],
+        u'targets': sorted(operations.keys()),
+        u'ingestion_time': first[u'ingestion_time'],
+        u'start': start,
+        u'end': end,
+        u'duration': (end - start).total_seconds(),
+        u'operations': {collection: dict(counts) for collection, counts in operations.items()},
+        u'differs': dict(differs),
+    }
+    metrics_list = [stats[u'metrics'] for stats in stats_list if u'metrics' in stats]
+    if metrics_list:
+        merged[u'metrics'] = merge_metrics(metrics_list)
+    return merged
+
+
+class LeaseCoordinator(object):
+    """
+    Coordinates the ingestion of a version by a number of workers, potentially running on different
+    machines, using a collection in mongo. The ingestion job is split up into work units, each of
+    which is a dict of parameters a worker can use to create a feeder for part of the source (for
+    example a file path, a byte range or a hash partition). Workers claim a lease on a unit, keep it
+    alive with heartbeats while they ingest it and then mark it as done along with the ingestion
+    stats. If a worker dies its lease expires and the unit can be claimed by another worker.
+    """
+
+    def __init__(self, config, job, collection=u'eevee_work_units', lease_seconds=300):
+        """
+        :param config: the config object
+        :param job: the name of the job, this must be unique across jobs sharing the collection
+        :param collection: the mongo collection to store the work units in
+        :param lease_seconds: the number of seconds a lease lasts for without a heartbeat
+        """
+        self.config = config
+        self.job = job
+        self.collection = collection
+        self.lease_seconds = lease_seconds
+
+    def get_unit_id(self, number):
+        """
+        Returns the id of the given work unit.
+
+        :param number: the unit's number
+        :return: the id
+        """
+        return u'{}-{}'.format(self.job, number)
+
+    def create_units(self, version, units):
+        """
+        Creates the work units for the job. This is idempotent so it's safe for every worker to call
+        it when it starts up, any units that already exist are left alone.
+
+        :param version: the version being ingested
+        :param units: a list of dicts of parameters, one for each work unit
+        """
+        with get_mongo(self.config, collection=self.collection) as mongo:
+            mongo.create_index([(u'job', 1), (u'status', 1), (u'lease_expires', 1)])
+            for number, params in enumerate(units):
+                mongo.update_one({u'_id': self.get_unit_id(number)}, {u'$setOnInsert': {
+                    u'job': self.job,
+                    u'version': version,
+                    u'number': number,
+                    u'params': params,
+                    u'status': PENDING,
+                    u'owner': None,
+                    u'lease_expires': None,
+                    u'attempts': 0,
+                    u'stats': None,
+                }}, upsert=True)
+
+    def get_lease_expiry(self):
+        """
+        Returns the time a lease taken or extended now would expire.
+
+        :return: a UTC datetime
+        """
+        return datetime.utcnow() + timedelta(seconds=self.lease_seconds)
+
+    def claim(self, worker_id):
+        """
+        Claims a lease on a work unit which is either pending or has an expired lease.
+
+        :param worker_id: the id of the worker claiming the unit
+        :return: the unit's document or None if there are no units available
+        """
+        available = {
+            u'job': self.job,
+            u'$or': [
+                {u'status': PENDING},
+                {u'status': LEASED, u'lease_expires': {u'$lt': datetime.utcnow()}},
+            ],
+        }
+        claim = {
+            u'$set': {u'status': LEASED, u'owner': worker_id,
+                      u'lease_expires': self.get_lease_expiry()},
+            u'$inc': {u'attempts': 1},
+        }
+        with get_mongo(self.config, collection=self.collection) as mongo:
+            return mongo.find_one_and_update(available, claim, sort=[(u'number', 1)],
+                                             return_document=ReturnDocument.AFTER)
+
+    def heartbeat(self, unit_id, worker_id):
+        """
+        Extends the lease on the given unit.
+
+        :param unit_id: the unit's id
+        :param worker_id: the id of the worker holding the lease
+        :return: True if the lease was extended, False if the worker no longer holds it
+        """
+        with get_mongo(self.config, collection=self.collection) as mongo:
+            result = mongo.update_one({u'_id': unit_id, u'owner': worker_id, u'status': LEASED},
+                                      {u'$set': {u'lease_expires': self.get_lease_expiry()}})
+            return result.matched_count == 1
+
+    def complete(self, unit_id, worker_id, stats):
+        """
+        Marks the given unit as done and stores the ingestion stats for it. If the stats include
+        metrics totals they are stored encoded, see encode_metrics.
+
+        :param unit_id: the unit's id
+        :param worker_id: the id of the worker holding the lease
+        :param stats: the stats dict from the ingester
+        :return: True if the unit was marked as done, False if the worker no longer held the lease
+        """
+        if u'metrics' in stats:
+            stats = dict(stats, metrics=encode_metrics(stats[u'metrics']))
+        with get_mongo(self.config, collection=self.collection) as mongo:
+            result = mongo.update_one({u'_id': unit_id, u'owner': worker_id, u'status': LEASED},
+                                      {u'$set': {u'status': DONE, u'stats': stats,
+                                                 u'lease_expires': None}})
+            return result.matched_count == 1
+
+    def release(self, unit_id, worker_id):
+        """
+        Releases the lease on the given unit so that another worker can claim it straight away.
+
+        :param unit_id: the unit's id
+        :param worker_id: the id of the worker holding the lease
+        """
+        with get_mongo(self.config, collection=self.collection) as mongo:
+            mongo.update_one({u'_id': unit_id, u'owner': worker_id, u'status': LEASED},
+                             {u'$set': {u'status': PENDING, u'owner': None,
+                                        u'lease_expires': None}})
+
+    def is_finished(self):
+        """
+        Checks whether all the job's work units are done.
+
+        :return: True if they are, False if not
+        """
+        with get_mongo(self.config, collection=self.collection) as mongo:
+            return mongo.count_documents({u'job': self.job, u'status': {u'$ne': DONE}}) == 0
+
+    def get_stats(self):
+        """
+        Returns the merged stats of all the completed work units, see merge_stats.
+
+        :return: a stats dict or None if no units have been completed
+        """
+        stats_list = []
+        with get_mongo(self.config, collection=self.collection) as mongo:
+            for unit in mongo.find({u'job': self.job, u'status': DONE}):
+                stats = unit[u'stats']
+                if u'metrics' in stats:
+                    stats = dict(stats, metrics=decode_metrics(stats[u'metrics']))
+                stats_list.append(stats)
+        return merge_stats(stats_list) if stats_list else None
+
+
+class Heartbeat(object):
+    """
+    Context manager which runs a thread that keeps a lease on a work unit alive.
+    """
+
+    def __init__(self, coordinator, unit_id, worker_id, interval=None):
+        """
+        :param coordinator: the LeaseCoordinator object
+        :param unit_id: the id of the unit the lease is on
+        :param worker_id: the id of the worker holding the lease
+        :param interval: the number of seconds between heartbeats, defaults to a third of the lease
+        """
+        self.coordinator = coordinator
+        self.unit_id = unit_id
+        self.worker_id = worker_id
+        self.interval = interval if interval is not None else coordinator.lease_seconds / 3.0
+        self.stopped = threading.Event()
+        self.lost = False
+        self.thread = None
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            if not self.coordinator.heartbeat(self.unit_id, self.worker_id):
+                # the lease has expired and been claimed by another worker
+                self.lost = True
+                return
+
+    def __enter__(self):
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stopped.set()
+        self.thread.join()
+
+
+class Worker(object):
+    """
+    Claims work units from a LeaseCoordinator and ingests them until there are none left.
+    """
+
+    def __init__(self, coordinator, ingester_factory, worker_id=None, heartbeat_interval=None):
+        """
+        :param coordinator: the LeaseCoordinator object
+        :param ingester_factory: a function which takes a work unit's document and returns an
+                                 Ingester object which will ingest the unit's records. The version
+                                 and params stored in the unit should be used to create the feeder.
+        :param worker_id: the id of this worker, defaults to the hostname and process id along with
+                          a random suffix
+        :param heartbeat_interval: the number of seconds between heartbeats, see Heartbeat
+        """
+        self.coordinator = coordinator
+        self.ingester_factory = ingester_factory
+        if worker_id is None:
+            worker_id = u'{}-{}-{}'.format(socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+        self.worker_id = worker_id
+        self.heartbeat_interval = heartbeat_interval
+
+    def run(self):
+        """
+        Ingests work units until there are none left to claim.
+
+        :return: the number of units this worker completed
+        """
+        completed = 0
+        while True:
+            unit = self.coordinator.claim(self.worker_id)
+            if unit is None:
+                return completed
+
+            ingester = self.ingester_factory(unit)
+            # other workers could be writing to the same collections so the ingester can't assume
+            # an empty collection will stay that way
+            ingester.clean_load = False
+            try:
+                with Heartbeat(self.coordinator, unit[u'_id'], self.worker_id,
+                               self.heartbeat_interval):
+                    stats = ingester.ingest()
+            except Exception:
+                self.coordinator.release(unit[u'_id'], self.worker_id)
+                raise
+
+            # if the lease was lost another worker will have ingested the unit again, which is safe
+            # as the ingester's writes are idempotent, and its stats will be recorded instead
+            if self.coordinator.complete(unit[u'_id'], self.worker_id, stats):
+                completed += 1
@@ -64,16 +64,28 @@ class BaseRecord(object):
 @six.add_metaclass(abc.ABCMeta)
 class IngestionFeeder(object):
 
-    def __init__(self, version):
+    def __init__(self, version, read_batch_size=1000):
         """
         :param version: the version the records produced by this feeder will be
+        :param read_batch_size: the number of records to send in each read_batch_signal (default:
+                                1000)
         """
         self.version = version
+        self.read_batch_size = read_batch_size
         self.read_signal = Signal(doc=u'''Signal fired for each record read from the feeder. The
                                           kwargs passed when the signal is triggered are "number"
                                           and "record", the number is the number of the record from
                                           the feeder so far (so essentially a count) and the record
-                                          is the actual record object.''')
+                                          is the actual record object. This signal is only sent if
+                                          it has receivers when reading starts.''')
+        self.read_batch_signal = Signal(doc=u'''Signal fired for each batch of records read from
+                                                the feeder, this is a lower overhead alternative to
+                                                the read_signal. The kwargs passed when the signal
+                                                is triggered are "numbers" and "records", which are
+                                                lists of the values the read_signal would have been
+                                                sent for each record in the batch. This signal is
+                                                only sent if it has receivers when reading starts.
+                                                ''')
         self.finish_signal = Signal(doc=u'''Signal fired when the feeder has been exhausted and all
                                             records read. One kwarg is passed when the signal is
                                             triggered: "number", the total number of records read.
@@ -101,7 +113,28 @@ class IngestionFeeder(object):
         Generator function which yields each record from the source.
         """
         number = 0
+        # avoid the overhead of sending signals that have nothing listening to them
+        send_records = bool(self.read_signal.receivers)
+        batch = [] if self.read_batch_signal.receivers else None
         for number, record in enumerate(self.records(), start=1):
-            self.read_signal.send(self, number=number, record=record)
+            if send_records:
+                self.read_signal.send(self, number=number, record=record)
+            if batch is not None:
+                batch.append(record)
+                if len(batch) >= self.read_batch_size:
+                    self._send_read_batch(number, batch)
+                    batch = []
             yield record
+        if batch:
+            self._send_read_batch(number, batch)
         self.finish_signal.send(self, number=number)
+
+    def _send_read_batch(self, number, batch):
+        """
+        Sends the read_batch_signal for the given batch of records.
+
+        :param number: the number of the last record in the batch
+        :param batch: the list of records
+        """
+        numbers = list(range(number - len(batch) + 1, number + 1))
+        self.read_batch_signal.send(self, numbers=numbers, records=batch)
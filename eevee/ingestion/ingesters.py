@@ -5,16 +5,121 @@ from collections import defaultdict, Counter
 from datetime import datetime
 
 from blinker import Signal
-from pymongo import InsertOne, UpdateOne
+from pymongo import InsertOne, UpdateOne, ReturnDocument
+from pymongo.errors import BulkWriteError
 
 from eevee import utils
+from eevee.diffing import FORWARD
+from eevee.ingestion.sidecar import data_hash
+from eevee.metrics import timed_iterator, NULL_METRICS
 from eevee.mongo import get_mongo
 
 
+# the mongo error code produced when a write violates a unique index
+DUPLICATE_KEY_ERROR = 11000
+# the mongo collection eevee stores per collection settings in, keyed by collection name
+SETTINGS_COLLECTION = u'eevee_collection_settings'
+
+
+class IngestionConflictError(Exception):
+    """
+    Raised when the writes for some records still conflict with concurrent writes from other
+    ingesters after the maximum number of retries.
+    """
+    pass
+
+
+class DiffModeError(Exception):
+    """
+    Raised when records are ingested into a collection with a different diff mode to the one the
+    collection uses.
+    """
+    pass
+
+
+def ensure_diff_mode(config, mongo_collection, diff_mode):
+    """
+    Ensures the given collection uses the given diff mode. If the collection doesn't have a diff
+    mode recorded yet then the given mode is recorded for it. Note that the records in a collection
+    which existed before its mode was recorded are always forward mode records. These are still
+    handled correctly as each record is marked with its own diff mode.
+
+    :param config: the config object
+    :param mongo_collection: the name of the mongo collection
+    :param diff_mode: the diff mode the collection should use
+    """
+    with get_mongo(config, collection=SETTINGS_COLLECTION) as mongo:
+        settings = mongo.find_one_and_update({u'_id': mongo_collection},
+                                             {u'$setOnInsert': {u'diff_mode': diff_mode}},
+                                             upsert=True, return_document=ReturnDocument.AFTER)
+    check_diff_mode(mongo_collection, settings, diff_mode)
+
+
+def check_diff_mode(mongo_collection, settings, diff_mode):
+    """
+    Checks the diff mode recorded in the given collection settings matches the given diff mode.
+
+    :param mongo_collection: the name of the mongo collection
+    :param settings: the collection's settings document
+    :param diff_mode: the diff mode the collection should use
+    """
+    if settings[u'diff_mode'] != diff_mode:
+        raise DiffModeError(u'Collection {} uses the {} diff mode, not {}'.format(
+            mongo_collection, settings[u'diff_mode'], diff_mode))
+
+
+def get_collection_diff_mode(config, mongo_collection):
+    """
+    Returns the diff mode recorded for the given collection, collections without a recorded mode
+    use the forward mode.
+
+    :param config: the config object
+    :param mongo_collection: the name of the mongo collection
+    :return: the diff mode
+    """
+    with get_mongo(config, collection=SETTINGS_COLLECTION) as mongo:
+        settings = mongo.find_one({u'_id': mongo_collection})
+    return settings[u'diff_mode'] if settings is not None else FORWARD
+
+
+def get_operation_differ_id(operation, version):
+    """
+    Returns the id of the differ which produced the diff the given write operation stores for the
+    given version.
+
+    :param operation: an InsertOne or UpdateOne operation created by the Ingester
+    :param version: the version being ingested
+    :return: the differ id or None if the operation doesn't store a diff for the version
+    """
+    if isinstance(operation, InsertOne):
+        stored_diff = operation._doc.get(u'diffs', {}).get(str(version), None)
+    else:
+        stored_diff = operation._doc.get(u'$set', {}).get(u'diffs.{}'.format(version), None)
+    return stored_diff.get(u'id', None) if isinstance(stored_diff, dict) else None
+
+
+def ensure_mongo_indexes_exist(config, mongo_collection):
+    """
+    Creates the indexes eevee needs on the given mongo collection if they don't exist already.
+
+    :param config: the config object
+    :param mongo_collection: the name of the mongo collection to add the indexes to
+    """
+    with get_mongo(config, collection=mongo_collection) as mongo:
+        # index id for quick access to specific records
+        mongo.create_index(u'id', unique=True)
+        # index versions for faster searches for records that were updated in specific versions
+        mongo.create_index(u'versions')
+        # index latest_version for faster searches for records that were last updated in a
+        # specific version
+        mongo.create_index(u'latest_version')
+
+
 class Ingester(object):
 
     def __init__(self, version, feeder, record_to_mongo_converter, config, chunk_size=1000,
-                 insert_op_name=u'inserted', update_op_name=u'updated'):
+                 insert_op_name=u'inserted', update_op_name=u'updated', metrics=None,
+                 clean_load=True, max_conflict_retries=5, sidecar=None):
         """
         :param version: the version the records to be ingested by this ingester
         :param feeder: the feeder object to get records from
@@ -25,6 +130,37 @@ class Ingester(object):
                            lists of this size
         :param insert_op_name: the name of the insert operation (for stats)
         :param update_op_name: the name of the update operation (for stats)
+        :param metrics: a Metrics object to report timings and counts to. If one is provided, the
+                        converter's metrics attribute is set to it too so that the conversion and
+                        diffing of records is measured. If None (the default) the converter's
+                        metrics object is used.
+        :param clean_load: whether to use the faster clean load mode when a collection is empty
+                           before ingestion starts (default: True). In this mode the existing docs
+                           aren't looked up for records that can't be in the collection yet,
+                           inserts are written unordered and the collection's indexes are only
+                           created once the ingestion is complete. Note that the ids of all the
+                           records ingested into a clean collection are held in memory so that any
+                           duplicates in the source are still handled correctly. When running
+                           more than one ingester against the same collection at the same time
+                           this must be turned off as the ingesters can't tell whether the others
+                           have started writing to the collection.
+        :param max_conflict_retries: the number of times to retry the writes for records which
+                                     conflict with writes made by other ingesters running against
+                                     the same collection at the same time (default: 5). Updates are
+                                     only applied if the record's latest_version hasn't changed
+                                     since it was read and inserts fail if the record has been
+                                     inserted since it was looked up, in both cases the record is
+                                     read again, diffed against the new data and the write retried.
+                                     If the records still conflict after this many retries an
+                                     IngestionConflictError is raised.
+        :param sidecar: a SidecarIndex object to check the records against before looking them up
+                        in mongo (default: None). Records whose data hashes match the index haven't
+                        changed and are skipped without being looked up, the rest are looked up and
+                        written as normal and the index is updated after each bulk write. The index
+                        is built from mongo the first time a collection is encountered if it hasn't
+                        been already. When using a sidecar the converter must accept the already
+                        converted data as an extra parameter to its for_insert and for_update
+                        functions, as the RecordToMongoConverter does.
         """
         self.version = version
         self.feeder = feeder
@@ -33,6 +169,12 @@ class Ingester(object):
         self.chunk_size = chunk_size
         self.insert_op_name = insert_op_name
         self.update_op_name = update_op_name
+        self.clean_load = clean_load
+        self.max_conflict_retries = max_conflict_retries
+        self.sidecar = sidecar
+        if metrics is not None:
+            self.record_to_mongo_converter.metrics = metrics
+        self.metrics = getattr(self.record_to_mongo_converter, u'metrics', NULL_METRICS)
 
         # setup some signals so that the ingestion can be tracked
         self.insert_signal = Signal(doc=u'''Triggered when a record is about to be inserted. Note
@@ -49,6 +191,22 @@ class Ingester(object):
                                             this signal is sent are "record" and "doc" which hold
                                             the record object and the update doc returned by the
                                             converter (could be None) respectively.''')
+        self.insert_batch_signal = Signal(doc=u'''Triggered once for each chunk of records about
+                                                  to be inserted into a collection, this is a lower
+                                                  overhead alternative to the insert_signal. The
+                                                  kwargs passed when this signal is sent are
+                                                  "records" and "docs" which hold lists of the
+                                                  values the insert_signal would have been sent for
+                                                  each record in the chunk. The signal is not sent
+                                                  if there are no inserts in the chunk.''')
+        self.update_batch_signal = Signal(doc=u'''Triggered once for each chunk of records about
+                                                  to be updated in a collection, this is a lower
+                                                  overhead alternative to the update_signal. The
+                                                  kwargs passed when this signal is sent are
+                                                  "records" and "docs" which hold lists of the
+                                                  values the update_signal would have been sent for
+                                                  each record in the chunk. The signal is not sent
+                                                  if there are no updates in the chunk.''')
         self.totals_signal = Signal(doc=u'''Triggered after each batch of write operations is sent
                                             to mongo. The kwargs passed when this signal is sent are
                                             "total", "inserted" and "updated" which hold the total
@@ -63,25 +221,188 @@ class Ingester(object):
                                             documents updated and the report stats that will be
                                             entered into mongo respectively''')
         self.seen_collections = set()
+        # the number of diffs written to mongo by each differ, keyed by differ id
+        self.differ_counts = Counter()
+        # the collections being loaded in clean load mode -> the ids ingested into them so far
+        self.clean_collections = {}
         self.start = datetime.now()
 
+    def ensure_diff_mode(self, mongo_collection):
+        """
+        Ensures the given collection uses the converter's diff mode, see ensure_diff_mode. This
+        function is only called the first time a collection is encountered during ingestion.
+
+        :param mongo_collection: the name of the mongo collection
+        """
+        ensure_diff_mode(self.config, mongo_collection, self.record_to_mongo_converter.diff_mode)
+
     def ensure_mongo_indexes_exist(self, mongo_collection):
         """
         To improve performance we need some mongo indexes, this function ensures the indexes we want
         exist. If overriding ensure this function is called as well to avoid potentially lower
         ingestion/indexing performance. This function is only called the first time a collection is
-        encountered during ingestion.
+        encountered during ingestion, or at the end of the ingestion if the collection was loaded
+        in clean load mode.
 
         :param mongo_collection: the name of the mongo collection to add the indexes to
         """
+        ensure_mongo_indexes_exist(self.config, mongo_collection)
+
+    def is_clean_collection(self, mongo_collection):
+        """
+        Checks whether the given collection is empty or not.
+
+        :param mongo_collection: the name of the mongo collection
+        :return: True if the collection has no documents in it, False if not
+        """
         with get_mongo(self.config, collection=mongo_collection) as mongo:
-            # index id for quick access to specific records
-            mongo.create_index(u'id', unique=True)
-            # index versions for faster searches for records that were updated in specific versions
-            mongo.create_index(u'versions')
-            # index latest_version for faster searches for records that were last updated in a
-            # specific version
-            mongo.create_index(u'latest_version')
+            return mongo.find_one({}, {u'_id': 1}) is None
+
+    def create_operation(self, record, mongo_doc, converted_record=None):
+        """
+        Uses the converter to create the insert or update document for the given record and returns
+        it along with the write operation that should be sent to mongo. Updates are guarded with the
+        latest_version of the mongo doc so that they aren't applied if another ingester has updated
+        the record since the mongo doc was read.
+
+        :param record: the record
+        :param mongo_doc: the record's current mongo doc, or None if it isn't in mongo
+        :param converted_record: the record's converted data if it has already been converted,
+                                 if None (the default) the converter converts the record
+        :return: a 2-tuple containing the insert or update doc from the converter and the write
+                 operation, the operation is None if no write is needed
+        """
+        # the converted data is only passed on when there is some so that converters which don't
+        # accept it can still be used when no sidecar is in use
+        extra_args = () if converted_record is None else (converted_record,)
+        if not mongo_doc:
+            insert_doc = self.record_to_mongo_converter.for_insert(record, *extra_args)
+            return insert_doc, (InsertOne(insert_doc) if insert_doc else None)
+        else:
+            update_doc = self.record_to_mongo_converter.for_update(record, mongo_doc, *extra_args)
+            if not update_doc:
+                return update_doc, None
+            guard = {u'id': record.id, u'latest_version': mongo_doc[u'latest_version']}
+            return update_doc, UpdateOne(guard, update_doc)
+
+    def write_operations(self, mongo, operations, records):
+        """
+        Writes the given operations to mongo in bulk, detecting any that conflict with writes made
+        by other ingesters and retrying them after reading the current state of the records again.
+
+        :param mongo: the mongo collection object
+        :param operations: a dict of record ids -> write operations
+        :param records: a dict of record ids -> records
+        :return: a 2-tuple containing the number of documents inserted and the number updated
+        """
+        inserted = 0
+        updated = 0
+        retries = 0
+        while True:
+            with self.metrics.timer(u'ingest.bulk_write'):
+                try:
+                    # the operations all act on different ids so the order doesn't matter
+                    result = mongo.bulk_write(list(operations.values()), ordered=False)
+                    details = {u'nInserted': result.inserted_count,
+                               u'nMatched': result.matched_count,
+                               u'nModified': result.modified_count,
+                               u'writeErrors': []}
+                except BulkWriteError as e:
+                    details = e.details
+                    # only duplicate key errors on inserts are conflicts, anything else is a real
+                    # problem
+                    if any(error[u'code'] != DUPLICATE_KEY_ERROR
+                           for error in details[u'writeErrors']):
+                        raise
+            self.metrics.observe(u'ingest.bulk_write_size', len(operations))
+            inserted += details[u'nInserted']
+            updated += details[u'nModified']
+
+            conflicts = self.get_conflicts(operations, details, retries)
+            if not conflicts:
+                self.count_written_differs(operations)
+                return inserted, updated
+            retries += 1
+
+            # read the records again and recreate the operations against the new data
+            filter_query = {u'id': {u'$in': list(conflicts)}}
+            with self.metrics.timer(u'ingest.mongo_find'):
+                current_docs = {doc[u'id']: doc for doc in mongo.find(filter_query)}
+            self.count_written_differs(operations, conflicts, current_docs)
+            operations = self.recreate_operations(conflicts, current_docs, records)
+            if not operations:
+                return inserted, updated
+
+    def get_conflicts(self, operations, details, retries):
+        """
+        Works out which of the given operations conflicted with writes made by other ingesters from
+        the details of the bulk write that ran them.
+
+        :param operations: a dict of record ids -> write operations, in the order they were written
+        :param details: the details of the bulk write in the form of BulkWriteError.details
+        :param retries: the number of times the operations have been retried already
+        :return: a set of the ids of the records whose operations conflicted
+        """
+        record_ids = list(operations.keys())
+        # inserts which failed because the record has been inserted since we looked it up
+        conflicts = {record_ids[error[u'index']] for error in details[u'writeErrors']}
+        update_ids = [record_id for record_id, operation in operations.items()
+                      if isinstance(operation, UpdateOne)]
+        if details[u'nMatched'] < len(update_ids):
+            # some updates weren't applied because the record's latest version has changed since
+            # we read it. We can't tell which from the result so all the updates are checked again,
+            # the ones that were applied will produce no changes this time
+            conflicts.update(update_ids)
+
+        if conflicts:
+            if retries >= self.max_conflict_retries:
+                raise IngestionConflictError(u'Writes for {} records still conflicted after {} '
+                                             u'retries'.format(len(conflicts), retries))
+            self.metrics.increment(u'ingest.conflicts', len(conflicts))
+        return conflicts
+
+    def count_written_differs(self, operations, conflicts=frozenset(), current_docs=None):
+        """
+        Counts the differs used by the given operations which were written to mongo. Operations
+        which didn't conflict were written. Conflicting updates may have been written too as all
+        the updates are treated as conflicting when any of them weren't applied, the ones whose
+        record is now at this version in the current docs were. Operations which weren't written
+        are recreated and counted when the new operations are written, if they are.
+
+        :param operations: a dict of record ids -> the write operations which were sent to mongo
+        :param conflicts: the ids of the records whose operations conflicted
+        :param current_docs: a dict of record ids -> the conflicting records' current mongo docs,
+                             only needed if there are conflicts
+        """
+        for record_id, operation in operations.items():
+            if record_id in conflicts:
+                if not isinstance(operation, UpdateOne):
+                    continue
+                current_doc = current_docs.get(record_id, None)
+                if current_doc is None or current_doc[u'latest_version'] != self.version:
+                    continue
+            differ_id = get_operation_differ_id(operation, self.version)
+            if differ_id is not None:
+                self.differ_counts[differ_id] += 1
+
+    def recreate_operations(self, conflicts, current_docs, records):
+        """
+        Recreates the write operations for the given conflicting records against their current
+        mongo docs.
+
+        :param conflicts: the ids of the records whose operations conflicted
+        :param current_docs: a dict of record ids -> the records' current mongo docs
+        :param records: a dict of record ids -> records
+        :return: a dict of record ids -> write operations, records which no longer need writing are
+                 left out
+        """
+        operations = {}
+        for record_id in conflicts:
+            _doc, operation = self.create_operation(records[record_id],
+                                                    current_docs.get(record_id, None))
+            if operation is not None:
+                operations[record_id] = operation
+        return operations
 
     def get_stats(self, operations):
         """
@@ -94,7 +415,7 @@ class Ingester(object):
         """
         end = datetime.now()
         # generate and return a stats dict
-        return {
+        stats = {
             u'version': self.version,
             u'source': self.feeder.source,
             u'targets': sorted(operations.keys()),
@@ -103,7 +424,176 @@ class Ingester(object):
             u'end': end,
             u'duration': (end - self.start).total_seconds(),
             u'operations': operations,
+            # the number of diffs written by each differ
+            u'differs': dict(self.differ_counts),
         }
+        if self.metrics.enabled:
+            stats[u'metrics'] = self.metrics.get_totals()
+        return stats
+
+    def prepare_collection(self, mongo_collection):
+        """
+        Prepares the given collection for ingestion. This function is only called the first time a
+        collection is encountered during ingestion. The collection's diff mode is checked, the
+        sidecar is built for it if needed and its indexes are created, unless it's empty and can be
+        loaded in clean mode in which case the indexes are created once the data is in.
+
+        :param mongo_collection: the name of the mongo collection
+        """
+        self.ensure_diff_mode(mongo_collection)
+        if self.sidecar is not None and not self.sidecar.is_built(mongo_collection):
+            with self.metrics.timer(u'ingest.sidecar_build'):
+                self.sidecar.build(self.config, mongo_collection)
+        if self.clean_load and self.is_clean_collection(mongo_collection):
+            self.clean_collections[mongo_collection] = set()
+        else:
+            self.ensure_mongo_indexes_exist(mongo_collection)
+
+    def get_lookup_ids(self, mongo_collection, records):
+        """
+        Returns the ids of the given records which need to be looked up in mongo. If the collection
+        is being clean loaded only the ids which have already been ingested into it could be in
+        mongo, otherwise all the ids need to be looked up.
+
+        :param mongo_collection: the name of the mongo collection
+        :param records: the records in the chunk destined for the collection
+        :return: a list of record ids
+        """
+        # if the collection is being clean loaded, this is the set of ids already ingested
+        seen_ids = self.clean_collections.get(mongo_collection, None)
+        if seen_ids is None:
+            return [r.id for r in records]
+        # when clean loading, only records with ids duplicated from previous chunks could be in the
+        # collection already
+        lookup_ids = [r.id for r in records if r.id in seen_ids]
+        seen_ids.update(r.id for r in records)
+        return lookup_ids
+
+    def check_sidecar(self, mongo_collection, records):
+        """
+        Converts the given records and checks their data against the sidecar to find the ones which
+        haven't changed.
+
+        :param mongo_collection: the name of the mongo collection
+        :param records: the records in the chunk destined for the collection
+        :return: a 3-tuple containing a dict of record ids -> converted data, a dict of record ids
+                 -> data hashes and a set of the ids of the records which haven't changed
+        """
+        converted = {}
+        hashes = {}
+        for record in records:
+            # only the first record for an id is used, as in create_chunk_operations
+            if record.id not in converted:
+                converted[record.id] = self.record_to_mongo_converter.convert(record)
+                hashes[record.id] = data_hash(converted[record.id])
+        with self.metrics.timer(u'ingest.sidecar_get'):
+            entries = self.sidecar.get(mongo_collection, list(hashes.keys()))
+        unchanged = {record_id for record_id, (_version, entry_hash) in entries.items()
+                     if entry_hash is not None and entry_hash == hashes[record_id]}
+        self.metrics.increment(u'ingest.sidecar_skipped', len(unchanged))
+        return converted, hashes, unchanged
+
+    def create_chunk_operations(self, records, current_docs, converted=None, hashes=None,
+                                unchanged=frozenset()):
+        """
+        Creates the write operations for the given chunk of records, which must all be destined for
+        the same collection, and sends the insert and update signals for them.
+
+        :param records: the records
+        :param current_docs: a dict of record ids -> the current mongo docs of the records
+        :param converted: a dict of record ids -> the records' converted data, if available
+        :param hashes: a dict of record ids -> the hashes of the records' converted data, only
+                       passed when using a sidecar
+        :param unchanged: the ids of the records the sidecar shows haven't changed
+        :return: a 3-tuple containing a dict of record ids -> write operations, a dict of record
+                 ids -> the records the operations are for and a dict of record ids -> the
+                 sidecar entries to write once the operations have been written
+        """
+        # avoid the overhead of sending signals that have nothing listening to them
+        send_inserts = bool(self.insert_signal.receivers)
+        send_updates = bool(self.update_signal.receivers)
+        send_insert_batches = bool(self.insert_batch_signal.receivers)
+        send_update_batches = bool(self.update_batch_signal.receivers)
+
+        # keep a dict of operations so that we can do them in bulk and also avoid attempting to act
+        # twice on the same record id in case entries in the source are duplicated. Only the first
+        # operation against an id is run, the other entries are ignored
+        operations = {}
+        # the records the operations are for, keyed on their ids
+        operation_records = {}
+        # the sidecar entries to write once the operations have been written
+        sidecar_entries = {}
+        # the records and docs to send with the batch signals
+        inserted_batch = ([], [])
+        updated_batch = ([], [])
+
+        for record in records:
+            # ignore ids we've already dealt with
+            if record.id in operations:
+                continue
+            if record.id in unchanged:
+                # the record is in mongo with the same data so this is an update with no changes,
+                # exactly as for_update would have produced
+                is_update, doc, operation = True, {}, None
+            else:
+                # see if there is a version of this record already in mongo
+                mongo_doc = current_docs.get(record.id, None)
+                # create the insert or update operation for the record
+                doc, operation = self.create_operation(
+                    record, mongo_doc, converted.get(record.id, None) if converted else None)
+                is_update = bool(mongo_doc)
+                if hashes is not None:
+                    if operation is not None:
+                        sidecar_entries[record.id] = (self.version, hashes[record.id])
+                    elif mongo_doc:
+                        # the data hasn't changed but the sidecar didn't know that
+                        sidecar_entries.setdefault(record.id, (mongo_doc[u'latest_version'],
+                                                               hashes[record.id]))
+            # trigger the signals, even if no insert or update is going to occur
+            if not is_update:
+                if send_inserts:
+                    self.insert_signal.send(self, record=record, doc=doc)
+                if send_insert_batches:
+                    inserted_batch[0].append(record)
+                    inserted_batch[1].append(doc)
+            else:
+                if send_updates:
+                    self.update_signal.send(self, record=record, doc=doc)
+                if send_update_batches:
+                    updated_batch[0].append(record)
+                    updated_batch[1].append(doc)
+            if operation is not None:
+                operations[record.id] = operation
+                operation_records[record.id] = record
+
+        if inserted_batch[0]:
+            self.insert_batch_signal.send(self, records=inserted_batch[0], docs=inserted_batch[1])
+        if updated_batch[0]:
+            self.update_batch_signal.send(self, records=updated_batch[0], docs=updated_batch[1])
+        return operations, operation_records, sidecar_entries
+
+    def finish(self, op_stats, total_records, total_inserted, total_updated):
+        """
+        Reports the totals of a completed ingestion to the metrics, generates the stats dict and
+        sends the finish signal.
+
+        :param op_stats: a dict of collections -> Counters of the operations that occurred
+        :param total_records: the total number of records that passed through the ingester
+        :param total_inserted: the total number of records inserted
+        :param total_updated: the total number of records updated
+        :return: the stats dict
+        """
+        self.metrics.increment(u'ingest.records', total_records)
+        self.metrics.increment(u'ingest.inserted', total_inserted)
+        self.metrics.increment(u'ingest.updated', total_updated)
+        self.metrics.flush()
+        # generate a stats dict
+        stats = self.get_stats(op_stats)
+        # send the stats to the finish signal
+        self.finish_signal.send(self, total=total_records, inserted=total_inserted,
+                                updated=total_updated, stats=stats)
+        # return the stats dict produced
+        return stats
 
     def ingest(self):
         """
@@ -119,7 +609,8 @@ class Ingester(object):
         # store for stats about the insert and update operations that occur on each collection
         op_stats = defaultdict(Counter)
 
-        for chunk in utils.chunk_iterator(self.feeder.read(), chunk_size=self.chunk_size):
+        records_iterator = timed_iterator(self.metrics, u'ingest.feeder_read', self.feeder.read())
+        for chunk in utils.chunk_iterator(records_iterator, chunk_size=self.chunk_size):
             # map all of the records to the collections they should be inserted into first
             collection_mapping = defaultdict(list)
             for record in chunk:
@@ -128,65 +619,61 @@ class Ingester(object):
             # then iterate over the collections and their records, inserting/updating the records
             # into each collection in turn
             for collection, records in collection_mapping.items():
-                # if we haven't seen this collection before during this ingestion we should ensure
-                # it has the appropriate indexes on it
+                # if we haven't seen this collection before during this ingestion we should prepare
+                # it for ingestion
                 if collection not in self.seen_collections:
                     self.seen_collections.add(collection)
-                    self.ensure_mongo_indexes_exist(collection)
+                    self.prepare_collection(collection)
 
                 with get_mongo(self.config, self.config.mongo_database, collection) as mongo:
-                    # keep a dict of operations so that we can do them in bulk and also avoid
-                    # attempting to act twice on the same record id in case entries in the source
-                    # are duplicated. Only the first operation against an id is run, the other
-                    # entries are ignored
-                    operations = {}
+                    lookup_ids = self.get_lookup_ids(collection, records)
+
+                    # when using a sidecar, records whose data hasn't changed since they were last
+                    # written are skipped without being looked up in mongo
+                    converted, hashes, unchanged = None, None, frozenset()
+                    if self.sidecar is not None:
+                        converted, hashes, unchanged = self.check_sidecar(collection, records)
+                        lookup_ids = [record_id for record_id in lookup_ids
+                                      if record_id not in unchanged]
 
                     # create a lookup of the current docs in this collection, keyed on their ids
-                    filter_query = {u'id': {u'$in': [r.id for r in records]}}
-                    current_docs = {doc[u'id']: doc for doc in mongo.find(filter_query)}
-
-                    for record in records:
-                        total_records += 1
-                        # ignore ids we've already dealt with
-                        if record.id not in operations:
-                            # see if there is a version of this record already in mongo
-                            mongo_doc = current_docs.get(record.id, None)
-                            if not mongo_doc:
-                                # record needs adding to the collection, add an insert operation to
-                                # our list if the converter returns one
-                                insert_doc = self.record_to_mongo_converter.for_insert(record)
-                                # trigger the signal, even if no insert is going to occur
-                                self.insert_signal.send(self, record=record, doc=insert_doc)
-                                if insert_doc:
-                                    operations[record.id] = InsertOne(insert_doc)
-                            else:
-                                # record might need updating
-                                update_doc = self.record_to_mongo_converter.for_update(record,
-                                                                                       mongo_doc)
-                                # trigger the signal, even if no update is going to occur
-                                self.update_signal.send(self, record=record, doc=update_doc)
-                                if update_doc:
-                                    # an update is required, add the update operation to our list
-                                    operations[record.id] = UpdateOne({u'id': record.id},
-                                                                      update_doc)
+                    current_docs = {}
+                    if lookup_ids:
+                        filter_query = {u'id': {u'$in': lookup_ids}}
+                        with self.metrics.timer(u'ingest.mongo_find'):
+                            current_docs = {doc[u'id']: doc for doc in mongo.find(filter_query)}
+
+                    total_records += len(records)
+                    operations, operation_records, sidecar_entries = \
+                        self.create_chunk_operations(records, current_docs, converted, hashes,
+                                                     unchanged)
 
                     if operations:
                         # run the operations in bulk on mongo
-                        bulk_result = mongo.bulk_write(list(operations.values()))
+                        inserted, updated = self.write_operations(mongo, operations,
+                                                                  operation_records)
                         # add insert and update totals to the per-collection stats
-                        op_stats[collection][self.insert_op_name] += bulk_result.inserted_count
-                        op_stats[collection][self.update_op_name] += bulk_result.modified_count
+                        op_stats[collection][self.insert_op_name] += inserted
+                        op_stats[collection][self.update_op_name] += updated
                         # add the insert and update totals to the total stats
-                        total_inserted += bulk_result.inserted_count
-                        total_updated += bulk_result.modified_count
+                        total_inserted += inserted
+                        total_updated += updated
                         # trigger the totals signal
                         self.totals_signal.send(self, total=total_records, inserted=total_inserted,
                                                 updated=total_updated)
 
-        # generate a stats dict
-        stats = self.get_stats(op_stats)
-        # send the stats to the finish signal
-        self.finish_signal.send(self, total=total_records, inserted=total_inserted,
-                                updated=total_updated, stats=stats)
-        # return the stats dict produced
-        return stats
+                    # the sidecar is only updated once the writes have succeeded so that it never
+                    # gets ahead of mongo
+                    if sidecar_entries:
+                        with self.metrics.timer(u'ingest.sidecar_update'):
+                            self.sidecar.update(collection,
+                                                [(record_id,) + entry
+                                                 for record_id, entry in sidecar_entries.items()])
+
+        # create the indexes on the collections we clean loaded now that the data is in
+        for collection in self.clean_collections:
+            with self.metrics.timer(u'ingest.create_indexes'):
+                self.ensure_mongo_indexes_exist(collection)
+        self.clean_collections = {}
+
+        return self.finish(op_stats, total_records, total_inserted, total_updated)
@@ -0,0 +1,375 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Asyncio versions of the feeder and ingester in eevee.ingestion. This module requires Python 3.6+
+and the motor package (install eevee with the "async" extra).
+"""
+import abc
+import asyncio
+import timeit
+from collections import defaultdict, Counter
+
+from pymongo import ReturnDocument
+from pymongo.errors import BulkWriteError
+
+from eevee.ingestion.feeders import IngestionFeeder
+from eevee.ingestion.ingesters import Ingester, DUPLICATE_KEY_ERROR, SETTINGS_COLLECTION, \
+    check_diff_mode
+
+try:
+    from motor.motor_asyncio import AsyncIOMotorClient
+except ImportError:
+    AsyncIOMotorClient = None
+
+
+def get_motor_client(config, **kwargs):
+    """
+    Returns an async mongo client created using the mongo host and port of the passed config
+    object. All kwargs are passed on to the client constructor.
+
+    :param config: the config object
+    :param kwargs: kwargs for the motor client constructor
+    :return: a new AsyncIOMotorClient object
+    """
+    if AsyncIOMotorClient is None:
+        raise ImportError(u'The motor package is required to create an async mongo client')
+    return AsyncIOMotorClient(config.mongo_host, config.mongo_port, **kwargs)
+
+
+async def async_timed_iterator(metrics, name, iterable):
+    """
+    Async version of eevee.metrics.timed_iterator which records the time taken to retrieve each
+    element from the given async iterable under the given name.
+
+    :param metrics: the metrics object
+    :param name: the name of the timer
+    :param iterable: the async iterable to wrap
+    """
+    iterator = iterable.__aiter__()
+    while True:
+        start = timeit.default_timer()
+        try:
+            element = await iterator.__anext__()
+        except StopAsyncIteration:
+            return
+        finally:
+            metrics.record_time(name, timeit.default_timer() - start)
+        yield element
+
+
+async def async_chunk_iterator(iterable, chunk_size=1000):
+    """
+    Async version of eevee.utils.chunk_iterator which chunks up an async iterable.
+
+    :param iterable: the async iterable to chunk up
+    :param chunk_size: the maximum size of each yielded chunk
+    """
+    chunk = []
+    async for element in iterable:
+        chunk.append(element)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+class AsyncIngestionFeeder(IngestionFeeder):
+    """
+    A feeder which produces its records asynchronously, for example by paging through an HTTP API.
+    The records function must be an async generator and read is an async generator too, otherwise
+    this behaves in the same way as IngestionFeeder and sends the same signals.
+    """
+
+    @abc.abstractmethod
+    async def records(self):
+        """
+        Abstract async generator function which produces records. An example implementation of
+        this function: request each page of results from an API in turn and yield each record on
+        the page.
+
+        :return: yields each record
+        """
+        pass
+
+    async def read(self):
+        """
+        Async generator function which yields each record from the source.
+        """
+        number = 0
+        # avoid the overhead of sending signals that have nothing listening to them
+        send_records = bool(self.read_signal.receivers)
+        batch = [] if self.read_batch_signal.receivers else None
+        async for record in self.records():
+            number += 1
+            if send_records:
+                self.read_signal.send(self, number=number, record=record)
+            if batch is not None:
+                batch.append(record)
+                if len(batch) >= self.read_batch_size:
+                    self._send_read_batch(number, batch)
+                    batch = []
+            yield record
+        if batch:
+            self._send_read_batch(number, batch)
+        self.finish_signal.send(self, number=number)
+
+
+class AsyncIngester(Ingester):
+    """
+    Asyncio version of the Ingester which reads records from an AsyncIngestionFeeder and uses motor
+    to look up and write to mongo. A number of chunks can be in flight at once so that waiting for
+    the feeder and for mongo overlap. All the methods which communicate with mongo are coroutines
+    and behave in the same way as their Ingester counterparts, the mongo docs produced, the stats
+    and the signals sent are all the same too.
+
+    Chunks which contain the same record ids as chunks already in flight wait for those chunks to
+    finish before they start so that the records are always written in the order they were read.
+    The converting and diffing of the records is still done on the event loop's thread.
+    """
+
+    def __init__(self, version, feeder, record_to_mongo_converter, config, chunk_size=1000,
+                 insert_op_name=u'inserted', update_op_name=u'updated', metrics=None,
+                 clean_load=True, max_conflict_retries=5, concurrency=4, client=None):
+        """
+        See Ingester for details of the parameters shared with it. Sidecars aren't supported.
+
+        :param concurrency: the maximum number of chunks in flight at once (default: 4)
+        :param client: the motor client to use, if None (the default) one is created when ingestion
+                       starts and closed when it finishes
+        """
+        super(AsyncIngester, self).__init__(version, feeder, record_to_mongo_converter, config,
+                                            chunk_size, insert_op_name, update_op_name, metrics,
+                                            clean_load, max_conflict_retries)
+        self.concurrency = concurrency
+        self.client = client
+
+    def get_collection(self, mongo_collection):
+        """
+        Returns the motor collection object for the given collection in the database in the config.
+
+        :param mongo_collection: the name of the mongo collection
+        :return: an AsyncIOMotorCollection object
+        """
+        return self.client[self.config.mongo_database][mongo_collection]
+
+    async def ensure_diff_mode(self, mongo_collection):
+        """
+        Ensures the given collection uses the converter's diff mode, see ensure_diff_mode.
+
+        :param mongo_collection: the name of the mongo collection
+        """
+        diff_mode = self.record_to_mongo_converter.diff_mode
+        settings = await self.get_collection(SETTINGS_COLLECTION).find_one_and_update(
+            {u'_id': mongo_collection}, {u'$setOnInsert': {u'diff_mode': diff_mode}},
+            upsert=True, return_document=ReturnDocument.AFTER)
+        check_diff_mode(mongo_collection, settings, diff_mode)
+
+    async def ensure_mongo_indexes_exist(self, mongo_collection):
+        """
+        Creates the same indexes on the given collection as ensure_mongo_indexes_exist.
+
+        :param mongo_collection: the name of the mongo collection to add the indexes to
+        """
+        mongo = self.get_collection(mongo_collection)
+        await mongo.create_index(u'id', unique=True)
+        await mongo.create_index(u'versions')
+        await mongo.create_index(u'latest_version')
+
+    async def is_clean_collection(self, mongo_collection):
+        """
+        Checks whether the given collection is empty or not.
+
+        :param mongo_collection: the name of the mongo collection
+        :return: True if the collection has no documents in it, False if not
+        """
+        return await self.get_collection(mongo_collection).find_one({}, {u'_id': 1}) is None
+
+    async def prepare_collection(self, mongo_collection):
+        """
+        Prepares the given collection for ingestion, see Ingester.prepare_collection.
+
+        :param mongo_collection: the name of the mongo collection
+        """
+        await self.ensure_diff_mode(mongo_collection)
+        if self.clean_load and await self.is_clean_collection(mongo_collection):
+            self.clean_collections[mongo_collection] = set()
+        else:
+            await self.ensure_mongo_indexes_exist(mongo_collection)
+
+    async def write_operations(self, mongo, operations, records):
+        """
+        Writes the given operations to mongo in bulk, retrying any that conflict with writes made by
+        other ingesters. See Ingester.write_operations for details.
+
+        :param mongo: the motor collection object
+        :param operations: a dict of record ids -> write operations
+        :param records: a dict of record ids -> records
+        :return: a 2-tuple containing the number of documents inserted and the number updated
+        """
+        inserted = 0
+        updated = 0
+        retries = 0
+        while True:
+            with self.metrics.timer(u'ingest.bulk_write'):
+                try:
+                    # the operations all act on different ids so the order doesn't matter
+                    result = await mongo.bulk_write(list(operations.values()), ordered=False)
+                    details = {u'nInserted': result.inserted_count,
+                               u'nMatched': result.matched_count,
+                               u'nModified': result.modified_count,
+                               u'writeErrors': []}
+                except BulkWriteError as e:
+                    details = e.details
+                    # only duplicate key errors on inserts are conflicts, anything else is a real
+                    # problem
+                    if any(error[u'code'] != DUPLICATE_KEY_ERROR
+                           for error in details[u'writeErrors']):
+                        raise
+            self.metrics.observe(u'ingest.bulk_write_size', len(operations))
+            inserted += details[u'nInserted']
+            updated += details[u'nModified']
+
+            conflicts = self.get_conflicts(operations, details, retries)
+            if not conflicts:
+                self.count_written_differs(operations)
+                return inserted, updated
+            retries += 1
+
+            # read the records again and recreate the operations against the new data
+            filter_query = {u'id': {u'$in': list(conflicts)}}
+            with self.metrics.timer(u'ingest.mongo_find'):
+                current_docs = {doc[u'id']: doc async for doc in mongo.find(filter_query)}
+            self.count_written_differs(operations, conflicts, current_docs)
+            operations = self.recreate_operations(conflicts, current_docs, records)
+            if not operations:
+                return inserted, updated
+
+    async def ingest_chunk(self, collection, records, dependencies, op_stats, totals):
+        """
+        Ingests the given chunk of records into the given collection.
+
+        :param collection: the name of the mongo collection
+        :param records: the records in the chunk destined for the collection
+        :param dependencies: the tasks ingesting earlier chunks containing the same record ids, this
+                             chunk is only ingested once they have finished
+        :param op_stats: a dict of collections -> Counters to add the operation stats to
+        :param totals: a Counter of the running totals to add to
+        """
+        if dependencies:
+            await asyncio.gather(*dependencies)
+
+        mongo = self.get_collection(collection)
+        lookup_ids = self.get_lookup_ids(collection, records)
+
+        # create a lookup of the current docs in this collection, keyed on their ids
+        current_docs = {}
+        if lookup_ids:
+            filter_query = {u'id': {u'$in': lookup_ids}}
+            with self.metrics.timer(u'ingest.mongo_find'):
+                current_docs = {doc[u'id']: doc async for doc in mongo.find(filter_query)}
+
+        totals[u'records'] += len(records)
+        operations, operation_records, _sidecar_entries = self.create_chunk_operations(
+            records, current_docs)
+
+        if operations:
+            # run the operations in bulk on mongo
+            inserted, updated = await self.write_operations(mongo, operations, operation_records)
+            # add insert and update totals to the per-collection stats
+            op_stats[collection][self.insert_op_name] += inserted
+            op_stats[collection][self.update_op_name] += updated
+            # add the insert and update totals to the total stats
+            totals[u'inserted'] += inserted
+            totals[u'updated'] += updated
+            # trigger the totals signal
+            self.totals_signal.send(self, total=totals[u'records'], inserted=totals[u'inserted'],
+                                    updated=totals[u'updated'])
+
+    async def ingest_chunks(self, op_stats, totals):
+        """
+        Reads the records from the feeder in chunks and ingests them, keeping up to the configured
+        number of chunks in flight at once.
+
+        :param op_stats: a dict of collections -> Counters to add the operation stats to
+        :param totals: a Counter of the running totals to add to
+        """
+        in_flight = asyncio.Semaphore(self.concurrency)
+        # the tasks which haven't been checked for failures yet
+        tasks = set()
+        # (collection, record id) -> the most recent task ingesting a chunk containing the record
+        latest_tasks = {}
+
+        def on_chunk_done(keys, task):
+            in_flight.release()
+            for key in keys:
+                if latest_tasks.get(key, None) is task:
+                    del latest_tasks[key]
+
+        records_iterator = async_timed_iterator(self.metrics, u'ingest.feeder_read',
+                                                self.feeder.read())
+        try:
+            async for chunk in async_chunk_iterator(records_iterator, self.chunk_size):
+                # map all of the records to the collections they should be inserted into first
+                collection_mapping = defaultdict(list)
+                for record in chunk:
+                    collection_mapping[record.mongo_collection].append(record)
+
+                for collection, records in collection_mapping.items():
+                    # if we haven't seen this collection before during this ingestion we should
+                    # prepare it for ingestion before any chunks are written to it
+                    if collection not in self.seen_collections:
+                        self.seen_collections.add(collection)
+                        await self.prepare_collection(collection)
+
+                    await in_flight.acquire()
+                    # raise any errors from the chunks which have finished as soon as possible
+                    for task in [task for task in tasks if task.done()]:
+                        tasks.discard(task)
+                        task.result()
+
+                    keys = {(collection, record.id) for record in records}
+                    dependencies = {latest_tasks[key] for key in keys if key in latest_tasks}
+                    task = asyncio.ensure_future(self.ingest_chunk(collection, records,
+                                                                   dependencies, op_stats, totals))
+                    task.add_done_callback(lambda done, keys=keys: on_chunk_done(keys, done))
+                    for key in keys:
+                        latest_tasks[key] = task
+                    tasks.add(task)
+
+            await asyncio.gather(*tasks)
+        except BaseException:
+            # don't leave any chunks running in the background
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+
+    async def ingest(self):
+        """
+        Ingests all the records from the feeder object into mongo.
+
+        :return: the stats dict
+        """
+        # keep some running totals for reporting
+        totals = Counter()
+        # store for stats about the insert and update operations that occur on each collection
+        op_stats = defaultdict(Counter)
+
+        created_client = self.client is None
+        if created_client:
+            self.client = get_motor_client(self.config)
+        try:
+            await self.ingest_chunks(op_stats, totals)
+
+            # create the indexes on the collections we clean loaded now that the data is in
+            for collection in self.clean_collections:
+                with self.metrics.timer(u'ingest.create_indexes'):
+                    await self.ensure_mongo_indexes_exist(collection)
+            self.clean_collections = {}
+        finally:
+            if created_client:
+                self.client.close()
+                self.client = None
+
+        return self.finish(op_stats, totals[u'records'], totals[u'inserted'], totals[u'updated'])
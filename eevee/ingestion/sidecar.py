@@ -0,0 +1,219 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import hashlib
+import sqlite3
+
+import ujson
+
+from eevee import utils
+from eevee.mongo import get_mongo
+
+# sqlite limits the number of parameters a single statement can have, older versions to 999
+MAX_PARAMETERS = 900
+
+
+def data_hash(data):
+    """
+    Returns a hash of the given record data. The data is serialised with its keys sorted so that
+    equal dicts always produce the same hash regardless of their key order.
+
+    :param data: the record's data dict
+    :return: the hex digest of the hash or None if the data can't be serialised
+    """
+    try:
+        serialised = ujson.dumps(data, sort_keys=True, escape_forward_slashes=False)
+    except (TypeError, OverflowError, ValueError):
+        # data which can't be hashed is always looked up in mongo
+        return None
+    # the serialised data is always ascii as non-ascii characters are escaped
+    return hashlib.sha1(serialised.encode(u'ascii')).hexdigest()
+
+
+class SidecarIndex(object):
+    """
+    A local, persistent index of the latest version and the hash of the data of each record in mongo
+    which is stored in an sqlite database. The Ingester uses it to skip records whose data hasn't
+    changed without having to look them up in mongo, which when most of a version is unchanged
+    removes most of the reads from an ingestion.
+
+    The index for a collection is built from mongo the first time it is used and is then kept up to
+    date by the Ingester after each bulk write. Entries are only written once the mongo write has
+    succeeded so if an ingestion dies part way through the index is left stale rather than ahead of
+    mongo, which just means the affected records are looked up again next time. The index can't see
+    writes made to mongo by anything else though, so only ingesters using the index should write to
+    a collection it covers. The verify function can be used to check for and repair any drift.
+
+    Only one process should use an index at a time.
+    """
+
+    def __init__(self, path):
+        """
+        :param path: the path of the sqlite database file, it is created if it doesn't exist
+        """
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        with self.connection:
+            self.connection.execute(u'PRAGMA journal_mode=WAL')
+            # the id column has no type so that ids keep their type, this means 1 and "1" are
+            # different ids just as they are in mongo
+            self.connection.execute(u'CREATE TABLE IF NOT EXISTS records ('
+                                    u'collection TEXT NOT NULL, '
+                                    u'id NOT NULL, '
+                                    u'latest_version INTEGER NOT NULL, '
+                                    u'hash TEXT, '
+                                    u'PRIMARY KEY (collection, id))')
+            self.connection.execute(u'CREATE TABLE IF NOT EXISTS collections ('
+                                    u'collection TEXT PRIMARY KEY)')
+
+    def is_built(self, mongo_collection):
+        """
+        Checks whether the index has been built for the given collection.
+
+        :param mongo_collection: the name of the mongo collection
+        :return: True if it has, False if not
+        """
+        cursor = self.connection.execute(u'SELECT 1 FROM collections WHERE collection = ?',
+                                         (mongo_collection,))
+        return cursor.fetchone() is not None
+
+    @staticmethod
+    def iter_mongo_entries(config, mongo_collection):
+        """
+        Reads every record in the given collection from mongo and yields the index entry for each.
+
+        :param config: the config object
+        :param mongo_collection: the name of the mongo collection
+        :return: a generator of 3-tuples containing the record id, latest version and data hash
+        """
+        projection = {u'id': 1, u'latest_version': 1, u'data': 1}
+        with get_mongo(config, config.mongo_database, mongo_collection) as mongo:
+            for mongo_doc in mongo.find({}, projection):
+                yield mongo_doc[u'id'], mongo_doc[u'latest_version'], data_hash(mongo_doc[u'data'])
+
+    def build(self, config, mongo_collection, chunk_size=1000):
+        """
+        Builds the index for the given collection from the records currently in mongo, replacing
+        any existing entries for the collection.
+
+        :param config: the config object
+        :param mongo_collection: the name of the mongo collection
+        :param chunk_size: the number of entries to write at a time
+        """
+        with self.connection:
+            self.connection.execute(u'DELETE FROM records WHERE collection = ?',
+                                    (mongo_collection,))
+            for entries in utils.chunk_iterator(self.iter_mongo_entries(config, mongo_collection),
+                                                chunk_size=chunk_size):
+                self.connection.executemany(u'INSERT INTO records VALUES (?, ?, ?, ?)',
+                                            [(mongo_collection,) + entry for entry in entries])
+            self.connection.execute(u'INSERT OR IGNORE INTO collections VALUES (?)',
+                                    (mongo_collection,))
+
+    def get(self, mongo_collection, record_ids):
+        """
+        Returns the entries for the given record ids. Ids which aren't in the index are left out.
+
+        :param mongo_collection: the name of the mongo collection
+        :param record_ids: the record ids
+        :return: a dict of record ids -> 2-tuples containing the latest version and data hash
+        """
+        entries = {}
+        for chunk in utils.chunk_iterator(record_ids, chunk_size=MAX_PARAMETERS):
+            query = u'SELECT id, latest_version, hash FROM records ' \
+                    u'WHERE collection = ? AND id IN ({})'.format(u', '.join(u'?' * len(chunk)))
+            for record_id, latest_version, entry_hash in self.connection.execute(
+                    query, [mongo_collection] + chunk):
+                entries[record_id] = (latest_version, entry_hash)
+        return entries
+
+    def update(self, mongo_collection, entries):
+        """
+        Adds or replaces the given entries in the index.
+
+        :param mongo_collection: the name of the mongo collection
+        :param entries: an iterable of 3-tuples containing the record id, latest version and data
+                        hash
+        """
+        with self.connection:
+            self.connection.executemany(u'INSERT OR REPLACE INTO records VALUES (?, ?, ?, ?)',
+                                        [(mongo_collection,) + tuple(entry) for entry in entries])
+
+    def delete(self, mongo_collection, record_ids):
+        """
+        Removes the entries for the given record ids from the index.
+
+        :param mongo_collection: the name of the mongo collection
+        :param record_ids: the record ids
+        """
+        with self.connection:
+            self.connection.executemany(u'DELETE FROM records WHERE collection = ? AND id = ?',
+                                        [(mongo_collection, record_id)
+                                         for record_id in record_ids])
+
+    def verify(self, config, mongo_collection, repair=False, chunk_size=1000):
+        """
+        Checks the index for the given collection against the records in mongo and reports any
+        drift between them. Every record in the collection is read from mongo so this is as
+        expensive as building the index.
+
+        :param config: the config object
+        :param mongo_collection: the name of the mongo collection
+        :param repair: whether to correct the index where it has drifted (default: False)
+        :param chunk_size: the number of records to check at a time
+        :return: a dict containing the number of records checked along with lists of the ids of
+                 the records which are missing from the index, have stale entries in the index and
+                 are in the index but not in mongo
+        """
+        report = {
+            u'checked': 0,
+            u'missing': [],
+            u'stale': [],
+            u'extra': [],
+        }
+        # the ids found in mongo are tracked in a temporary table so that the entries for records
+        # which aren't in mongo can be found without holding every id in memory
+        self.connection.execute(u'CREATE TEMP TABLE IF NOT EXISTS verified (id PRIMARY KEY)')
+        self.connection.execute(u'DELETE FROM verified')
+        for entries in utils.chunk_iterator(self.iter_mongo_entries(config, mongo_collection),
+                                            chunk_size=chunk_size):
+            report[u'checked'] += len(entries)
+            self.connection.executemany(u'INSERT OR IGNORE INTO verified VALUES (?)',
+                                        [(entry[0],) for entry in entries])
+            current = self.get(mongo_collection, [entry[0] for entry in entries])
+            drifted = []
+            for record_id, latest_version, entry_hash in entries:
+                if record_id not in current:
+                    report[u'missing'].append(record_id)
+                elif current[record_id] != (latest_version, entry_hash):
+                    report[u'stale'].append(record_id)
+                else:
+                    continue
+                drifted.append((record_id, latest_version, entry_hash))
+            if repair and drifted:
+                self.update(mongo_collection, drifted)
+
+        cursor = self.connection.execute(u'SELECT id FROM records WHERE collection = ? AND id NOT '
+                                         u'IN (SELECT id FROM verified)', (mongo_collection,))
+        report[u'extra'] = [row[0] for row in cursor]
+        self.connection.execute(u'DELETE FROM verified')
+        self.connection.commit()
+        if repair:
+            self.delete(mongo_collection, report[u'extra'])
+            # the index now matches mongo so it counts as built
+            with self.connection:
+                self.connection.execute(u'INSERT OR IGNORE INTO collections VALUES (?)',
+                                        (mongo_collection,))
+        return report
+
+    def close(self):
+        """
+        Closes the sqlite database.
+        """
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
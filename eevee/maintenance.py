@@ -0,0 +1,583 @@
+#!/usr/bin/env python
+# encoding: utf-8
+from __future__ import print_function
+
+import abc
+import argparse
+import time
+import timeit
+from collections import Counter
+from datetime import datetime
+from multiprocessing import Pool, cpu_count
+
+import six
+from bson import BSON
+from pymongo import UpdateOne
+
+from eevee.archive import SegmentArchive
+from eevee.config import Config
+from eevee.diffing import extract_diff, format_diff, diff_codecs, get_diff_mode, SHALLOW_DIFFER, \
+    DICT_DIFFER_DIFFER, REVERSE
+from eevee.indexing.utils import get_versions_and_data
+from eevee.ingestion.sidecar import SidecarIndex
+from eevee.mongo import get_mongo, MongoOpBuffer
+from eevee.utils import chunk_iterator, bounded_imap
+
+
+def document_size(document):
+    """
+    Returns the size of the given document when encoded as BSON.
+
+    :param document: the document
+    :return: the size in bytes
+    """
+    return len(BSON.encode(document))
+
+
+def get_cutoff(days, now=None):
+    """
+    Returns the version the given number of days before now.
+
+    :param days: the number of days
+    :param now: the current time as a version (i.e. a timestamp in milliseconds), defaults to now
+    :return: the version
+    """
+    now = now if now is not None else int(time.time() * 1000)
+    return now - days * 24 * 60 * 60 * 1000
+
+
+def decode_diffs(diffs):
+    """
+    Decodes all the diffs in the given diffs dict and returns the time taken.
+
+    :param diffs: a dict of versions -> stored diffs
+    :return: the number of seconds taken
+    """
+    start = timeit.default_timer()
+    for raw_diff in diffs.values():
+        extract_diff(raw_diff)
+    return timeit.default_timer() - start
+
+
+class DiffRecompressor(object):
+    """
+    Re-encodes all the stored diffs in a collection with a codec (or with no codec at all) and
+    reports the space saved and the change in the time taken to decode them. This should be run
+    whilst nothing is ingesting into the collection.
+    """
+
+    def __init__(self, config, collection, codec=None, batch_size=1000):
+        """
+        :param config: the config object
+        :param collection: the mongo collection to recompress
+        :param codec: the DiffCodec to encode the diffs with, if None the diffs are stored
+                      unencoded
+        :param batch_size: the number of updates to send to mongo in each bulk write
+        """
+        self.config = config
+        self.collection = collection
+        self.codec = codec
+        self.batch_size = batch_size
+
+    def recompress_diffs(self, diffs):
+        """
+        Re-encodes the given diffs with this recompressor's codec.
+
+        :param diffs: a dict of versions -> stored diffs
+        :return: a dict of versions -> re-encoded stored diffs
+        """
+        recompressed = {}
+        for version, raw_diff in diffs.items():
+            differ, diff = extract_diff(raw_diff)
+            recompressed[version] = format_diff(differ, diff, self.codec)
+        return recompressed
+
+    def run(self):
+        """
+        Recompresses the diffs of every record in the collection.
+
+        :return: a report dict containing the number of records processed and changed, the total
+                 size of the diffs before and after in bytes and the total time taken to decode the
+                 diffs before and after in seconds
+        """
+        report = {
+            u'records': 0,
+            u'changed': 0,
+            u'bytes_before': 0,
+            u'bytes_after': 0,
+            u'decode_seconds_before': 0.0,
+            u'decode_seconds_after': 0.0,
+        }
+        with get_mongo(self.config, self.config.mongo_database, self.collection) as mongo:
+            mongo_docs = mongo.find({}, projection={u'diffs': True})
+            with MongoOpBuffer(self.config, get_mongo(self.config, self.config.mongo_database,
+                                                      self.collection),
+                               size=self.batch_size) as op_buffer:
+                for mongo_doc in mongo_docs:
+                    diffs = mongo_doc[u'diffs']
+                    recompressed = self.recompress_diffs(diffs)
+
+                    report[u'records'] += 1
+                    report[u'bytes_before'] += document_size({u'diffs': diffs})
+                    report[u'bytes_after'] += document_size({u'diffs': recompressed})
+                    report[u'decode_seconds_before'] += decode_diffs(diffs)
+                    report[u'decode_seconds_after'] += decode_diffs(recompressed)
+
+                    if recompressed != diffs:
+                        report[u'changed'] += 1
+                        op_buffer.add(UpdateOne({u'_id': mongo_doc[u'_id']},
+                                                {u'$set': {u'diffs': recompressed}}))
+        report[u'bytes_saved'] = report[u'bytes_before'] - report[u'bytes_after']
+        return report
+
+
+@six.add_metaclass(abc.ABCMeta)
+class RetentionPolicy(object):
+    """
+    Abstract class defining the interface for retention policies which decide which versions of a
+    record to keep when compacting its history.
+    """
+
+    @abc.abstractmethod
+    def keep(self, versions):
+        """
+        Returns the versions that should be kept from the given versions. The latest version must
+        always be kept.
+
+        :param versions: a sorted list of versions
+        :return: a set of versions
+        """
+        pass
+
+
+class MonthlyRetentionPolicy(RetentionPolicy):
+    """
+    Keeps all the versions on or after a cutoff version and, before that, only the last version in
+    each calendar month (UTC).
+    """
+
+    def __init__(self, cutoff):
+        """
+        :param cutoff: the cutoff version, all versions on or after this are kept
+        """
+        self.cutoff = cutoff
+
+    @classmethod
+    def from_age(cls, days=365, now=None):
+        """
+        Creates a policy which keeps all the versions from the last given number of days.
+
+        :param days: the number of days to keep all versions for (default: 365)
+        :param now: the current time as a version (i.e. a timestamp in milliseconds), defaults to
+                    now
+        :return: a MonthlyRetentionPolicy
+        """
+        return cls(get_cutoff(days, now))
+
+    def keep(self, versions):
+        months = {}
+        kept = set()
+        for version in versions:
+            if version >= self.cutoff:
+                kept.add(version)
+            else:
+                moment = datetime.utcfromtimestamp(version / 1000.0)
+                # the versions are sorted so this leaves the last version in each month
+                months[(moment.year, moment.month)] = version
+        kept.update(months.values())
+        return kept
+
+
+def compact_mongo_doc(mongo_doc, policy, codec=None, differs=(SHALLOW_DIFFER, DICT_DIFFER_DIFFER)):
+    """
+    Compacts the history of the given record by removing the versions the retention policy doesn't
+    keep. The diffs of the removed versions are squashed into the diff of the next kept version so
+    that the data at each kept version is unchanged. Kept versions whose data turns out to be the
+    same as the previous kept version's data are removed too, as ingestion would never have created
+    them. The new diffs are created in the same diff mode as the record's existing diffs.
+
+    :param mongo_doc: the mongo doc, this must include the id, latest_version and diffs fields as
+                      well as the data and diff_mode fields if the record is in reverse mode
+    :param policy: the RetentionPolicy object
+    :param codec: the DiffCodec to encode the new diffs with, defaults to None
+    :param differs: the differs to choose from when creating the new diffs, the first one that can
+                    diff each version's data is used
+    :return: a 2-tuple containing the update document for the record (or None if there is nothing
+             to compact) and the number of versions the record had before compaction
+    """
+    versions = sorted(int(version) for version in mongo_doc[u'diffs'])
+    keep = policy.keep(versions)
+    if len(keep) == len(versions):
+        return None, len(versions)
+
+    reverse = get_diff_mode(mongo_doc) == REVERSE
+    previous = {}
+    new_diffs = {}
+    new_versions = []
+    for version, data, _next_version in get_versions_and_data(mongo_doc):
+        if version not in keep:
+            continue
+        if reverse:
+            # the diff patches this version's data back to the previous kept version's data
+            differ = next(differ for differ in differs if differ.can_diff(previous))
+            diff = differ.diff(data, previous)
+        else:
+            differ = next(differ for differ in differs if differ.can_diff(data))
+            diff = differ.diff(previous, data)
+        if diff:
+            new_diffs[str(version)] = format_diff(differ, diff, codec)
+            new_versions.append(version)
+            previous = data
+
+    if not new_versions:
+        # there's no data at any of the kept versions, leave the record alone
+        return None, len(versions)
+    return {u'$set': {u'diffs': new_diffs, u'versions': new_versions,
+                      u'latest_version': new_versions[-1]}}, len(versions)
+
+
+def compact_mongo_docs(args):
+    """
+    Compacts the histories of the given records. This is a module level function so that it can be
+    run in a process pool.
+
+    :param args: a 3-tuple of the list of mongo docs, the RetentionPolicy and the DiffCodec to use
+    :return: a 2-tuple of the list of UpdateOne operations needed and a Counter of stats
+    """
+    mongo_docs, policy, codec = args
+    operations = []
+    stats = Counter()
+    for mongo_doc in mongo_docs:
+        update, version_count = compact_mongo_doc(mongo_doc, policy, codec)
+        stats[u'records'] += 1
+        stats[u'versions_before'] += version_count
+        if update is None:
+            stats[u'versions_after'] += version_count
+            continue
+        stats[u'compacted'] += 1
+        stats[u'versions_after'] += len(update[u'$set'][u'versions'])
+        stats[u'bytes_before'] += document_size({u'diffs': mongo_doc[u'diffs']})
+        stats[u'bytes_after'] += document_size({u'diffs': update[u'$set'][u'diffs']})
+        # only apply the update if the record hasn't been changed by an ingestion or had its diffs
+        # archived since we read it
+        operations.append(UpdateOne({u'_id': mongo_doc[u'_id'],
+                                     u'latest_version': mongo_doc[u'latest_version'],
+                                     u'archive': None}, update))
+    return operations, stats
+
+
+class Compactor(object):
+    """
+    Compacts the histories of all the records in a collection according to a retention policy. The
+    records are processed in chunks in a pool of processes with a limit on the number of chunks in
+    flight at once so that memory usage is bounded.
+
+    Records with archived diffs (see DiffArchiver) are skipped, collections should be compacted
+    before they are archived.
+
+    Once a collection has been compacted the indexes built from it should be reindexed using a
+    feeder over the whole collection (e.g. SimpleIndexFeeder(config, collection, None, None)). The
+    indexer replaces the index documents of each record with ones built from the compacted history
+    and deletes the documents for the removed versions.
+    """
+
+    def __init__(self, config, collection, policy, codec=None, chunk_size=1000, processes=None,
+                 max_pending=None):
+        """
+        :param config: the config object
+        :param collection: the mongo collection to compact
+        :param policy: the RetentionPolicy object
+        :param codec: the DiffCodec to encode the new diffs with, defaults to None
+        :param chunk_size: the number of records to compact in each task
+        :param processes: the number of processes to use, defaults to the number of CPUs
+        :param max_pending: the maximum number of chunks being compacted or waiting to be written at
+                            any one time, defaults to twice the number of processes
+        """
+        self.config = config
+        self.collection = collection
+        self.policy = policy
+        self.codec = codec
+        self.chunk_size = chunk_size
+        self.processes = processes
+        self.max_pending = max_pending
+
+    def iter_mongo_docs(self):
+        """
+        Yields the mongo docs from the collection, only including the fields needed for compaction.
+
+        :return: a generator of dicts
+        """
+        # the data and diff mode are needed to replay records in reverse mode
+        projection = {u'diffs': True, u'latest_version': True, u'id': True, u'data': True,
+                      u'diff_mode': True}
+        with get_mongo(self.config, self.config.mongo_database, self.collection) as mongo:
+            for mongo_doc in mongo.find({u'archive': None}, projection=projection):
+                yield mongo_doc
+
+    def run(self):
+        """
+        Compacts the collection.
+
+        :return: a report dict containing the number of records processed and compacted, the total
+                 number of versions before and after and the total size of the compacted records'
+                 diffs before and after in bytes
+        """
+        stats = Counter({name: 0 for name in (u'records', u'compacted', u'versions_before',
+                                              u'versions_after', u'bytes_before', u'bytes_after')})
+        processes = self.processes or cpu_count()
+        max_pending = self.max_pending or 2 * processes
+        pool = Pool(processes=processes)
+        try:
+            chunks = chunk_iterator(self.iter_mongo_docs(), chunk_size=self.chunk_size)
+            tasks = ((chunk, self.policy, self.codec) for chunk in chunks)
+            with MongoOpBuffer(self.config, get_mongo(self.config, self.config.mongo_database,
+                                                      self.collection),
+                               size=self.chunk_size) as op_buffer:
+                for operations, chunk_stats in bounded_imap(pool, compact_mongo_docs, tasks,
+                                                            max_pending):
+                    op_buffer.add_all(operations)
+                    stats.update(chunk_stats)
+        finally:
+            pool.terminate()
+            pool.join()
+
+        report = dict(stats)
+        report[u'versions_removed'] = report[u'versions_before'] - report[u'versions_after']
+        report[u'bytes_saved'] = report[u'bytes_before'] - report[u'bytes_after']
+        return report
+
+
+class DiffArchiver(object):
+    """
+    Moves the diffs of versions older than a cutoff out of the records in a collection and into a
+    SegmentArchive. The latest version's diff is always left in the record. Each record's archived
+    diffs are stored as a single entry in the archive and a pointer to it is stored in the record
+    under the archive key, get_versions_and_data then combines the archived and unarchived diffs
+    when the record's history is replayed. Archiving a record again appends a new entry containing
+    all of its archived diffs to the archive.
+
+    Ingestion can continue whilst a collection is being archived as it only adds new diffs to
+    records. Only one archiver should write to an archive at a time.
+    """
+
+    def __init__(self, config, collection, archive, cutoff, batch_size=1000):
+        """
+        :param config: the config object
+        :param collection: the mongo collection to archive
+        :param archive: the SegmentArchive object to write the diffs to
+        :param cutoff: the diffs of versions before this version are archived
+        :param batch_size: the number of records to archive before flushing the archive to disk and
+                           writing the updates to mongo
+        """
+        self.config = config
+        self.collection = collection
+        self.archive = archive
+        self.cutoff = cutoff
+        self.batch_size = batch_size
+
+    def get_cold_diffs(self, mongo_doc):
+        """
+        Returns the diffs in the given mongo doc which should be archived.
+
+        :param mongo_doc: the mongo doc
+        :return: a dict of versions -> stored diffs
+        """
+        return {version: raw_diff for version, raw_diff in mongo_doc[u'diffs'].items()
+                if int(version) < self.cutoff and int(version) != mongo_doc[u'latest_version']}
+
+    def archive_mongo_doc(self, mongo_doc, cold_diffs):
+        """
+        Writes the given cold diffs, along with any diffs the mongo doc already has in the archive,
+        to the archive and returns the update needed to remove them from the record.
+
+        :param mongo_doc: the mongo doc
+        :param cold_diffs: the diffs to archive, see get_cold_diffs
+        :return: an UpdateOne operation
+        """
+        pointer = mongo_doc.get(u'archive', None)
+        diffs = self.archive.read(pointer) if pointer is not None else {}
+        diffs.update(cold_diffs)
+        update = {
+            u'$set': {u'archive': self.archive.write(diffs)},
+            u'$unset': {u'diffs.{}'.format(version): u'' for version in cold_diffs},
+        }
+        # the update is guarded so that it's only applied if the record's archive pointer hasn't
+        # changed since we read it, note that a None filter matches a missing field in mongo
+        return UpdateOne({u'_id': mongo_doc[u'_id'], u'archive': pointer}, update)
+
+    def run(self):
+        """
+        Archives the collection.
+
+        :return: a report dict containing the number of records processed and archived, the number
+                 of versions archived and the total size of the archived records' diffs in mongo
+                 before and after in bytes
+        """
+        report = {
+            u'records': 0,
+            u'archived': 0,
+            u'versions_archived': 0,
+            u'bytes_before': 0,
+            u'bytes_after': 0,
+        }
+        projection = {u'diffs': True, u'latest_version': True, u'archive': True}
+        with get_mongo(self.config, self.config.mongo_database, self.collection) as mongo:
+            mongo_docs = mongo.find({u'versions': {u'$lt': self.cutoff}}, projection=projection)
+            for chunk in chunk_iterator(mongo_docs, chunk_size=self.batch_size):
+                operations = []
+                for mongo_doc in chunk:
+                    report[u'records'] += 1
+                    cold_diffs = self.get_cold_diffs(mongo_doc)
+                    if not cold_diffs:
+                        continue
+                    remaining = {version: raw_diff
+                                 for version, raw_diff in mongo_doc[u'diffs'].items()
+                                 if version not in cold_diffs}
+                    report[u'archived'] += 1
+                    report[u'versions_archived'] += len(cold_diffs)
+                    report[u'bytes_before'] += document_size({u'diffs': mongo_doc[u'diffs']})
+                    report[u'bytes_after'] += document_size({u'diffs': remaining})
+                    operations.append(self.archive_mongo_doc(mongo_doc, cold_diffs))
+                if operations:
+                    # the archive entries must be on disk before the records point to them
+                    self.archive.flush()
+                    mongo.bulk_write(operations, ordered=False)
+        report[u'bytes_saved'] = report[u'bytes_before'] - report[u'bytes_after']
+        return report
+
+
+def recompress(config, options):
+    """
+    Runs the recompress command.
+
+    :param config: the config object
+    :param options: the parsed options
+    """
+    codec = None if options.codec == u'none' else diff_codecs[options.codec]
+    report = DiffRecompressor(config, options.collection, codec, options.batch_size).run()
+    print(u'Recompressed {changed} of {records} records'.format(**report))
+    print(u'Diffs size: {bytes_before} -> {bytes_after} bytes ({bytes_saved} saved)'.format(
+        **report))
+    print(u'Decode time: {decode_seconds_before:.3f} -> {decode_seconds_after:.3f} '
+          u'seconds'.format(**report))
+
+
+def compact(config, options):
+    """
+    Runs the compact command.
+
+    :param config: the config object
+    :param options: the parsed options
+    """
+    codec = None if options.codec == u'none' else diff_codecs[options.codec]
+    policy = MonthlyRetentionPolicy.from_age(options.keep_days)
+    report = Compactor(config, options.collection, policy, codec, options.chunk_size,
+                       options.processes).run()
+    print(u'Compacted {compacted} of {records} records'.format(**report))
+    print(u'Versions: {versions_before} -> {versions_after} ({versions_removed} removed)'.format(
+        **report))
+    print(u'Compacted diffs size: {bytes_before} -> {bytes_after} bytes ({bytes_saved} '
+          u'saved)'.format(**report))
+
+
+def archive(config, options):
+    """
+    Runs the archive command.
+
+    :param config: the config object
+    :param options: the parsed options
+    """
+    with SegmentArchive(config.archive_path) as segment_archive:
+        report = DiffArchiver(config, options.collection, segment_archive,
+                              get_cutoff(options.keep_days), options.batch_size).run()
+    print(u'Archived {archived} of {records} records'.format(**report))
+    print(u'Versions archived: {versions_archived}'.format(**report))
+    print(u'Diffs size in mongo: {bytes_before} -> {bytes_after} bytes ({bytes_saved} '
+          u'saved)'.format(**report))
+
+
+def verify_sidecar(config, options):
+    """
+    Runs the verify-sidecar command.
+
+    :param config: the config object
+    :param options: the parsed options
+    """
+    with SidecarIndex(options.sidecar_path) as sidecar:
+        report = sidecar.verify(config, options.collection, repair=options.repair)
+    print(u'Checked {} records'.format(report[u'checked']))
+    for problem in (u'missing', u'stale', u'extra'):
+        print(u'{}: {}'.format(problem.capitalize(), len(report[problem])))
+    if options.repair:
+        print(u'Sidecar repaired')
+
+
+def main(args=None):
+    """
+    Command line entry point for the maintenance tools.
+
+    :param args: the command line arguments, if None then sys.argv is used
+    """
+    parser = argparse.ArgumentParser(description=u'Eevee maintenance tools')
+    parser.add_argument(u'--mongo-host', default=u'localhost')
+    parser.add_argument(u'--mongo-port', type=int, default=27017)
+    parser.add_argument(u'--mongo-database', default=u'eevee')
+    parser.add_argument(u'--archive-path', default=None,
+                        help=u'the directory containing the diff archive segment files')
+    commands = parser.add_subparsers(dest=u'command')
+    commands.required = True
+
+    recompress_parser = commands.add_parser(u'recompress',
+                                            help=u're-encode the stored diffs in a collection')
+    recompress_parser.add_argument(u'collection', help=u'the mongo collection to recompress')
+    recompress_parser.add_argument(u'--codec', choices=sorted(diff_codecs) + [u'none'],
+                                   default=u'zj', help=u'the codec to encode the diffs with')
+    recompress_parser.add_argument(u'--batch-size', type=int, default=1000,
+                                   help=u'the number of updates to write in each batch')
+    recompress_parser.set_defaults(function=recompress)
+
+    compact_parser = commands.add_parser(u'compact',
+                                         help=u'remove old versions from the records in a '
+                                              u'collection')
+    compact_parser.add_argument(u'collection', help=u'the mongo collection to compact')
+    compact_parser.add_argument(u'--keep-days', type=int, default=365,
+                                help=u'keep every version from this many days ago onwards, '
+                                     u'before that only the last version in each month is kept')
+    compact_parser.add_argument(u'--codec', choices=sorted(diff_codecs) + [u'none'],
+                                default=u'none', help=u'the codec to encode the new diffs with')
+    compact_parser.add_argument(u'--chunk-size', type=int, default=1000,
+                                help=u'the number of records to compact in each task')
+    compact_parser.add_argument(u'--processes', type=int, default=None,
+                                help=u'the number of processes to use, defaults to the CPU count')
+    compact_parser.set_defaults(function=compact)
+
+    archive_parser = commands.add_parser(u'archive',
+                                         help=u'move old diffs from the records in a collection '
+                                              u'into the archive')
+    archive_parser.add_argument(u'collection', help=u'the mongo collection to archive')
+    archive_parser.add_argument(u'--keep-days', type=int, default=365,
+                                help=u'archive the diffs of versions from before this many days '
+                                     u'ago')
+    archive_parser.add_argument(u'--batch-size', type=int, default=1000,
+                                help=u'the number of records to archive in each batch')
+    archive_parser.set_defaults(function=archive)
+
+    sidecar_parser = commands.add_parser(u'verify-sidecar',
+                                         help=u'check an ingestion sidecar index against the '
+                                              u'records in a collection')
+    sidecar_parser.add_argument(u'sidecar_path', help=u'the path of the sidecar database file')
+    sidecar_parser.add_argument(u'collection', help=u'the mongo collection to check')
+    sidecar_parser.add_argument(u'--repair', action=u'store_true',
+                                help=u'correct any entries which have drifted from mongo')
+    sidecar_parser.set_defaults(function=verify_sidecar)
+
+    options = parser.parse_args(args)
+    if options.command == u'archive' and options.archive_path is None:
+        parser.error(u'--archive-path is required by the archive command')
+    config = Config(mongo_host=options.mongo_host, mongo_port=options.mongo_port,
+                    mongo_database=options.mongo_database, archive_path=options.archive_path)
+    options.function(config, options)
+
+
+if __name__ == u'__main__':
+    main()
@@ -0,0 +1,301 @@
+#!/usr/bin/env python
+# encoding: utf-8
+import bisect
+import os
+import re
+import tempfile
+import threading
+import timeit
+from collections import Counter
+
+
+class Timer(object):
+    """
+    Context manager which times the code run inside it and records the time with a metrics object.
+    """
+
+    __slots__ = (u'metrics', u'name', u'start')
+
+    def __init__(self, metrics, name):
+        """
+        :param metrics: the metrics object to record the time with
+        :param name: the name of the timer
+        """
+        self.metrics = metrics
+        self.name = name
+        self.start = None
+
+    def __enter__(self):
+        self.start = timeit.default_timer()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.metrics.record_time(self.name, timeit.default_timer() - self.start)
+
+
+class NullTimer(object):
+    """
+    Context manager which does nothing, used by the no-op Metrics class.
+    """
+
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+
+NULL_TIMER = NullTimer()
+
+
+class Metrics(object):
+    """
+    The metrics interface which ingestion and indexing report their timings, counts and value
+    distributions to. This base class does nothing at all and is the default used everywhere so
+    that no overhead is added unless metrics are requested. Subclasses should set enabled to True
+    and override the record_time, increment and observe methods at the very least.
+    """
+
+    # whether this metrics object actually records anything. Callers can check this to avoid doing
+    # any extra work to produce metrics which would be thrown away
+    enabled = False
+
+    def timer(self, name):
+        """
+        Returns a context manager which times the code run inside it and records the time under the
+        given name.
+
+        :param name: the name of the timer
+        :return: a context manager
+        """
+        return NULL_TIMER
+
+    def record_time(self, name, seconds):
+        """
+        Records the given time under the given name.
+
+        :param name: the name of the timer
+        :param seconds: the time taken in seconds
+        """
+        pass
+
+    def increment(self, name, value=1):
+        """
+        Increments the given counter.
+
+        :param name: the name of the counter
+        :param value: the amount to increment the counter by (default: 1)
+        """
+        pass
+
+    def observe(self, name, value):
+        """
+        Records an observed value in the given histogram.
+
+        :param name: the name of the histogram
+        :param value: the value
+        """
+        pass
+
+    def get_totals(self):
+        """
+        Returns the totals recorded so far as a dict.
+
+        :return: a dict
+        """
+        return {}
+
+    def flush(self):
+        """
+        Called when ingestion or indexing completes, this allows implementations to export their
+        metrics.
+        """
+        pass
+
+
+# the default metrics object used when one isn't provided
+NULL_METRICS = Metrics()
+
+
+def timed_iterator(metrics, name, iterable):
+    """
+    Wraps the given iterable so that the time taken to retrieve each element from it is recorded
+    under the given name. If the metrics object isn't enabled the iterable is returned as is.
+
+    :param metrics: the metrics object
+    :param name: the name of the timer
+    :param iterable: the iterable to wrap
+    :return: an iterable
+    """
+    if not metrics.enabled:
+        return iterable
+    return _timed_iterator(metrics, name, iterable)
+
+
+def _timed_iterator(metrics, name, iterable):
+    iterator = iter(iterable)
+    while True:
+        start = timeit.default_timer()
+        try:
+            element = next(iterator)
+        except StopIteration:
+            return
+        finally:
+            metrics.record_time(name, timeit.default_timer() - start)
+        yield element
+
+
+# the default histogram buckets, these are suitable for sizes and counts
+DEFAULT_BUCKETS = (1, 10, 100, 1000, 10000, 100000, 1000000, 10000000, float(u'inf'))
+
+
+class InMemoryMetrics(Metrics):
+    """
+    Metrics implementation which aggregates everything in memory. Timers record the number of times
+    they were run and the total and maximum time taken, counters record a total and histograms
+    record the number of observed values which fall into each bucket along with the count and sum
+    of the values. This class is threadsafe.
+    """
+
+    enabled = True
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        """
+        :param buckets: the upper bounds of the histogram buckets, in ascending order. The last
+                        bucket should be infinity so that all values fall into a bucket.
+        """
+        self.buckets = tuple(buckets)
+        self.lock = threading.Lock()
+        # name -> [count, total, max]
+        self.timers = {}
+        self.counters = Counter()
+        # name -> [bucket counts, count, sum]
+        self.histograms = {}
+
+    def timer(self, name):
+        return Timer(self, name)
+
+    def record_time(self, name, seconds):
+        with self.lock:
+            timer = self.timers.get(name, None)
+            if timer is None:
+                self.timers[name] = [1, seconds, seconds]
+            else:
+                timer[0] += 1
+                timer[1] += seconds
+                timer[2] = max(timer[2], seconds)
+
+    def increment(self, name, value=1):
+        with self.lock:
+            self.counters[name] += value
+
+    def observe(self, name, value):
+        with self.lock:
+            histogram = self.histograms.get(name, None)
+            if histogram is None:
+                histogram = self.histograms[name] = [[0] * len(self.buckets), 0, 0]
+            # find the first bucket the value fits in
+            bucket = bisect.bisect_left(self.buckets, value)
+            if bucket < len(self.buckets):
+                histogram[0][bucket] += 1
+            histogram[1] += 1
+            histogram[2] += value
+
+    def get_totals(self):
+        """
+        Returns the totals recorded so far as a dict of the form:
+
+            {
+                "timers": {<name>: {"count": <count>, "total": <seconds>, "max": <seconds>}},
+                "counters": {<name>: <total>},
+                "histograms": {<name>: {"count": <count>, "sum": <sum>, "buckets": [<counts>]}},
+            }
+
+        The bucket counts are not cumulative and are in the same order as the buckets attribute.
+
+        :return: a dict
+        """
+        with self.lock:
+            return {
+                u'timers': {name: {u'count': count, u'total': total, u'max': maximum}
+                            for name, (count, total, maximum) in self.timers.items()},
+                u'counters': dict(self.counters),
+                u'histograms': {name: {u'count': count, u'sum': total, u'buckets': list(buckets)}
+                                for name, (buckets, count, total) in self.histograms.items()},
+            }
+
+
+class PrometheusTextfileMetrics(InMemoryMetrics):
+    """
+    Metrics implementation which aggregates everything in memory and writes it to a file in the
+    Prometheus text exposition format when flushed. This is intended for use with the node
+    exporter's textfile collector. Timers are written as summaries (in seconds), counters as
+    counters and histograms as histograms.
+    """
+
+    def __init__(self, path, namespace=u'eevee', buckets=DEFAULT_BUCKETS):
+        """
+        :param path: the path of the file to write
+        :param namespace: the prefix added to the name of each metric (default: eevee)
+        :param buckets: the upper bounds of the histogram buckets, see InMemoryMetrics
+        """
+        super(PrometheusTextfileMetrics, self).__init__(buckets)
+        self.path = path
+        self.namespace = namespace
+
+    def metric_name(self, name, suffix=u''):
+        """
+        Converts the given name into a valid Prometheus metric name.
+
+        :param name: the name
+        :param suffix: a suffix to add
+        :return: the metric name
+        """
+        return re.sub(u'[^a-zA-Z0-9_]', u'_', u'{}_{}{}'.format(self.namespace, name, suffix))
+
+    def render(self):
+        """
+        Renders the metrics in the Prometheus text exposition format.
+
+        :return: the text
+        """
+        totals = self.get_totals()
+        lines = []
+        for name, timer in sorted(totals[u'timers'].items()):
+            metric = self.metric_name(name, u'_seconds')
+            lines.append(u'# TYPE {} summary'.format(metric))
+            lines.append(u'{}_count {}'.format(metric, timer[u'count']))
+            lines.append(u'{}_sum {!r}'.format(metric, timer[u'total']))
+        for name, total in sorted(totals[u'counters'].items()):
+            metric = self.metric_name(name, u'_total')
+            lines.append(u'# TYPE {} counter'.format(metric))
+            lines.append(u'{} {}'.format(metric, total))
+        for name, histogram in sorted(totals[u'histograms'].items()):
+            metric = self.metric_name(name)
+            lines.append(u'# TYPE {} histogram'.format(metric))
+            cumulative = 0
+            for bound, count in zip(self.buckets, histogram[u'buckets']):
+                cumulative += count
+                le = u'+Inf' if bound == float(u'inf') else u'{}'.format(bound)
+                lines.append(u'{}_bucket{{le="{}"}} {}'.format(metric, le, cumulative))
+            lines.append(u'{}_sum {}'.format(metric, histogram[u'sum']))
+            lines.append(u'{}_count {}'.format(metric, histogram[u'count']))
+        return u'\n'.join(lines) + u'\n'
+
+    def flush(self):
+        """
+        Writes the metrics to the file. The file is written atomically by writing to a temporary
+        file in the same directory and then renaming it so that the collector never reads a partial
+        file.
+        """
+        directory = os.path.dirname(os.path.abspath(self.path))
+        handle, temp_path = tempfile.mkstemp(dir=directory, suffix=u'.tmp')
+        try:
+            with os.fdopen(handle, u'wb') as temp_file:
+                temp_file.write(self.render().encode(u'utf-8'))
+            os.rename(temp_path, self.path)
+        except Exception:
+            os.remove(temp_path)
+            raise
@@ -1,9 +1,12 @@
 #!/usr/bin/env python
 # encoding: utf-8
 
+import threading
 from contextlib import contextmanager
 
-from pymongo import MongoClient
+from bson import BSON
+from pymongo import MongoClient, UpdateOne
+from six.moves import queue
 
 from eevee.utils import OpBuffer
 
@@ -38,13 +41,100 @@ def get_mongo(config, database=None, collection=None):
             yield client[database][collection]
 
 
+# mongo's maximum message size, bulk writes are split into batches of at most this size
+MAX_MESSAGE_BYTES = 48000000
+
+
+def bson_op_size(op):
+    """
+    Returns the approximate size of the given pymongo write operation in bytes by encoding its
+    filter and document as BSON.
+
+    :param op: a pymongo write operation object (e.g. InsertOne, UpdateOne etc)
+    :return: the size in bytes
+    """
+    size = 0
+    for attribute in (u'_filter', u'_doc'):
+        value = getattr(op, attribute, None)
+        if value is not None:
+            size += len(BSON.encode(value))
+    return size
+
+
+def update_op_key(op):
+    """
+    Key function for use with the OpBuffer which allows UpdateOne operations with the same filter
+    to be merged with merge_update_ops. All other operations aren't merged and, as they have no key,
+    the buffer doesn't merge updates across them.
+
+    :param op: a pymongo write operation object
+    :return: the key or None if the op shouldn't be merged
+    """
+    if not isinstance(op, UpdateOne) or op._collation or op._array_filters:
+        return None
+    return repr(sorted(op._filter.items())), op._upsert
+
+
+def _as_each(value):
+    """
+    Returns the list of values being added by an $addToSet field value.
+
+    :param value: the $addToSet field value
+    :return: a list
+    """
+    if isinstance(value, dict) and u'$each' in value:
+        return list(value[u'$each'])
+    return [value]
+
+
+def merge_update_ops(existing, new):
+    """
+    Merge function for use with the OpBuffer which merges two UpdateOne operations with the same
+    filter into a single UpdateOne. The $set and $unset operators are merged with the new op's
+    values taking precedence, $addToSet values are combined using $each and $inc values are added
+    together. If the ops use any other operators or their fields clash then None is returned to
+    indicate that they can't be merged.
+
+    :param existing: the UpdateOne already in the buffer
+    :param new: the new UpdateOne
+    :return: an UpdateOne or None
+    """
+    merged = {operator: dict(fields) for operator, fields in existing._doc.items()}
+    for operator, fields in new._doc.items():
+        target = merged.setdefault(operator, {})
+        for field, value in fields.items():
+            if operator in (u'$set', u'$unset') or field not in target:
+                target[field] = value
+            elif operator == u'$addToSet':
+                values = _as_each(target[field])
+                values.extend(v for v in _as_each(value) if v not in values)
+                target[field] = {u'$each': values}
+            elif operator == u'$inc':
+                target[field] += value
+            else:
+                return None
+
+    # mongo rejects updates which modify the same field, or a field and its parent, in more than
+    # one place
+    fields = [field for fields in merged.values() for field in fields]
+    unique_fields = set(fields)
+    if len(unique_fields) != len(fields):
+        return None
+    for field in fields:
+        parts = field.split(u'.')
+        if any(u'.'.join(parts[:i]) in unique_fields for i in range(1, len(parts))):
+            return None
+    return UpdateOne(existing._filter, merged, upsert=existing._upsert)
+
+
 class MongoOpBuffer(OpBuffer):
     """
     Wrapper around the OpBuffer which when handling the ops added simply passes them to mongo's
     bulk_write function.
     """
 
-    def __init__(self, config, mongo_context, size=1000):
+    def __init__(self, config, mongo_context, size=1000, max_bytes=None, max_age=None,
+                 coalesce=False):
         """
         :param config: the config object
         :param mongo_context: the mongo context manager object. This will be entered (using
@@ -52,8 +142,18 @@ class MongoOpBuffer(OpBuffer):
                               called on it when handling. An example of the object expected here
                               would be the unentered return from the get_mongo util function.
         :param size: the size of the op buffer, defaults to 1000
+        :param max_bytes: the maximum size of each batch of ops in bytes, measured by encoding the
+                          ops as BSON. Defaults to None, meaning there is no limit.
+                          MAX_MESSAGE_BYTES is a sensible value to use when the ops are large.
+        :param max_age: the maximum number of seconds an op can wait in the buffer before it is
+                        handled, see OpBuffer. Defaults to None, meaning there is no limit.
+        :param coalesce: whether to merge UpdateOne operations with the same filter together
+                         before they are written (default: False)
         """
-        super(MongoOpBuffer, self).__init__(size)
+        super(MongoOpBuffer, self).__init__(size, max_bytes=max_bytes, size_of=bson_op_size,
+                                            max_age=max_age,
+                                            key=update_op_key if coalesce else None,
+                                            merge=merge_update_ops)
         self.config = config
         self.mongo_context = mongo_context
         self.mongo = None
@@ -74,3 +174,109 @@ class MongoOpBuffer(OpBuffer):
         # exit the context and clear the mongo attribute we stored in __enter__
         self.mongo_context.__exit__(*args, **kwargs)
         self.mongo = None
+
+
+class ThreadedMongoOpBuffer(MongoOpBuffer):
+    """
+    A MongoOpBuffer which writes the full buffers to mongo in one or more background writer
+    threads rather than in the thread adding the ops. The buffers are handed to the writers through
+    a bounded queue so if mongo falls behind, adding ops blocks until there is space in the queue.
+
+    If a write fails, the error is raised by the next call to add, flush or __exit__ and any
+    buffers still waiting in the queue are discarded. When the context is exited without an error
+    all the buffers are written before __exit__ returns.
+    """
+
+    def __init__(self, config, mongo_context, size=1000, writers=1, queue_size=2, max_bytes=None,
+                 max_age=None, coalesce=False):
+        """
+        :param config: the config object
+        :param mongo_context: the mongo context manager object, see MongoOpBuffer
+        :param size: the size of the op buffer, defaults to 1000
+        :param writers: the number of writer threads to use, defaults to 1. Note that when using
+                        more than one writer the buffers may be written in a different order to
+                        the one they were filled in.
+        :param queue_size: the maximum number of full buffers that can be waiting to be written,
+                           defaults to 2
+        :param max_bytes: the maximum size of each batch of ops in bytes, see MongoOpBuffer
+        :param max_age: the maximum number of seconds an op can wait in the buffer, see
+                        MongoOpBuffer
+        :param coalesce: whether to merge UpdateOne operations with the same filter, see
+                         MongoOpBuffer
+        """
+        super(ThreadedMongoOpBuffer, self).__init__(config, mongo_context, size, max_bytes,
+                                                    max_age, coalesce)
+        self.writers = writers
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.threads = []
+        self.error = None
+
+    def write(self):
+        """
+        Writer thread target which writes the buffers from the queue to mongo until it receives
+        None.
+        """
+        while True:
+            ops = self.queue.get()
+            try:
+                if ops is None:
+                    return
+                # once a write has failed there is no point writing anything else
+                if self.error is None:
+                    self.mongo.bulk_write(ops)
+            except Exception as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def check_error(self):
+        """
+        Raises the error from a failed write if there has been one. The error is cleared once
+        raised.
+        """
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def handle_ops(self):
+        """
+        Puts the current buffer on the queue for the writer threads, blocking if the queue is full.
+        """
+        self.check_error()
+        self.queue.put(self.ops)
+
+    def add(self, op):
+        self.check_error()
+        return super(ThreadedMongoOpBuffer, self).add(op)
+
+    def flush(self):
+        """
+        Flushes any remaining ops in the buffer and waits for all the buffers to be written.
+        """
+        super(ThreadedMongoOpBuffer, self).flush()
+        self.queue.join()
+        self.check_error()
+
+    def __enter__(self):
+        super(ThreadedMongoOpBuffer, self).__enter__()
+        for _ in range(self.writers):
+            thread = threading.Thread(target=self.write)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        try:
+            # only flush if there are no exceptions
+            if exc_type is None and exc_val is None and exc_tb is None:
+                self.flush()
+        finally:
+            # stop the writer threads, they'll finish writing anything already on the queue first
+            for _ in self.threads:
+                self.queue.put(None)
+            for thread in self.threads:
+                thread.join()
+            self.threads = []
+            self.mongo_context.__exit__(exc_type, exc_val, exc_tb)
+            self.mongo = None
@@ -1,12 +1,19 @@
 #!/usr/bin/env python
 # encoding: utf-8
+import base64
 import bisect
+import itertools
+import json
+import threading
 from collections import defaultdict
 
+import six
+
+from elasticsearch import NotFoundError
 from elasticsearch_dsl import Search, Q, A
 from elasticsearch_dsl.query import Bool
 
-from eevee.indexing.utils import get_elasticsearch_client
+from eevee.indexing.utils import DOC_TYPE, get_elasticsearch_client
 
 
 def create_version_query(version):
@@ -55,6 +62,482 @@ def create_index_specific_version_filter(indexes_and_versions):
         return Bool(should=filters, minimum_should_match=1)
 
 
+def iter_composite_buckets(search, aggregation_name):
+    """
+    Runs the given search and yields each bucket from the named composite aggregation, paginating
+    through the aggregation's results using the after key until they are exhausted. The search is
+    modified in place as the after key is updated on each iteration.
+
+    :param search: a Search object with a composite aggregation defined on it
+    :param aggregation_name: the name of the composite aggregation
+    :return: a generator of bucket dicts
+    """
+    while True:
+        # run the search and get the result, ignore_cache makes sure that calling execute gives us
+        # back new data from the backend. We need this because we just sneakily change the after
+        # value in the aggregation without generating a new search object
+        result = search.execute(ignore_cache=True).aggs.to_dict()[aggregation_name]
+
+        for bucket in result[u'buckets']:
+            yield bucket
+
+        # retrieve the after key for pagination if there is one
+        after_key = result.get(u'after_key', None)
+        if after_key is None:
+            # if there isn't then we're done
+            break
+        else:
+            # otherwise apply it to the aggregation
+            search.aggs[aggregation_name].after = after_key
+
+
+def round_version(versions, target_version):
+    """
+    Rounds the target version down to the nearest version in the given sorted list of versions.
+
+    If the target version is lower than the lowest version in the list then the target version is
+    returned. If the target version is None or higher than the highest version in the list then the
+    highest version is returned. If the list of versions is empty, None is returned.
+
+    :param versions: a list of versions in ascending order
+    :param target_version: the target version
+    :return: the rounded version
+    """
+    if not versions:
+        # something isn't right, just return None
+        return None
+    elif target_version is None or target_version >= versions[-1]:
+        # cap the requested version to the latest version
+        return versions[-1]
+    elif target_version < versions[0]:
+        # use the requested version if it's lower than the lowest available version
+        return target_version
+    else:
+        # find the lowest, nearest version to the requested one
+        position = bisect.bisect_right(versions, target_version)
+        return versions[position - 1]
+
+
+def create_status_search(config, indexes=None):
+    """
+    Creates a Search object which will find the status documents of the given indexes, or of all
+    indexes if indexes is None. Only the index name and latest version are retrieved for each.
+
+    :param config: the config object
+    :param indexes: the prefixed index names, optional
+    :return: a Search object
+    """
+    search = Search(index=config.elasticsearch_status_index_name) \
+        .source([u'index_name', u'latest_version'])
+    if indexes is not None:
+        search = search.filter(
+            Q(u'bool',
+              should=[Q(u'term', index_name=index) for index in indexes],
+              minimum_should_match=1))
+    return search
+
+
+def create_version_summaries_body(indexes):
+    """
+    Creates the body of the mget request which retrieves the latest versions and version summaries
+    from the status documents of the given indexes.
+
+    :param indexes: the prefixed index names
+    :return: a dict
+    """
+    return {u'docs': [{u'_id': index, u'_source': [u'latest_version', u'version_summary']}
+                      for index in indexes]}
+
+
+def parse_version_summaries(response):
+    """
+    Extracts the version summaries from the response to a request made with the body from
+    create_version_summaries_body. Only summaries that were written alongside their index's current
+    status are returned.
+
+    :param response: the mget response
+    :return: a dict of index names -> version summary dicts
+    """
+    summaries = {}
+    for doc in response[u'docs']:
+        if not doc.get(u'found', False):
+            continue
+        source = doc[u'_source']
+        summary = source.get(u'version_summary', None)
+        if summary is not None and summary[u'latest_version'] == source[u'latest_version']:
+            summaries[doc[u'_id']] = summary
+    return summaries
+
+
+def create_index_counts_search(indexes):
+    """
+    Creates a Search object which will count the documents in each of the given indexes using a
+    single terms aggregation named "indexes".
+
+    :param indexes: the prefixed index names
+    :return: a Search object
+    """
+    # [0:0] ensures we don't waste time by getting hits back
+    search = Search(index=list(indexes)).params(ignore_unavailable=True)[0:0]
+    search.aggs.bucket(u'indexes', u'terms', field=u'_index', size=len(indexes))
+    return search
+
+
+def filter_valid_summaries(summaries, counts_response):
+    """
+    Filters out the summaries which don't match the number of documents in their indexes and
+    returns the version lists from the ones that do.
+
+    :param summaries: a dict of index names -> version summary dicts
+    :param counts_response: the raw response from the search created by create_index_counts_search
+    :return: a dict of index names -> version summary lists
+    """
+    counts = {bucket[u'key']: bucket[u'doc_count']
+              for bucket in counts_response[u'aggregations'][u'indexes'][u'buckets']}
+    return {index: summary[u'versions'] for index, summary in summaries.items()
+            if summary[u'total'] == counts.get(index, 0)}
+
+
+def create_version_counts_search(index, search=None):
+    """
+    Creates a Search object with a composite aggregation named "versions" on it which counts the
+    number of records in the given index at each version.
+
+    :param index: the prefixed index name
+    :param search: a Search object to limit the versions counted, optional
+    :return: a Search object
+    """
+    # if there is no search passed in, make our own
+    if search is None:
+        search = Search()
+    # [0:0] ensures we don't waste time by getting hits back
+    search = search.index(index)[0:0]
+    search.aggs.bucket(u'versions', u'composite', size=1000,
+                       sources={u'version': A(u'terms', field=u'meta.version', order=u'asc')})
+    return search
+
+
+def create_records_versions_search(index, record_ids):
+    """
+    Creates a Search object with a composite aggregation named "versions" on it which finds the
+    versions of each of the given records in the given index. The aggregation's buckets are keyed
+    on the record id and the version.
+
+    :param index: the prefixed index name
+    :param record_ids: the record ids
+    :return: a Search object
+    """
+    # [0:0] ensures we don't waste time by getting hits back
+    search = Search(index=index).filter(u'terms', **{u'data._id': list(record_ids)})[0:0]
+    # the sources are defined in a list to ensure the buckets are ordered by record id first and
+    # then by version
+    search.aggs.bucket(u'versions', u'composite', size=1000, sources=[
+        {u'id': A(u'terms', field=u'data._id')},
+        {u'version': A(u'terms', field=u'meta.version', order=u'asc')},
+    ])
+    return search
+
+
+def collect_records_versions(record_ids, buckets):
+    """
+    Given some record ids and the buckets from the aggregation created by
+    create_records_versions_search, return the versions of each record. The ids returned by
+    elasticsearch may not be the same type as the ones requested (for example, an int rather than a
+    string) and, as the data._id field is normalised to lowercase, may not be the same case either.
+    They are therefore matched up using their lowercased string representations and the returned
+    dict is keyed on the record ids exactly as they were passed in. Note that this means ids which
+    only differ by case can't be told apart, just as they can't when searching on data._id.
+
+    :param record_ids: the record ids
+    :param buckets: an iterable of composite aggregation buckets
+    :return: a dict of record ids -> lists of versions in ascending order
+    """
+    versions = {record_id: [] for record_id in record_ids}
+    lookup = defaultdict(list)
+    for record_id in versions:
+        lookup[six.text_type(record_id).lower()].append(record_id)
+    for bucket in buckets:
+        for record_id in lookup.get(six.text_type(bucket[u'key'][u'id']).lower(), []):
+            versions[record_id].append(bucket[u'key'][u'version'])
+    return versions
+
+
+def create_versions_after_search(indexes_and_tails):
+    """
+    Creates a Search object with a composite aggregation named "versions" on it which finds the
+    versions in each of the given indexes after the version the index is mapped to. If an index is
+    mapped to None then all of its versions are found. The aggregation's buckets are keyed on the
+    index and the version.
+
+    :param indexes_and_tails: a dict of concrete prefixed index names -> versions (or None)
+    :return: a Search object
+    """
+    filters = []
+    cold_indexes = [index for index, tail in indexes_and_tails.items() if tail is None]
+    if cold_indexes:
+        # get everything from the indexes we have nothing for
+        filters.append(Q(u'terms', _index=cold_indexes))
+    for index, tail in indexes_and_tails.items():
+        if tail is not None:
+            # only get the versions after the tail from the indexes we have partial data for
+            filters.append(Bool(filter=[Q(u'term', _index=index),
+                                        Q(u'range', **{u'meta.version': {u'gt': tail}})]))
+
+    # [0:0] ensures we don't waste time by getting hits back
+    search = Search(index=list(indexes_and_tails.keys())) \
+        .filter(Bool(should=filters, minimum_should_match=1)) \
+        .params(ignore_unavailable=True)[0:0]
+    # the sources are defined in a list to ensure the buckets are ordered by index first and then
+    # by version
+    search.aggs.bucket(u'versions', u'composite', size=1000, sources=[
+        {u'index': A(u'terms', field=u'_index')},
+        {u'version': A(u'terms', field=u'meta.version', order=u'asc')},
+    ])
+    return search
+
+
+# the filter path used when retrieving index details to resolve concrete index names and uuids
+CONCRETE_INDEXES_FILTER_PATH = u'*.aliases,*.settings.index.uuid'
+
+
+def parse_concrete_indexes(indexes, response):
+    """
+    Given some index names and the response from an indices.get request on them (filtered using
+    CONCRETE_INDEXES_FILTER_PATH), work out the concrete indexes each name refers to and the uuid of
+    each concrete index. Names which can't be resolved, for example because they are wildcard
+    patterns or don't exist, are mapped to an empty list.
+
+    :param indexes: a list of index names
+    :param response: the indices.get response
+    :return: a 2-tuple containing a dict of index names -> lists of concrete index names and a
+             dict of concrete index names -> uuids
+    """
+    concrete_indexes = {index: [] for index in indexes}
+    uuids = {}
+    for concrete_index, details in response.items():
+        uuids[concrete_index] = details[u'settings'][u'index'][u'uuid']
+        for name in itertools.chain([concrete_index], details.get(u'aliases', {})):
+            if name in concrete_indexes:
+                concrete_indexes[name].append(concrete_index)
+    return concrete_indexes, uuids
+
+
+def merge_timelines(indexes, concrete_indexes, concrete_timelines):
+    """
+    Given some index names, the concrete indexes they refer to and the versions of each concrete
+    index, return the versions of each index name. Names which refer to multiple concrete indexes
+    are given the combined versions of those indexes. Names which don't refer to any concrete
+    indexes are left out of the returned dict.
+
+    :param indexes: a list of index names
+    :param concrete_indexes: a dict of index names -> lists of concrete index names
+    :param concrete_timelines: a dict of concrete index names -> lists of versions
+    :return: a dict of index names -> lists of versions in ascending order
+    """
+    timelines = {}
+    for index in indexes:
+        if len(concrete_indexes[index]) == 1:
+            timelines[index] = concrete_timelines[concrete_indexes[index][0]]
+        elif concrete_indexes[index]:
+            # the name is an alias for a few indexes, merge their versions
+            timelines[index] = sorted(set(itertools.chain.from_iterable(
+                concrete_timelines[concrete_index] for concrete_index in concrete_indexes[index])))
+    return timelines
+
+
+# the sort used when paging through versioned searches with search_after. Each record only has one
+# document per index at any given version so sorting on the index and record id nearly gives a total
+# order, the version is included to keep it total if a search isn't limited to a single version.
+# The data._id field is normalised to lowercase though so records whose ids only differ by case
+# would tie, the document id (which is unique within an index) breaks these ties. It comes last so
+# that it is only compared when everything else is equal
+SEARCH_AFTER_SORT = [
+    {u'_index': {u'order': u'asc'}},
+    {u'data._id': {u'order': u'asc'}},
+    {u'meta.version': {u'order': u'asc'}},
+    {u'_id': {u'order': u'asc'}},
+]
+
+
+def encode_cursor(sort_values):
+    """
+    Encodes the sort values of a hit into an opaque string cursor which can be passed back to
+    iter_search_after to resume paging after the hit.
+
+    :param sort_values: the sort values of the hit
+    :return: the cursor string
+    """
+    data = json.dumps(list(sort_values), separators=(u',', u':')).encode(u'utf-8')
+    return base64.urlsafe_b64encode(data).decode(u'ascii')
+
+
+def decode_cursor(cursor):
+    """
+    Decodes a cursor created by encode_cursor back into the sort values it holds.
+
+    :param cursor: the cursor string
+    :return: a list of sort values
+    """
+    try:
+        sort_values = json.loads(base64.urlsafe_b64decode(cursor.encode(u'ascii')).decode(u'utf-8'))
+    except (ValueError, TypeError, UnicodeError):
+        raise ValueError(u'Invalid cursor: {}'.format(cursor))
+    if not isinstance(sort_values, list) or len(sort_values) != len(SEARCH_AFTER_SORT):
+        raise ValueError(u'Invalid cursor: {}'.format(cursor))
+    return sort_values
+
+
+def create_search_after_search(search, batch_size, sort_values=None):
+    """
+    Creates a Search object which will retrieve the next batch of hits from the given search, in the
+    stable SEARCH_AFTER_SORT order, after the hit with the given sort values. If the sort values are
+    None then the first batch is retrieved.
+
+    :param search: a Search object
+    :param batch_size: the number of hits to retrieve
+    :param sort_values: the sort values of the last hit retrieved, optional
+    :return: a Search object
+    """
+    search = search.sort(*SEARCH_AFTER_SORT)[0:batch_size]
+    if sort_values is not None:
+        search = search.extra(search_after=sort_values)
+    return search
+
+
+class VersionTimelines(object):
+    """
+    Threadsafe cache of the versions available in each concrete index. Each index's timeline is
+    stored alongside the index's UUID and the latest version the status index reported for it when
+    the timeline was last refreshed. This allows the timeline to be used until the status index
+    reports a new latest version, at which point it can be extended by appending the versions found
+    after the cached tail.
+
+    If the index's UUID changes (i.e. it has been deleted and recreated) or its latest version goes
+    backwards then the cached timeline is discarded as the index's contents can't be an extension
+    of what is cached. Versions can also disappear from an index without either of these things
+    happening, for example if a record's history is pruned and the record reindexed, in which case
+    the cache should be told using clear.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # index name -> 3-tuple of the uuid, the latest version and the list of versions in
+        # ascending order
+        self._timelines = {}
+
+    def _get_entry(self, index, uuid, latest_version):
+        """
+        Returns the cached latest version and versions for the given index if they can be used as
+        the basis of the timeline for the index with the given uuid and latest version, otherwise
+        returns (None, None).
+
+        :param index: the concrete index name
+        :param uuid: the index's uuid
+        :param latest_version: the latest version of the index according to the status index
+        :return: a 2-tuple of the cached latest version and the list of cached versions
+        """
+        with self._lock:
+            cached_uuid, cached_latest_version, versions = self._timelines.get(index,
+                                                                               (None, None, None))
+        if cached_uuid != uuid or cached_latest_version > latest_version:
+            return None, None
+        return cached_latest_version, versions
+
+    def get(self, index, uuid, latest_version):
+        """
+        Returns the cached versions for the given index if the timeline is current with respect to
+        the given uuid and latest version, otherwise None is returned.
+
+        :param index: the concrete index name
+        :param uuid: the index's uuid
+        :param latest_version: the latest version of the index according to the status index
+        :return: a list of versions in ascending order or None
+        """
+        cached_latest_version, versions = self._get_entry(index, uuid, latest_version)
+        if versions is not None and cached_latest_version == latest_version:
+            return versions
+        return None
+
+    def get_tail(self, index, uuid, latest_version):
+        """
+        Returns the highest version cached for the given index, or None if nothing is cached or
+        the cached timeline can't be extended to bring it up to date with the given uuid and latest
+        version.
+
+        :param index: the concrete index name
+        :param uuid: the index's uuid
+        :param latest_version: the latest version of the index according to the status index
+        :return: a version or None
+        """
+        _cached_latest_version, versions = self._get_entry(index, uuid, latest_version)
+        return versions[-1] if versions else None
+
+    def update(self, index, uuid, latest_version, new_versions, replace=False):
+        """
+        Appends the given new versions to the index's timeline and records the uuid and latest
+        version it is now current with. Any new versions that aren't after the cached tail are
+        ignored. If the cached timeline can't be extended (see get_tail) or replace is True then
+        the timeline is replaced with the new versions.
+
+        :param index: the concrete index name
+        :param uuid: the index's uuid
+        :param latest_version: the latest version of the index according to the status index
+        :param new_versions: the versions to append, in ascending order
+        :param replace: whether to replace the timeline rather than extend it (default: False)
+        :return: the updated list of versions for the index
+        """
+        with self._lock:
+            cached_uuid, cached_latest_version, versions = self._timelines.get(index,
+                                                                               (None, None, []))
+            if replace or cached_uuid != uuid or cached_latest_version > latest_version:
+                versions = []
+            tail = versions[-1] if versions else None
+            # create a new list rather than extending the existing one in place as callers may be
+            # holding a reference to it
+            versions = versions + [version for version in new_versions
+                                   if tail is None or version > tail]
+            self._timelines[index] = (uuid, latest_version, versions)
+        return versions
+
+    def lookup(self, uuids, latest_versions):
+        """
+        Looks up the cached timelines for the given concrete indexes. Indexes with a current
+        timeline are returned with their cached versions, the rest are returned with the version
+        after which new versions need retrieving to bring their timelines up to date (None if all
+        versions are needed). Indexes without a latest version always need all their versions.
+
+        :param uuids: a dict of concrete index names -> uuids
+        :param latest_versions: a dict of concrete index names -> latest versions
+        :return: a 2-tuple containing a dict of index names -> cached versions and a dict of index
+                 names -> tails (or None)
+        """
+        timelines = {}
+        to_refresh = {}
+        for index, uuid in uuids.items():
+            latest_version = latest_versions.get(index, None)
+            if latest_version is None:
+                to_refresh[index] = None
+                continue
+            versions = self.get(index, uuid, latest_version)
+            if versions is None:
+                to_refresh[index] = self.get_tail(index, uuid, latest_version)
+            else:
+                timelines[index] = versions
+        return timelines, to_refresh
+
+    def clear(self, index=None):
+        """
+        Clears the cached timeline for the given index, or for all indexes if index is None.
+
+        :param index: the concrete index name, optional
+        """
+        with self._lock:
+            if index is None:
+                self._timelines.clear()
+            else:
+                self._timelines.pop(index, None)
+
+
 class SearchHelper(object):
     """
     Class providing a set of helper functions for elasticsearch indexes created using eevee. This
@@ -76,6 +559,7 @@ class SearchHelper(object):
                                                    http_compress=False)
         else:
             self.client = client
+        self.version_timelines = VersionTimelines()
 
     def get_latest_index_versions(self, indexes=None):
         """
@@ -93,14 +577,45 @@ class SearchHelper(object):
         if not self.client.indices.exists(self.config.elasticsearch_status_index_name):
             return {}
 
-        search = Search(using=self.client, index=self.config.elasticsearch_status_index_name)
-        if indexes is not None:
-            search = search.filter(
-                Q(u'bool',
-                  should=[Q(u'term', index_name=index) for index in indexes],
-                  minimum_should_match=1))
+        search = create_status_search(self.config, indexes).using(self.client)
         return {hit.index_name: hit.latest_version for hit in search.scan()}
 
+    def get_version_summaries(self, indexes, validate=True):
+        """
+        Returns the version summaries held in the status index for the given indexes. Each summary
+        is a list of dicts in ascending version order, each containing a version and the number of
+        changes made in it, exactly as returned by get_index_version_counts. The summaries are
+        written by the indexer when it updates an index's status and are retrieved here in a single
+        request.
+
+        Summaries which weren't written alongside the index's current status are ignored. If
+        validate is True (the default) the summaries are also checked against the number of
+        documents in each index, using a single aggregation, and ignored if they don't match. This
+        catches indexes which have been modified without their summaries being updated.
+
+        Indexes without a usable summary are not included in the returned dict.
+
+        :param indexes: the names of the concrete indexes (aliases are not resolved)
+        :param validate: whether to check the summaries against the index document counts
+        :return: a dict of index names -> version summaries
+        """
+        if not indexes:
+            return {}
+        try:
+            response = self.client.mget(create_version_summaries_body(indexes),
+                                        index=self.config.elasticsearch_status_index_name,
+                                        doc_type=DOC_TYPE)
+        except NotFoundError:
+            # the status index doesn't exist
+            return {}
+
+        summaries = parse_version_summaries(response)
+        if validate and summaries:
+            search = create_index_counts_search(list(summaries.keys()))
+            counts_response = search.using(self.client).execute().to_dict()
+            return filter_valid_summaries(summaries, counts_response)
+        return {index: summary[u'versions'] for index, summary in summaries.items()}
+
     def get_record_versions(self, index, record_id):
         """
         Given the id of a record, returns all the available versions of that record in the given
@@ -111,12 +626,24 @@ class SearchHelper(object):
         :param record_id: the record id
         :return: a list of sorted versions available for the given record
         """
-        search = Search(using=self.client, index=index) \
-            .query(u'term', **{u'data._id': record_id}) \
-            .source([u'meta.version'])
-        return sorted(hit[u'meta'][u'version'] for hit in search.scan())
+        return self.get_records_versions(index, [record_id])[record_id]
 
-    def get_index_versions(self, index, search=None):
+    def get_records_versions(self, index, record_ids):
+        """
+        Given some record ids, returns all the available versions of each record in the given index.
+        The versions of all the records are found using a single composite aggregation on the record
+        id and version, rather than a search per record.
+
+        :param index: the prefixed index name
+        :param record_ids: the record ids
+        :return: a dict of record ids -> lists of versions in ascending order
+        """
+        if not record_ids:
+            return {}
+        search = create_records_versions_search(index, record_ids).using(self.client)
+        return collect_records_versions(record_ids, iter_composite_buckets(search, u'versions'))
+
+    def get_index_versions(self, index, search=None, use_summary=False):
         """
         Given an index, return a list of the versions available for that index. These will be
         provided in ascending order. If the search argument is provided then the versions returned
@@ -124,11 +651,13 @@ class SearchHelper(object):
 
         :param index: the prefixed index name
         :param search: a Search object, optional
+        :param use_summary: whether to use the index's version summary from the status index if
+                            there is a valid one and no search is passed (default: False)
         :return: a list of versions in ascending order
         """
-        return [vc[u'version'] for vc in self.get_index_version_counts(index, search)]
+        return [vc[u'version'] for vc in self.get_index_version_counts(index, search, use_summary)]
 
-    def get_index_version_counts(self, index, search=None):
+    def get_index_version_counts(self, index, search=None, use_summary=False):
         """
         Given an index, return a list of dicts each containing a version and a count of the number
         of records that were changed in that version. The dict is structure like so:
@@ -142,43 +671,111 @@ class SearchHelper(object):
         provided then the versions and counts returned will be limited to the versions covered by
         the search.
 
+        If use_summary is True, no search is passed and the status index holds a valid version
+        summary for the index (see get_version_summaries) then the summary is returned rather than
+        aggregating over the whole index.
+
         :param index: the prefixed index
         :param search: a Search object, optional
+        :param use_summary: whether to use the index's version summary from the status index if
+                            there is a valid one and no search is passed (default: False)
         :return: a list of dicts of version and changes count data
         """
-        versions = []
-        # if there is no search passed in, make our own
-        if search is None:
-            search = Search()
-        # [0:0] ensures we don't waste time by getting hits back
-        search = search.using(self.client).index(index)[0:0]
-        # create an aggregation to count the number of records in the index at each version
-        search.aggs.bucket(u'versions', u'composite', size=1000,
-                           sources={u'version': A(u'terms', field=u'meta.version', order=u'asc')})
-        while True:
-            # run the search and get the result, ignore_cache makes sure that calling execute gives
-            # us back new data from the backend. We need this because we just sneakily change the
-            # after value in the aggregation without generating a new search object
-            result = search.execute(ignore_cache=True).aggs.to_dict()[u'versions']
-
-            # iterate over the results
-            for bucket in result[u'buckets']:
-                versions.append({
-                    u'version': bucket[u'key'][u'version'],
-                    u'changes': bucket[u'doc_count']
-                })
-
-            # retrieve the after key for pagination if there is one
-            after_key = result.get(u'after_key', None)
-            if after_key is None:
-                # if there isn't then we're done
-                break
-            else:
-                # otherwise apply it to the aggregation
-                search.aggs[u'versions'].after = after_key
+        if search is None and use_summary:
+            summary = self.get_version_summaries([index]).get(index, None)
+            if summary is not None:
+                return summary
+        search = create_version_counts_search(index, search).using(self.client)
+        return [{u'version': bucket[u'key'][u'version'], u'changes': bucket[u'doc_count']}
+                for bucket in iter_composite_buckets(search, u'versions')]
+
+    def get_versions_after(self, indexes_and_tails):
+        """
+        Given a dict of index names -> versions, return the versions available in each index that
+        are after the version it is mapped to. If an index is mapped to None then all of its
+        versions are returned. All the indexes are covered by a single composite aggregation on the
+        index name and the version, rather than by an aggregation per index.
 
+        :param indexes_and_tails: a dict of concrete prefixed index names -> versions (or None)
+        :return: a dict of prefixed index names -> lists of versions in ascending order
+        """
+        versions = {index: [] for index in indexes_and_tails}
+        if not versions:
+            return versions
+
+        search = create_versions_after_search(indexes_and_tails).using(self.client)
+        for bucket in iter_composite_buckets(search, u'versions'):
+            index = bucket[u'key'][u'index']
+            if index in versions:
+                versions[index].append(bucket[u'key'][u'version'])
         return versions
 
+    def get_concrete_indexes(self, indexes):
+        """
+        Resolves the given index names, any of which may be aliases, into the concrete indexes they
+        refer to. The UUID of each concrete index is returned too. Names which can't be resolved,
+        for example because they are wildcard patterns or don't exist, are mapped to an empty list.
+
+        :param indexes: a list of index names
+        :return: a 2-tuple containing a dict of index names -> lists of concrete index names and a
+                 dict of concrete index names -> uuids
+        """
+        response = {}
+        if indexes:
+            try:
+                response = self.client.indices.get(list(indexes), ignore_unavailable=True,
+                                                   filter_path=CONCRETE_INDEXES_FILTER_PATH)
+            except NotFoundError:
+                pass
+        return parse_concrete_indexes(indexes, response)
+
+    def get_index_timelines(self, indexes):
+        """
+        Given a list of indexes, return the versions available in each one. The names are resolved
+        to concrete indexes first (so aliases can be passed) and the versions of each concrete index
+        are cached. The cache for an index is only refreshed when the status index reports a new
+        latest version for it. When this happens the index's version summary is used if the status
+        index holds a valid one (see get_version_summaries), otherwise only the versions after the
+        cached tail are retrieved (unless the index has been recreated, in which case everything is
+        retrieved). All the indexes which need refreshing are refreshed together using a single
+        request for the summaries and a single aggregation for the rest.
+
+        Concrete indexes without an entry in the status index are never cached as there is no way
+        to know when their cached versions would become stale. Names which can't be resolved to
+        concrete indexes, such as wildcard patterns, are aggregated over directly.
+
+        :param indexes: a list of prefixed indexes
+        :return: a dict of prefixed index names -> lists of versions in ascending order
+        """
+        concrete_indexes, uuids = self.get_concrete_indexes(indexes)
+        latest_versions = self.get_latest_index_versions(list(uuids)) if uuids else {}
+        concrete_timelines, to_refresh = self.version_timelines.lookup(uuids, latest_versions)
+
+        if to_refresh:
+            # summaries only exist for indexes with a status
+            summarised = [index for index in to_refresh if index in latest_versions]
+            for index, summary in self.get_version_summaries(summarised).items():
+                # the summary is complete so it replaces whatever is cached
+                versions = [entry[u'version'] for entry in summary]
+                concrete_timelines[index] = self.version_timelines.update(
+                    index, uuids[index], latest_versions[index], versions, replace=True)
+                del to_refresh[index]
+
+        if to_refresh:
+            for index, new_versions in self.get_versions_after(to_refresh).items():
+                if index in latest_versions:
+                    concrete_timelines[index] = self.version_timelines.update(
+                        index, uuids[index], latest_versions[index], new_versions)
+                else:
+                    concrete_timelines[index] = new_versions
+
+        timelines = merge_timelines(indexes, concrete_indexes, concrete_timelines)
+        for index in indexes:
+            if index not in timelines:
+                # the name couldn't be resolved so just aggregate over it directly
+                timelines[index] = self.get_index_versions(index)
+        return timelines
+
     def get_rounded_versions(self, indexes, target_version):
         """
         Given a list of indexes, work out their individual rounded versions based on the target
@@ -191,30 +788,67 @@ class SearchHelper(object):
         If there are no versions found for an index then the index is assigned to None in the
         returned dict.
 
+        The versions of each index are retrieved using get_index_timelines and are therefore cached
+        between calls.
+
         :param indexes: a list of prefixed indexes
         :param target_version: the target version
         :return: a dict of index names mapped to their rounded version
         """
-        result = {}
-        for index in indexes:
-            # get all the versions available for this index
-            versions = self.get_index_versions(index)
-
-            if not versions:
-                # something isn't right, just set to None
-                result[index] = None
-            elif target_version is None or target_version >= versions[-1]:
-                # cap the requested version to the latest version
-                result[index] = versions[-1]
-            elif target_version < versions[0]:
-                # use the requested version if it's lower than the lowest available version
-                result[index] = target_version
-            else:
-                # find the lowest, nearest version to the requested one
-                position = bisect.bisect_right(versions, target_version)
-                result[index] = versions[position - 1]
+        timelines = self.get_index_timelines(indexes)
+        return {index: round_version(timelines[index], target_version) for index in indexes}
 
-        return result
+    def create_versioned_search(self, search, version, indexes=None):
+        """
+        Filters the given search so that it only matches records at the given version. If indexes
+        are passed then the version is rounded for each index individually (see
+        get_rounded_versions) and the filter is created using create_index_specific_version_filter,
+        otherwise the version is used as is in a single version query.
+
+        :param search: a Search object
+        :param version: the version
+        :param indexes: a list of prefixed indexes, optional
+        :return: a new Search object
+        """
+        if indexes:
+            rounded_versions = self.get_rounded_versions(indexes, version)
+            version_filter = create_index_specific_version_filter(rounded_versions)
+        else:
+            version_filter = create_version_query(version)
+        return search.filter(version_filter)
+
+    def iter_search_after(self, search, version, indexes=None, batch_size=1000, cursor=None):
+        """
+        Lazily yields the hits from the given search at the given version, using search_after on a
+        stable sort to page through them in batches rather than a scroll. No context is held in
+        elasticsearch between batches and only one batch is held in memory at a time.
+
+        Each hit is yielded alongside an opaque cursor string. Passing the cursor back to this
+        method with the same search, version and indexes resumes paging after the hit it was
+        yielded with.
+
+        :param search: a Search object, any sort set on it will be replaced
+        :param version: the version, see create_versioned_search
+        :param indexes: a list of prefixed indexes to round the version for, optional. If the
+                        search doesn't already target the indexes they are also set on it.
+        :param batch_size: the number of hits to retrieve in each request (default: 1000)
+        :param cursor: a cursor to resume from, optional
+        :return: a generator of 2-tuples containing a hit and a cursor
+        """
+        if indexes and not search._index:
+            search = search.index(indexes)
+        search = self.create_versioned_search(search.using(self.client), version, indexes)
+        sort_values = decode_cursor(cursor) if cursor is not None else None
+
+        while True:
+            response = create_search_after_search(search, batch_size, sort_values).execute()
+            hits = response.hits
+            for hit in hits:
+                sort_values = list(hit.meta.sort)
+                yield hit, encode_cursor(sort_values)
+            if len(hits) < batch_size:
+                # there can't be any more hits
+                break
 
     def prefix_index(self, index):
         """
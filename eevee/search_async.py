@@ -0,0 +1,424 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Asyncio versions of the helpers in eevee.search. This module requires Python 3.6+ and the
+elasticsearch-async package (install eevee with the "async" extra).
+"""
+import asyncio
+
+from elasticsearch import NotFoundError
+
+from eevee.indexing.utils import DOC_TYPE
+from eevee.search import create_status_search, create_version_summaries_body, \
+    parse_version_summaries, create_index_counts_search, filter_valid_summaries, \
+    create_version_counts_search, create_records_versions_search, \
+    collect_records_versions, create_versions_after_search, CONCRETE_INDEXES_FILTER_PATH, \
+    parse_concrete_indexes, merge_timelines, round_version, VersionTimelines, \
+    create_index_specific_version_filter, create_version_query, create_search_after_search, \
+    encode_cursor, decode_cursor
+
+try:
+    from elasticsearch_async import AsyncElasticsearch
+except ImportError:
+    AsyncElasticsearch = None
+
+
+def get_async_elasticsearch_client(config, **kwargs):
+    """
+    Returns an async elasticsearch client created using the hosts attribute of the passed config
+    object. All kwargs are passed on to the client constructor to allow for more precise control
+    over the client object, for example maxsize can be used to set the size of the connection pool
+    used for each host.
+
+    :param config: the config object
+    :param kwargs: kwargs for the async elasticsearch client constructor
+    :return: a new async elasticsearch client object
+    """
+    if AsyncElasticsearch is None:
+        raise ImportError(u'The elasticsearch-async package is required to create an async client')
+    return AsyncElasticsearch(hosts=config.elasticsearch_hosts, **kwargs)
+
+
+async def execute_search(client, search, **kwargs):
+    """
+    Runs the given Search object using the given async client and returns the raw response dict.
+    The search's indexes and params are passed through in the same way as Search.execute does.
+
+    :param client: an async elasticsearch client
+    :param search: a Search object
+    :param kwargs: extra parameters for the search request
+    :return: the raw response dict
+    """
+    params = dict(search._params, **kwargs)
+    return await client.search(index=search._index, body=search.to_dict(), **params)
+
+
+async def scan_search(client, search, scroll=u'1m', size=1000):
+    """
+    Scrolls through all the hits matched by the given Search object using the given async client
+    and returns them as a list of raw hit dicts. The scroll context is cleared when finished.
+
+    :param client: an async elasticsearch client
+    :param search: a Search object
+    :param scroll: how long each scroll context should be kept alive for
+    :param size: the number of hits to retrieve per request
+    :return: a list of hit dicts
+    """
+    response = await execute_search(client, search, scroll=scroll, size=size)
+    scroll_id = response.get(u'_scroll_id', None)
+    hits = []
+    try:
+        while response[u'hits'][u'hits']:
+            hits.extend(response[u'hits'][u'hits'])
+            if scroll_id is None:
+                break
+            response = await client.scroll(body={u'scroll_id': scroll_id}, scroll=scroll)
+            scroll_id = response.get(u'_scroll_id', scroll_id)
+    finally:
+        if scroll_id is not None:
+            await client.clear_scroll(body={u'scroll_id': [scroll_id]}, ignore=(404,))
+    return hits
+
+
+async def get_composite_buckets(client, search, aggregation_name):
+    """
+    Runs the given search using the given async client and returns all the buckets from the named
+    composite aggregation, paginating through the aggregation's results using the after key until
+    they are exhausted. The search is modified in place as the after key is updated on each
+    iteration.
+
+    :param client: an async elasticsearch client
+    :param search: a Search object with a composite aggregation defined on it
+    :param aggregation_name: the name of the composite aggregation
+    :return: a list of bucket dicts
+    """
+    buckets = []
+    while True:
+        response = await execute_search(client, search)
+        result = response[u'aggregations'][aggregation_name]
+        buckets.extend(result[u'buckets'])
+
+        # retrieve the after key for pagination if there is one
+        after_key = result.get(u'after_key', None)
+        if after_key is None:
+            # if there isn't then we're done
+            return buckets
+        else:
+            # otherwise apply it to the aggregation
+            search.aggs[aggregation_name].after = after_key
+
+
+class AsyncSearchHelper(object):
+    """
+    Asyncio version of eevee.search.SearchHelper. All the methods which communicate with
+    elasticsearch are coroutines and behave in the same way as their SearchHelper counterparts.
+    The requests are built and parsed using the same functions SearchHelper uses and the same
+    VersionTimelines cache class is used, so an instance can be shared with a SearchHelper if
+    required.
+    """
+
+    def __init__(self, config, client=None, version_timelines=None):
+        """
+        :param config: the config object
+        :param client: an instance of the async elasticsearch client class to be used by any
+                       methods in this object that need to communicate with elasticsearch. If one
+                       isn't provided then one is created using some sensible parameters.
+        :param version_timelines: a VersionTimelines object to use as the version cache, optional.
+                                  If one isn't provided a new one is created.
+        """
+        self.config = config
+        if client is None:
+            self.client = get_async_elasticsearch_client(self.config, sniff_on_start=True,
+                                                         sniff_on_connection_fail=True,
+                                                         sniffer_timeout=60, sniff_timeout=10,
+                                                         http_compress=False)
+        else:
+            self.client = client
+        if version_timelines is None:
+            self.version_timelines = VersionTimelines()
+        else:
+            self.version_timelines = version_timelines
+
+    async def close(self):
+        """
+        Closes the client's connections.
+        """
+        await self.client.transport.close()
+
+    async def get_latest_index_versions(self, indexes=None):
+        """
+        Returns the current indexes and their latest versions as a dict. See
+        SearchHelper.get_latest_index_versions for details.
+
+        :param indexes: the index names to match and return data for. The names should be the full
+                        index names with prefix.
+        :return: a dict of index names -> latest version
+        """
+        if not await self.client.indices.exists(self.config.elasticsearch_status_index_name):
+            return {}
+
+        hits = await scan_search(self.client, create_status_search(self.config, indexes))
+        return {hit[u'_source'][u'index_name']: hit[u'_source'][u'latest_version']
+                for hit in hits}
+
+    async def get_version_summaries(self, indexes, validate=True):
+        """
+        Returns the version summaries held in the status index for the given indexes. See
+        SearchHelper.get_version_summaries for details.
+
+        :param indexes: the names of the concrete indexes (aliases are not resolved)
+        :param validate: whether to check the summaries against the index document counts
+        :return: a dict of index names -> version summaries
+        """
+        if not indexes:
+            return {}
+        try:
+            response = await self.client.mget(create_version_summaries_body(indexes),
+                                              index=self.config.elasticsearch_status_index_name,
+                                              doc_type=DOC_TYPE)
+        except NotFoundError:
+            # the status index doesn't exist
+            return {}
+
+        summaries = parse_version_summaries(response)
+        if validate and summaries:
+            search = create_index_counts_search(list(summaries.keys()))
+            counts_response = await execute_search(self.client, search)
+            return filter_valid_summaries(summaries, counts_response)
+        return {index: summary[u'versions'] for index, summary in summaries.items()}
+
+    async def get_record_versions(self, index, record_id):
+        """
+        Given the id of a record, returns all the available versions of that record in the given
+        index as a list in ascending order.
+
+        :param index: the prefixed index name
+        :param record_id: the record id
+        :return: a list of sorted versions available for the given record
+        """
+        return (await self.get_records_versions(index, [record_id]))[record_id]
+
+    async def get_records_versions(self, index, record_ids):
+        """
+        Given some record ids, returns all the available versions of each record in the given index.
+        See SearchHelper.get_records_versions for details.
+
+        :param index: the prefixed index name
+        :param record_ids: the record ids
+        :return: a dict of record ids -> lists of versions in ascending order
+        """
+        if not record_ids:
+            return {}
+        buckets = await get_composite_buckets(self.client,
+                                              create_records_versions_search(index, record_ids),
+                                              u'versions')
+        return collect_records_versions(record_ids, buckets)
+
+    async def get_index_versions(self, index, search=None, use_summary=False):
+        """
+        Given an index, return a list of the versions available for that index in ascending order.
+        See SearchHelper.get_index_versions for details.
+
+        :param index: the prefixed index name
+        :param search: a Search object, optional
+        :param use_summary: whether to use the index's version summary from the status index if
+                            there is a valid one and no search is passed (default: False)
+        :return: a list of versions in ascending order
+        """
+        counts = await self.get_index_version_counts(index, search, use_summary)
+        return [vc[u'version'] for vc in counts]
+
+    async def get_index_version_counts(self, index, search=None, use_summary=False):
+        """
+        Given an index, return a list of dicts each containing a version and a count of the number
+        of records that were changed in that version. See SearchHelper.get_index_version_counts for
+        details.
+
+        :param index: the prefixed index
+        :param search: a Search object, optional
+        :param use_summary: whether to use the index's version summary from the status index if
+                            there is a valid one and no search is passed (default: False)
+        :return: a list of dicts of version and changes count data
+        """
+        if search is None and use_summary:
+            summary = (await self.get_version_summaries([index])).get(index, None)
+            if summary is not None:
+                return summary
+        buckets = await get_composite_buckets(self.client,
+                                              create_version_counts_search(index, search),
+                                              u'versions')
+        return [{u'version': bucket[u'key'][u'version'], u'changes': bucket[u'doc_count']}
+                for bucket in buckets]
+
+    async def get_versions_after(self, indexes_and_tails):
+        """
+        Given a dict of index names -> versions, return the versions available in each index that
+        are after the version it is mapped to. See SearchHelper.get_versions_after for details.
+
+        :param indexes_and_tails: a dict of concrete prefixed index names -> versions (or None)
+        :return: a dict of prefixed index names -> lists of versions in ascending order
+        """
+        versions = {index: [] for index in indexes_and_tails}
+        if not versions:
+            return versions
+
+        buckets = await get_composite_buckets(self.client,
+                                              create_versions_after_search(indexes_and_tails),
+                                              u'versions')
+        for bucket in buckets:
+            index = bucket[u'key'][u'index']
+            if index in versions:
+                versions[index].append(bucket[u'key'][u'version'])
+        return versions
+
+    async def get_concrete_indexes(self, indexes):
+        """
+        Resolves the given index names, any of which may be aliases, into the concrete indexes they
+        refer to. See SearchHelper.get_concrete_indexes for details.
+
+        :param indexes: a list of index names
+        :return: a 2-tuple containing a dict of index names -> lists of concrete index names and a
+                 dict of concrete index names -> uuids
+        """
+        response = {}
+        if indexes:
+            try:
+                response = await self.client.indices.get(list(indexes), ignore_unavailable=True,
+                                                         filter_path=CONCRETE_INDEXES_FILTER_PATH)
+            except NotFoundError:
+                pass
+        return parse_concrete_indexes(indexes, response)
+
+    async def _refresh_timelines(self, to_refresh, uuids, latest_versions):
+        """
+        Retrieves the versions needed to bring the given concrete indexes' timelines up to date and
+        updates the cache with them, using the version summaries where possible and a single
+        aggregation for the rest.
+
+        :param to_refresh: a dict of concrete index names -> tails (or None)
+        :param uuids: a dict of concrete index names -> uuids
+        :param latest_versions: a dict of concrete index names -> latest versions
+        :return: a dict of concrete index names -> lists of versions in ascending order
+        """
+        timelines = {}
+        to_refresh = dict(to_refresh)
+        # summaries only exist for indexes with a status
+        summarised = [index for index in to_refresh if index in latest_versions]
+        for index, summary in (await self.get_version_summaries(summarised)).items():
+            # the summary is complete so it replaces whatever is cached
+            versions = [entry[u'version'] for entry in summary]
+            timelines[index] = self.version_timelines.update(
+                index, uuids[index], latest_versions[index], versions, replace=True)
+            del to_refresh[index]
+
+        if to_refresh:
+            for index, new_versions in (await self.get_versions_after(to_refresh)).items():
+                if index in latest_versions:
+                    timelines[index] = self.version_timelines.update(
+                        index, uuids[index], latest_versions[index], new_versions)
+                else:
+                    timelines[index] = new_versions
+        return timelines
+
+    async def get_index_timelines(self, indexes):
+        """
+        Given a list of indexes, return the versions available in each one. See
+        SearchHelper.get_index_timelines for details. The concrete indexes that need refreshing are
+        refreshed concurrently with the aggregations over any names which can't be resolved.
+
+        :param indexes: a list of prefixed indexes
+        :return: a dict of prefixed index names -> lists of versions in ascending order
+        """
+        concrete_indexes, uuids = await self.get_concrete_indexes(indexes)
+        latest_versions = (await self.get_latest_index_versions(list(uuids))) if uuids else {}
+        concrete_timelines, to_refresh = self.version_timelines.lookup(uuids, latest_versions)
+
+        # names which can't be resolved, such as wildcard patterns, are aggregated over directly
+        unresolved = [index for index in indexes if not concrete_indexes[index]]
+        tasks = [self.get_index_versions(index) for index in unresolved]
+        if to_refresh:
+            tasks.append(self._refresh_timelines(to_refresh, uuids, latest_versions))
+        results = await asyncio.gather(*tasks)
+
+        if to_refresh:
+            concrete_timelines.update(results.pop())
+        timelines = merge_timelines(indexes, concrete_indexes, concrete_timelines)
+        timelines.update(zip(unresolved, results))
+        return timelines
+
+    async def get_rounded_versions(self, indexes, target_version):
+        """
+        Given a list of indexes, work out their individual rounded versions based on the target
+        version. See SearchHelper.get_rounded_versions for details.
+
+        :param indexes: a list of prefixed indexes
+        :param target_version: the target version
+        :return: a dict of index names mapped to their rounded version
+        """
+        timelines = await self.get_index_timelines(indexes)
+        return {index: round_version(timelines[index], target_version) for index in indexes}
+
+    async def create_versioned_search(self, search, version, indexes=None):
+        """
+        Filters the given search so that it only matches records at the given version. See
+        SearchHelper.create_versioned_search for details.
+
+        :param search: a Search object
+        :param version: the version
+        :param indexes: a list of prefixed indexes, optional
+        :return: a new Search object
+        """
+        if indexes:
+            rounded_versions = await self.get_rounded_versions(indexes, version)
+            version_filter = create_index_specific_version_filter(rounded_versions)
+        else:
+            version_filter = create_version_query(version)
+        return search.filter(version_filter)
+
+    async def iter_search_after(self, search, version, indexes=None, batch_size=1000,
+                                cursor=None):
+        """
+        Lazily yields the hits from the given search at the given version, paging through them with
+        search_after. This is an async generator, see SearchHelper.iter_search_after for details.
+        The hits are yielded as raw dicts.
+
+        :param search: a Search object, any sort set on it will be replaced
+        :param version: the version
+        :param indexes: a list of prefixed indexes to round the version for, optional
+        :param batch_size: the number of hits to retrieve in each request (default: 1000)
+        :param cursor: a cursor to resume from, optional
+        :return: an async generator of 2-tuples containing a hit dict and a cursor
+        """
+        if indexes and not search._index:
+            search = search.index(indexes)
+        search = await self.create_versioned_search(search, version, indexes)
+        sort_values = decode_cursor(cursor) if cursor is not None else None
+
+        while True:
+            response = await execute_search(self.client, create_search_after_search(
+                search, batch_size, sort_values))
+            hits = response[u'hits'][u'hits']
+            for hit in hits:
+                sort_values = hit[u'sort']
+                yield hit, encode_cursor(sort_values)
+            if len(hits) < batch_size:
+                # there can't be any more hits
+                break
+
+    def prefix_index(self, index):
+        """
+        Adds the prefix from the config to the index.
+
+        :param index: the index name (without the prefix)
+        :return: the prefixed index name
+        """
+        return u'{}{}'.format(self.config.elasticsearch_index_prefix, index)
+
+    async def ensure_index_exists(self, index):
+        """
+        Ensures that an index exists in Elasticsearch for the given index object.
+
+        :param index: the index object
+        """
+        if not await self.client.indices.exists(index.name):
+            await self.client.indices.create(index.name, body=index.get_index_create_body())
@@ -3,7 +3,10 @@
 
 import abc
 import calendar
+import collections
 import itertools
+import timeit
+import zlib
 
 import six
 from six.moves import zip
@@ -68,19 +71,220 @@ def iter_pairs(iterable, final_partner=None):
     return zip(i1, itertools.chain(itertools.islice(i2, 1, None), [final_partner]))
 
 
+def bounded_imap(pool, function, iterable, max_pending):
+    """
+    Like pool.imap, this applies the function to each element of the iterable using the given pool
+    and yields the results in order. Unlike pool.imap, the iterable is only consumed as results are
+    yielded so that no more than max_pending elements are being processed or waiting to be yielded
+    at any one time. This keeps memory usage bounded when the iterable is large or slow to read.
+
+    :param pool: a multiprocessing Pool or ThreadPool
+    :param function: the function to apply to each element
+    :param iterable: the elements
+    :param max_pending: the maximum number of elements submitted to the pool but not yet yielded
+    :return: a generator of results
+    """
+    pending = collections.deque()
+    for element in iterable:
+        if len(pending) >= max_pending:
+            yield pending.popleft().get()
+        pending.append(pool.apply_async(function, (element,)))
+    while pending:
+        yield pending.popleft().get()
+
+
+def stable_partition(value, partitions):
+    """
+    Returns the partition the given value belongs in. A stable hash of the value's text
+    representation is used so that the result is the same regardless of the python version, hash
+    seed or process and therefore the value 10 and the value "10" are in the same partition.
+
+    :param value: the value, usually a record id
+    :param partitions: the number of partitions
+    :return: the partition number, between 0 and partitions - 1
+    """
+    key = six.text_type(value).encode(u'utf-8')
+    return (zlib.crc32(key) & 0xffffffff) % partitions
+
+
+def per_record_receiver(receiver, **names):
+    """
+    Adapts a receiver written for a per-record signal so that it can be connected to the batched
+    version of the signal. The names kwargs map the names of the list kwargs sent with the batched
+    signal to the names of the kwargs the receiver expects for each record, for example:
+
+        ingester.insert_batch_signal.connect(
+            per_record_receiver(on_insert, records=u'record', docs=u'doc'), weak=False)
+
+    will call on_insert(sender, record=<record>, doc=<doc>) once for each record in each batch. Any
+    other kwargs sent with the batched signal are passed through to every call. Note that as the
+    adapter is a new function it must be connected with weak=False (or have a reference held
+    elsewhere) otherwise blinker will drop it.
+
+    :param receiver: the per-record receiver function
+    :param names: the batched kwarg names mapped to the per-record kwarg names
+    :return: a receiver function for the batched signal
+    """
+    def adapter(sender, **kwargs):
+        batch_names = list(names.keys())
+        batch_values = [kwargs.pop(name) for name in batch_names]
+        record_names = [names[name] for name in batch_names]
+        for values in zip(*batch_values):
+            record_kwargs = dict(kwargs)
+            record_kwargs.update(zip(record_names, values))
+            receiver(sender, **record_kwargs)
+    return adapter
+
+
+def _read_only(*args, **kwargs):
+    raise TypeError(u'This object is read only, use thaw to get a mutable copy')
+
+
+class ReadOnlyDict(dict):
+    """
+    A dict which can't be modified. This is a dict subclass rather than a mapping view so that it
+    can be used anywhere a dict can, for example when serialising to JSON or BSON. Note that the
+    dict's values are not made read only by this class, use freeze for that.
+    """
+
+    __slots__ = ()
+
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = update = _read_only
+
+    def __reduce__(self):
+        # the default implementation adds the items using __setitem__ which would fail
+        return ReadOnlyDict, (dict(self),)
+
+    def __copy__(self):
+        # the dict can't be changed so there's no need to copy it
+        return self
+
+
+class ReadOnlyList(list):
+    """
+    A list which can't be modified, see ReadOnlyDict.
+    """
+
+    __slots__ = ()
+
+    __setitem__ = __delitem__ = __iadd__ = __imul__ = append = extend = insert = pop = remove = \
+        reverse = sort = _read_only
+    if six.PY2:
+        __setslice__ = __delslice__ = _read_only
+
+    def __reduce__(self):
+        return ReadOnlyList, (list(self),)
+
+    def __copy__(self):
+        return self
+
+
+def freeze(value):
+    """
+    Returns a read only version of the given value. Dicts and lists are converted into ReadOnlyDicts
+    and ReadOnlyLists recursively, any which are already read only are used as they are (and are
+    therefore shared with the given value). Other values are returned as they are.
+
+    :param value: the value to freeze
+    :return: the read only value
+    """
+    if isinstance(value, (ReadOnlyDict, ReadOnlyList)):
+        return value
+    if isinstance(value, dict):
+        return ReadOnlyDict((key, freeze(item)) for key, item in value.items())
+    if isinstance(value, list):
+        return ReadOnlyList(freeze(item) for item in value)
+    return value
+
+
+def thaw(value):
+    """
+    Returns a mutable deep copy of the given value, converting any ReadOnlyDicts and ReadOnlyLists
+    into dicts and lists.
+
+    :param value: the value to thaw
+    :return: the mutable copy
+    """
+    if isinstance(value, dict):
+        return {key: thaw(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [thaw(item) for item in value]
+    return value
+
+
 @six.add_metaclass(abc.ABCMeta)
 class OpBuffer(object):
     """
     Convenience class and context manager which allows buffering operations and then handling them
     in bulk.
+
+    By default the buffer is handled when it contains a set number of ops but it can also be
+    handled when the ops it contains reach a total size in bytes or when the oldest op in it
+    reaches a certain age. Additionally, if a key function is provided, ops with the same key can
+    be merged together into a single op using the merge function.
     """
 
-    def __init__(self, size):
+    def __init__(self, size, max_bytes=None, size_of=None, max_age=None, key=None, merge=None):
         """
         :param size: the number of ops to buffer up before handling as a batch
+        :param max_bytes: the maximum total size of the ops in a batch, in bytes. If adding an op
+                          would take the buffer over this size then the buffer is handled before
+                          the op is added. Defaults to None, meaning there is no limit.
+        :param size_of: a function which returns the size of an op in bytes, this must be provided
+                        if max_bytes is
+        :param max_age: the maximum number of seconds an op can wait in the buffer. This is only
+                        checked when ops are added so a buffer can't be handled without any further
+                        activity, however is_expired can be used to check if a flush is due.
+                        Defaults to None, meaning there is no limit.
+        :param key: a function which returns the key of an op, or None if the op shouldn't be
+                    merged with any other ops. Ops with the same key are merged together using the
+                    merge function. As a merged op takes the place of the op already in the
+                    buffer, ops with no key act as barriers which ops added after them can't be
+                    merged across, otherwise an op could be moved before one it must follow.
+                    Defaults to None, meaning no merging is done.
+        :param merge: a function which takes the op already in the buffer and the new op with the
+                      same key and returns a single op which has the effect of both, or None if the
+                      ops can't be merged in which case the buffer is handled before the new op is
+                      added. This must be provided if key is.
         """
-        self.ops = []
+        if max_bytes is not None and size_of is None:
+            raise ValueError(u'A size_of function is required when using max_bytes')
+        if key is not None and merge is None:
+            raise ValueError(u'A merge function is required when using key')
         self.size = size
+        self.max_bytes = max_bytes
+        self.size_of = size_of
+        self.max_age = max_age
+        self.key = key
+        self.merge = merge
+        self.clear()
+
+    def clear(self):
+        """
+        Empties the buffer. A new ops list is created rather than clearing the existing one so that
+        the handled list can be safely kept by the handle_ops implementation.
+        """
+        self.ops = []
+        # the sizes of the ops in the buffer, only maintained when using max_bytes
+        self.op_sizes = []
+        self.bytes = 0
+        # the positions of the ops in the buffer, keyed on the ops' keys
+        self.positions = {}
+        # when the first op currently in the buffer was added
+        self.oldest = None
+
+    def is_expired(self):
+        """
+        Checks whether the oldest op in the buffer has been waiting longer than the max_age.
+
+        :return: True if the buffer should be handled, False if not
+        """
+        return (self.max_age is not None and self.oldest is not None and
+                timeit.default_timer() - self.oldest >= self.max_age)
+
+    def _handle(self):
+        self.handle_ops()
+        self.clear()
 
     def add(self, op):
         """
@@ -89,12 +293,63 @@ class OpBuffer(object):
         :param op: the op
         :return: True if the buffer was handled, False if not
         """
+        handled = False
+        op_key = self.key(op) if self.key is not None else None
+        if op_key is not None and op_key in self.positions:
+            position = self.positions[op_key]
+            merged = self.merge(self.ops[position], op)
+            if merged is not None:
+                self._replace(position, merged)
+                return self._handle_if_full()
+            # the ops can't be merged so handle the buffer before adding the new op
+            self._handle()
+            handled = True
+        elif op_key is None and self.positions:
+            # this op could affect the same things as the ops already in the buffer so nothing added
+            # after it can be merged into them
+            self.positions = {}
+
+        op_size = self.size_of(op) if self.max_bytes is not None else 0
+        if self.ops and self.max_bytes is not None and self.bytes + op_size > self.max_bytes:
+            # adding this op would take the batch over the max size, handle the buffer first
+            self._handle()
+            handled = True
+
+        if not self.ops:
+            self.oldest = timeit.default_timer()
+        if op_key is not None:
+            self.positions[op_key] = len(self.ops)
         self.ops.append(op)
+        if self.max_bytes is not None:
+            self.op_sizes.append(op_size)
+            self.bytes += op_size
+        return self._handle_if_full() or handled
+
+    def _replace(self, position, op):
+        """
+        Replaces the op at the given position in the buffer with the given op.
+
+        :param position: the position of the op to replace
+        :param op: the new op
+        """
+        self.ops[position] = op
+        if self.max_bytes is not None:
+            op_size = self.size_of(op)
+            self.bytes += op_size - self.op_sizes[position]
+            self.op_sizes[position] = op_size
+
+    def _handle_if_full(self):
+        """
+        Handles the buffer if any of its limits have been reached.
+
+        :return: True if the buffer was handled, False if not
+        """
         # check greater than or equal to instead of just equal to to avoid any issues with the op
         # list being modified out of sequence
-        if len(self.ops) >= self.size:
-            self.handle_ops()
-            self.ops = []
+        if (len(self.ops) >= self.size or
+                (self.max_bytes is not None and self.bytes >= self.max_bytes) or
+                self.is_expired()):
+            self._handle()
             return True
         return False
 
@@ -112,8 +367,7 @@ class OpBuffer(object):
         Flushes any remaining ops in the buffer.
         """
         if self.ops:
-            self.handle_ops()
-            self.ops = []
+            self._handle()
 
     @abc.abstractmethod
     def handle_ops(self):
@@ -23,9 +23,21 @@ setup(
     author_email=EMAIL,
     python_requires=REQUIRES_PYTHON,
     url=URL,
-    packages=find_packages(exclude=["*.tests", "*.tests.*", "tests.*", "tests"]),
+    packages=find_packages(exclude=["*.tests", "*.tests.*", "tests.*", "tests", "benchmarks",
+                                    "benchmarks.*"]),
     install_requires=REQUIRED,
+    extras_require={
+        'async': ['elasticsearch-async>=6.0.0,<7.0.0', 'motor>=2.0.0,<3.0.0'],
+        'columnar': ['pyarrow>=7.0.0'],
+        'msgpack': ['msgpack>=0.6.0'],
+    },
     include_package_data=True,
+    entry_points={
+        'console_scripts': [
+            'eevee-export=eevee.exporting:main',
+            'eevee-maintenance=eevee.maintenance:main',
+        ],
+    },
     license='MIT',
     classifiers=[
         'License :: OSI Approved :: MIT License',
@@ -0,0 +1,34 @@
+#!/usr/bin/env python
+# encoding: utf-8
+import json
+
+import pytest
+import six
+from bson import BSON
+
+collect_ignore = []
+if six.PY2:
+    # these modules use the async/await syntax and can't even be imported on python 2
+    collect_ignore.append(u'test_search_async.py')
+    collect_ignore.append(u'ingestion/test_ingesters_async.py')
+
+
+def bson_encoding_works():
+    try:
+        BSON.encode({u'a': 1})
+        return True
+    except SystemError:
+        return False
+
+
+@pytest.fixture(autouse=True)
+def archive_entries(monkeypatch):
+    """
+    Some builds of bson's C extension can't encode documents on newer pythons. When that is the case
+    the archive's entries are serialised as JSON instead so that the archive can still be tested.
+    """
+    if not bson_encoding_works():
+        monkeypatch.setattr(u'eevee.archive.encode_entry',
+                            lambda diffs: json.dumps(diffs).encode(u'utf-8'))
+        monkeypatch.setattr(u'eevee.archive.decode_entry',
+                            lambda data: json.loads(data.decode(u'utf-8')))
@@ -7,8 +7,12 @@ import pytest
 import ujson
 from mock import MagicMock, call, create_autospec
 
-from eevee.indexing.indexers import IndexingStats, IndexedRecord, IndexingTask, Indexer
+from elasticsearch import NotFoundError, ConflictError
+
+from eevee.indexing.indexers import IndexingStats, IndexedRecord, IndexingTask, Indexer, \
+    TimedBulkClient
 from eevee.indexing.utils import DOC_TYPE
+from eevee.metrics import InMemoryMetrics
 
 
 class TestIndexingStats(object):
@@ -78,6 +82,15 @@ class TestIndexingStats(object):
         }
         assert stats.seen_versions == {1290, 10000, 18, 23, 24, 25, 26, 27, 28, 29, 30, 31, 32}
 
+    def test_update_version_changes(self):
+        stats = IndexingStats(1029)
+        index_name = u'nhm-some-index'
+        indexed_record = MagicMock(get_version_changes=MagicMock(return_value=Counter({1: -1,
+                                                                                      2: 1})))
+        stats.update(index_name, indexed_record)
+        stats.update(index_name, indexed_record)
+        assert stats.version_changes == {index_name: {1: -2, 2: 2}}
+
     def test_update_no_stats(self):
         stats = IndexingStats(1029)
         index_name = u'nhm-some-index'
@@ -122,6 +135,36 @@ class TestIndexedRecord(object):
         assert not done
         assert indexed_record.stats == {u'something': 1}
 
+    def test_get_version_changes_created(self):
+        to_index = [(10, MagicMock()), (20, MagicMock())]
+        indexed_record = IndexedRecord(MagicMock(), MagicMock(), to_index, {}, 2, 0)
+        indexed_record.update_with_result(u'index', dict(result=u'created'), 0)
+        indexed_record.update_with_result(u'index', dict(result=u'created'), 1)
+        assert indexed_record.get_version_changes() == {10: 1, 20: 1}
+
+    def test_get_version_changes_updated(self):
+        to_index = [(10, MagicMock()), (30, MagicMock())]
+        existing = {
+            u'0': {u'meta': {u'version': 10}},
+            u'1': {u'meta': {u'version': 20}},
+        }
+        indexed_record = IndexedRecord(MagicMock(), MagicMock(), to_index, existing, 2, 0)
+        indexed_record.update_with_result(u'index', dict(result=u'updated'), 0)
+        indexed_record.update_with_result(u'index', dict(result=u'updated'), 1)
+        # the second document has moved from version 20 to version 30, the first one has stayed
+        # at version 10
+        assert indexed_record.get_version_changes() == {10: 0, 20: -1, 30: 1}
+
+    def test_get_version_changes_deleted(self):
+        existing = {
+            u'0': {u'meta': {u'version': 10}},
+            u'1': {u'meta': {u'version': 20}},
+        }
+        indexed_record = IndexedRecord(MagicMock(), MagicMock(), [], existing, 0, 2)
+        indexed_record.update_with_result(u'delete', dict(result=u'deleted'), 0)
+        indexed_record.update_with_result(u'delete', dict(result=u'not_found'), 1)
+        assert indexed_record.get_version_changes() == {10: -1}
+
     def test_is_new(self):
         indexed_record = IndexedRecord(MagicMock(), MagicMock(), MagicMock(),
                                        {u'0': MagicMock(), u'1': MagicMock()}, 0, 0)
@@ -365,6 +408,27 @@ class TestIndexingTask(object):
             assert u'indexed_record' in kwargs
             assert isinstance(kwargs[u'indexed_record'], IndexedRecord)
 
+    def test_index_doc_iterator_no_ops_batch_signal(self):
+        mongo_docs = [dict(id=str(i)) for i in range(5)]
+        feeder = MagicMock(documents=MagicMock(return_value=mongo_docs))
+        partial_batch_signal = MagicMock()
+        task = IndexingTask(feeder, MagicMock(), None, MagicMock(), bulk_size=2000,
+                            elasticsearch=MagicMock(), check_batch_size=2, always_replace=False,
+                            partial_batch_signal=partial_batch_signal)
+
+        task.is_clean_index = create_autospec(task.is_clean_index)
+        task.get_indexed_documents = create_autospec(task.get_indexed_documents)
+        task.get_bulk_ops = create_autospec(task.get_bulk_ops, return_value=([], []))
+
+        assert list(task.index_doc_iterator()) == []
+        # full batches are sent straight away, the rest is left for the end of the run
+        assert [len(kwargs[u'indexed_records'])
+                for _args, kwargs in partial_batch_signal.call_args_list] == [2, 2]
+        assert len(task.completed_batch) == 1
+        task.send_completed_batch()
+        assert partial_batch_signal.call_count == 3
+        assert task.completed_batch == []
+
     def test_index_doc_iterator_ops(self):
         mongo_docs = [dict(id=str(i)) for i in range(10)]
         delete_ops = [MagicMock(), MagicMock()]
@@ -527,6 +591,20 @@ class TestIndexingTask(object):
 
 class TestIndexer(object):
 
+    @mock.patch(u'eevee.indexing.indexers.get_elasticsearch_client')
+    def test_get_stats_metrics(self, elasticsearch_mock):
+        metrics = InMemoryMetrics()
+        metrics.increment(u'index.records', 4)
+        feeders_and_indexes = [(MagicMock(mongo_collection=u'collection'), MagicMock())]
+        indexer = Indexer(10, MagicMock(), feeders_and_indexes, metrics=metrics)
+        indexing_stats = create_autospec(IndexingStats, seen_versions=set(), op_stats={})
+
+        stats = indexer.get_stats(indexing_stats)
+        assert stats[u'metrics'][u'counters'] == {u'index.records': 4}
+        # without metrics there should be no metrics in the stats
+        indexer = Indexer(10, MagicMock(), feeders_and_indexes)
+        assert u'metrics' not in indexer.get_stats(indexing_stats)
+
     @mock.patch(u'eevee.indexing.indexers.get_elasticsearch_client')
     @mock.patch(u'eevee.indexing.indexers.datetime', now=MagicMock(
         side_effect=[datetime(2019, 1, 1), datetime(2019, 1, 2)]))
@@ -624,6 +702,10 @@ class TestIndexer(object):
                         u'latest_version': {
                             u'type': u'date',
                             u'format': u'epoch_millis'
+                        },
+                        u'version_summary': {
+                            u'type': u'object',
+                            u'enabled': False
                         }
                     }
                 }
@@ -678,6 +760,10 @@ class TestIndexer(object):
                         u'latest_version': {
                             u'type': u'date',
                             u'format': u'epoch_millis'
+                        },
+                        u'version_summary': {
+                            u'type': u'object',
+                            u'enabled': False
                         }
                     }
                 }
@@ -685,8 +771,10 @@ class TestIndexer(object):
         }
         version = 2093423
         indexer = Indexer(version, MagicMock(), feeders_and_indexes, update_status=True)
+        indexer.update_status_doc = create_autospec(indexer.update_status_doc)
+        indexing_stats = IndexingStats(0)
 
-        indexer.update_statuses()
+        indexer.update_statuses(indexing_stats)
 
         assert elasticsearch_mock.indices.exists.call_args_list == [
             call(indexer.config.elasticsearch_status_index_name)
@@ -694,12 +782,137 @@ class TestIndexer(object):
         assert elasticsearch_mock.indices.create.call_args_list == [
             call(indexer.config.elasticsearch_status_index_name, body=index_definition)
         ]
-        assert elasticsearch_mock.index.call_count == 3
+        assert not elasticsearch_mock.indices.put_mapping.called
+        assert indexer.update_status_doc.call_count == 3
         for index in [index1, index2, index3]:
-            assert call(indexer.config.elasticsearch_status_index_name, DOC_TYPE,
-                        dict(name=index.unprefixed_name, index_name=index.name,
-                             latest_version=version),
-                        id=index.name) in elasticsearch_mock.index.call_args_list
+            assert call(index.name) in elasticsearch_mock.indices.refresh.call_args_list
+            assert call(index, indexing_stats.version_changes[index.name]) in \
+                indexer.update_status_doc.call_args_list
+
+    def test_update_statuses_existing_status_index(self, monkeypatch):
+        elasticsearch_mock = MagicMock(indices=MagicMock(exists=MagicMock(return_value=True)))
+        monkeypatch.setattr(u'eevee.indexing.indexers.get_elasticsearch_client',
+                            MagicMock(return_value=elasticsearch_mock))
+        indexer = Indexer(MagicMock(), MagicMock(), [(MagicMock(), MagicMock())],
+                          update_status=False)
+
+        indexer.update_statuses()
+
+        assert not elasticsearch_mock.indices.create.called
+        # the version summary mapping should be added to the existing status index
+        assert elasticsearch_mock.indices.put_mapping.call_args_list == [
+            call(DOC_TYPE, {u'properties': {u'version_summary': {u'type': u'object',
+                                                                 u'enabled': False}}},
+                 index=indexer.config.elasticsearch_status_index_name)
+        ]
+
+    def test_update_status_doc_new(self, monkeypatch):
+        elasticsearch_mock = MagicMock(get=MagicMock(side_effect=NotFoundError()))
+        monkeypatch.setattr(u'eevee.indexing.indexers.get_elasticsearch_client',
+                            MagicMock(return_value=elasticsearch_mock))
+        index = MagicMock()
+        index.configure_mock(name=u'index1', unprefixed_name=u'unprefixed1')
+        version = 2093423
+        indexer = Indexer(version, MagicMock(), [(MagicMock(), index)])
+        summary = MagicMock()
+        indexer.get_version_summary = MagicMock(return_value=summary)
+        version_changes = Counter({version: 4})
+
+        indexer.update_status_doc(index, version_changes)
+
+        assert indexer.get_version_summary.call_args == call(index, None, version_changes)
+        assert elasticsearch_mock.index.call_args_list == [
+            call(indexer.config.elasticsearch_status_index_name, DOC_TYPE,
+                 dict(name=u'unprefixed1', index_name=u'index1', latest_version=version,
+                      version_summary=summary),
+                 id=u'index1', op_type=u'create')
+        ]
+
+    def test_update_status_doc_retries_on_conflict(self, monkeypatch):
+        statuses = [{u'_version': 3, u'_source': {}}, {u'_version': 4, u'_source': {}}]
+        elasticsearch_mock = MagicMock(get=MagicMock(side_effect=statuses),
+                                       index=MagicMock(side_effect=[ConflictError(), None]))
+        monkeypatch.setattr(u'eevee.indexing.indexers.get_elasticsearch_client',
+                            MagicMock(return_value=elasticsearch_mock))
+        index = MagicMock()
+        index.configure_mock(name=u'index1', unprefixed_name=u'unprefixed1')
+        indexer = Indexer(MagicMock(), MagicMock(), [(MagicMock(), index)])
+        indexer.get_version_summary = MagicMock()
+
+        indexer.update_status_doc(index, Counter())
+
+        # the status should have been read again after the conflict and written conditionally
+        assert indexer.get_version_summary.call_args_list == [
+            call(index, statuses[0], Counter()),
+            call(index, statuses[1], Counter()),
+        ]
+        assert [c[1][u'version'] for c in elasticsearch_mock.index.call_args_list] == [3, 4]
+
+    def _create_summary_status(self, latest_version, summary_latest_version, versions):
+        return {
+            u'_version': 1,
+            u'_source': {
+                u'latest_version': latest_version,
+                u'version_summary': {
+                    u'latest_version': summary_latest_version,
+                    u'total': sum(entry[u'changes'] for entry in versions),
+                    u'versions': versions,
+                },
+            },
+        }
+
+    def test_get_version_summary_updates_existing(self, monkeypatch):
+        monkeypatch.setattr(u'eevee.indexing.indexers.get_elasticsearch_client', MagicMock())
+        # 9 documents are in the index after the changes are applied
+        monkeypatch.setattr(u'eevee.indexing.indexers.Search',
+                            MagicMock(return_value=MagicMock(count=MagicMock(return_value=9))))
+        rebuild_mock = MagicMock()
+        monkeypatch.setattr(u'eevee.indexing.indexers.SearchHelper.get_index_version_counts',
+                            rebuild_mock)
+        indexer = Indexer(30, MagicMock(), [(MagicMock(), MagicMock())])
+        status = self._create_summary_status(20, 20, [
+            {u'version': 10, u'changes': 5},
+            {u'version': 20, u'changes': 2},
+        ])
+
+        summary = indexer.get_version_summary(MagicMock(), status,
+                                              Counter({10: -1, 20: -2, 30: 5}))
+
+        # version 20 has no changes left so should have been dropped
+        assert summary == {
+            u'latest_version': 30,
+            u'total': 9,
+            u'versions': [
+                {u'version': 10, u'changes': 4},
+                {u'version': 30, u'changes': 5},
+            ],
+        }
+        assert not rebuild_mock.called
+
+    def test_get_version_summary_rebuilds(self, monkeypatch):
+        monkeypatch.setattr(u'eevee.indexing.indexers.get_elasticsearch_client', MagicMock())
+        # the index contains more documents than the updated summary accounts for
+        monkeypatch.setattr(u'eevee.indexing.indexers.Search',
+                            MagicMock(return_value=MagicMock(count=MagicMock(return_value=100))))
+        versions = [{u'version': 10, u'changes': 60}, {u'version': 30, u'changes': 40}]
+        rebuild_mock = MagicMock(return_value=versions)
+        monkeypatch.setattr(u'eevee.indexing.indexers.SearchHelper.get_index_version_counts',
+                            rebuild_mock)
+        indexer = Indexer(30, MagicMock(), [(MagicMock(), MagicMock())])
+        rebuilt = {u'latest_version': 30, u'total': 100, u'versions': versions}
+        current_status = self._create_summary_status(20, 20, [{u'version': 10, u'changes': 5}])
+        # the summary wasn't updated when the status was last written
+        stale_status = self._create_summary_status(20, 10, [{u'version': 10, u'changes': 5}])
+
+        # the summary doesn't match the index
+        assert indexer.get_version_summary(MagicMock(), current_status, Counter({30: 2})) == rebuilt
+        # the summary wasn't current when the status was written
+        assert indexer.get_version_summary(MagicMock(), stale_status, Counter({30: 2})) == rebuilt
+        # there's no status
+        assert indexer.get_version_summary(MagicMock(), None, Counter({30: 2})) == rebuilt
+        # there are no changes to apply
+        assert indexer.get_version_summary(MagicMock(), current_status, None) == rebuilt
+        assert rebuild_mock.call_count == 4
 
     def test_index(self, monkeypatch):
         monkeypatch.setattr(u'eevee.indexing.indexers.get_elasticsearch_client', MagicMock())
@@ -737,10 +950,27 @@ class TestIndexer(object):
             assert feeder.total.called
             assert call(feeder, index, mock.ANY, indexing_stats_mock, indexer.bulk_size,
                         indexer.elasticsearch, indexer.check_batch_size,
-                        indexer.always_replace) in indexing_task_mock.call_args_list
+                        indexer.always_replace, indexer.metrics,
+                        None) in indexing_task_mock.call_args_list
         assert indexer.update_statuses.call_count == 1
         assert indexer.get_stats.call_args_list == [call(indexing_stats_mock)]
         assert indexer.finish_signal.send.call_args_list == [
             call(indexer, indexing_stats=indexing_stats_mock, stats=stats_mock)
         ]
         assert stats == stats_mock
+
+
+class TestTimedBulkClient(object):
+
+    def test_bulk(self):
+        client = MagicMock()
+        metrics = InMemoryMetrics()
+        timed_client = TimedBulkClient(client, metrics)
+
+        assert timed_client.bulk(u'body', index=u'index') == client.bulk.return_value
+        assert client.bulk.call_args == call(u'body', index=u'index')
+        totals = metrics.get_totals()
+        assert totals[u'timers'][u'index.bulk_send'][u'count'] == 1
+        assert totals[u'histograms'][u'index.bulk_send_bytes'][u'sum'] == 4
+        # everything else should be passed through
+        assert timed_client.indices is client.indices
@@ -3,11 +3,16 @@
 
 from collections import OrderedDict
 
+import pytest
 from mock import MagicMock, call
 from six.moves import zip
 
-from eevee.diffing import format_diff, DICT_DIFFER_DIFFER
+from eevee.archive import SegmentArchive
+from eevee.diffing import FORWARD, REVERSE, SHALLOW_DIFFER, format_diff, DICT_DIFFER_DIFFER
 from eevee.indexing.utils import get_versions_and_data, update_refresh_interval
+from eevee.ingestion.backfill import apply_update
+from eevee.ingestion.converters import RecordToMongoConverter
+from eevee.utils import thaw
 
 
 def test_get_versions_and_data():
@@ -36,6 +41,108 @@ def test_get_versions_and_data():
         assert rnv == tnv
 
 
+def test_get_versions_and_data_copy_on_write():
+    datas = [{u'a': 1, u'b': {u'c': [1]}, u'd': {u'e': 1}},
+             {u'a': 2, u'b': {u'c': [1, 2]}, u'd': {u'e': 1}},
+             {u'b': {u'c': [1, 2]}, u'd': {u'e': 1}, u'f': 3}]
+    diffs = {}
+    previous = {}
+    for version, data in enumerate(datas, start=1):
+        diffs[str(version)] = format_diff(DICT_DIFFER_DIFFER,
+                                          DICT_DIFFER_DIFFER.diff(previous, data))
+        previous = data
+    mongo_doc = {u'diffs': diffs}
+
+    results = list(get_versions_and_data(mongo_doc, copy_on_write=True))
+    # every version's data must still be correct after all the versions have been replayed
+    assert [data for _version, data, _next in results] == datas
+    assert [data for _version, data, _next in results] == \
+        [data for _version, data, _next in get_versions_and_data(mongo_doc)]
+    # the unchanged nested dict is shared between all the versions
+    assert results[0][1][u'd'] is results[1][1][u'd'] is results[2][1][u'd']
+    with pytest.raises(TypeError):
+        results[0][1][u'd'][u'e'] = 2
+
+    with pytest.raises(ValueError):
+        list(get_versions_and_data(mongo_doc, in_place=True, copy_on_write=True))
+
+
+def create_mongo_doc(diff_mode, versions_and_data):
+    """
+    Creates a mongo doc in the given diff mode by ingesting each of the given versions in turn.
+    """
+    mongo_doc = None
+    for version, data in versions_and_data:
+        converter = RecordToMongoConverter(version, MagicMock(), diff_mode=diff_mode)
+        record = MagicMock(id=1, convert=MagicMock(return_value=data),
+                           modify_metadata=MagicMock(return_value={}))
+        if mongo_doc is None:
+            mongo_doc = converter.for_insert(record)
+        else:
+            apply_update(mongo_doc, converter.for_update(record, mongo_doc))
+    return mongo_doc
+
+
+REVERSE_TEST_DATA = [
+    (1, {u'a': 1}),
+    (2, {u'a': 2, u'b': {u'c': [1, 2]}}),
+    (4, {u'b': {u'c': [1]}}),
+    (7, {}),
+    (9, {u'a': u'x', u'b': {u'c': [1], u'd': 4}}),
+]
+
+
+@pytest.mark.parametrize(u'diff_mode', [FORWARD, REVERSE])
+@pytest.mark.parametrize(u'options', [
+    {}, {u'in_place': True}, {u'copy_on_write': True},
+    {u'latest_first': True}, {u'latest_first': True, u'in_place': True},
+    {u'latest_first': True, u'copy_on_write': True},
+])
+def test_get_versions_and_data_diff_modes(diff_mode, options):
+    mongo_doc = create_mongo_doc(diff_mode, REVERSE_TEST_DATA)
+    assert mongo_doc.get(u'diff_mode', FORWARD) == diff_mode
+
+    expected = [(version, data, next_version) for (version, data), next_version in
+                zip(REVERSE_TEST_DATA, [1, 2, 4, 7, 9][1:] + [float(u'inf')])]
+    if options.get(u'latest_first', False):
+        expected.reverse()
+    # the data is thawed as it's copied so that in place updates don't affect it
+    results = [(version, thaw(data), next_version) for version, data, next_version in
+               get_versions_and_data(mongo_doc, **options)]
+    assert results == expected
+    # the data field of the mongo doc should never be modified
+    assert mongo_doc[u'data'] == REVERSE_TEST_DATA[-1][1]
+
+
+def test_get_versions_and_data_reverse_diffs():
+    mongo_doc = create_mongo_doc(REVERSE, REVERSE_TEST_DATA[:2])
+    # the diff at each version patches that version's data back to the previous version's
+    assert mongo_doc[u'diffs'][u'2'] == format_diff(
+        SHALLOW_DIFFER, SHALLOW_DIFFER.diff(REVERSE_TEST_DATA[1][1], REVERSE_TEST_DATA[0][1]))
+    assert mongo_doc[u'diffs'][u'1'] == format_diff(SHALLOW_DIFFER, {u'r': [u'a']})
+
+
+def test_get_versions_and_data_with_archive(tmpdir):
+    datas = [{u'a': 1}, {u'a': 2, u'b': 3}, {u'b': 4}]
+    diffs = {}
+    previous = {}
+    for version, data in enumerate(datas, start=1):
+        diffs[str(version)] = format_diff(DICT_DIFFER_DIFFER,
+                                          DICT_DIFFER_DIFFER.diff(previous, data))
+        previous = data
+
+    with SegmentArchive(str(tmpdir)) as archive:
+        pointer = archive.write({u'1': diffs[u'1'], u'2': diffs[u'2']})
+        archive.flush()
+        mongo_doc = {u'id': 1, u'diffs': {u'3': diffs[u'3']}, u'archive': pointer}
+
+        assert [(version, data) for version, data, _next in
+                get_versions_and_data(mongo_doc, archive=archive)] == list(zip([1, 2, 3], datas))
+
+        with pytest.raises(ValueError):
+            list(get_versions_and_data(mongo_doc))
+
+
 def test_update_refresh_interval():
     # update_refresh_interval(elasticsearch, indexes, refresh_interval)
     mock_elasticsearch_client = MagicMock(indices=MagicMock(put_settings=MagicMock()))
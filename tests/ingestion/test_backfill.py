@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+# encoding: utf-8
+from contextlib import contextmanager
+from datetime import datetime
+
+from mock import MagicMock
+
+from eevee.ingestion.backfill import apply_update, BackfillIngester
+from eevee.ingestion.converters import RecordToMongoConverter
+from eevee.ingestion.feeders import BaseRecord
+from eevee.ingestion.ingesters import Ingester
+from tests.ingestion.test_feeders import ExampleFeederForTests
+from tests.ingestion.test_ingesters import FakeCollection
+
+
+class PicklableRecord(BaseRecord):
+
+    def __init__(self, version, record_id, data):
+        super(PicklableRecord, self).__init__(version)
+        self.record_id = record_id
+        self.data = data
+
+    def convert(self):
+        return dict(self.data)
+
+    @property
+    def id(self):
+        return self.record_id
+
+    @property
+    def mongo_collection(self):
+        return u'test'
+
+
+def patch_mongo(monkeypatch, module, collection):
+    @contextmanager
+    def get_mongo(*args, **kwargs):
+        yield collection
+
+    monkeypatch.setattr(u'eevee.ingestion.{}.get_mongo'.format(module), get_mongo)
+    monkeypatch.setattr(u'eevee.ingestion.ingesters.get_mongo', get_mongo)
+
+
+INGESTION_TIME = datetime(2020, 1, 1)
+
+VERSIONS_AND_DATA = [
+    (1, [(1, {u'a': 1}), (2, {u'a': 2}), (3, {u'a': 3})]),
+    # record 2 is missing, record 4 appears and record 1 appears twice
+    (2, [(1, {u'a': 5}), (1, {u'a': 6}), (3, {u'a': 3}), (4, {u'b': 1})]),
+    (3, [(1, {u'a': 5}), (2, {u'a': 7}), (3, {u'a': 4, u'c': {u'd': 1}}), (4, {u'b': 1})]),
+]
+
+
+def create_feeders():
+    return [(version, ExampleFeederForTests(version, [PicklableRecord(version, record_id, data)
+                                                      for record_id, data in records]))
+            for version, records in VERSIONS_AND_DATA]
+
+
+def test_apply_update():
+    doc = {u'data': {u'a': 1}, u'diffs': {u'1': u'x'}, u'versions': [1]}
+    apply_update(doc, {u'$set': {u'data': {u'a': 2}, u'diffs.2': u'y'},
+                       u'$addToSet': {u'versions': 2}})
+    assert doc == {u'data': {u'a': 2}, u'diffs': {u'1': u'x', u'2': u'y'}, u'versions': [1, 2]}
+    apply_update(doc, {u'$addToSet': {u'versions': 2}})
+    assert doc[u'versions'] == [1, 2]
+
+
+def test_get_partition():
+    ingester = BackfillIngester([], MagicMock(), MagicMock(), partitions=8)
+    assert ingester.get_partition(10) == ingester.get_partition(u'10')
+    assert all(0 <= ingester.get_partition(i) < 8 for i in range(100))
+
+
+def test_backfill_matches_sequential_ingestion(monkeypatch, tmpdir):
+    # ingest each version in turn with the normal ingester
+    sequential = FakeCollection()
+    patch_mongo(monkeypatch, u'ingesters', sequential)
+    sequential_stats = []
+    for version, feeder in create_feeders():
+        converter = RecordToMongoConverter(version, INGESTION_TIME)
+        sequential_stats.append(Ingester(version, feeder, converter, MagicMock()).ingest())
+
+    backfilled = FakeCollection()
+    # start with record 3 already in the collection from an earlier version
+    backfilled.docs[3] = RecordToMongoConverter(0, INGESTION_TIME).for_insert(
+        PicklableRecord(0, 3, {u'a': 0}))
+    patch_mongo(monkeypatch, u'backfill', backfilled)
+    ingester = BackfillIngester(create_feeders(),
+                                lambda version: RecordToMongoConverter(version, INGESTION_TIME),
+                                MagicMock(), partitions=3, spill_dir=str(tmpdir))
+    stats = ingester.ingest()
+
+    assert sorted(backfilled.docs) == [1, 2, 3, 4]
+    for record_id in (1, 2, 4):
+        assert backfilled.docs[record_id] == sequential.docs[record_id]
+    assert backfilled.docs[3][u'versions'] == [0, 1, 3]
+    assert backfilled.docs[3][u'data'] == sequential.docs[3][u'data']
+
+    assert [s[u'version'] for s in stats] == [1, 2, 3]
+    assert stats[0][u'operations'] == {u'test': {u'inserted': 2, u'updated': 1}}
+    assert stats[1][u'operations'] == {u'test': {u'inserted': 1, u'updated': 1}}
+    assert stats[2][u'operations'] == {u'test': {u'updated': 2}}
+    assert stats[0][u'differs'] == {u'sd': 3}
+    assert [s[u'differs'] for s in stats] == [s[u'differs'] for s in sequential_stats]
+    # the spill directory should have been cleaned up
+    assert tmpdir.listdir() == []
@@ -2,10 +2,14 @@
 # encoding: utf-8
 
 import dictdiffer
+import pytest
 from mock import MagicMock, call
 
-from eevee.diffing import DICT_DIFFER_DIFFER, SHALLOW_DIFFER
-from eevee.ingestion.converters import RecordToMongoConverter
+from eevee.diffing import DICT_DIFFER_DIFFER, SHALLOW_DIFFER, REVERSE, format_diff
+from eevee.ingestion.converters import RecordToMongoConverter, FirstMatchSelector, \
+    AdaptiveDifferSelector, get_shape
+from eevee.metrics import InMemoryMetrics
+from eevee.utils import ReadOnlyDict
 
 
 def test_diff_data():
@@ -48,7 +52,7 @@ def test_for_insert(monkeypatch):
     assert mongo_doc[u'diffs'] == {u'10': u'formatted_diff'}
     # check the diff data and serialise diff functions are called correctly
     assert mock_diff_data.call_args == call({}, {u'a': 4})
-    assert mock_format_diff.call_args == call(mock_differ, u'the_diff')
+    assert mock_format_diff.call_args == call(mock_differ, u'the_diff', None)
 
 
 def test_for_insert_no_insert(monkeypatch):
@@ -85,7 +89,7 @@ def test_for_update(monkeypatch):
     assert update_doc[u'$set'][u'metadata'] == {u'metadataaaa': u'nope!'}
     assert update_doc[u'$addToSet'][u'versions'] == 12
     assert mock_diff_data.call_args == call({u'a': 4}, {u'a': 5})
-    assert mock_format_diff.call_args == call(mock_differ, u'the_diff')
+    assert mock_format_diff.call_args == call(mock_differ, u'the_diff', None)
 
 
 def test_for_update_no_update(monkeypatch):
@@ -102,3 +106,126 @@ def test_for_update_no_update(monkeypatch):
     update_doc = converter.for_update(record, mongo_doc)
     assert not update_doc
     assert mock_diff_data.call_args == call({u'a': 4}, {u'a': 4})
+
+
+def test_metrics():
+    metrics = InMemoryMetrics()
+    converter = RecordToMongoConverter(10, MagicMock(), metrics=metrics)
+    record = MagicMock(id=3, modify_metadata=MagicMock(return_value={}),
+                       convert=MagicMock(return_value={u'a': 4}))
+    converter.for_insert(record)
+    converter.for_update(record, {u'data': {u'a': 3}, u'metadata': {}})
+
+    timers = metrics.get_totals()[u'timers']
+    assert timers[u'ingest.convert'][u'count'] == 2
+    assert timers[u'ingest.diff'][u'count'] == 2
+
+
+def test_differ_counts():
+    converter = RecordToMongoConverter(10, MagicMock())
+    converter.diff_data({}, {u'a': 4})
+    converter.diff_data({u'a': 4}, {u'a': 4})
+    converter.diff_data({}, {u'a': {u'b': 1}})
+    assert converter.differ_counts == {u'sd': 1, u'dd': 1}
+
+
+def test_get_shape():
+    assert get_shape({u'a': 1, u'b': u'x'}) == get_shape({u'b': u'y', u'a': 2})
+    assert get_shape({u'a': 1}) != get_shape({u'a': u'1'})
+    assert get_shape({u'a': 1}) != get_shape({u'a': 1, u'b': 1})
+
+
+def test_first_match_selector():
+    selector = FirstMatchSelector([SHALLOW_DIFFER, DICT_DIFFER_DIFFER])
+    assert selector.diff({}, {u'a': 1}) == (SHALLOW_DIFFER, {u'c': {u'a': 1}})
+    assert selector.diff({}, {u'a': {u'b': 1}})[0] is DICT_DIFFER_DIFFER
+
+
+class TestAdaptiveDifferSelector(object):
+
+    def create_selector(self, sizes, **kwargs):
+        """
+        Creates a selector which measures the diffs of each differ as having the given sizes and
+        ignores the patch time.
+        """
+        return AdaptiveDifferSelector(cost=lambda size, seconds: size,
+                                      size_of=lambda differ, diff, codec: sizes[differ.differ_id],
+                                      **kwargs)
+
+    def test_chooses_cheapest(self):
+        selector = self.create_selector({u'sd': 10, u'dd': 5})
+        assert selector.diff({}, {u'a': 1}) == (DICT_DIFFER_DIFFER,
+                                                DICT_DIFFER_DIFFER.diff({}, {u'a': 1}))
+        selector = self.create_selector({u'sd': 5, u'dd': 10})
+        assert selector.diff({}, {u'a': 1}) == (SHALLOW_DIFFER, {u'c': {u'a': 1}})
+
+    def test_only_candidates_considered(self):
+        selector = self.create_selector({u'sd': 1, u'dd': 10})
+        # the shallow differ can't diff nested data so no sampling is needed
+        assert selector.diff({}, {u'a': {u'b': 1}})[0] is DICT_DIFFER_DIFFER
+        assert selector.samples == 0
+
+    def test_choice_is_cached_by_shape(self):
+        sizes = {u'sd': 10, u'dd': 5}
+        selector = self.create_selector(sizes, sample_interval=3)
+        assert selector.diff({}, {u'a': 1})[0] is DICT_DIFFER_DIFFER
+        sizes[u'sd'] = 1
+        # the same shape uses the cached choice until it's resampled
+        for value in range(2, 5):
+            assert selector.diff({}, {u'a': value})[0] is DICT_DIFFER_DIFFER
+        assert selector.samples == 1
+        assert selector.diff({}, {u'a': 5})[0] is SHALLOW_DIFFER
+        assert selector.samples == 2
+        # a different shape is sampled straight away
+        assert selector.diff({}, {u'a': u'x'})[0] is SHALLOW_DIFFER
+        assert selector.samples == 3
+
+    def test_patch_time_excludes_copying(self):
+        differs = [MagicMock(differ_id=u'sd'), MagicMock(differ_id=u'dd')]
+        selector = self.create_selector({u'sd': 10, u'dd': 5}, differs=differs)
+        old = {u'a': {u'b': 1}}
+        assert selector.sample(differs, old, {u'a': {u'b': 2}})[0] is differs[1]
+        for differ in differs:
+            # the differs patch shared, read only data instead of copying the old data
+            assert not differ.patch.called
+            diff, frozen_old = differ.patch_shared.call_args[0]
+            assert diff is differ.diff.return_value
+            assert isinstance(frozen_old, ReadOnlyDict)
+            assert frozen_old == old
+        # the old data is only frozen once
+        assert differs[0].patch_shared.call_args[0][1] is differs[1].patch_shared.call_args[0][1]
+
+    def test_max_shapes(self):
+        selector = self.create_selector({u'sd': 1, u'dd': 2}, max_shapes=2)
+        for key in (u'a', u'b', u'c'):
+            selector.diff({}, {key: 1})
+        assert len(selector.shapes) == 2
+        assert get_shape({u'a': 1}) not in selector.shapes
+
+    def test_with_converter(self):
+        selector = self.create_selector({u'sd': 10, u'dd': 5})
+        converter = RecordToMongoConverter(10, MagicMock(), selector=selector)
+        assert converter.diff_data({}, {u'a': 1})[1] is DICT_DIFFER_DIFFER
+        assert converter.differ_counts == {u'dd': 1}
+
+
+def test_reverse_mode():
+    converter = RecordToMongoConverter(10, MagicMock(), diff_mode=REVERSE)
+    record = MagicMock(id=3, modify_metadata=MagicMock(return_value={}),
+                       convert=MagicMock(return_value={u'a': 4}))
+    mongo_doc = converter.for_insert(record)
+    assert mongo_doc[u'diff_mode'] == REVERSE
+    assert mongo_doc[u'data'] == {u'a': 4}
+    assert mongo_doc[u'diffs'] == {u'10': format_diff(SHALLOW_DIFFER, {u'r': [u'a']})}
+
+    converter = RecordToMongoConverter(11, MagicMock())
+    record.convert.return_value = {u'a': 5}
+    update = converter.for_update(record, mongo_doc)
+    # existing records are updated in their own diff mode, whatever the converter's mode
+    assert update[u'$set'][u'diffs.11'] == format_diff(SHALLOW_DIFFER, {u'c': {u'a': 4}})
+
+    # forward records aren't marked
+    assert u'diff_mode' not in converter.for_insert(record)
+
+    with pytest.raises(ValueError):
+        RecordToMongoConverter(10, MagicMock(), diff_mode=u'sideways')
@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+# encoding: utf-8
+from contextlib import contextmanager
+from datetime import datetime
+
+import pytest
+from mock import MagicMock, call
+
+from eevee.ingestion.distributed import hash_partition_units, HashPartitionFeeder, merge_stats, \
+    LeaseCoordinator, Heartbeat, Worker, PENDING, LEASED, DONE, encode_metrics, decode_metrics
+from eevee.metrics import InMemoryMetrics
+from tests.ingestion.test_feeders import ExampleFeederForTests
+
+
+@pytest.fixture
+def mongo(monkeypatch):
+    collection = MagicMock()
+
+    @contextmanager
+    def get_mongo(*args, **kwargs):
+        yield collection
+
+    monkeypatch.setattr(u'eevee.ingestion.distributed.get_mongo', get_mongo)
+    return collection
+
+
+def test_hash_partition_feeder():
+    records = [MagicMock(id=i) for i in range(50)]
+    feeder = ExampleFeederForTests(4, records)
+    partitions = [list(HashPartitionFeeder(feeder, **params).read())
+                  for params in hash_partition_units(3)]
+
+    assert sorted(r.id for partition in partitions for r in partition) == list(range(50))
+    assert all(partitions)
+    assert HashPartitionFeeder(feeder, 0, 3).source == u'testsource'
+    assert HashPartitionFeeder(feeder, 0, 3).version == 4
+
+
+def test_merge_stats():
+    stats = merge_stats([
+        {u'version': 4, u'source': u's', u'ingestion_time': 1, u'start': datetime(2020, 1, 1, 1),
+         u'end': datetime(2020, 1, 1, 2), u'operations': {u'a': {u'inserted': 2, u'updated': 1}},
+         u'differs': {u'sd': 3}},
+        {u'version': 4, u'source': u's', u'ingestion_time': 1, u'start': datetime(2020, 1, 1, 0),
+         u'end': datetime(2020, 1, 1, 1), u'operations': {u'a': {u'inserted': 1},
+                                                          u'b': {u'updated': 5}},
+         u'differs': {u'sd': 4, u'dd': 2}},
+    ])
+    assert stats[u'differs'] == {u'sd': 7, u'dd': 2}
+    assert stats[u'targets'] == [u'a', u'b']
+    assert stats[u'operations'] == {u'a': {u'inserted': 3, u'updated': 1}, u'b': {u'updated': 5}}
+    assert stats[u'start'] == datetime(2020, 1, 1, 0)
+    assert stats[u'duration'] == 7200
+    assert u'metrics' not in stats
+
+
+def create_metrics(diff_seconds, conflicts, bulk_write_size):
+    metrics = InMemoryMetrics(buckets=[10, 100])
+    metrics.record_time(u'ingest.diff', diff_seconds)
+    metrics.increment(u'ingest.conflicts', conflicts)
+    metrics.observe(u'ingest.bulk_write_size', bulk_write_size)
+    return metrics.get_totals()
+
+
+def create_stats(metrics):
+    return {u'version': 4, u'source': u's', u'ingestion_time': 1,
+            u'start': datetime(2020, 1, 1), u'end': datetime(2020, 1, 1, 1),
+            u'operations': {u'a': {u'inserted': 1}}, u'metrics': metrics}
+
+
+def test_merge_stats_metrics():
+    stats = merge_stats([create_stats(create_metrics(2, 1, 5)),
+                         create_stats(create_metrics(3, 4, 50))])
+    assert stats[u'metrics'] == {
+        u'timers': {u'ingest.diff': {u'count': 2, u'total': 5, u'max': 3}},
+        u'counters': {u'ingest.conflicts': 5},
+        u'histograms': {u'ingest.bulk_write_size': {u'count': 2, u'sum': 55,
+                                                    u'buckets': [1, 1]}},
+    }
+
+
+def test_encode_metrics():
+    metrics = create_metrics(2, 1, 5)
+    encoded = encode_metrics(metrics)
+
+    def keys(value):
+        if isinstance(value, dict):
+            for key, nested in value.items():
+                yield key
+                for nested_key in keys(nested):
+                    yield nested_key
+        elif isinstance(value, list):
+            for nested in value:
+                for nested_key in keys(nested):
+                    yield nested_key
+
+    # mongo doesn't allow dots in keys
+    assert not any(u'.' in key for key in keys(encoded))
+    assert encoded[u'counters'] == [{u'name': u'ingest.conflicts', u'value': 1}]
+    assert decode_metrics(encoded) == metrics
+
+
+class TestLeaseCoordinator(object):
+
+    def test_create_units(self, mongo):
+        coordinator = LeaseCoordinator(MagicMock(), u'job1')
+        coordinator.create_units(4, hash_partition_units(2))
+
+        assert mongo.update_one.call_count == 2
+        unit_filter, update = mongo.update_one.call_args_list[1][0]
+        assert unit_filter == {u'_id': u'job1-1'}
+        assert update[u'$setOnInsert'][u'params'] == {u'partition': 1, u'partitions': 2}
+        assert update[u'$setOnInsert'][u'status'] == PENDING
+        assert mongo.update_one.call_args_list[1][1] == {u'upsert': True}
+
+    def test_claim(self, mongo):
+        coordinator = LeaseCoordinator(MagicMock(), u'job1', lease_seconds=60)
+        assert coordinator.claim(u'worker1') is mongo.find_one_and_update.return_value
+
+        available, claim = mongo.find_one_and_update.call_args[0]
+        # pending units and units with expired leases can be claimed
+        assert available[u'job'] == u'job1'
+        assert available[u'$or'][0] == {u'status': PENDING}
+        assert available[u'$or'][1][u'status'] == LEASED
+        assert claim[u'$set'][u'owner'] == u'worker1'
+        assert claim[u'$set'][u'lease_expires'] > datetime.utcnow()
+
+    def test_heartbeat_lost(self, mongo):
+        mongo.update_one.return_value = MagicMock(matched_count=0)
+        coordinator = LeaseCoordinator(MagicMock(), u'job1')
+        assert not coordinator.heartbeat(u'job1-0', u'worker1')
+        assert mongo.update_one.call_args[0][0] == {u'_id': u'job1-0', u'owner': u'worker1',
+                                                    u'status': LEASED}
+
+    def test_get_stats(self, mongo):
+        mongo.find.return_value = []
+        assert LeaseCoordinator(MagicMock(), u'job1').get_stats() is None
+
+    def test_complete_and_get_stats_with_metrics(self, mongo):
+        mongo.update_one.return_value = MagicMock(matched_count=1)
+        coordinator = LeaseCoordinator(MagicMock(), u'job1')
+        metrics = [create_metrics(2, 1, 5), create_metrics(3, 4, 50)]
+        for number, unit_metrics in enumerate(metrics):
+            assert coordinator.complete(u'job1-{}'.format(number), u'worker1',
+                                        create_stats(unit_metrics))
+
+        stored = [update[u'$set'][u'stats'] for (_unit_filter, update), _kwargs
+                  in mongo.update_one.call_args_list]
+        assert stored[0][u'metrics'] == encode_metrics(metrics[0])
+        assert all(update[u'$set'][u'status'] == DONE
+                   for (_unit_filter, update), _kwargs in mongo.update_one.call_args_list)
+
+        mongo.find.return_value = [{u'stats': stats} for stats in stored]
+        assert coordinator.get_stats()[u'metrics'] == merge_stats(
+            [create_stats(unit_metrics) for unit_metrics in metrics])[u'metrics']
+
+
+def test_heartbeat_thread():
+    coordinator = MagicMock(lease_seconds=1)
+    coordinator.heartbeat.side_effect = [True, False]
+    with Heartbeat(coordinator, u'job1-0', u'worker1', interval=0.01) as heartbeat:
+        heartbeat.thread.join(5)
+    assert heartbeat.lost
+    assert coordinator.heartbeat.call_args_list == [call(u'job1-0', u'worker1')] * 2
+
+
+class TestWorker(object):
+
+    def test_run(self):
+        units = [{u'_id': u'job1-0'}, {u'_id': u'job1-1'}, None]
+        coordinator = MagicMock(lease_seconds=60)
+        coordinator.claim.side_effect = units
+        ingesters = []
+
+        def ingester_factory(unit):
+            ingester = MagicMock(clean_load=True)
+            ingester.ingest.return_value = {u'unit': unit[u'_id']}
+            ingesters.append(ingester)
+            return ingester
+
+        worker = Worker(coordinator, ingester_factory, worker_id=u'worker1')
+        assert worker.run() == 2
+        assert all(not ingester.clean_load for ingester in ingesters)
+        assert coordinator.complete.call_args_list == [
+            call(u'job1-0', u'worker1', {u'unit': u'job1-0'}),
+            call(u'job1-1', u'worker1', {u'unit': u'job1-1'}),
+        ]
+
+    def test_run_failure_releases(self):
+        coordinator = MagicMock(lease_seconds=60)
+        coordinator.claim.return_value = {u'_id': u'job1-0'}
+        ingester = MagicMock()
+        ingester.ingest.side_effect = ValueError()
+
+        worker = Worker(coordinator, lambda unit: ingester, worker_id=u'worker1')
+        with pytest.raises(ValueError):
+            worker.run()
+        assert coordinator.release.call_args == call(u'job1-0', u'worker1')
+        assert not coordinator.complete.called
@@ -44,6 +44,23 @@ def test_feeder_signals():
     ]
 
 
+def test_feeder_batch_signals():
+    test_records = [u'1', u'beans', u'a', u'00000000', u'x']
+    feeder = ExampleFeederForTests(10, test_records)
+    feeder.read_batch_size = 2
+
+    mock_batch_monitor = MagicMock(spec=lambda *args, **kwargs: None)
+    feeder.read_batch_signal.connect(mock_batch_monitor)
+
+    read_records = list(feeder.read())
+    assert read_records == test_records
+    assert mock_batch_monitor.call_args_list == [
+        call(feeder, numbers=[1, 2], records=[u'1', u'beans']),
+        call(feeder, numbers=[3, 4], records=[u'a', u'00000000']),
+        call(feeder, numbers=[5], records=[u'x']),
+    ]
+
+
 def test_feeder_empty():
     test_records = []
     feeder = ExampleFeederForTests(10, test_records)
@@ -0,0 +1,309 @@
+#!/usr/bin/env python
+# encoding: utf-8
+import copy
+from contextlib import contextmanager
+
+import pytest
+from mock import MagicMock, call
+from pymongo import InsertOne, UpdateOne, ReplaceOne
+from pymongo.errors import BulkWriteError
+
+from eevee.diffing import FORWARD, REVERSE
+from eevee.ingestion.converters import RecordToMongoConverter
+from eevee.ingestion.ingesters import Ingester, IngestionConflictError, DiffModeError, \
+    ensure_diff_mode, get_collection_diff_mode
+from tests.ingestion.test_feeders import ExampleFeederForTests
+
+
+class FakeCollection(object):
+    """
+    An in memory stand in for a mongo collection supporting the operations the ingesters use.
+    """
+
+    def __init__(self):
+        self.docs = {}
+        self.settings = {}
+
+    def find(self, query, projection=None):
+        if not query:
+            return [copy.deepcopy(doc) for doc in self.docs.values()]
+        return [copy.deepcopy(self.docs[record_id]) for record_id in query[u'id'][u'$in']
+                if record_id in self.docs]
+
+    def find_one(self, *args):
+        return next(iter(self.docs.values()), None)
+
+    def create_index(self, *args, **kwargs):
+        pass
+
+    def find_one_and_update(self, query, update, **kwargs):
+        # only used for the collection settings
+        settings = self.settings.setdefault(query[u'_id'], {u'_id': query[u'_id']})
+        for key, value in update[u'$setOnInsert'].items():
+            settings.setdefault(key, value)
+        return dict(settings)
+
+    def bulk_write(self, operations, ordered=True):
+        # imported here to avoid a circular import
+        from eevee.ingestion.backfill import apply_update
+
+        details = {u'nInserted': 0, u'nMatched': 0, u'nModified': 0, u'writeErrors': []}
+        for index, operation in enumerate(operations):
+            if isinstance(operation, InsertOne):
+                if operation._doc[u'id'] in self.docs:
+                    details[u'writeErrors'].append({u'index': index, u'code': 11000})
+                else:
+                    self.docs[operation._doc[u'id']] = copy.deepcopy(operation._doc)
+                    details[u'nInserted'] += 1
+            else:
+                doc = self.docs.get(operation._filter[u'id'], None)
+                if doc is None or any(doc.get(key) != value
+                                      for key, value in operation._filter.items()):
+                    continue
+                details[u'nMatched'] += 1
+                details[u'nModified'] += 1
+                if isinstance(operation, UpdateOne):
+                    apply_update(doc, operation._doc)
+                elif isinstance(operation, ReplaceOne):
+                    self.docs[operation._filter[u'id']] = copy.deepcopy(operation._doc)
+        if details[u'writeErrors']:
+            raise BulkWriteError(details)
+        return MagicMock(inserted_count=details[u'nInserted'],
+                         matched_count=details[u'nMatched'],
+                         modified_count=details[u'nModified'])
+
+
+def create_record(record_id, collection=u'test'):
+    return MagicMock(id=record_id, mongo_collection=collection)
+
+
+def create_ingester(monkeypatch, records, existing_docs=(), mongo=None, **kwargs):
+    if mongo is None:
+        mongo = MagicMock(wraps=FakeCollection())
+        mongo.find_one.return_value = existing_docs[0] if existing_docs else None
+        for doc in existing_docs:
+            mongo._mock_wraps.docs[doc[u'id']] = doc
+
+    @contextmanager
+    def get_mongo(*args, **kwargs):
+        yield mongo
+
+    monkeypatch.setattr(u'eevee.ingestion.ingesters.get_mongo', get_mongo)
+    converter = MagicMock()
+    converter.for_insert.side_effect = lambda record: {u'id': record.id, u'latest_version': 2}
+    converter.for_update.side_effect = lambda record, doc: (
+        {u'$set': {u'latest_version': 2}} if doc[u'latest_version'] != 2 else {})
+    ingester = Ingester(2, ExampleFeederForTests(2, records), converter, MagicMock(), **kwargs)
+    ingester.ensure_mongo_indexes_exist = MagicMock()
+    ingester.ensure_diff_mode = MagicMock()
+    return ingester, mongo
+
+
+def get_operations(mongo):
+    return [args[0] for args, _kwargs in mongo.bulk_write.call_args_list]
+
+
+class TestCleanLoad(object):
+
+    def test_clean_collection(self, monkeypatch):
+        records = [create_record(1), create_record(2), create_record(1), create_record(3)]
+        ingester, mongo = create_ingester(monkeypatch, records, chunk_size=10)
+
+        ingester.ingest()
+
+        # no lookups should be done and the duplicate id should be ignored
+        assert not mongo.find.called
+        assert get_operations(mongo) == [
+            [InsertOne({u'id': 1, u'latest_version': 2}),
+             InsertOne({u'id': 2, u'latest_version': 2}),
+             InsertOne({u'id': 3, u'latest_version': 2})],
+        ]
+        # the indexes should be created once at the end
+        assert ingester.ensure_mongo_indexes_exist.call_args_list == [call(u'test')]
+        assert ingester.clean_collections == {}
+
+    def test_clean_collection_duplicates_across_chunks(self, monkeypatch):
+        records = [create_record(1), create_record(2), create_record(1), create_record(3)]
+        ingester, mongo = create_ingester(monkeypatch, records, chunk_size=2)
+
+        ingester.ingest()
+
+        # only the duplicated id should be looked up, it is found and needs no update
+        assert mongo.find.call_args_list == [call({u'id': {u'$in': [1]}})]
+        assert get_operations(mongo) == [
+            [InsertOne({u'id': 1, u'latest_version': 2}),
+             InsertOne({u'id': 2, u'latest_version': 2})],
+            [InsertOne({u'id': 3, u'latest_version': 2})],
+        ]
+
+    def test_existing_collection(self, monkeypatch):
+        records = [create_record(1), create_record(2)]
+        ingester, mongo = create_ingester(monkeypatch, records, [{u'id': 1, u'latest_version': 1}])
+
+        ingester.ingest()
+
+        assert mongo.find.call_args_list == [call({u'id': {u'$in': [1, 2]}})]
+        assert get_operations(mongo) == [
+            [UpdateOne({u'id': 1, u'latest_version': 1}, {u'$set': {u'latest_version': 2}}),
+             InsertOne({u'id': 2, u'latest_version': 2})],
+        ]
+        assert mongo.bulk_write.call_args[1] == {u'ordered': False}
+        assert ingester.ensure_mongo_indexes_exist.call_args_list == [call(u'test')]
+
+    def test_clean_load_disabled(self, monkeypatch):
+        ingester, mongo = create_ingester(monkeypatch, [create_record(1)], clean_load=False)
+
+        ingester.ingest()
+
+        assert mongo.find.called
+        assert not mongo.find_one.called
+
+
+class TestConflicts(object):
+
+    def test_update_conflict(self, monkeypatch):
+        collection = FakeCollection()
+        collection.docs[1] = {u'id': 1, u'latest_version': 1}
+        collection.docs[2] = {u'id': 2, u'latest_version': 1}
+        mongo = MagicMock(wraps=collection)
+        ingester, _mongo = create_ingester(monkeypatch, [create_record(1), create_record(2)],
+                                           mongo=mongo, clean_load=False)
+        # another ingester updates record 1 between our read and write
+        ingester.record_to_mongo_converter.for_update.side_effect = [
+            {u'$set': {u'latest_version': 2}},
+            {u'$set': {u'latest_version': 2}},
+            {u'$set': {u'latest_version': 2}},
+            {},
+        ]
+        real_bulk_write = collection.bulk_write
+
+        def bulk_write(operations, ordered=True):
+            if mongo.bulk_write.call_count == 1:
+                collection.docs[1][u'latest_version'] = 3
+            return real_bulk_write(operations, ordered)
+
+        mongo.bulk_write.side_effect = bulk_write
+
+        stats = ingester.ingest()
+
+        operations = get_operations(mongo)
+        assert len(operations) == 2
+        # both updates are rechecked but only the conflicting one needs writing again
+        assert operations[1] == [UpdateOne({u'id': 1, u'latest_version': 3},
+                                           {u'$set': {u'latest_version': 2}})]
+        assert mongo.find.call_args_list[1] == call({u'id': {u'$in': [1, 2]}})
+        assert stats[u'operations'] == {u'test': {u'inserted': 0, u'updated': 2}}
+
+    def test_insert_conflict(self, monkeypatch):
+        collection = FakeCollection()
+        collection.docs[5] = {u'id': 5, u'latest_version': 1}
+        mongo = MagicMock(wraps=collection)
+        ingester, _mongo = create_ingester(monkeypatch, [create_record(1)], mongo=mongo,
+                                           clean_load=False)
+        real_bulk_write = collection.bulk_write
+
+        def bulk_write(operations, ordered=True):
+            # another ingester inserts the record between our read and write
+            if mongo.bulk_write.call_count == 1:
+                collection.docs[1] = {u'id': 1, u'latest_version': 1}
+            return real_bulk_write(operations, ordered)
+
+        mongo.bulk_write.side_effect = bulk_write
+
+        ingester.ingest()
+
+        assert get_operations(mongo)[1] == [UpdateOne({u'id': 1, u'latest_version': 1},
+                                                      {u'$set': {u'latest_version': 2}})]
+        assert collection.docs[1][u'latest_version'] == 2
+
+    def test_conflicts_differ_counts(self, monkeypatch):
+        collection = FakeCollection()
+        mongo = MagicMock(wraps=collection)
+        ingester, _mongo = create_ingester(monkeypatch, [], mongo=mongo, clean_load=False)
+        converter = RecordToMongoConverter(1, MagicMock())
+        for record_id in (1, 2):
+            collection.docs[record_id] = converter.for_insert(
+                MagicMock(id=record_id, convert=MagicMock(return_value={u'a': 1}),
+                          modify_metadata=MagicMock(return_value={})))
+        records = [MagicMock(id=record_id, mongo_collection=u'test',
+                             convert=MagicMock(return_value={u'a': 2}),
+                             modify_metadata=MagicMock(return_value={}))
+                   for record_id in (1, 2, 3)]
+        ingester.feeder = ExampleFeederForTests(2, records)
+        ingester.record_to_mongo_converter = RecordToMongoConverter(2, MagicMock())
+        real_bulk_write = collection.bulk_write
+
+        def bulk_write(operations, ordered=True):
+            # another ingester updates record 1 and inserts record 3 between our read and write
+            if mongo.bulk_write.call_count == 1:
+                collection.docs[1][u'latest_version'] = 3
+                collection.docs[3] = copy.deepcopy(collection.docs[2])
+                collection.docs[3][u'id'] = 3
+            return real_bulk_write(operations, ordered)
+
+        mongo.bulk_write.side_effect = bulk_write
+
+        stats = ingester.ingest()
+
+        assert stats[u'operations'] == {u'test': {u'inserted': 0, u'updated': 3}}
+        # records 1 and 3 are diffed twice and record 2 is rediffed with no changes, but only the
+        # written diffs are counted
+        assert ingester.record_to_mongo_converter.differ_counts == {u'sd': 5}
+        assert stats[u'differs'] == {u'sd': 3}
+
+    def test_too_many_conflicts(self, monkeypatch):
+        collection = FakeCollection()
+        collection.docs[1] = {u'id': 1, u'latest_version': 1}
+        mongo = MagicMock(wraps=collection)
+        ingester, _mongo = create_ingester(monkeypatch, [create_record(1)], mongo=mongo,
+                                           clean_load=False, max_conflict_retries=2)
+        # the update never matches
+        mongo.bulk_write.side_effect = None
+        mongo.bulk_write.return_value = MagicMock(inserted_count=0, matched_count=0,
+                                                  modified_count=0)
+
+        with pytest.raises(IngestionConflictError):
+            ingester.ingest()
+        assert mongo.bulk_write.call_count == 3
+
+    def test_other_write_errors(self, monkeypatch):
+        mongo = MagicMock(wraps=FakeCollection())
+        ingester, _mongo = create_ingester(monkeypatch, [create_record(1)], mongo=mongo,
+                                           clean_load=False)
+        mongo.bulk_write.side_effect = BulkWriteError({u'writeErrors': [{u'index': 0,
+                                                                         u'code': 121}]})
+
+        with pytest.raises(BulkWriteError):
+            ingester.ingest()
+
+
+class TestDiffMode(object):
+
+    def patch_mongo(self, monkeypatch):
+        collection = FakeCollection()
+
+        @contextmanager
+        def get_mongo(*args, **kwargs):
+            yield collection
+
+        monkeypatch.setattr(u'eevee.ingestion.ingesters.get_mongo', get_mongo)
+        return collection
+
+    def test_ensure_diff_mode(self, monkeypatch):
+        collection = self.patch_mongo(monkeypatch)
+        assert get_collection_diff_mode(MagicMock(), u'test') == FORWARD
+        ensure_diff_mode(MagicMock(), u'test', REVERSE)
+        assert collection.settings == {u'test': {u'_id': u'test', u'diff_mode': REVERSE}}
+        # the same mode again is fine
+        ensure_diff_mode(MagicMock(), u'test', REVERSE)
+        with pytest.raises(DiffModeError):
+            ensure_diff_mode(MagicMock(), u'test', FORWARD)
+
+    def test_ingester_checks_diff_mode(self, monkeypatch):
+        collection = self.patch_mongo(monkeypatch)
+        collection.settings[u'test'] = {u'_id': u'test', u'diff_mode': FORWARD}
+        converter = RecordToMongoConverter(2, MagicMock(), diff_mode=REVERSE)
+        ingester = Ingester(2, ExampleFeederForTests(2, [create_record(1)]), converter,
+                            MagicMock())
+        with pytest.raises(DiffModeError):
+            ingester.ingest()
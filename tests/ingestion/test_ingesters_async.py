@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+# encoding: utf-8
+import asyncio
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import datetime
+
+import pytest
+from mock import MagicMock
+from pymongo.errors import BulkWriteError
+
+from eevee.ingestion import ingesters_async
+from eevee.ingestion.converters import RecordToMongoConverter
+from eevee.ingestion.ingesters import Ingester
+from eevee.ingestion.ingesters_async import AsyncIngester, AsyncIngestionFeeder, \
+    async_chunk_iterator, get_motor_client
+from tests.ingestion.test_backfill import PicklableRecord
+from tests.ingestion.test_feeders import ExampleFeederForTests
+from tests.ingestion.test_ingesters import FakeCollection
+from tests.test_search_async import run
+
+INGESTION_TIME = datetime(2020, 1, 1)
+
+
+class ExampleAsyncFeeder(AsyncIngestionFeeder):
+
+    def __init__(self, version, test_records):
+        super(ExampleAsyncFeeder, self).__init__(version, read_batch_size=2)
+        self.test_records = test_records
+
+    @property
+    def source(self):
+        return u'testsource'
+
+    async def records(self):
+        for record in self.test_records:
+            # give the ingester's tasks a chance to run
+            await asyncio.sleep(0)
+            yield record
+
+
+class AsyncFakeCollection(object):
+    """
+    An async wrapper around a FakeCollection supporting the motor operations the ingester uses.
+    """
+
+    def __init__(self):
+        self.collection = FakeCollection()
+        self.writing = 0
+        self.max_writing = 0
+
+    async def find_one(self, *args):
+        return self.collection.find_one(*args)
+
+    def find(self, query):
+        async def cursor():
+            for doc in self.collection.find(query):
+                yield doc
+        return cursor()
+
+    async def create_index(self, *args, **kwargs):
+        pass
+
+    async def find_one_and_update(self, *args, **kwargs):
+        return self.collection.find_one_and_update(*args, **kwargs)
+
+    async def bulk_write(self, operations, ordered=True):
+        self.writing += 1
+        self.max_writing = max(self.max_writing, self.writing)
+        try:
+            # let any other chunks in flight run before the write completes
+            for _ in range(10):
+                await asyncio.sleep(0)
+            return self.collection.bulk_write(operations, ordered)
+        finally:
+            self.writing -= 1
+
+
+def create_client():
+    return defaultdict(lambda: defaultdict(AsyncFakeCollection))
+
+
+def create_config():
+    return MagicMock(mongo_database=u'eevee')
+
+
+def get_test_collection(client):
+    return client[u'eevee'][u'test']
+
+
+def create_monitor():
+    return MagicMock(spec=lambda *args, **kwargs: None)
+
+
+def create_records(version, data):
+    return [PicklableRecord(version, record_id, record_data) for record_id, record_data in data]
+
+
+VERSIONS_AND_DATA = [
+    (1, [(record_id, {u'a': record_id}) for record_id in range(10)]),
+    # record 1 is duplicated across chunks with different data, record 10 is new
+    (2, [(0, {u'a': 0}), (1, {u'a': 5}), (2, {u'a': 6}), (1, {u'a': 7}), (3, {u'a': 3}),
+         (10, {u'b': 1}), (1, {u'a': 8}), (4, {u'a': 9})]),
+]
+
+
+def test_async_chunk_iterator():
+    async def numbers():
+        for number in range(5):
+            yield number
+
+    async def collect():
+        return [chunk async for chunk in async_chunk_iterator(numbers(), chunk_size=2)]
+
+    assert run(collect()) == [[0, 1], [2, 3], [4]]
+
+
+def test_async_feeder_signals():
+    feeder = ExampleAsyncFeeder(1, [u'a', u'b', u'c'])
+    read_monitor = create_monitor()
+    batch_monitor = create_monitor()
+    finish_monitor = create_monitor()
+    feeder.read_signal.connect(read_monitor)
+    feeder.read_batch_signal.connect(batch_monitor)
+    feeder.finish_signal.connect(finish_monitor)
+
+    async def collect():
+        return [record async for record in feeder.read()]
+
+    assert run(collect()) == [u'a', u'b', u'c']
+    assert [kwargs[u'number'] for _args, kwargs in read_monitor.call_args_list] == [1, 2, 3]
+    assert [kwargs[u'records'] for _args, kwargs in batch_monitor.call_args_list] == [
+        [u'a', u'b'], [u'c']]
+    assert finish_monitor.call_args[1] == {u'number': 3}
+
+
+def test_matches_sync_ingestion(monkeypatch):
+    sync_mongo = FakeCollection()
+
+    @contextmanager
+    def get_mongo(*args, **kwargs):
+        yield sync_mongo
+
+    monkeypatch.setattr(u'eevee.ingestion.ingesters.get_mongo', get_mongo)
+    client = create_client()
+
+    for version, data in VERSIONS_AND_DATA:
+        sync_ingester = Ingester(version, ExampleFeederForTests(version,
+                                                                create_records(version, data)),
+                                 RecordToMongoConverter(version, INGESTION_TIME), MagicMock(),
+                                 chunk_size=2)
+        async_ingester = AsyncIngester(version, ExampleAsyncFeeder(version,
+                                                                   create_records(version, data)),
+                                       RecordToMongoConverter(version, INGESTION_TIME),
+                                       create_config(), chunk_size=2, concurrency=3, client=client)
+        sync_monitors = {}
+        async_monitors = {}
+        for ingester, monitors in ((sync_ingester, sync_monitors),
+                                   (async_ingester, async_monitors)):
+            for name in (u'insert_signal', u'update_signal', u'insert_batch_signal',
+                         u'update_batch_signal', u'totals_signal', u'finish_signal'):
+                monitors[name] = create_monitor()
+                getattr(ingester, name).connect(monitors[name])
+
+        sync_stats = sync_ingester.ingest()
+        async_stats = run(async_ingester.ingest())
+
+        for key in (u'version', u'source', u'targets', u'ingestion_time', u'operations',
+                    u'differs'):
+            assert async_stats[key] == sync_stats[key]
+        for name in (u'insert_signal', u'update_signal'):
+            assert sorted(kwargs[u'record'].id for _args, kwargs
+                          in async_monitors[name].call_args_list) == \
+                sorted(kwargs[u'record'].id for _args, kwargs
+                       in sync_monitors[name].call_args_list)
+        assert async_monitors[u'finish_signal'].call_args[1][u'total'] == len(data)
+        assert async_monitors[u'totals_signal'].call_args_list[-1][1][u'total'] <= len(data)
+
+    assert get_test_collection(client).collection.docs == sync_mongo.docs
+    # the last of the duplicated records should win, just as it does when ingesting in sequence
+    assert sync_mongo.docs[1][u'data'] == {u'a': 8}
+
+
+def test_concurrency():
+    client = create_client()
+    records = create_records(1, [(record_id, {u'a': record_id}) for record_id in range(20)])
+    ingester = AsyncIngester(1, ExampleAsyncFeeder(1, records),
+                             RecordToMongoConverter(1, INGESTION_TIME), create_config(),
+                             chunk_size=2, concurrency=3, client=client)
+    stats = run(ingester.ingest())
+
+    assert stats[u'operations'] == {u'test': {u'inserted': 20, u'updated': 0}}
+    assert get_test_collection(client).max_writing == 3
+
+
+def test_failures_are_raised():
+    client = create_client()
+
+    async def bulk_write(*args, **kwargs):
+        raise BulkWriteError({u'writeErrors': [{u'index': 0, u'code': 1}]})
+
+    get_test_collection(client).bulk_write = bulk_write
+    records = create_records(1, [(record_id, {u'a': record_id}) for record_id in range(10)])
+    ingester = AsyncIngester(1, ExampleAsyncFeeder(1, records),
+                             RecordToMongoConverter(1, INGESTION_TIME), create_config(),
+                             chunk_size=2, client=client)
+    with pytest.raises(BulkWriteError):
+        run(ingester.ingest())
+
+
+def test_get_motor_client_without_motor(monkeypatch):
+    monkeypatch.setattr(ingesters_async, u'AsyncIOMotorClient', None)
+    with pytest.raises(ImportError):
+        get_motor_client(MagicMock())
@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+# encoding: utf-8
+from datetime import datetime
+
+import pytest
+from mock import MagicMock, call
+
+from eevee.ingestion.converters import RecordToMongoConverter
+from eevee.ingestion.ingesters import Ingester
+from eevee.ingestion.sidecar import data_hash, SidecarIndex, MAX_PARAMETERS
+from tests.ingestion.test_backfill import PicklableRecord, patch_mongo
+from tests.ingestion.test_feeders import ExampleFeederForTests
+from tests.ingestion.test_ingesters import FakeCollection
+
+INGESTION_TIME = datetime(2020, 1, 1)
+
+
+@pytest.fixture
+def sidecar(tmpdir):
+    with SidecarIndex(str(tmpdir.join(u'sidecar.db'))) as index:
+        yield index
+
+
+def test_data_hash():
+    assert data_hash({u'a': 1, u'b': {u'c': [1, 2]}}) == data_hash({u'b': {u'c': [1, 2]}, u'a': 1})
+    assert data_hash({u'a': 1}) != data_hash({u'a': 2})
+    assert data_hash({u'a': 1}) != data_hash({u'a': 1.5})
+    assert data_hash({u'a': u'é'}) != data_hash({u'a': u'e'})
+    # data that can't be serialised can't be hashed
+    assert data_hash({u'a': object()}) is None
+
+
+class TestSidecarIndex(object):
+
+    def test_update_get_and_delete(self, sidecar):
+        sidecar.update(u'test', [(1, 1, u'x'), (u'1', 2, u'y'), (2, 1, None)])
+        sidecar.update(u'other', [(1, 5, u'z')])
+        # ids keep their types
+        assert sidecar.get(u'test', [1, u'1', 2, 3]) == {1: (1, u'x'), u'1': (2, u'y'),
+                                                          2: (1, None)}
+        sidecar.update(u'test', [(1, 3, u'w')])
+        sidecar.delete(u'test', [2])
+        assert sidecar.get(u'test', [1, u'1', 2]) == {1: (3, u'w'), u'1': (2, u'y')}
+        assert sidecar.get(u'other', [1]) == {1: (5, u'z')}
+
+    def test_get_many(self, sidecar):
+        record_ids = list(range(MAX_PARAMETERS * 2 + 10))
+        sidecar.update(u'test', [(record_id, 1, u'x') for record_id in record_ids])
+        assert sorted(sidecar.get(u'test', record_ids)) == record_ids
+
+    def test_persistent(self, tmpdir):
+        path = str(tmpdir.join(u'sidecar.db'))
+        with SidecarIndex(path) as sidecar:
+            sidecar.update(u'test', [(1, 1, u'x')])
+        with SidecarIndex(path) as sidecar:
+            assert sidecar.get(u'test', [1]) == {1: (1, u'x')}
+
+    def test_build(self, monkeypatch, sidecar):
+        mongo = FakeCollection()
+        mongo.docs = {
+            1: {u'id': 1, u'latest_version': 1, u'data': {u'a': 1}},
+            2: {u'id': 2, u'latest_version': 3, u'data': {u'a': 2}},
+        }
+        patch_mongo(monkeypatch, u'sidecar', mongo)
+        # stale entries are replaced
+        sidecar.update(u'test', [(3, 1, u'x')])
+
+        assert not sidecar.is_built(u'test')
+        sidecar.build(MagicMock(), u'test', chunk_size=1)
+        assert sidecar.is_built(u'test')
+        assert not sidecar.is_built(u'other')
+        assert sidecar.get(u'test', [1, 2, 3]) == {1: (1, data_hash({u'a': 1})),
+                                                   2: (3, data_hash({u'a': 2}))}
+
+    def test_verify(self, monkeypatch, sidecar):
+        mongo = FakeCollection()
+        mongo.docs = {record_id: {u'id': record_id, u'latest_version': 1,
+                                  u'data': {u'a': record_id}}
+                      for record_id in (1, 2, 3)}
+        patch_mongo(monkeypatch, u'sidecar', mongo)
+        sidecar.build(MagicMock(), u'test')
+        report = sidecar.verify(MagicMock(), u'test')
+        assert report == {u'checked': 3, u'missing': [], u'stale': [], u'extra': []}
+
+        # drift the index away from mongo in each possible way
+        mongo.docs[2][u'data'] = {u'a': 20}
+        mongo.docs[4] = {u'id': 4, u'latest_version': 2, u'data': {u'a': 4}}
+        sidecar.update(u'test', [(5, 1, u'x')])
+        report = sidecar.verify(MagicMock(), u'test', chunk_size=2)
+        assert report == {u'checked': 4, u'missing': [4], u'stale': [2], u'extra': [5]}
+        # nothing should have been changed
+        assert sidecar.verify(MagicMock(), u'test') == report
+
+        sidecar.verify(MagicMock(), u'test', repair=True)
+        assert sidecar.verify(MagicMock(), u'test') == {u'checked': 4, u'missing': [],
+                                                        u'stale': [], u'extra': []}
+
+
+class TestIngesterWithSidecar(object):
+
+    def ingest(self, version, data, sidecar):
+        records = [PicklableRecord(version, record_id, record_data)
+                   for record_id, record_data in data]
+        converter = RecordToMongoConverter(version, INGESTION_TIME)
+        ingester = Ingester(version, ExampleFeederForTests(version, records), converter,
+                            MagicMock(), sidecar=sidecar)
+        ingester.update_signal = MagicMock()
+        return ingester.ingest(), ingester
+
+    def test_unchanged_records_are_skipped(self, monkeypatch, sidecar):
+        mongo = MagicMock(wraps=FakeCollection())
+        patch_mongo(monkeypatch, u'sidecar', mongo)
+
+        self.ingest(1, [(1, {u'a': 1}), (2, {u'a': 2}), (3, {u'a': 3})], sidecar)
+        assert sidecar.is_built(u'test')
+        assert sidecar.get(u'test', [1, 2, 3]) == {1: (1, data_hash({u'a': 1})),
+                                                   2: (1, data_hash({u'a': 2})),
+                                                   3: (1, data_hash({u'a': 3}))}
+
+        mongo.reset_mock()
+        stats, ingester = self.ingest(2, [(1, {u'a': 1}), (2, {u'a': 5}), (4, {u'a': 4})], sidecar)
+        # only the changed and new records should be looked up
+        assert mongo.find.call_args_list == [call({u'id': {u'$in': [2, 4]}})]
+        assert stats[u'operations'] == {u'test': {u'inserted': 1, u'updated': 1}}
+        # the skipped record still triggers the update signal with an empty update
+        assert ingester.update_signal.send.call_args_list[0][1][u'doc'] == {}
+        docs = mongo._mock_wraps.docs
+        assert docs[1][u'versions'] == [1]
+        assert docs[2][u'versions'] == [1, 2]
+        assert docs[4][u'versions'] == [2]
+        assert sidecar.get(u'test', [1, 2, 4]) == {1: (1, data_hash({u'a': 1})),
+                                                   2: (2, data_hash({u'a': 5})),
+                                                   4: (2, data_hash({u'a': 4}))}
+        assert sidecar.verify(MagicMock(), u'test')[u'checked'] == 4
+
+    def test_stale_sidecar_entries_are_corrected(self, monkeypatch, sidecar):
+        mongo = FakeCollection()
+        mongo.docs[1] = RecordToMongoConverter(1, INGESTION_TIME).for_insert(
+            PicklableRecord(1, 1, {u'a': 1}))
+        patch_mongo(monkeypatch, u'sidecar', mongo)
+        # the index has been built but has the wrong hash for record 1
+        sidecar.build(MagicMock(), u'test')
+        sidecar.update(u'test', [(1, 1, u'wrong')])
+
+        stats, _ingester = self.ingest(2, [(1, {u'a': 1})], sidecar)
+        # the record is looked up and found to be unchanged, the index is then corrected
+        assert stats[u'operations'] == {}
+        assert mongo.docs[1][u'versions'] == [1]
+        assert sidecar.get(u'test', [1]) == {1: (1, data_hash({u'a': 1}))}
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# encoding: utf-8
+import os
+
+import pytest
+
+from eevee.archive import SegmentArchive, ArchiveError
+
+
+def test_write_and_read(tmpdir):
+    with SegmentArchive(str(tmpdir)) as archive:
+        first = archive.write({u'1': {u'id': u'sh', u'd': {u'c': {u'a': 1}}}})
+        second = archive.write({u'2': {u'id': u'sh', u'd': {u'c': {u'b': 2}}}})
+        archive.flush()
+        assert first[u'offset'] == 0
+        assert second[u'offset'] == first[u'length']
+        assert archive.read(first) == {u'1': {u'id': u'sh', u'd': {u'c': {u'a': 1}}}}
+        assert archive.read(second) == {u'2': {u'id': u'sh', u'd': {u'c': {u'b': 2}}}}
+
+        # reads work whilst the segment is being appended to
+        third = archive.write({u'3': {}})
+        archive.flush()
+        assert archive.read(third) == {u'3': {}}
+
+    # and from a new archive object once everything has been closed
+    with SegmentArchive(str(tmpdir)) as archive:
+        assert archive.read(second) == {u'2': {u'id': u'sh', u'd': {u'c': {u'b': 2}}}}
+        # new entries are appended to the last segment
+        assert archive.write({u'4': {}})[u'offset'] > third[u'offset']
+
+
+def test_segment_rollover(tmpdir):
+    with SegmentArchive(str(tmpdir), max_segment_bytes=1) as archive:
+        pointers = [archive.write({str(i): {u'x': i}}) for i in range(3)]
+        archive.flush()
+        assert [pointer[u'segment'] for pointer in pointers] == [0, 1, 2]
+        assert archive.get_segments() == [0, 1, 2]
+        assert [archive.read(pointer) for pointer in pointers] == [{str(i): {u'x': i}}
+                                                                   for i in range(3)]
+
+
+def test_corrupt_entry(tmpdir):
+    with SegmentArchive(str(tmpdir)) as archive:
+        pointer = archive.write({u'1': {u'x': u'y' * 100}})
+        path = archive.get_segment_path(pointer[u'segment'])
+
+    with open(path, u'r+b') as segment_file:
+        # flip the bits of the last byte of the entry
+        segment_file.seek(pointer[u'length'] - 1)
+        last = bytearray(segment_file.read(1))[0]
+        segment_file.seek(pointer[u'length'] - 1)
+        segment_file.write(bytearray([last ^ 0xff]))
+
+    with SegmentArchive(str(tmpdir)) as archive:
+        with pytest.raises(ArchiveError):
+            archive.read(pointer)
+        with pytest.raises(ArchiveError):
+            archive.read(dict(pointer, length=pointer[u'length'] + 10))
+
+
+def test_get_diffs(tmpdir):
+    with SegmentArchive(str(tmpdir)) as archive:
+        pointer = archive.write({u'1': u'a', u'2': u'b'})
+        archive.flush()
+        assert archive.get_diffs({u'diffs': {u'3': u'c'}}) == {u'3': u'c'}
+        assert archive.get_diffs({u'diffs': {u'3': u'c'}, u'archive': pointer}) == \
+            {u'1': u'a', u'2': u'b', u'3': u'c'}
+
+
+def test_creates_directory(tmpdir):
+    path = os.path.join(str(tmpdir), u'archive')
+    SegmentArchive(path).close()
+    assert os.path.isdir(path)
@@ -1,6 +1,10 @@
+from datetime import datetime
+
 import pytest
 
-from eevee.diffing import SHALLOW_DIFFER
+from eevee.diffing import SHALLOW_DIFFER, DICT_DIFFER_DIFFER, ZLIB_JSON_CODEC, \
+    ZLIB_MSGPACK_CODEC, format_diff, extract_diff
+from eevee.utils import freeze, thaw, ReadOnlyDict, ReadOnlyList
 
 
 class TestShallowDiffer(object):
@@ -40,3 +44,75 @@ class TestShallowDiffer(object):
         with pytest.raises(KeyError):
             assert SHALLOW_DIFFER.patch({u'r': [u'x']}, {})
         assert SHALLOW_DIFFER.patch({u'r': [u'x'], u'c': {u'b': 2}}, {u'x': 2380}) == {u'b': 2}
+
+    def test_patch_shared(self):
+        old = freeze({u'x': 4, u'y': [1, 2], u'z': u'beans'})
+        new = SHALLOW_DIFFER.patch_shared({u'r': [u'z'], u'c': {u'x': 5, u'l': [3]}}, old)
+        assert new == {u'x': 5, u'y': [1, 2], u'l': [3]}
+        assert isinstance(new, ReadOnlyDict)
+        assert isinstance(new[u'l'], ReadOnlyList)
+        # the old data is untouched and the unchanged list is shared
+        assert old == {u'x': 4, u'y': [1, 2], u'z': u'beans'}
+        assert new[u'y'] is old[u'y']
+
+
+class TestDictDifferDiffer(object):
+
+    @pytest.mark.parametrize(u'old,new', [
+        ({}, {u'a': 1, u'b': {u'c': [1, 2, {u'd': 3}]}}),
+        ({u'a': 1, u'b': {u'c': [1, 2]}}, {u'a': 2, u'b': {u'c': [1, 2, 3]}}),
+        ({u'a': {u'b': {u'c': 1}}, u'x': {u'y': 1}}, {u'a': {u'b': {u'c': 2, u'd': 1}},
+                                                      u'x': {u'y': 1}}),
+        ({u'a': [{u'b': 1}, {u'c': 2}]}, {u'a': [{u'b': 2}, {u'c': 2}]}),
+        ({u'a': [1, 2, 3], u'b': {u'c': 1}}, {u'a': [1], u'b': {}}),
+        ({u'a.b': {u'c': 1}}, {u'a.b': {u'c': 2}}),
+    ])
+    def test_patch_shared(self, old, new):
+        diff = DICT_DIFFER_DIFFER.diff(old, new)
+        frozen_old = freeze(old)
+        patched = DICT_DIFFER_DIFFER.patch_shared(diff, frozen_old)
+        assert patched == new
+        assert thaw(frozen_old) == old
+        assert patched == DICT_DIFFER_DIFFER.patch(diff, old)
+
+    def test_patch_shared_shares_unchanged_data(self):
+        old = freeze({u'a': {u'b': {u'c': 1}, u'd': [1, 2]}, u'x': {u'y': 1}})
+        new = DICT_DIFFER_DIFFER.patch_shared(DICT_DIFFER_DIFFER.diff(
+            old, {u'a': {u'b': {u'c': 2}, u'd': [1, 2]}, u'x': {u'y': 1}}), old)
+        assert new[u'a'][u'b'] == {u'c': 2}
+        assert old[u'a'][u'b'] == {u'c': 1}
+        assert new[u'x'] is old[u'x']
+        assert new[u'a'][u'd'] is old[u'a'][u'd']
+        assert new[u'a'] is not old[u'a']
+        with pytest.raises(TypeError):
+            new[u'a'][u'b'][u'c'] = 3
+
+
+class TestCodecs(object):
+
+    def _check_round_trip(self, codec):
+        old = {u'a': u'x', u'b': {u'c': [1, 2, 3]}}
+        new = {u'a': u'ý', u'b': {u'c': [1, 2]}, u'd': 4.5}
+        diff = DICT_DIFFER_DIFFER.diff(old, new)
+        raw_diff = format_diff(DICT_DIFFER_DIFFER, diff, codec)
+        assert raw_diff[u'c'] == codec.codec_id
+        differ, extracted = extract_diff(raw_diff)
+        assert differ is DICT_DIFFER_DIFFER
+        assert differ.patch(extracted, old) == new
+
+    def test_zlib_json(self):
+        self._check_round_trip(ZLIB_JSON_CODEC)
+
+    def test_zlib_msgpack(self):
+        pytest.importorskip(u'msgpack')
+        self._check_round_trip(ZLIB_MSGPACK_CODEC)
+
+    def test_no_codec(self):
+        diff = SHALLOW_DIFFER.diff({}, {u'a': 1})
+        raw_diff = format_diff(SHALLOW_DIFFER, diff)
+        assert raw_diff == {u'id': u'sd', u'd': diff}
+        assert extract_diff(raw_diff) == (SHALLOW_DIFFER, diff)
+
+    def test_unsupported_types_stored_as_is(self):
+        diff = SHALLOW_DIFFER.diff({}, {u'a': datetime(2020, 1, 1)})
+        assert format_diff(SHALLOW_DIFFER, diff, ZLIB_JSON_CODEC) == {u'id': u'sd', u'd': diff}
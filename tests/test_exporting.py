@@ -0,0 +1,258 @@
+#!/usr/bin/env python
+# encoding: utf-8
+import gzip
+import json
+import os
+
+import pytest
+from mock import MagicMock, patch
+
+from eevee.diffing import SHALLOW_DIFFER, REVERSE, format_diff
+from eevee.exporting import flatten_mapping, get_path, CSVSerialiser, JSONLSerialiser, Exporter, \
+    main, get_data_at_version, reconstruct_records, ColumnarExporter
+
+
+def read_gzip(path):
+    with gzip.open(path, u'rb') as gzip_file:
+        return gzip_file.read().decode(u'utf-8')
+
+
+def test_flatten_mapping():
+    properties = {
+        u'b': {u'type': u'keyword'},
+        u'a': {u'properties': {u'y': {u'type': u'long'}, u'x': {u'type': u'text'}}},
+    }
+    assert flatten_mapping(properties) == [u'a.x', u'a.y', u'b']
+
+
+def test_get_path():
+    data = {u'a': {u'b': 4}, u'c': u'beans'}
+    assert get_path(data, u'a.b') == 4
+    assert get_path(data, u'c') == u'beans'
+    assert get_path(data, u'a.z') is None
+    assert get_path(data, u'c.z') is None
+
+
+def test_jsonl_serialiser():
+    serialiser = JSONLSerialiser()
+    assert serialiser.header() == u''
+    assert json.loads(serialiser.serialise({u'a': u'é'})) == {u'a': u'é'}
+
+
+def test_csv_serialiser():
+    serialiser = CSVSerialiser([u'a', u'b.c', u'd'])
+    assert serialiser.header() == u'a,b.c,d\r\n'
+    assert serialiser.serialise({u'a': u'x,y', u'b': {u'c': 3}}) == u'"x,y",3,\r\n'
+    assert serialiser.serialise({u'a': [1, 2], u'd': u'é'}) == u'"[1,2]",,é\r\n'
+
+
+class TestExporter(object):
+
+    def _create_exporter(self, tmpdir, slice_hits, **kwargs):
+        search_helper = MagicMock()
+        search_helper.prefix_index.side_effect = lambda index: u'eevee-{}'.format(index)
+        search_helper.get_rounded_versions.return_value = {u'eevee-test': 10}
+        exporter = Exporter(MagicMock(), u'test', str(tmpdir), version=12,
+                            slices=len(slice_hits), search_helper=search_helper, **kwargs)
+
+        def create_search(version, slice_id):
+            hits = [MagicMock(to_dict=MagicMock(return_value={u'data': data}))
+                    for data in slice_hits[slice_id]]
+            return MagicMock(scan=MagicMock(return_value=iter(hits)))
+
+        exporter.create_search = MagicMock(side_effect=create_search)
+        return exporter
+
+    def test_invalid_format(self, tmpdir):
+        with pytest.raises(ValueError):
+            Exporter(MagicMock(), u'test', str(tmpdir), export_format=u'xml',
+                     search_helper=MagicMock())
+
+    def test_create_search(self, tmpdir):
+        search_helper = MagicMock(prefix_index=MagicMock(return_value=u'eevee-test'))
+        exporter = Exporter(MagicMock(), u'test', str(tmpdir), slices=3,
+                            search_helper=search_helper)
+        body = exporter.create_search(10, 1).to_dict()
+        assert body[u'slice'] == {u'id': 1, u'max': 3}
+        assert body[u'query'] == {u'bool': {u'filter': [{u'term': {u'meta.versions': 10}}]}}
+
+        # a single slice shouldn't be sent to elasticsearch
+        exporter.slices = 1
+        assert u'slice' not in exporter.create_search(10, 0).to_dict()
+
+    def test_export_jsonl(self, tmpdir):
+        exporter = self._create_exporter(tmpdir, [[{u'_id': 1}, {u'_id': 2}], [{u'_id': 3}]])
+        paths, total = exporter.export()
+
+        assert total == 3
+        assert [os.path.basename(path) for path in paths] == [u'test-0.jsonl.gz',
+                                                              u'test-1.jsonl.gz']
+        assert [json.loads(line) for line in read_gzip(paths[0]).splitlines()] == [{u'_id': 1},
+                                                                                  {u'_id': 2}]
+        assert exporter.search_helper.get_rounded_versions.call_args[0] == ([u'eevee-test'], 12)
+        # all the searches should use the rounded version
+        assert all(call[0][0] == 10 for call in exporter.create_search.call_args_list)
+
+    def test_export_csv_concatenate(self, tmpdir):
+        exporter = self._create_exporter(tmpdir, [[{u'_id': 1, u'a': u'x'}], [{u'_id': 2}]],
+                                         export_format=u'csv')
+        exporter.search_helper.client.indices.get_mapping.return_value = {
+            u'eevee-test': {u'mappings': {u'doc': {u'properties': {u'data': {u'properties': {
+                u'_id': {u'type': u'long'},
+                u'a': {u'type': u'keyword'},
+            }}}}}}
+        }
+        paths, total = exporter.export(concatenate=True)
+
+        assert total == 2
+        assert [os.path.basename(path) for path in paths] == [u'test.csv.gz']
+        # the header should only be written once and the shards should have been removed
+        assert read_gzip(paths[0]) == u'_id,a\r\n1,x\r\n2,\r\n'
+        assert os.listdir(str(tmpdir)) == [u'test.csv.gz']
+
+    def test_export_no_data(self, tmpdir):
+        exporter = self._create_exporter(tmpdir, [[]])
+        exporter.search_helper.get_rounded_versions.return_value = {u'eevee-test': None}
+        assert exporter.export() == ([], 0)
+
+
+@patch(u'eevee.exporting.Exporter')
+def test_main(mock_exporter):
+    mock_exporter.formats = Exporter.formats
+    mock_exporter.return_value.export.return_value = ([u'out/test.csv.gz'], 5)
+    main([u'test', u'out', u'--format', u'csv', u'--slices', u'2', u'--concatenate'])
+
+    args, kwargs = mock_exporter.call_args
+    assert args[1:] == (u'test', u'out')
+    assert kwargs[u'export_format'] == u'csv'
+    assert kwargs[u'slices'] == 2
+    assert mock_exporter.return_value.export.call_args[1] == {u'concatenate': True}
+
+
+def create_mongo_doc(record_id, *versions_and_data):
+    diffs = {}
+    previous = {}
+    for version, data in versions_and_data:
+        diffs[str(version)] = format_diff(SHALLOW_DIFFER, SHALLOW_DIFFER.diff(previous, data))
+        previous = data
+    return {u'id': record_id, u'data': previous, u'diffs': diffs}
+
+
+def test_get_data_at_version():
+    mongo_doc = create_mongo_doc(1, (2, {u'a': 1}), (5, {u'a': 2}), (8, {}))
+    assert get_data_at_version(mongo_doc, 1) is None
+    assert get_data_at_version(mongo_doc, 2) == {u'a': 1}
+    assert get_data_at_version(mongo_doc, 4) == {u'a': 1}
+    assert get_data_at_version(mongo_doc, 5) == {u'a': 2}
+    assert get_data_at_version(mongo_doc, 9) == {}
+
+
+def test_reconstruct_records():
+    mongo_docs = [
+        create_mongo_doc(1, (2, {u'a': 1}), (5, {u'a': 2})),
+        # deleted at version 4
+        create_mongo_doc(2, (2, {u'a': 3}), (4, {})),
+        create_mongo_doc(3, (1, {u'a': 4})),
+    ]
+    assert reconstruct_records((mongo_docs, 4)) == [{u'a': 1}, {u'a': 4}]
+
+
+class TestColumnarExporter(object):
+
+    def test_invalid_format(self):
+        with pytest.raises(ValueError):
+            ColumnarExporter(MagicMock(), u'test', u'out.csv', export_format=u'csv')
+
+    def test_iter_row_groups(self):
+        exporter = ColumnarExporter(MagicMock(), u'test', u'out.parquet', version=3,
+                                    row_group_size=2, processes=2)
+        exporter.iter_mongo_docs = MagicMock(return_value=iter([
+            create_mongo_doc(i, (1, {u'a': i}), (2 + 3 * (i % 2), {}))
+            for i in range(8)
+        ]))
+        # the even records are deleted before version 3 so their data is left out
+        assert list(exporter.iter_row_groups()) == [[{u'a': 1}, {u'a': 3}], [{u'a': 5}, {u'a': 7}]]
+
+    def test_iter_row_groups_latest(self):
+        exporter = ColumnarExporter(MagicMock(), u'test', u'out.parquet', row_group_size=2)
+        exporter.iter_mongo_docs = MagicMock(return_value=iter([
+            {u'data': {u'a': 1}}, {u'data': {}}, {u'data': {u'a': 3}},
+        ]))
+        assert list(exporter.iter_row_groups()) == [[{u'a': 1}], [{u'a': 3}]]
+
+    def test_export(self, tmpdir):
+        parquet = pytest.importorskip(u'pyarrow.parquet')
+        path = str(tmpdir.join(u'out.parquet'))
+        exporter = ColumnarExporter(MagicMock(), u'test', path, row_group_size=2,
+                                    spill_dir=str(tmpdir))
+        exporter.iter_row_groups = MagicMock(return_value=iter([
+            [{u'a': 1, u'b': u'x'}, {u'a': 2, u'b': u'y'}],
+            [{u'a': 3, u'c': u'z'}],
+        ]))
+        assert exporter.export() == 3
+
+        table = parquet.read_table(path)
+        assert table.num_rows == 3
+        # fields missing from a row group are written as nulls
+        assert table.column_names == [u'a', u'b', u'c']
+        assert table.to_pylist()[2] == {u'a': 3, u'b': None, u'c': u'z'}
+        # the spilled row groups should have been cleaned up
+        assert tmpdir.listdir() == [tmpdir.join(u'out.parquet')]
+
+    def test_export_null_field_in_first_group(self, tmpdir):
+        ipc = pytest.importorskip(u'pyarrow.ipc')
+        path = str(tmpdir.join(u'out.arrow'))
+        exporter = ColumnarExporter(MagicMock(), u'test', path, export_format=u'arrow',
+                                    row_group_size=2)
+        exporter.iter_row_groups = MagicMock(return_value=iter([
+            [{u'a': 1, u'b': None}, {u'a': 2, u'b': None}],
+            [{u'a': 3, u'b': {u'c': 1.5}}],
+        ]))
+        assert exporter.export() == 3
+
+        table = ipc.open_file(path).read_all()
+        assert table.to_pylist() == [{u'a': 1, u'b': None}, {u'a': 2, u'b': None},
+                                     {u'a': 3, u'b': {u'c': 1.5}}]
+
+    def test_export_type_change(self, tmpdir):
+        parquet = pytest.importorskip(u'pyarrow.parquet')
+        path = str(tmpdir.join(u'out.parquet'))
+        exporter = ColumnarExporter(MagicMock(), u'test', path, row_group_size=2)
+        exporter.iter_row_groups = MagicMock(return_value=iter([
+            [{u'a': 1, u'b': 1, u'c': 1}, {u'a': 2, u'b': 2, u'c': 2}],
+            [{u'a': u'2', u'b': 2.5, u'c': {u'd': 1}}],
+        ]))
+        assert exporter.export() == 3
+
+        table = parquet.read_table(path)
+        # ints and floats are promoted to floats and anything else to strings
+        assert str(table.schema.field(u'a').type) == u'string'
+        assert str(table.schema.field(u'b').type) == u'double'
+        assert table.to_pylist() == [
+            {u'a': u'1', u'b': 1.0, u'c': u'1'},
+            {u'a': u'2', u'b': 2.0, u'c': u'2'},
+            {u'a': u'2', u'b': 2.5, u'c': u'{"d":1}'},
+        ]
+
+    def test_export_no_records(self, tmpdir):
+        pytest.importorskip(u'pyarrow')
+        path = str(tmpdir.join(u'out.parquet'))
+        exporter = ColumnarExporter(MagicMock(), u'test', path)
+        exporter.iter_row_groups = MagicMock(return_value=iter([]))
+        assert exporter.export() == 0
+
+
+def test_get_data_at_version_reverse():
+    versions_and_data = [(2, {u'a': 1}), (5, {u'a': 2}), (8, {})]
+    diffs = {}
+    previous = {}
+    for version, data in versions_and_data:
+        diffs[str(version)] = format_diff(SHALLOW_DIFFER, SHALLOW_DIFFER.diff(data, previous))
+        previous = data
+    mongo_doc = {u'id': 1, u'data': {}, u'diffs': diffs, u'diff_mode': REVERSE}
+    assert get_data_at_version(mongo_doc, 1) is None
+    assert get_data_at_version(mongo_doc, 2) == {u'a': 1}
+    assert get_data_at_version(mongo_doc, 4) == {u'a': 1}
+    assert get_data_at_version(mongo_doc, 5) == {u'a': 2}
+    assert get_data_at_version(mongo_doc, 9) == {}
+    assert mongo_doc[u'data'] == {}
@@ -0,0 +1,254 @@
+#!/usr/bin/env python
+# encoding: utf-8
+import calendar
+from contextlib import contextmanager
+from datetime import datetime
+
+from mock import MagicMock, patch
+
+from eevee.archive import SegmentArchive
+from eevee.diffing import SHALLOW_DIFFER, ZLIB_JSON_CODEC, REVERSE, format_diff, extract_diff
+from eevee.indexing.utils import get_versions_and_data
+from eevee.maintenance import Compactor, DiffArchiver, DiffRecompressor, \
+    MonthlyRetentionPolicy, compact_mongo_doc, compact_mongo_docs, main
+
+
+def create_diffs(*datas):
+    diffs = {}
+    previous = {}
+    for version, data in enumerate(datas, start=1):
+        diffs[str(version)] = format_diff(SHALLOW_DIFFER, SHALLOW_DIFFER.diff(previous, data))
+        previous = data
+    return diffs
+
+
+@patch(u'eevee.maintenance.document_size', side_effect=lambda document: len(repr(document)))
+def test_recompress(document_size, monkeypatch):
+    mongo = MagicMock()
+    mongo.find.return_value = [
+        {u'_id': 1, u'diffs': create_diffs({u'a': u'x' * 100}, {u'a': u'y' * 100})},
+        {u'_id': 2, u'diffs': {u'1': format_diff(SHALLOW_DIFFER, {u'c': {u'a': 1}},
+                                                 ZLIB_JSON_CODEC)}},
+    ]
+
+    @contextmanager
+    def get_mongo(*args, **kwargs):
+        yield mongo
+
+    monkeypatch.setattr(u'eevee.maintenance.get_mongo', get_mongo)
+
+    report = DiffRecompressor(MagicMock(), u'test', ZLIB_JSON_CODEC).run()
+
+    assert report[u'records'] == 2
+    # the second record is already encoded with the codec so doesn't need updating
+    assert report[u'changed'] == 1
+    assert report[u'bytes_saved'] == report[u'bytes_before'] - report[u'bytes_after']
+    assert report[u'bytes_after'] < report[u'bytes_before']
+
+    operations = mongo.bulk_write.call_args[0][0]
+    assert len(operations) == 1
+    assert operations[0]._filter == {u'_id': 1}
+    diffs = operations[0]._doc[u'$set'][u'diffs']
+    assert all(raw_diff[u'c'] == u'zj' for raw_diff in diffs.values())
+    assert extract_diff(diffs[u'2']) == (SHALLOW_DIFFER, {u'c': {u'a': u'y' * 100}})
+
+
+@patch(u'eevee.maintenance.DiffRecompressor')
+def test_main_recompress(recompressor):
+    recompressor.return_value.run.return_value = {
+        u'records': 2, u'changed': 1, u'bytes_before': 10, u'bytes_after': 5, u'bytes_saved': 5,
+        u'decode_seconds_before': 0.1, u'decode_seconds_after': 0.2,
+    }
+    main([u'--mongo-database', u'test', u'recompress', u'collection1', u'--codec', u'none'])
+
+    config, collection, codec, batch_size = recompressor.call_args[0]
+    assert config.mongo_database == u'test'
+    assert (collection, codec, batch_size) == (u'collection1', None, 1000)
+
+
+def version(year, month, day):
+    return calendar.timegm(datetime(year, month, day).timetuple()) * 1000
+
+
+def test_monthly_retention_policy():
+    cutoff = version(2020, 1, 1)
+    policy = MonthlyRetentionPolicy(cutoff)
+    versions = [version(2019, 5, 1), version(2019, 5, 20), version(2019, 6, 3),
+                version(2019, 12, 31), cutoff, version(2020, 1, 2), version(2020, 1, 3)]
+    assert policy.keep(versions) == {version(2019, 5, 20), version(2019, 6, 3),
+                                     version(2019, 12, 31), cutoff, version(2020, 1, 2),
+                                     version(2020, 1, 3)}
+
+    policy = MonthlyRetentionPolicy.from_age(days=10, now=cutoff)
+    assert policy.cutoff == version(2019, 12, 22)
+
+
+def test_compact_mongo_doc():
+    versions = [version(2019, 5, 1), version(2019, 5, 20), version(2019, 6, 3),
+                version(2020, 1, 2)]
+    datas = [{u'a': 1}, {u'a': 2, u'b': 1}, {u'a': 1, u'b': 1}, {u'a': 4}]
+    mongo_doc = {u'_id': 1, u'id': 1, u'latest_version': versions[-1], u'diffs': {}}
+    previous = {}
+    for record_version, data in zip(versions, datas):
+        mongo_doc[u'diffs'][str(record_version)] = format_diff(
+            SHALLOW_DIFFER, SHALLOW_DIFFER.diff(previous, data))
+        previous = data
+
+    policy = MonthlyRetentionPolicy(version(2020, 1, 1))
+    update, version_count = compact_mongo_doc(mongo_doc, policy, ZLIB_JSON_CODEC)
+    assert version_count == 4
+    assert update[u'$set'][u'versions'] == versions[1:]
+    assert update[u'$set'][u'latest_version'] == versions[-1]
+
+    # the data at each kept version must be unchanged
+    compacted = {u'diffs': update[u'$set'][u'diffs']}
+    assert [(v, data) for v, data, _next in get_versions_and_data(compacted)] == \
+        list(zip(versions[1:], datas[1:]))
+
+    # nothing to remove
+    assert compact_mongo_doc(mongo_doc, MonthlyRetentionPolicy(0)) == (None, 4)
+
+
+@patch(u'eevee.maintenance.document_size', side_effect=lambda document: len(repr(document)))
+def test_compact_mongo_docs(document_size):
+    mongo_doc = {u'_id': 1, u'id': 1, u'latest_version': 2,
+                 u'diffs': create_diffs({u'a': u'x' * 100}, {u'a': u'y' * 100})}
+    unchanged = {u'_id': 2, u'id': 2, u'latest_version': 2,
+                 u'diffs': create_diffs({u'a': 1}, {u'a': 2})}
+    policy = MagicMock()
+    policy.keep.side_effect = [{2}, {1, 2}]
+
+    operations, stats = compact_mongo_docs(([mongo_doc, unchanged], policy, None))
+
+    assert stats == {u'records': 2, u'compacted': 1, u'versions_before': 4, u'versions_after': 3,
+                     u'bytes_before': stats[u'bytes_before'],
+                     u'bytes_after': stats[u'bytes_after']}
+    assert stats[u'bytes_after'] < stats[u'bytes_before']
+    assert len(operations) == 1
+    # the update is guarded so that it isn't applied if the record has been ingested or archived
+    # since
+    assert operations[0]._filter == {u'_id': 1, u'latest_version': 2, u'archive': None}
+    assert operations[0]._doc[u'$set'][u'versions'] == [2]
+
+
+@patch(u'eevee.maintenance.Compactor')
+def test_main_compact(compactor):
+    compactor.return_value.run.return_value = {
+        u'records': 2, u'compacted': 1, u'versions_before': 4, u'versions_after': 3,
+        u'versions_removed': 1, u'bytes_before': 10, u'bytes_after': 5, u'bytes_saved': 5,
+    }
+    main([u'compact', u'collection1', u'--keep-days', u'30', u'--processes', u'2'])
+
+    config, collection, policy, codec, chunk_size, processes = compactor.call_args[0]
+    assert (collection, codec, chunk_size, processes) == (u'collection1', None, 1000, 2)
+    assert isinstance(policy, MonthlyRetentionPolicy)
+
+
+@patch(u'eevee.maintenance.document_size', side_effect=lambda document: len(repr(document)))
+def test_compactor(document_size, monkeypatch):
+    mongo = MagicMock()
+    mongo.find.return_value = [
+        {u'_id': record_id, u'id': record_id, u'latest_version': 3,
+         u'diffs': create_diffs({u'a': 1}, {u'a': record_id + 10}, {u'a': 3})}
+        for record_id in range(5)
+    ]
+
+    @contextmanager
+    def get_mongo(*args, **kwargs):
+        yield mongo
+
+    monkeypatch.setattr(u'eevee.maintenance.get_mongo', get_mongo)
+
+    report = Compactor(MagicMock(), u'test', MonthlyRetentionPolicy(3), chunk_size=2,
+                       processes=1).run()
+
+    # every record's first two versions are before the cutoff and in the same month
+    assert report[u'records'] == 5
+    assert report[u'compacted'] == 5
+    assert report[u'versions_before'] == 15
+    assert report[u'versions_after'] == 10
+    assert report[u'versions_removed'] == 5
+    operations = [op for call in mongo.bulk_write.call_args_list for op in call[0][0]]
+    assert sorted(op._filter[u'_id'] for op in operations) == list(range(5))
+    assert all(op._doc[u'$set'][u'versions'] == [2, 3] for op in operations)
+
+
+@patch(u'eevee.maintenance.document_size', side_effect=lambda document: len(repr(document)))
+def test_archiver(document_size, monkeypatch, tmpdir):
+    datas = [{u'a': 1}, {u'a': 2}, {u'a': 3}, {u'a': 4}]
+    mongo = MagicMock()
+    mongo.find.return_value = [
+        {u'_id': 1, u'id': 1, u'latest_version': 4, u'diffs': create_diffs(*datas)},
+        # only the latest version is before the cutoff so there's nothing to archive
+        {u'_id': 2, u'id': 2, u'latest_version': 1, u'diffs': create_diffs({u'a': 1})},
+    ]
+
+    @contextmanager
+    def get_mongo(*args, **kwargs):
+        yield mongo
+
+    monkeypatch.setattr(u'eevee.maintenance.get_mongo', get_mongo)
+
+    with SegmentArchive(str(tmpdir)) as archive:
+        report = DiffArchiver(MagicMock(), u'test', archive, cutoff=3).run()
+        assert report[u'records'] == 2
+        assert report[u'archived'] == 1
+        assert report[u'versions_archived'] == 2
+        assert report[u'bytes_saved'] > 0
+
+        operations = mongo.bulk_write.call_args[0][0]
+        assert len(operations) == 1
+        assert operations[0]._filter == {u'_id': 1, u'archive': None}
+        update = operations[0]._doc
+        assert update[u'$unset'] == {u'diffs.1': u'', u'diffs.2': u''}
+
+        # apply the update and check the history is still intact
+        mongo_doc = mongo.find.return_value[0]
+        mongo_doc[u'archive'] = update[u'$set'][u'archive']
+        del mongo_doc[u'diffs'][u'1']
+        del mongo_doc[u'diffs'][u'2']
+        assert [data for _version, data, _next in
+                get_versions_and_data(mongo_doc, archive=archive)] == datas
+
+        # archiving again with a later cutoff adds to the record's archived diffs
+        report = DiffArchiver(MagicMock(), u'test', archive, cutoff=10).run()
+        assert report[u'versions_archived'] == 1
+        operation = mongo.bulk_write.call_args[0][0][0]
+        assert operation._filter == {u'_id': 1, u'archive': mongo_doc[u'archive']}
+        assert sorted(archive.read(operation._doc[u'$set'][u'archive'])) == [u'1', u'2', u'3']
+
+
+def test_compact_mongo_doc_reverse():
+    datas = [{u'a': 1}, {u'a': 2, u'b': {u'c': 1}}, {u'a': 1, u'b': {u'c': 2}}, {u'a': 4}]
+    diffs = {}
+    previous = {}
+    for record_version, data in zip([1, 2, 3, 4], datas):
+        diffs[str(record_version)] = format_diff(SHALLOW_DIFFER,
+                                                 SHALLOW_DIFFER.diff(data, previous))
+        previous = data
+    mongo_doc = {u'_id': 1, u'id': 1, u'latest_version': 4, u'data': datas[-1], u'diffs': diffs,
+                 u'diff_mode': REVERSE}
+
+    policy = MagicMock()
+    policy.keep.return_value = {1, 3, 4}
+    update, version_count = compact_mongo_doc(mongo_doc, policy)
+    assert version_count == 4
+    assert update[u'$set'][u'versions'] == [1, 3, 4]
+
+    compacted = dict(mongo_doc, diffs=update[u'$set'][u'diffs'])
+    assert [(v, data) for v, data, _next in get_versions_and_data(compacted)] == \
+        [(1, datas[0]), (3, datas[2]), (4, datas[3])]
+
+
+@patch(u'eevee.maintenance.SidecarIndex')
+def test_main_verify_sidecar(sidecar_index):
+    sidecar = sidecar_index.return_value.__enter__.return_value
+    sidecar.verify.return_value = {u'checked': 3, u'missing': [1], u'stale': [], u'extra': [4]}
+    main([u'--mongo-database', u'test', u'verify-sidecar', u'/tmp/sidecar.db', u'collection1',
+          u'--repair'])
+
+    assert sidecar_index.call_args == ((u'/tmp/sidecar.db',),)
+    config, collection = sidecar.verify.call_args[0]
+    assert config.mongo_database == u'test'
+    assert collection == u'collection1'
+    assert sidecar.verify.call_args[1] == {u'repair': True}
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+# encoding: utf-8
+import os
+
+from mock import MagicMock
+
+from eevee.metrics import NULL_METRICS, NULL_TIMER, InMemoryMetrics, PrometheusTextfileMetrics, \
+    timed_iterator
+
+
+def test_null_metrics():
+    assert not NULL_METRICS.enabled
+    assert NULL_METRICS.timer(u'beans') is NULL_TIMER
+    with NULL_METRICS.timer(u'beans'):
+        pass
+    NULL_METRICS.increment(u'beans')
+    NULL_METRICS.observe(u'beans', 4)
+    assert NULL_METRICS.get_totals() == {}
+
+    # the iterable should be returned untouched when the metrics aren't enabled
+    iterable = [1, 2, 3]
+    assert timed_iterator(NULL_METRICS, u'beans', iterable) is iterable
+
+
+class TestInMemoryMetrics(object):
+
+    def test_timers(self):
+        metrics = InMemoryMetrics()
+        with metrics.timer(u'a'):
+            pass
+        metrics.record_time(u'a', 2.0)
+        metrics.record_time(u'b', 1.5)
+
+        timers = metrics.get_totals()[u'timers']
+        assert timers[u'a'][u'count'] == 2
+        assert 2.0 <= timers[u'a'][u'total'] < 3.0
+        assert timers[u'a'][u'max'] == 2.0
+        assert timers[u'b'] == {u'count': 1, u'total': 1.5, u'max': 1.5}
+
+    def test_counters(self):
+        metrics = InMemoryMetrics()
+        metrics.increment(u'a')
+        metrics.increment(u'a', 4)
+        metrics.increment(u'b', 2)
+        assert metrics.get_totals()[u'counters'] == {u'a': 5, u'b': 2}
+
+    def test_histograms(self):
+        metrics = InMemoryMetrics(buckets=(1, 10, float(u'inf')))
+        for value in (0, 1, 5, 100):
+            metrics.observe(u'a', value)
+        assert metrics.get_totals()[u'histograms'] == {
+            u'a': {u'count': 4, u'sum': 106, u'buckets': [2, 1, 1]}
+        }
+
+    def test_timed_iterator(self):
+        metrics = InMemoryMetrics()
+        assert list(timed_iterator(metrics, u'read', [1, 2, 3])) == [1, 2, 3]
+        # each element and the final exhausting call to next are timed
+        assert metrics.get_totals()[u'timers'][u'read'][u'count'] == 4
+
+
+def test_prometheus_textfile_metrics(tmpdir):
+    path = str(tmpdir.join(u'eevee.prom'))
+    metrics = PrometheusTextfileMetrics(path, buckets=(10, float(u'inf')))
+    metrics.record_time(u'ingest.bulk_write', 0.5)
+    metrics.increment(u'ingest.records', 3)
+    metrics.observe(u'ingest.bulk_write_size', 4)
+    metrics.observe(u'ingest.bulk_write_size', 40)
+    metrics.flush()
+
+    with open(path) as prom_file:
+        lines = prom_file.read().splitlines()
+    assert lines == [
+        u'# TYPE eevee_ingest_bulk_write_seconds summary',
+        u'eevee_ingest_bulk_write_seconds_count 1',
+        u'eevee_ingest_bulk_write_seconds_sum 0.5',
+        u'# TYPE eevee_ingest_records_total counter',
+        u'eevee_ingest_records_total 3',
+        u'# TYPE eevee_ingest_bulk_write_size histogram',
+        u'eevee_ingest_bulk_write_size_bucket{le="10"} 1',
+        u'eevee_ingest_bulk_write_size_bucket{le="+Inf"} 2',
+        u'eevee_ingest_bulk_write_size_sum 44',
+        u'eevee_ingest_bulk_write_size_count 2',
+    ]
+    # no temporary files should be left behind
+    assert os.listdir(str(tmpdir)) == [u'eevee.prom']
@@ -1,13 +1,17 @@
 #!/usr/bin/env python
 # encoding: utf-8
 
+import threading
+
+import pytest
 from mock import MagicMock
 from pymongo.collection import Collection
 from pymongo.database import Database
 
-from eevee.mongo import get_mongo, MongoOpBuffer
+from eevee.mongo import get_mongo, MongoOpBuffer, ThreadedMongoOpBuffer, update_op_key, \
+    merge_update_ops
 
-from pymongo import MongoClient
+from pymongo import MongoClient, InsertOne, UpdateOne, DeleteOne, ReplaceOne
 
 
 class TestMongo(object):
@@ -48,3 +52,124 @@ def test_mongo_op_buffer():
         # and that it was called with the ops
         assert mongo_mock.bulk_write.call_args[0][0] == [mock_op]
     assert mongo_ctx_mock.__exit__.called
+
+
+def create_mongo_context(mongo_mock):
+    return MagicMock(__enter__=MagicMock(return_value=mongo_mock))
+
+
+class TestThreadedMongoOpBuffer(object):
+
+    def test_writes_everything_on_exit(self):
+        mongo_mock = MagicMock()
+        mongo_ctx_mock = create_mongo_context(mongo_mock)
+        with ThreadedMongoOpBuffer(MagicMock(), mongo_ctx_mock, size=2, writers=2) as op_buffer:
+            op_buffer.add_all(range(7))
+        written = sorted(op for args, _kwargs in mongo_mock.bulk_write.call_args_list
+                         for op in args[0])
+        assert written == list(range(7))
+        assert mongo_mock.bulk_write.call_count == 4
+        assert mongo_ctx_mock.__exit__.called
+        assert op_buffer.threads == []
+
+    def test_back_pressure(self):
+        release = threading.Event()
+        mongo_mock = MagicMock()
+        mongo_mock.bulk_write.side_effect = lambda ops: release.wait(5)
+        op_buffer = ThreadedMongoOpBuffer(MagicMock(), create_mongo_context(mongo_mock), size=1,
+                                          queue_size=1)
+        with op_buffer:
+            # the first op is taken by the writer, the second fills the queue
+            op_buffer.add(1)
+            op_buffer.add(2)
+            adder = threading.Thread(target=op_buffer.add, args=(3,))
+            adder.start()
+            adder.join(0.1)
+            # the third add should be blocked waiting for space in the queue
+            assert adder.is_alive()
+            release.set()
+            adder.join(5)
+        assert mongo_mock.bulk_write.call_count == 3
+
+    def test_error_raised_on_add(self):
+        mongo_mock = MagicMock()
+        mongo_mock.bulk_write.side_effect = ValueError()
+        op_buffer = ThreadedMongoOpBuffer(MagicMock(), create_mongo_context(mongo_mock), size=1)
+        with pytest.raises(ValueError):
+            with op_buffer:
+                op_buffer.add(1)
+                op_buffer.queue.join()
+                op_buffer.add(2)
+        # the buffer added after the error shouldn't have been written
+        assert mongo_mock.bulk_write.call_count == 1
+
+    def test_error_raised_on_exit(self):
+        mongo_mock = MagicMock()
+        mongo_mock.bulk_write.side_effect = ValueError()
+        mongo_ctx_mock = create_mongo_context(mongo_mock)
+        with pytest.raises(ValueError):
+            with ThreadedMongoOpBuffer(MagicMock(), mongo_ctx_mock, size=10) as op_buffer:
+                op_buffer.add(1)
+        assert mongo_ctx_mock.__exit__.called
+
+
+def test_update_op_key():
+    assert update_op_key(InsertOne({u'id': 1})) is None
+    assert update_op_key(UpdateOne({u'id': 1}, {})) == update_op_key(UpdateOne({u'id': 1}, {}))
+    assert update_op_key(UpdateOne({u'id': 1}, {})) != update_op_key(UpdateOne({u'id': 2}, {}))
+    assert update_op_key(UpdateOne({u'id': 1}, {})) != update_op_key(UpdateOne({u'id': 1}, {},
+                                                                                upsert=True))
+
+
+def test_merge_update_ops():
+    merged = merge_update_ops(
+        UpdateOne({u'id': 1}, {u'$set': {u'a': 1, u'b': 2}, u'$addToSet': {u'versions': 1},
+                               u'$inc': {u'count': 1}}),
+        UpdateOne({u'id': 1}, {u'$set': {u'a': 3}, u'$addToSet': {u'versions': 2},
+                               u'$inc': {u'count': 2}}),
+    )
+    assert merged == UpdateOne({u'id': 1}, {
+        u'$set': {u'a': 3, u'b': 2},
+        u'$addToSet': {u'versions': {u'$each': [1, 2]}},
+        u'$inc': {u'count': 3},
+    })
+
+
+def test_merge_update_ops_clashes():
+    # the same field modified by different operators
+    assert merge_update_ops(UpdateOne({u'id': 1}, {u'$set': {u'a': 1}}),
+                            UpdateOne({u'id': 1}, {u'$unset': {u'a': u''}})) is None
+    # a field and its parent
+    assert merge_update_ops(UpdateOne({u'id': 1}, {u'$set': {u'diffs.1': 1}}),
+                            UpdateOne({u'id': 1}, {u'$unset': {u'diffs': u''}})) is None
+    # unsupported operators
+    assert merge_update_ops(UpdateOne({u'id': 1}, {u'$push': {u'a': 1}}),
+                            UpdateOne({u'id': 1}, {u'$push': {u'a': 2}})) is None
+
+
+def test_mongo_op_buffer_coalesce():
+    mongo_mock = MagicMock()
+    with MongoOpBuffer(MagicMock(), create_mongo_context(mongo_mock), coalesce=True) as op_buffer:
+        op_buffer.add(UpdateOne({u'id': 1}, {u'$set': {u'a': 1}}))
+        op_buffer.add(UpdateOne({u'id': 1}, {u'$set': {u'b': 1}}))
+    assert mongo_mock.bulk_write.call_args[0][0] == [
+        UpdateOne({u'id': 1}, {u'$set': {u'a': 1, u'b': 1}})]
+
+
+def test_mongo_op_buffer_coalesce_keeps_order():
+    mongo_mock = MagicMock()
+    with MongoOpBuffer(MagicMock(), create_mongo_context(mongo_mock), coalesce=True) as op_buffer:
+        op_buffer.add(UpdateOne({u'id': 1}, {u'$set': {u'a': 1}}))
+        op_buffer.add(DeleteOne({u'id': 1}))
+        op_buffer.add(UpdateOne({u'id': 1}, {u'$set': {u'b': 1}}, upsert=True))
+        op_buffer.add(ReplaceOne({u'id': 1}, {u'id': 1, u'c': 1}))
+        op_buffer.add(UpdateOne({u'id': 1}, {u'$set': {u'd': 1}}))
+        op_buffer.add(UpdateOne({u'id': 1}, {u'$set': {u'e': 1}}))
+    # the updates either side of the delete and replace mustn't be merged across them
+    assert mongo_mock.bulk_write.call_args[0][0] == [
+        UpdateOne({u'id': 1}, {u'$set': {u'a': 1}}),
+        DeleteOne({u'id': 1}),
+        UpdateOne({u'id': 1}, {u'$set': {u'b': 1}}, upsert=True),
+        ReplaceOne({u'id': 1}, {u'id': 1, u'c': 1}),
+        UpdateOne({u'id': 1}, {u'$set': {u'd': 1, u'e': 1}}),
+    ]
@@ -1,2 +1,411 @@
 #!/usr/bin/env python
 # encoding: utf-8
+
+from elasticsearch import NotFoundError
+from mock import MagicMock, call
+
+import pytest
+from elasticsearch_dsl import Search
+
+from eevee.search import round_version, VersionTimelines, SearchHelper, encode_cursor, \
+    decode_cursor
+
+
+def test_round_version():
+    versions = [2, 5, 9]
+    assert round_version([], 4) is None
+    assert round_version(versions, None) == 9
+    assert round_version(versions, 9) == 9
+    assert round_version(versions, 100) == 9
+    assert round_version(versions, 1) == 1
+    assert round_version(versions, 2) == 2
+    assert round_version(versions, 4) == 2
+    assert round_version(versions, 5) == 5
+    assert round_version(versions, 8) == 5
+
+
+def test_cursors():
+    sort_values = [u'index1', 12, 1500000000000, u'12-1500000000000']
+    cursor = encode_cursor(sort_values)
+    assert decode_cursor(cursor) == sort_values
+
+    with pytest.raises(ValueError):
+        decode_cursor(u'not a cursor')
+    with pytest.raises(ValueError):
+        decode_cursor(encode_cursor([1, 2]))
+
+
+class TestVersionTimelines(object):
+
+    def test_get_empty(self):
+        timelines = VersionTimelines()
+        assert timelines.get(u'index', u'uuid', 10) is None
+        assert timelines.get_tail(u'index', u'uuid', 10) is None
+
+    def test_update_and_get(self):
+        timelines = VersionTimelines()
+        assert timelines.update(u'index', u'uuid', 10, [1, 4, 10]) == [1, 4, 10]
+        assert timelines.get(u'index', u'uuid', 10) == [1, 4, 10]
+        assert timelines.get_tail(u'index', u'uuid', 12) == 10
+        # the timeline is stale when the latest version changes
+        assert timelines.get(u'index', u'uuid', 12) is None
+
+    def test_update_appends_after_tail(self):
+        timelines = VersionTimelines()
+        versions = timelines.update(u'index', u'uuid', 10, [1, 4, 10])
+        # versions at or before the tail should be ignored
+        assert timelines.update(u'index', u'uuid', 14, [10, 12, 14]) == [1, 4, 10, 12, 14]
+        assert timelines.get(u'index', u'uuid', 14) == [1, 4, 10, 12, 14]
+        # the list returned previously shouldn't have been modified
+        assert versions == [1, 4, 10]
+
+    def test_update_replace(self):
+        timelines = VersionTimelines()
+        timelines.update(u'index', u'uuid', 10, [1, 4, 10])
+        assert timelines.update(u'index', u'uuid', 14, [1, 14], replace=True) == [1, 14]
+
+    def test_recreated_index(self):
+        timelines = VersionTimelines()
+        timelines.update(u'index', u'uuid', 10, [1, 4, 10])
+        # the index has been recreated so has a new uuid, nothing cached should be used
+        assert timelines.get(u'index', u'new-uuid', 10) is None
+        assert timelines.get_tail(u'index', u'new-uuid', 14) is None
+        assert timelines.update(u'index', u'new-uuid', 14, [12, 14]) == [12, 14]
+
+    def test_latest_version_goes_backwards(self):
+        timelines = VersionTimelines()
+        timelines.update(u'index', u'uuid', 10, [1, 4, 10])
+        assert timelines.get(u'index', u'uuid', 8) is None
+        assert timelines.get_tail(u'index', u'uuid', 8) is None
+        assert timelines.update(u'index', u'uuid', 8, [1, 8]) == [1, 8]
+
+    def test_clear(self):
+        timelines = VersionTimelines()
+        timelines.update(u'index1', u'uuid1', 10, [1, 4, 10])
+        timelines.update(u'index2', u'uuid2', 10, [1, 4, 10])
+        timelines.clear(u'index1')
+        assert timelines.get(u'index1', u'uuid1', 10) is None
+        assert timelines.get(u'index2', u'uuid2', 10) == [1, 4, 10]
+        timelines.clear()
+        assert timelines.get(u'index2', u'uuid2', 10) is None
+
+
+def create_composite_response(buckets, after_key=None):
+    aggregation = {u'buckets': buckets}
+    if after_key is not None:
+        aggregation[u'after_key'] = after_key
+    return {u'hits': {u'total': 0, u'hits': []}, u'aggregations': {u'versions': aggregation}}
+
+
+class TestSearchHelper(object):
+
+    def test_get_versions_after(self):
+        client = MagicMock(search=MagicMock(side_effect=[
+            create_composite_response([
+                {u'key': {u'index': u'index1', u'version': 1}, u'doc_count': 4},
+                {u'key': {u'index': u'index1', u'version': 5}, u'doc_count': 1},
+            ], after_key={u'index': u'index1', u'version': 5}),
+            create_composite_response([
+                {u'key': {u'index': u'index2', u'version': 8}, u'doc_count': 2},
+            ]),
+        ]))
+        helper = SearchHelper(MagicMock(), client=client)
+
+        versions = helper.get_versions_after({u'index1': None, u'index2': 6, u'index3': None})
+
+        assert versions == {u'index1': [1, 5], u'index2': [8], u'index3': []}
+        # the pagination should have happened using the after key
+        assert client.search.call_count == 2
+        body = client.search.call_args_list[1][1][u'body']
+        assert body[u'aggs'][u'versions'][u'composite'][u'after'] == {u'index': u'index1',
+                                                                      u'version': 5}
+
+    def test_get_versions_after_nothing(self):
+        client = MagicMock()
+        helper = SearchHelper(MagicMock(), client=client)
+        assert helper.get_versions_after({}) == {}
+        assert not client.search.called
+
+    def test_get_records_versions(self):
+        client = MagicMock(search=MagicMock(side_effect=[
+            create_composite_response([
+                {u'key': {u'id': 1, u'version': 2}, u'doc_count': 1},
+                {u'key': {u'id': 1, u'version': 7}, u'doc_count': 1},
+            ], after_key={u'id': 1, u'version': 7}),
+            create_composite_response([
+                {u'key': {u'id': 3, u'version': 4}, u'doc_count': 1},
+            ]),
+        ]))
+        helper = SearchHelper(MagicMock(), client=client)
+
+        # the ids returned should match the ones passed in, even if their types differ
+        assert helper.get_records_versions(u'index1', [u'1', u'2', u'3']) == {
+            u'1': [2, 7],
+            u'2': [],
+            u'3': [4],
+        }
+        assert client.search.call_count == 2
+        body = client.search.call_args_list[0][1][u'body']
+        assert body[u'query'] == {u'bool': {u'filter': [{u'terms': {u'data._id': [u'1', u'2',
+                                                                                  u'3']}}]}}
+        assert not client.scroll.called
+
+    def test_get_record_versions(self):
+        client = MagicMock(search=MagicMock(return_value=create_composite_response([
+            {u'key': {u'id': 5, u'version': 2}, u'doc_count': 1},
+            {u'key': {u'id': 5, u'version': 3}, u'doc_count': 1},
+        ])))
+        helper = SearchHelper(MagicMock(), client=client)
+        assert helper.get_record_versions(u'index1', 5) == [2, 3]
+        assert helper.get_records_versions(u'index1', []) == {}
+
+    def test_get_records_versions_mixed_case(self):
+        # data._id is normalised to lowercase so the aggregation's keys are lowercase too
+        client = MagicMock(search=MagicMock(return_value=create_composite_response([
+            {u'key': {u'id': u'abc-1', u'version': 2}, u'doc_count': 1},
+            {u'key': {u'id': u'abc-1', u'version': 4}, u'doc_count': 1},
+            {u'key': {u'id': u'def', u'version': 3}, u'doc_count': 1},
+        ])))
+        helper = SearchHelper(MagicMock(), client=client)
+        assert helper.get_record_versions(u'index1', u'ABC-1') == [2, 4]
+        assert helper.get_records_versions(u'index1', [u'Abc-1', u'DEF', u'ghi']) == {
+            u'Abc-1': [2, 4],
+            u'DEF': [3],
+            u'ghi': [],
+        }
+
+    def test_get_concrete_indexes(self):
+        client = MagicMock(indices=MagicMock(get=MagicMock(return_value={
+            u'index1': {u'settings': {u'index': {u'uuid': u'uuid1'}}},
+            u'index2': {u'aliases': {u'alias1': {}, u'alias2': {}},
+                        u'settings': {u'index': {u'uuid': u'uuid2'}}},
+            u'index3': {u'aliases': {u'alias2': {}}, u'settings': {u'index': {u'uuid': u'uuid3'}}},
+        })))
+        helper = SearchHelper(MagicMock(), client=client)
+
+        concrete_indexes, uuids = helper.get_concrete_indexes([u'index1', u'alias1', u'alias2',
+                                                               u'index*'])
+        assert concrete_indexes[u'index1'] == [u'index1']
+        assert concrete_indexes[u'alias1'] == [u'index2']
+        assert sorted(concrete_indexes[u'alias2']) == [u'index2', u'index3']
+        assert concrete_indexes[u'index*'] == []
+        assert uuids == {u'index1': u'uuid1', u'index2': u'uuid2', u'index3': u'uuid3'}
+
+    def _create_status_doc(self, index, latest_version, summary_latest_version, versions):
+        return {
+            u'_id': index,
+            u'found': True,
+            u'_source': {
+                u'latest_version': latest_version,
+                u'version_summary': {
+                    u'latest_version': summary_latest_version,
+                    u'total': sum(entry[u'changes'] for entry in versions),
+                    u'versions': versions,
+                },
+            },
+        }
+
+    def test_get_version_summaries(self):
+        versions1 = [{u'version': 1, u'changes': 4}, {u'version': 5, u'changes': 1}]
+        versions2 = [{u'version': 8, u'changes': 2}]
+        versions3 = [{u'version': 8, u'changes': 2}]
+        versions4 = [{u'version': 2, u'changes': 1}]
+        client = MagicMock(mget=MagicMock(return_value={u'docs': [
+            self._create_status_doc(u'index1', 5, 5, versions1),
+            self._create_status_doc(u'index2', 8, 8, versions2),
+            # the summary wasn't written alongside the current status
+            self._create_status_doc(u'index3', 9, 8, versions3),
+            # the summary doesn't match the documents in the index
+            self._create_status_doc(u'index4', 2, 2, versions4),
+            {u'_id': u'index5', u'found': False},
+        ]}), search=MagicMock(return_value={
+            u'hits': {u'total': 0, u'hits': []},
+            u'aggregations': {u'indexes': {u'buckets': [
+                {u'key': u'index1', u'doc_count': 5},
+                {u'key': u'index2', u'doc_count': 2},
+                {u'key': u'index4', u'doc_count': 7},
+            ]}},
+        }))
+        helper = SearchHelper(MagicMock(), client=client)
+        indexes = [u'index1', u'index2', u'index3', u'index4', u'index5']
+
+        assert helper.get_version_summaries(indexes) == {u'index1': versions1,
+                                                         u'index2': versions2}
+        assert helper.get_version_summaries(indexes, validate=False) == {
+            u'index1': versions1,
+            u'index2': versions2,
+            u'index4': versions4,
+        }
+
+    def test_get_version_summaries_no_status_index(self):
+        client = MagicMock(mget=MagicMock(side_effect=NotFoundError()))
+        helper = SearchHelper(MagicMock(), client=client)
+        assert helper.get_version_summaries([u'index1']) == {}
+
+    def test_get_index_version_counts_summary(self):
+        summary = [{u'version': 1, u'changes': 4}]
+        helper = SearchHelper(MagicMock(), client=MagicMock())
+        helper.get_version_summaries = MagicMock(return_value={u'index1': summary})
+
+        assert helper.get_index_version_counts(u'index1', use_summary=True) == summary
+        assert helper.get_version_summaries.call_args == call([u'index1'])
+        assert not helper.client.search.called
+
+    def test_get_index_version_counts_no_summary(self):
+        client = MagicMock(search=MagicMock(return_value=create_composite_response([
+            {u'key': {u'version': 1}, u'doc_count': 4},
+        ])))
+        helper = SearchHelper(MagicMock(), client=client)
+        helper.get_version_summaries = MagicMock(return_value={})
+
+        # the summary is only used when asked for
+        assert helper.get_index_version_counts(u'index1') == [{u'version': 1, u'changes': 4}]
+        assert not helper.get_version_summaries.called
+        # and if there isn't one, the index is aggregated over
+        assert helper.get_index_version_counts(u'index1', use_summary=True) == [
+            {u'version': 1, u'changes': 4}
+        ]
+        assert client.search.call_count == 2
+
+    def _create_timelines_helper(self, concrete_indexes, uuids, latest_versions, versions_after,
+                                 summaries=None):
+        helper = SearchHelper(MagicMock(), client=MagicMock())
+        helper.get_version_summaries = MagicMock(return_value=summaries or {})
+        helper.get_concrete_indexes = MagicMock(return_value=(concrete_indexes, uuids))
+        helper.get_latest_index_versions = MagicMock(return_value=latest_versions)
+        helper.get_versions_after = MagicMock(return_value=versions_after)
+        helper.get_index_versions = MagicMock(return_value=[u'fallback'])
+        return helper
+
+    def test_get_index_timelines_cold_then_cached(self):
+        helper = self._create_timelines_helper({u'index1': [u'index1'], u'index2': [u'index2']},
+                                               {u'index1': u'uuid1', u'index2': u'uuid2'},
+                                               {u'index1': 5, u'index2': 8},
+                                               {u'index1': [1, 5], u'index2': [8]})
+
+        assert helper.get_index_timelines([u'index1', u'index2']) == {u'index1': [1, 5],
+                                                                     u'index2': [8]}
+        assert helper.get_versions_after.call_args == call({u'index1': None, u'index2': None})
+
+        # a second call should use the cache
+        helper.get_versions_after.reset_mock()
+        assert helper.get_index_timelines([u'index1', u'index2']) == {u'index1': [1, 5],
+                                                                     u'index2': [8]}
+        assert not helper.get_versions_after.called
+
+    def test_get_index_timelines_refreshes_from_tail(self):
+        helper = self._create_timelines_helper({u'index1': [u'index1'], u'index2': [u'index2']},
+                                               {u'index1': u'uuid1', u'index2': u'uuid2'},
+                                               # index1 has a new version
+                                               {u'index1': 7, u'index2': 8},
+                                               {u'index1': [7]})
+        helper.version_timelines.update(u'index1', u'uuid1', 5, [1, 5])
+        helper.version_timelines.update(u'index2', u'uuid2', 8, [8])
+
+        assert helper.get_index_timelines([u'index1', u'index2']) == {u'index1': [1, 5, 7],
+                                                                     u'index2': [8]}
+        assert helper.get_versions_after.call_args == call({u'index1': 5})
+
+    def test_get_index_timelines_recreated_index(self):
+        helper = self._create_timelines_helper({u'index1': [u'index1']}, {u'index1': u'new-uuid'},
+                                               {u'index1': 7}, {u'index1': [6, 7]})
+        helper.version_timelines.update(u'index1', u'uuid1', 5, [1, 5])
+
+        assert helper.get_index_timelines([u'index1']) == {u'index1': [6, 7]}
+        # everything should be retrieved as the index has been recreated
+        assert helper.get_versions_after.call_args == call({u'index1': None})
+
+    def test_get_index_timelines_summaries(self):
+        helper = self._create_timelines_helper({u'index1': [u'index1'], u'index2': [u'index2']},
+                                               {u'index1': u'uuid1', u'index2': u'uuid2'},
+                                               {u'index1': 7, u'index2': 8},
+                                               {u'index2': [8]},
+                                               {u'index1': [{u'version': 1, u'changes': 3},
+                                                            {u'version': 7, u'changes': 1}]})
+        # version 5 no longer has any changes
+        helper.version_timelines.update(u'index1', u'uuid1', 5, [1, 5])
+
+        assert helper.get_index_timelines([u'index1', u'index2']) == {u'index1': [1, 7],
+                                                                     u'index2': [8]}
+        assert helper.get_version_summaries.call_args == call([u'index1', u'index2'])
+        # only the index without a summary should be aggregated over
+        assert helper.get_versions_after.call_args == call({u'index2': None})
+        assert helper.version_timelines.get(u'index1', u'uuid1', 7) == [1, 7]
+
+    def test_get_index_timelines_no_status(self):
+        helper = self._create_timelines_helper({u'index1': [u'index1']}, {u'index1': u'uuid1'}, {},
+                                               {u'index1': [1, 5]})
+
+        assert helper.get_index_timelines([u'index1']) == {u'index1': [1, 5]}
+        # without a status the versions shouldn't be cached
+        assert helper.version_timelines.get_tail(u'index1', u'uuid1', 5) is None
+
+    def test_get_index_timelines_aliases(self):
+        helper = self._create_timelines_helper(
+            {u'alias1': [u'index1'], u'alias2': [u'index1', u'index2'], u'index*': []},
+            {u'index1': u'uuid1', u'index2': u'uuid2'},
+            {u'index1': 5, u'index2': 8},
+            {u'index1': [1, 5], u'index2': [5, 8]})
+
+        assert helper.get_index_timelines([u'alias1', u'alias2', u'index*']) == {
+            u'alias1': [1, 5],
+            u'alias2': [1, 5, 8],
+            # names which can't be resolved are aggregated over directly
+            u'index*': [u'fallback'],
+        }
+        assert helper.get_index_versions.call_args == call(u'index*')
+
+    def test_get_rounded_versions(self):
+        helper = SearchHelper(MagicMock(), client=MagicMock())
+        helper.get_index_timelines = MagicMock(return_value={
+            u'index1': [1, 5, 9],
+            u'index2': [],
+            u'index3': [6],
+        })
+        assert helper.get_rounded_versions([u'index1', u'index2', u'index3'], 6) == {
+            u'index1': 5,
+            u'index2': None,
+            u'index3': 6,
+        }
+
+    def _create_hits_response(self, *sort_values):
+        hits = [{u'_index': values[0], u'_type': u'doc', u'_id': u'{}'.format(values[1]),
+                 u'_score': None, u'_source': {u'data': {u'_id': values[1]}}, u'sort': values}
+                for values in sort_values]
+        return {u'hits': {u'total': len(hits), u'hits': hits}}
+
+    def test_iter_search_after(self):
+        client = MagicMock(search=MagicMock(side_effect=[
+            self._create_hits_response([u'index1', 1, 4, u'1-4'], [u'index1', 2, 4, u'2-4']),
+            self._create_hits_response([u'index1', 3, 4, u'3-4']),
+        ]))
+        helper = SearchHelper(MagicMock(), client=client)
+
+        results = list(helper.iter_search_after(Search(index=u'index1'), 4, batch_size=2))
+        assert [hit.data._id for hit, _cursor in results] == [1, 2, 3]
+        assert client.search.call_count == 2
+
+        first_body = client.search.call_args_list[0][1][u'body']
+        assert first_body[u'query'] == {u'bool': {u'filter': [{u'term': {u'meta.versions': 4}}]}}
+        assert first_body[u'size'] == 2
+        assert [list(sort.keys())[0] for sort in first_body[u'sort']] == [u'_index', u'data._id',
+                                                                          u'meta.version', u'_id']
+        assert u'search_after' not in first_body
+        second_body = client.search.call_args_list[1][1][u'body']
+        assert second_body[u'search_after'] == [u'index1', 2, 4, u'2-4']
+
+        # resuming from a cursor should start after the hit it was yielded with
+        client.search = MagicMock(return_value=self._create_hits_response([u'index1', 3, 4, u'3-4']))
+        resumed = list(helper.iter_search_after(Search(index=u'index1'), 4, batch_size=2,
+                                                cursor=results[1][1]))
+        assert [hit.data._id for hit, _cursor in resumed] == [3]
+        assert client.search.call_args[1][u'body'][u'search_after'] == [u'index1', 2, 4, u'2-4']
+
+    def test_iter_search_after_rounds_versions(self):
+        client = MagicMock(search=MagicMock(return_value=self._create_hits_response()))
+        helper = SearchHelper(MagicMock(), client=client)
+        helper.get_rounded_versions = MagicMock(return_value={u'index1': 3, u'index2': 4})
+
+        assert list(helper.iter_search_after(Search(), 4, indexes=[u'index1', u'index2'])) == []
+        assert helper.get_rounded_versions.call_args == call([u'index1', u'index2'], 4)
+        assert client.search.call_args[1][u'index'] == [u'index1', u'index2']
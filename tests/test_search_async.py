@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+# encoding: utf-8
+import asyncio
+
+from elasticsearch import NotFoundError
+from elasticsearch_dsl import Search
+from mock import MagicMock, call
+
+from eevee.search import VersionTimelines
+from eevee.search_async import AsyncSearchHelper, get_composite_buckets, scan_search
+from tests.test_search import create_composite_response
+
+
+def run(coroutine):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+def coroutine_mock(**kwargs):
+    """
+    Creates a coroutine function which passes its arguments to a MagicMock (created with the given
+    kwargs) and returns the result. The MagicMock is available as the mock attribute so that calls
+    can be checked.
+    """
+    mock = MagicMock(**kwargs)
+
+    async def coroutine(*args, **kw):
+        return mock(*args, **kw)
+
+    coroutine.mock = mock
+    return coroutine
+
+
+def create_client(**coroutines):
+    client = MagicMock()
+    client.indices = MagicMock()
+    for name, mock_kwargs in coroutines.items():
+        target = client
+        parts = name.split(u'.')
+        for part in parts[:-1]:
+            target = getattr(target, part)
+        setattr(target, parts[-1], coroutine_mock(**mock_kwargs))
+    return client
+
+
+def test_get_composite_buckets():
+    client = create_client(search=dict(side_effect=[
+        create_composite_response([{u'key': {u'version': 1}, u'doc_count': 4}],
+                                  after_key={u'version': 1}),
+        create_composite_response([{u'key': {u'version': 5}, u'doc_count': 1}]),
+    ]))
+    search = MagicMock(_params={}, _index=[u'index1'], aggs=MagicMock())
+    search.to_dict.return_value = {}
+
+    buckets = run(get_composite_buckets(client, search, u'versions'))
+    assert buckets == [{u'key': {u'version': 1}, u'doc_count': 4},
+                       {u'key': {u'version': 5}, u'doc_count': 1}]
+    assert client.search.mock.call_count == 2
+    assert search.aggs[u'versions'].after == {u'version': 1}
+
+
+def test_scan_search():
+    client = create_client(
+        search=dict(return_value={u'_scroll_id': u'a', u'hits': {u'hits': [1, 2]}}),
+        scroll=dict(side_effect=[{u'_scroll_id': u'a', u'hits': {u'hits': [3]}},
+                                 {u'_scroll_id': u'a', u'hits': {u'hits': []}}]),
+        clear_scroll=dict(),
+    )
+    search = MagicMock(_params={}, _index=[u'index1'])
+    search.to_dict.return_value = {}
+
+    assert run(scan_search(client, search)) == [1, 2, 3]
+    assert client.clear_scroll.mock.called
+
+
+class TestAsyncSearchHelper(object):
+
+    def test_shared_version_timelines(self):
+        version_timelines = VersionTimelines()
+        helper = AsyncSearchHelper(MagicMock(), client=MagicMock(),
+                                   version_timelines=version_timelines)
+        assert helper.version_timelines is version_timelines
+
+    def test_get_latest_index_versions(self):
+        client = create_client(**{
+            u'indices.exists': dict(return_value=True),
+            u'search': dict(return_value={u'hits': {u'hits': [
+                {u'_source': {u'index_name': u'index1', u'latest_version': 4}},
+                {u'_source': {u'index_name': u'index2', u'latest_version': 9}},
+            ]}}),
+        })
+        helper = AsyncSearchHelper(MagicMock(elasticsearch_status_index_name=u'status'),
+                                   client=client)
+        assert run(helper.get_latest_index_versions()) == {u'index1': 4, u'index2': 9}
+
+    def test_get_latest_index_versions_no_status_index(self):
+        client = create_client(**{u'indices.exists': dict(return_value=False)})
+        helper = AsyncSearchHelper(MagicMock(), client=client)
+        assert run(helper.get_latest_index_versions()) == {}
+
+    def test_get_version_summaries_no_status_index(self):
+        client = create_client(mget=dict(side_effect=NotFoundError()))
+        helper = AsyncSearchHelper(MagicMock(), client=client)
+        assert run(helper.get_version_summaries([u'index1'])) == {}
+
+    def test_get_versions_after(self):
+        client = create_client(search=dict(side_effect=[
+            create_composite_response([
+                {u'key': {u'index': u'index1', u'version': 1}, u'doc_count': 4},
+                {u'key': {u'index': u'index2', u'version': 8}, u'doc_count': 2},
+            ]),
+        ]))
+        helper = AsyncSearchHelper(MagicMock(), client=client)
+
+        versions = run(helper.get_versions_after({u'index1': None, u'index2': 6, u'index3': None}))
+        assert versions == {u'index1': [1], u'index2': [8], u'index3': []}
+
+    def test_get_records_versions(self):
+        client = create_client(search=dict(return_value=create_composite_response([
+            {u'key': {u'id': 1, u'version': 2}, u'doc_count': 1},
+            {u'key': {u'id': 3, u'version': 4}, u'doc_count': 1},
+        ])))
+        helper = AsyncSearchHelper(MagicMock(), client=client)
+        assert run(helper.get_records_versions(u'index1', [1, 2, 3])) == {1: [2], 2: [], 3: [4]}
+        assert run(helper.get_record_versions(u'index1', 3)) == [4]
+
+    def test_get_index_timelines(self):
+        helper = AsyncSearchHelper(MagicMock(), client=MagicMock())
+        helper.get_concrete_indexes = coroutine_mock(return_value=(
+            {u'index1': [u'index1'], u'alias1': [u'index1', u'index2'], u'index*': []},
+            {u'index1': u'uuid1', u'index2': u'uuid2'}))
+        helper.get_latest_index_versions = coroutine_mock(return_value={u'index1': 5,
+                                                                        u'index2': 8})
+        helper.get_version_summaries = coroutine_mock(return_value={
+            u'index2': [{u'version': 8, u'changes': 1}]})
+        helper.get_versions_after = coroutine_mock(return_value={u'index1': [1, 5]})
+        helper.get_index_versions = coroutine_mock(return_value=[3])
+
+        assert run(helper.get_index_timelines([u'index1', u'alias1', u'index*'])) == {
+            u'index1': [1, 5],
+            u'alias1': [1, 5, 8],
+            u'index*': [3],
+        }
+        assert helper.get_versions_after.mock.call_args == call({u'index1': None})
+        assert helper.get_index_versions.mock.call_args == call(u'index*')
+
+        # a second call should use the cache
+        helper.get_versions_after.mock.reset_mock()
+        helper.get_version_summaries.mock.reset_mock()
+        run(helper.get_index_timelines([u'index1', u'alias1']))
+        assert not helper.get_versions_after.mock.called
+        assert not helper.get_version_summaries.mock.called
+
+    def test_get_rounded_versions(self):
+        helper = AsyncSearchHelper(MagicMock(), client=MagicMock())
+        helper.get_index_timelines = coroutine_mock(return_value={
+            u'index1': [1, 5, 9],
+            u'index2': [],
+        })
+        assert run(helper.get_rounded_versions([u'index1', u'index2'], 6)) == {
+            u'index1': 5,
+            u'index2': None,
+        }
+
+    def test_iter_search_after(self):
+        def hit(*values):
+            return {u'_index': values[0], u'_source': {}, u'sort': list(values)}
+
+        client = create_client(search=dict(side_effect=[
+            {u'hits': {u'hits': [hit(u'index1', 1, 4, u'1-4'), hit(u'index1', 2, 4, u'2-4')]}},
+            {u'hits': {u'hits': [hit(u'index1', 3, 4, u'3-4')]}},
+        ]))
+        helper = AsyncSearchHelper(MagicMock(), client=client)
+
+        async def collect():
+            return [result async for result in helper.iter_search_after(Search(), 4, batch_size=2)]
+
+        results = run(collect())
+        assert [h[u'sort'][1] for h, _cursor in results] == [1, 2, 3]
+        second_body = client.search.mock.call_args_list[1][1][u'body']
+        assert second_body[u'search_after'] == [u'index1', 2, 4, u'2-4']
@@ -1,9 +1,17 @@
 #!/usr/bin/env python
 # encoding: utf-8
 
+import copy
+import pickle
 from datetime import datetime, tzinfo, timedelta
+from multiprocessing.pool import ThreadPool
 
-from eevee.utils import chunk_iterator, to_timestamp, iter_pairs
+from mock import MagicMock, call, patch
+
+import pytest
+
+from eevee.utils import chunk_iterator, to_timestamp, iter_pairs, bounded_imap, \
+    per_record_receiver, OpBuffer, ReadOnlyDict, ReadOnlyList, freeze, thaw
 
 
 def test_chunk_iterator_when_iterator_len_equals_chunk_size():
@@ -92,3 +100,169 @@ def test_iter_pairs():
                                                               (None, u'final')]
     # check that it can handle iterators too
     assert list(iter_pairs(range(0, 4), u'final')) == [(0, 1), (1, 2), (2, 3), (3, u'final')]
+
+
+def test_bounded_imap():
+    consumed = []
+
+    def elements():
+        for element in range(10):
+            consumed.append(element)
+            yield element
+
+    pool = ThreadPool(processes=2)
+    try:
+        results = bounded_imap(pool, lambda x: x * 2, elements(), max_pending=3)
+        assert next(results) == 0
+        # only enough elements to fill the pending queue should have been consumed
+        assert len(consumed) == 4
+        assert list(results) == [x * 2 for x in range(1, 10)]
+    finally:
+        pool.close()
+        pool.join()
+
+
+def test_per_record_receiver():
+    receiver = MagicMock()
+    adapter = per_record_receiver(receiver, records=u'record', docs=u'doc')
+    adapter(u'sender', records=[1, 2], docs=[u'a', u'b'], other=4)
+    assert receiver.call_args_list == [
+        call(u'sender', record=1, doc=u'a', other=4),
+        call(u'sender', record=2, doc=u'b', other=4),
+    ]
+
+
+class ListOpBuffer(OpBuffer):
+
+    def __init__(self, size, **kwargs):
+        super(ListOpBuffer, self).__init__(size, **kwargs)
+        self.handled = []
+
+    def handle_ops(self):
+        self.handled.append(self.ops)
+
+
+class TestOpBuffer(object):
+
+    def test_size(self):
+        with ListOpBuffer(2) as op_buffer:
+            assert not op_buffer.add(1)
+            assert op_buffer.add(2)
+            op_buffer.add(3)
+        assert op_buffer.handled == [[1, 2], [3]]
+
+    def test_max_bytes(self):
+        with ListOpBuffer(100, max_bytes=10, size_of=len) as op_buffer:
+            op_buffer.add_all([u'aaaa', u'bbbb'])
+            # this would take the batch over the limit so the buffer is handled first
+            assert op_buffer.add(u'ccc')
+            assert op_buffer.handled == [[u'aaaa', u'bbbb']]
+            # this reaches the limit exactly
+            assert op_buffer.add(u'ddddddd')
+            op_buffer.add(u'eeeeeeeeeeeeeeee')
+        assert op_buffer.handled == [[u'aaaa', u'bbbb'], [u'ccc', u'ddddddd'],
+                                     [u'eeeeeeeeeeeeeeee']]
+
+    def test_max_bytes_requires_size_of(self):
+        with pytest.raises(ValueError):
+            ListOpBuffer(100, max_bytes=10)
+
+    @patch(u'eevee.utils.timeit.default_timer')
+    def test_max_age(self, timer):
+        timer.return_value = 10
+        op_buffer = ListOpBuffer(100, max_age=5)
+        op_buffer.add(1)
+        timer.return_value = 14
+        assert not op_buffer.is_expired()
+        assert not op_buffer.add(2)
+        timer.return_value = 15
+        assert op_buffer.is_expired()
+        assert op_buffer.add(3)
+        assert op_buffer.handled == [[1, 2, 3]]
+        assert not op_buffer.is_expired()
+
+    def test_key_and_merge(self):
+        def merge(existing, new):
+            # can't merge negative values
+            if new[1] < 0:
+                return None
+            return existing[0], existing[1] + new[1]
+
+        op_buffer = ListOpBuffer(3, max_bytes=100, size_of=lambda op: op[1], key=lambda op: op[0],
+                                 merge=merge)
+        with op_buffer:
+            op_buffer.add_all([(u'a', 1), (u'b', 2), (u'a', 3)])
+            assert op_buffer.ops == [(u'a', 4), (u'b', 2)]
+            assert op_buffer.bytes == 6
+            # can't be merged so the buffer is handled before this op is added
+            assert op_buffer.add((u'b', -1))
+            assert op_buffer.ops == [(u'b', -1)]
+        assert op_buffer.handled == [[(u'a', 4), (u'b', 2)], [(u'b', -1)]]
+
+    def test_key_and_merge_barrier(self):
+        def key(op):
+            # ops with no value can't be merged
+            return op[0] if op[1] is not None else None
+
+        op_buffer = ListOpBuffer(10, key=key, merge=lambda existing, new: (existing[0],
+                                                                          existing[1] + new[1]))
+        with op_buffer:
+            op_buffer.add_all([(u'a', 1), (u'b', 2), (u'a', 3), (u'a', None), (u'a', 4),
+                               (u'b', 5), (u'a', 6)])
+            # nothing can be merged across the op with no key
+            assert op_buffer.ops == [(u'a', 4), (u'b', 2), (u'a', None), (u'a', 10), (u'b', 5)]
+
+    def test_key_requires_merge(self):
+        with pytest.raises(ValueError):
+            ListOpBuffer(100, key=lambda op: op)
+
+
+class TestReadOnly(object):
+
+    def test_freeze(self):
+        data = {u'a': [1, {u'b': 2}], u'c': u'd'}
+        frozen = freeze(data)
+        assert frozen == data
+        assert isinstance(frozen, ReadOnlyDict)
+        assert isinstance(frozen[u'a'], ReadOnlyList)
+        assert isinstance(frozen[u'a'][1], ReadOnlyDict)
+        # already frozen values are reused
+        assert freeze(frozen) is frozen
+        assert freeze({u'x': frozen})[u'x'] is frozen
+
+    @pytest.mark.parametrize(u'mutate', [
+        lambda data: data.__setitem__(u'x', 1),
+        lambda data: data.__delitem__(u'c'),
+        lambda data: data.update({u'x': 1}),
+        lambda data: data.pop(u'c'),
+        lambda data: data.setdefault(u'x', 1),
+        lambda data: data.clear(),
+        lambda data: data[u'a'].append(1),
+        lambda data: data[u'a'].__setitem__(0, 2),
+        lambda data: data[u'a'].sort(),
+        lambda data: data[u'a'].__iadd__([1]),
+        lambda data: data[u'a'][1].__setitem__(u'b', 3),
+    ])
+    def test_read_only(self, mutate):
+        frozen = freeze({u'a': [1, {u'b': 2}], u'c': u'd'})
+        with pytest.raises(TypeError):
+            mutate(frozen)
+        assert frozen == {u'a': [1, {u'b': 2}], u'c': u'd'}
+
+    def test_thaw(self):
+        frozen = freeze({u'a': [1, {u'b': 2}]})
+        thawed = thaw(frozen)
+        assert thawed == frozen
+        assert type(thawed) is dict
+        assert type(thawed[u'a']) is list
+        assert type(thawed[u'a'][1]) is dict
+        thawed[u'a'][1][u'b'] = 3
+        assert frozen[u'a'][1][u'b'] == 2
+
+    def test_copy_and_pickle(self):
+        frozen = freeze({u'a': [1, {u'b': 2}]})
+        assert copy.copy(frozen) is frozen
+        for copied in (copy.deepcopy(frozen), pickle.loads(pickle.dumps(frozen))):
+            assert copied == frozen
+            assert isinstance(copied, ReadOnlyDict)
+            assert isinstance(copied[u'a'], ReadOnlyList)